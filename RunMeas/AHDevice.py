@@ -18,9 +18,16 @@ import visa
 import time
 from datetime import datetime
 from threading import Thread
-from queue import Queue
 #from ADwin import ADwin
 
+from RunMeas.Clock import get_clock
+from RunMeas.Polling import DELAY_CHANNEL
+from RunMeas.Recovery import GapRecorder, recover
+from RunMeas.Samples import SampleWriter, SampleQueue, channel_names
+
+# The channels in the order in which get_single returns them
+CHANNELS = ('Cap', 'Loss', 'Volt')
+
 
 class AHDevice(object):
     """The AH Driver Object
@@ -37,6 +44,9 @@ class AHDevice(object):
     read_term : str, optional
         The reading terminatin character of the device
         DEFUALT: "\n"
+    policy : RunMeas.Recovery.RetryPolicy, optional
+        If given, the timeout of the queries and how failed or garbled
+        measurements are retried. Otherwise a failed query raises at once.
 
     Attributes
     ----------
@@ -49,20 +59,29 @@ class AHDevice(object):
         The reading termination character of the device
     write_term : str
         The writing termination character of the device
+    open_resource : method
+        The method that opened the resource, kept to re-open it.
 
     Methods
     -------
     set_resource(resource=, resource_address)
+    reopen
+    get_average
+    set_average(aveg_exp)
+    get_single
+    get_all_values
 
     """
 
     def __init__(self, address, read_term="\n",
-                 write_term="\n"):
+                 write_term="\n", policy=None):
         super(AHDevice, self).__init__()
         self.resource = None
         self.address = address
         self.read_term = read_term
         self.write_term = write_term
+        self.policy = policy
+        self.open_resource = None
 
     def set_resource(self, resource):
         """Set the VISA resource for the device.
@@ -77,9 +96,21 @@ class AHDevice(object):
             the subsequent address attribute of the class as a parameter.
 
         """
+        self.open_resource = resource
         self.resource = resource(self.address,
                                  read_termination=self.read_term,
                                  write_termination=self.write_term)
+        if self.policy is not None:
+            # pyvisa takes the timeout in milliseconds
+            self.resource.timeout = self.policy.timeout * 1000
+
+    def reopen(self):
+        """Close the resource and open it again, e.g. after a bus error."""
+        try:
+            self.resource.close()
+        except Exception as e:
+            print('Closing {} failed: {}'.format(self.address, e))
+        self.set_resource(self.open_resource)
 
     def get_average(self):
         """Get the approximate time used to make a measurement.
@@ -122,6 +153,9 @@ class AHDevice(object):
             The applied voltage in V
 
         """
+        if self.policy is not None:
+            return recover(self._checked_single, self.policy, self.reopen,
+                           '{} SINGLE'.format(self.address))
         val_string = self.resource.query('SINGLE')
         val_list = val_string.split('= ')
         cap_string = val_list[1]
@@ -142,10 +176,193 @@ class AHDevice(object):
             volt = float(volt_string.rstrip('V'))
         return (cap, loss, volt)
 
+    def _checked_single(self):
+        """Get a single measurement, raising on a garbled reply.
+
+        Unlike get_single without a policy, a reply without all three values
+        raises an IndexError instead of giving zeros, so that it is retried.
+
+        """
+        val_list = self.resource.query('SINGLE').split('= ')
+        cap = float(val_list[1].rstrip('PF L'))
+        loss = float(val_list[2].rstrip('NS V'))
+        volt = float(val_list[3].rstrip('V OVEN'))
+        return (cap, loss, volt)
+
     def get_cap(self):
         """Collect and return """
         pass
 
+    def get_all_values(self):
+        """Get a single measurement with a timestamp.
+
+        Returns
+        -------
+        all_values : tuple
+            This tuple contains the following:
+            1. Current datetime stamp
+            2. The capacitance in pF
+            3. The loss in nS
+            4. The applied voltage in V
+
+        """
+        now = datetime.now()
+        (cap, loss, volt) = self.get_single()
+        return (now, ('Cap', cap), ('Loss', loss), ('Volt', volt))
+
+
+class AHMeasurementThread(Thread):
+    """Thread for running continuous retrieval of data from the AH bridge.
+
+    Once started, this thread will continuously and periodically ask the
+    bridge for a single measurement, with a period defined by the 'delay'
+    parameter. The thread can be stopped by calling its stop_thread method,
+    which sets the stop attribute to true.
+
+    Parameters
+    ----------
+    device : AHDevice
+        The instance of the device that shall be queried for data.
+    chan_list : list
+        A list of strings giving name to the channels that will be queried,
+        i.e. ['Cap', 'Loss', 'Volt']. A channel may also be given as a
+        (name, dtype) tuple, e.g. ('Volt', 'f4').
+    delay : float, optional
+        The delay, in seconds, between queries to the device.
+        DEFAULT: 0.2 s
+    block_size : int, optional
+        The number of samples handed to the queue at once, see
+        RunMeas.Samples.SampleWriter.
+        DEFAULT: 64
+    maxsize : int, optional
+        The maximum number of blocks in the queue, unbounded if 0. The
+        default holds about half an hour of samples at 0.1 s per sample.
+        DEFAULT: 256
+    overflow : str, optional
+        What to do when the queue is full, one of 'block', 'drop_oldest',
+        'drop_newest' or 'decimate', see RunMeas.Samples.SampleQueue.
+        DEFAULT: 'block'
+    rate_controller : RunMeas.Polling.RateController, optional
+        If given, it decides the delay before each next query instead of the
+        fixed 'delay'. Its decisions are recorded in the extra channel
+        'PollDelay', which is added to chan_list.
+    clock : RunMeas.Clock.RealClock, optional
+        The clock giving the delays and the timestamps, by default
+        RunMeas.Clock.get_clock(). With a RunMeas.Clock.VirtualClock the
+        device is queried on the simulated schedule.
+
+    Attributes
+    ----------
+    stop : boolean
+        The stop flag. When true the thread loop will end.
+    device : AHDevice
+        The instance of the device that shall be queried for data.
+    q : RunMeas.Samples.SampleQueue
+        The communications queue into which the queried data is insered for
+        other process to access.
+    delay : float
+        The delay, in seconds, between queries to the device.
+    chan_list : list
+        A list of strings giving name to the channels that will be queried.
+    writer : RunMeas.Samples.SampleWriter
+        The writer filling in the sample blocks that are put on the queue.
+    gaps : RunMeas.Recovery.GapRecorder
+        The spans without samples. A measurement that fails is written as a
+        row of NaN and the thread carries on.
+    next_delay : float
+        The delay before the next measurement, 'delay' unless a rate
+        controller changes it.
+
+    Methods
+    -------
+    run
+    sample
+    stop_thread
+
+    """
+
+    def __init__(self, device, chan_list, delay=0.2, block_size=64,
+                 maxsize=256, overflow='block', rate_controller=None,
+                 clock=None):
+        super(AHMeasurementThread, self).__init__()
+        assert type(chan_list) is list, ('The chan_list parameter needs to be '
+                                         'a list of strings naming the '
+                                         'from which data will be collected.')
+        assert type(delay) is float, ('The delay passed to the measurement '
+                                      'thread needs to be a float')
+        self.stop = False
+        self.device = device
+        self.q = SampleQueue(maxsize, overflow)
+        self.delay = delay
+        self.chan_list = chan_list
+        names = channel_names(chan_list)
+        for chan_name in names:
+            if chan_name not in CHANNELS:
+                raise ValueError("Unknown AH channel {}".format(chan_name))
+        self.indices = [CHANNELS.index(c) for c in names]
+        self.rate_controller = rate_controller
+        if rate_controller is not None:
+            self.chan_list = chan_list + [(DELAY_CHANNEL, 'f4')]
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.attach(self)
+        self.writer = SampleWriter(self.q, self.chan_list,
+                                   block_size=block_size, clock=self.clock)
+        self.gaps = GapRecorder(device.address)
+        self.next_delay = delay
+
+    def run(self):
+        """Method representing the thread's activity
+
+        See Also
+        --------
+        threading.Thread
+
+        """
+        clock = self.clock
+        while not self.stop:
+            clock.sleep(self.next_delay)
+            self.sample()
+        self.writer.flush()
+
+    def sample(self):
+        """Take one measurement.
+
+        This is the body of the thread's loop. A RunMeas.Pool.DevicePool
+        calls it directly instead of starting the thread.
+
+        Returns
+        -------
+        delay : float
+            The delay, in seconds, before the next measurement.
+
+        """
+        controller = self.rate_controller
+        block = self.writer.block
+        i = block.n
+        cols = block.columns
+        cols[0][i] = self.clock.now_ns()
+        try:
+            vals = self.device.get_single()
+        except Exception as e:
+            # Keep polling, the NaN row marks the gap in the data
+            vals = (float('nan'),) * len(CHANNELS)
+            self.gaps.failed(cols[0][i], e)
+        else:
+            self.gaps.succeeded(cols[0][i])
+        for j, k in enumerate(self.indices, 1):
+            cols[j][i] = vals[k]
+        if controller is not None:
+            if self.gaps.start is None:
+                self.next_delay = controller.update(cols[0][i], block.data[i])
+            cols[-1][i] = self.next_delay
+        self.writer.commit(self.next_delay)
+        return self.next_delay
+
+    def stop_thread(self):
+        """Method to call to halt the thread's activity."""
+        self.stop = True
+        self.clock.wake(self)
+
 
 def main(argv=None):
 
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Alarm Module.
+
+This module contains the alarm and watchdog engine, which acts when, e.g.,
+the 1K pot warms up or the sorption pump heater runs away, without anybody
+watching the plot. The rules on a device's channels are evaluated on every
+committed batch of the buffer at once, and the staleness of the devices is
+watched by the engine's thread, e.g.
+
+    engine = AlarmEngine(buffer)
+    engine.add_rule('ITC503', Above('T1K', 2.0, clear=1.8, debounce=5.0),
+                    log, HeaterOff(itc))
+    engine.add_rule('ITC503', RateAbove('TSorp', 0.5, window=10.0), log)
+    engine.add_rule('ITC503', Stale(30.0), log)
+    engine.start()
+
+The actions are run by the engine's thread, so that a slow action, e.g. the
+heater being switched off over GPIB, does not hold up the collection.
+
+"""
+
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+import numpy as np
+
+from RunMeas.Clock import to_datetime64
+from RunMeas.Polling import DELAY_CHANNEL
+
+
+class _ValueRule(object):
+    """The hysteresis and debounce common to the rules on a channel.
+
+    A subclass provides 'condition', which returns where a batch raises and
+    where it clears the alarm. In between the state is held, which gives
+    the hysteresis. An alarm is only raised once it has been raised for
+    'debounce' seconds without interruption.
+
+    """
+
+    def __init__(self, channel, debounce=0.0):
+        self.channel = channel
+        self.debounce = debounce
+        self.reset()
+
+    def reset(self):
+        self.active = False
+        self._raised = False
+        self._since = None
+
+    def evaluate(self, timestamps, values):
+        """Return where the alarm is raised or cleared in a batch.
+
+        Returns
+        -------
+        transitions : list
+            (index, active) tuples, in order.
+
+        """
+        ts = np.asarray(timestamps, dtype='int64')
+        (raise_, clear) = self.condition(ts, np.asarray(values, dtype=float))
+        n = len(ts)
+        index = np.arange(n)
+        # The raw state is the one of the last sample that decided it
+        last = np.maximum.accumulate(np.where(raise_ | clear, index, -1))
+        raised = np.where(last >= 0, raise_[np.maximum(last, 0)],
+                          self._raised)
+        # When the current run of raised samples started
+        prev = np.concatenate(([self._raised], raised[:-1]))
+        start = np.maximum.accumulate(np.where(raised & ~prev, index, -1))
+        since = np.where(start >= 0, ts[np.maximum(start, 0)],
+                         self._since if self._since is not None else 0)
+        active = raised & (ts - since >= int(self.debounce * 1e9))
+        before = np.concatenate(([self.active], active))
+        changes = np.flatnonzero(before[1:] != before[:-1])
+        self._raised = bool(raised[-1])
+        self._since = int(since[-1]) if self._raised else None
+        self.active = bool(active[-1])
+        return [(int(i), bool(active[i])) for i in changes]
+
+
+class Above(_ValueRule):
+    """Alarm while a channel is above a limit.
+
+    Parameters
+    ----------
+    channel : str
+        The name of the channel, e.g. 'T1K'.
+    limit : float
+        The alarm is raised above the limit.
+    clear : float, optional
+        The alarm is cleared below this value.
+        DEFAULT: limit
+    debounce : float, optional
+        How long, in seconds, the channel needs to stay above the limit.
+        DEFAULT: 0 s
+
+    """
+
+    def __init__(self, channel, limit, clear=None, debounce=0.0):
+        self.limit = limit
+        self.clear = clear if clear is not None else limit
+        self.name = '{} above {}'.format(channel, limit)
+        super(Above, self).__init__(channel, debounce)
+
+    def condition(self, timestamps, values):
+        return (values > self.limit, values <= self.clear)
+
+
+class Below(_ValueRule):
+    """Alarm while a channel is below a limit, see Above."""
+
+    def __init__(self, channel, limit, clear=None, debounce=0.0):
+        self.limit = limit
+        self.clear = clear if clear is not None else limit
+        self.name = '{} below {}'.format(channel, limit)
+        super(Below, self).__init__(channel, debounce)
+
+    def condition(self, timestamps, values):
+        return (values < self.limit, values >= self.clear)
+
+
+class RateAbove(_ValueRule):
+    """Alarm while a channel rises faster than a rate.
+
+    The rate is taken between each sample and the sample 'window' seconds
+    before it, so that the noise of single samples does not raise it.
+
+    Parameters
+    ----------
+    channel : str
+        The name of the channel, e.g. 'TSorp'.
+    limit : float
+        The rate, in units per second, above which the alarm is raised.
+    window : float, optional
+        The time, in seconds, over which the rate is taken.
+        DEFAULT: 10 s
+    clear : float, optional
+        The rate below which the alarm is cleared.
+        DEFAULT: limit
+    debounce : float, optional
+        How long, in seconds, the rate needs to stay above the limit.
+        DEFAULT: 0 s
+
+    """
+
+    def __init__(self, channel, limit, window=10.0, clear=None,
+                 debounce=0.0):
+        self.limit = limit
+        self.window = window
+        self.clear = clear if clear is not None else limit
+        self.name = '{} rising faster than {}/s'.format(channel, limit)
+        super(RateAbove, self).__init__(channel, debounce)
+
+    def reset(self):
+        super(RateAbove, self).reset()
+        self._tail = (np.array([], dtype='int64'), np.array([]))
+
+    def condition(self, timestamps, values):
+        t = np.concatenate((self._tail[0], timestamps))
+        v = np.concatenate((self._tail[1], values))
+        n = len(timestamps)
+        k = len(t) - n
+        # The latest sample at least a window before each new one
+        j = np.searchsorted(t, t[k:] - int(self.window * 1e9),
+                            side='right') - 1
+        valid = j >= 0
+        j = np.maximum(j, 0)
+        dt = (t[k:] - t[j]) / 1e9
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(valid & (dt > 0), (v[k:] - v[j]) / dt, np.nan)
+        keep = np.searchsorted(t, t[-1] - int(self.window * 1e9),
+                               side='right') - 1
+        self._tail = (t[max(keep, 0):], v[max(keep, 0):])
+        return (rate > self.limit, rate <= self.clear)
+
+
+class Stale(object):
+    """Alarm when a device has not delivered a sample for a while.
+
+    A device thread keeps committing rows of NaNs while its device does not
+    answer, to mark the gap. Only rows with at least one finite reading
+    count as samples, so that a dead bus makes the device stale.
+
+    Parameters
+    ----------
+    max_age : float
+        The age, in seconds, of the device's last sample at which the alarm
+        is raised. It is cleared by the next sample.
+
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.name = 'no sample for {} s'.format(max_age)
+        self.channel = None
+        self.reset()
+
+    def reset(self):
+        self.active = False
+        self.last = None
+
+
+def log(alarm):
+    """The action printing an alarm."""
+    print('ALARM {device}: {rule} at {time}, value {value}'.format(
+        time=to_datetime64(alarm['timestamp']), **alarm))
+
+
+class HeaterOff(object):
+    """The action switching the sorption pump heater of an ITC off.
+
+    The automatic heater control is switched off first, as it would
+    otherwise set the output again, and then the output is set to 0 %.
+
+    Parameters
+    ----------
+    itc : RunMeas.ITCDevice.ITCDevice
+        The ITC.
+
+    """
+
+    def __init__(self, itc):
+        self.itc = itc
+
+    def __call__(self, alarm):
+        self.itc.auto_heat_off()
+        self.itc.set_heater_output(0.0)
+        print('Heater of the ITC switched off')
+
+
+def _measured(batch):
+    """Return which rows of a batch hold at least one finite reading."""
+    measured = None
+    for (chan_name, values) in batch.items():
+        values = np.asarray(values)
+        if chan_name in ('timestamp', DELAY_CHANNEL) or \
+                values.dtype.kind != 'f':
+            continue
+        finite = np.isfinite(values)
+        measured = finite if measured is None else measured | finite
+    if measured is None:
+        # Without float channels there is no gap marker to tell apart
+        return np.ones(len(batch['timestamp']), dtype=bool)
+    return measured
+
+
+class _DeviceRules(object):
+    """The listener evaluating the rules of a device on its batches.
+
+    The value rules skip the NaN rows of a gap, which neither raise nor
+    clear an alarm, nor count towards its debounce.
+
+    """
+
+    def __init__(self, engine, dev_name):
+        self.engine = engine
+        self.dev_name = dev_name
+        self.rules = []
+
+    def update(self, batch):
+        detected = self.engine.clock.now_ns()
+        ts = np.asarray(batch['timestamp'])
+        if not len(ts):
+            return
+        measured = None
+        for (rule, actions) in self.rules:
+            if isinstance(rule, Stale):
+                if measured is None:
+                    measured = np.flatnonzero(_measured(batch))
+                if not len(measured):
+                    continue
+                rule.last = int(ts[measured[-1]])
+                if rule.active:
+                    rule.active = False
+                    self.engine._notify(self.dev_name, rule, actions, False,
+                                        rule.last, None, detected)
+                continue
+            if rule.channel not in batch:
+                continue
+            values = np.asarray(batch[rule.channel], dtype=float)
+            keep = np.flatnonzero(~np.isnan(values))
+            if not len(keep):
+                continue
+            for (i, active) in rule.evaluate(ts[keep], values[keep]):
+                i = keep[i]
+                self.engine._notify(self.dev_name, rule, actions, active,
+                                    int(ts[i]), float(values[i]), detected)
+
+
+class AlarmEngine(Thread):
+    """Thread running the actions of the alarm rules of a buffer.
+
+    The rules on channels are evaluated by the collection threads on every
+    committed batch, and the alarms they raise are handed to this thread,
+    which runs the actions and checks the staleness of the devices every
+    'period' seconds.
+    The latency of an alarm is the time from the sample that raised it, or
+    from when a device became stale, to the end of its actions.
+
+    Parameters
+    ----------
+    buffer : RunMeas.Buffer.Buffer
+        The buffer whose devices are watched.
+    period : float, optional
+        How often, in seconds, the staleness is checked.
+        DEFAULT: 1.0 s
+    max_latency : float, optional
+        A warning is printed for alarms with a longer latency, in seconds.
+        DEFAULT: 2.0 s
+    clock : RunMeas.Clock.RealClock, optional
+        The clock, by default the clock of the buffer.
+
+    Attributes
+    ----------
+    stop : boolean
+        The stop flag. When true the thread loop will end.
+    alarms : list
+        The alarms raised and cleared so far, as dictionaries with the
+        'device', the 'rule', whether it is 'active', the 'timestamp' and
+        'value' of the sample, and the 'latency' in seconds.
+
+    Methods
+    -------
+    add_rule(dev_name, rule, *actions)
+    active
+    latency_stats
+    run
+    stop_thread
+
+    """
+
+    def __init__(self, buffer, period=1.0, max_latency=2.0, clock=None):
+        super(AlarmEngine, self).__init__()
+        self.buffer = buffer
+        self.period = period
+        self.max_latency = max_latency
+        self.clock = clock if clock is not None else buffer.clock
+        self.clock.attach(self)
+        self.stop = False
+        self.q = Queue()
+        self.alarms = []
+        self._devices = {}
+        self._lock = Lock()
+
+    def add_rule(self, dev_name, rule, *actions):
+        """Watch a device with a rule.
+
+        Parameters
+        ----------
+        dev_name : str
+            The name of the device in the buffer.
+        rule : Above, Below, RateAbove or Stale
+            The rule.
+        actions : callable
+            The actions run when the alarm is raised. They are called with
+            the alarm dictionary, see the 'alarms' attribute.
+
+        """
+        if dev_name not in self._devices:
+            self._devices[dev_name] = _DeviceRules(self, dev_name)
+            self.buffer.add_listener(dev_name, self._devices[dev_name])
+        self._devices[dev_name].rules.append((rule, list(actions)))
+
+    def _notify(self, dev_name, rule, actions, active, timestamp, value,
+                detected):
+        alarm = {'device': dev_name, 'rule': rule.name, 'active': active,
+                 'timestamp': timestamp, 'value': value,
+                 'detected': detected, 'latency': None}
+        self.q.put((alarm, actions))
+        # Only needed on a virtual clock, where waiting on the queue is a
+        # sleep that a put does not end
+        self.clock.wake(self)
+
+    def run(self):
+        """Method representing the thread's activity
+
+        See Also
+        --------
+        threading.Thread
+
+        """
+        while not self.stop:
+            try:
+                (alarm, actions) = self.clock.get(self.q, self.period)
+            except Empty:
+                self._check_stale()
+                continue
+            self._handle(alarm, actions)
+            self._check_stale()
+        self.remove_rules()
+
+    def _handle(self, alarm, actions):
+        if alarm['active']:
+            for action in actions:
+                # A failing action must not stop the other ones
+                try:
+                    action(alarm)
+                except Exception as e:
+                    print("Alarm action {} failed: {}".format(action, e))
+        else:
+            print('Cleared {device}: {rule}'.format(**alarm))
+        alarm['latency'] = (self.clock.now_ns() - alarm['timestamp']) / 1e9
+        if alarm['active'] and alarm['latency'] > self.max_latency:
+            print('Alarm {device}: {rule} took {latency:.2f} s to act '
+                  'on'.format(**alarm))
+        with self._lock:
+            self.alarms.append(alarm)
+
+    def _check_stale(self):
+        now = self.clock.now_ns()
+        for (dev_name, device) in self._devices.items():
+            for (rule, actions) in device.rules:
+                if not isinstance(rule, Stale) or rule.active:
+                    continue
+                if rule.last is None:
+                    # Count from the first check, so that a device that
+                    # never delivers is noticed as well
+                    rule.last = now
+                    continue
+                deadline = rule.last + int(rule.max_age * 1e9)
+                if now >= deadline:
+                    rule.active = True
+                    self._handle({'device': dev_name, 'rule': rule.name,
+                                  'active': True, 'timestamp': deadline,
+                                  'value': None, 'detected': now,
+                                  'latency': None}, actions)
+
+    def active(self):
+        """Return the (device, rule name) of the alarms currently raised."""
+        return [(dev_name, rule.name)
+                for (dev_name, device) in self._devices.items()
+                for (rule, actions) in device.rules if rule.active]
+
+    def latency_stats(self):
+        """Return the 'count', 'mean' and 'max' latency of the raised alarms.
+
+        """
+        with self._lock:
+            latencies = [a['latency'] for a in self.alarms if a['active']]
+        if not latencies:
+            return {'count': 0, 'mean': None, 'max': None}
+        return {'count': len(latencies), 'mean': float(np.mean(latencies)),
+                'max': float(np.max(latencies))}
+
+    def remove_rules(self):
+        """Stop evaluating the rules on the buffer's batches."""
+        for (dev_name, device) in self._devices.items():
+            if device in self.buffer.listeners[dev_name]:
+                self.buffer.remove_listener(dev_name, device)
+
+    def stop_thread(self):
+        """Method to call to halt the thread's activity."""
+        self.stop = True
+        self.clock.wake(self)
@@ -6,54 +6,337 @@
 """
 
 import os
+import re
 import sys
 import time
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock
+from queue import Empty
 import numpy as np
 import pandas as pd
 
+from RunMeas.Clock import from_datetime, get_clock
+from RunMeas.Pool import DevicePool
+from RunMeas.Samples import SampleBlock, parse_channels
+from RunMeas.Journal import (Journal, journal_path, open_recording,
+                             replay_journal)
+from RunMeas.Compression import append_rows, packed_rows
+from RunMeas.Pyramid import LEVELS, PyramidBuilder
+from RunMeas.Manifest import MANIFEST_SUFFIX, Manifest
+from RunMeas.Catalog import CATALOG_NAME, RunCatalog
+from RunMeas.Trigger import write_events
+
+SEGMENT_COLUMNS = ['step', 'device', 'setpoint', 'start', 'stop']
+
+
+def _rows_to_columns(rows):
+    """Turn (datetime, (name, value), ...) tuples into channel arrays."""
+    columns = {}
+    for row in rows:
+        for val in row[1:]:
+            columns.setdefault(val[0], []).append(val[1])
+    batch = {'timestamp': np.array([from_datetime(row[0]) for row in rows],
+                                   dtype='int64')}
+    for chan_name, vals in columns.items():
+        batch[chan_name] = np.array(vals)
+    return batch
+
+
+def _blocks_to_columns(blocks):
+    """Copy the samples of SampleBlocks into channel arrays and release them.
+
+    """
+    data = np.concatenate([block.data[:block.n] for block in blocks])
+    for block in blocks:
+        block.release()
+    return dict((name, np.ascontiguousarray(data[name]))
+                for name in data.dtype.names)
+
 
 class BufferCollectionThread(Thread):
+    """The thread committing the queued samples of a device to its data.
+
+    Every channel is kept in a preallocated array whose capacity doubles
+    when it is full, so that committing a batch costs as much as the batch,
+    not as the history. 'dev_data' holds views of these arrays trimmed to
+    the committed rows, which are replaced after every commit.
+
+    The listeners are notified under 'listeners_lock', which
+    Buffer.add_listener and Buffer.remove_listener take as well, so that a
+    removed listener is no longer being updated once its removal returns.
 
-    def __init__(self, name, q, dev_data, delay=0.2):
+    """
+
+    def __init__(self, name, q, dev_data, delay=0.2, derived=None,
+                 listeners=None, clock=None):
         super(BufferCollectionThread, self).__init__()
         self.name = name
         self.q = q
         self.delay = delay
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.attach(self)
         self.stop = False
         self.dev_data = dev_data
+        self.n_rows = len(dev_data['timestamp'])
+        self._arrays = dict(dev_data)
+        self.derived = derived if derived is not None else []
+        self.listeners = listeners if listeners is not None else []
+        self.lock = Lock()
+        self.listeners_lock = Lock()
+        self.dropped_samples = 0
 
     def run(self):
         while not self.stop:
-            vals = self.q.get()
-            if type(vals[0]) is datetime:
-                self.dev_data['timestamp'] = np.append(
-                    self.dev_data['timestamp'], np.datetime64(vals[0]))
-                for val in vals[1:]:
-                    self.dev_data[val[0]] = np.append(
-                        self.dev_data[val[0]], val[1])
+            batch = self._get_batch()
+            if batch:
+                self._commit(batch)
+            self._check_drops()
+
+    def _check_drops(self):
+        """Report samples that a bounded queue had to drop."""
+        dropped = getattr(self.q, 'dropped_samples', 0)
+        if dropped > self.dropped_samples:
+            print('{}: {} samples dropped, collection is not keeping '
+                  'up'.format(self.name, dropped - self.dropped_samples))
+            self.dropped_samples = dropped
+
+    def _get_batch(self, wait=True):
+        """Wait for the next sample and return it with all queued behind it.
+
+        The items are either SampleBlocks or tuples of the form
+        (datetime, (name, value), (name, value), ...). Without 'wait' only
+        the samples already queued are returned.
+
+        """
+        items = []
+        try:
+            if wait:
+                vals = self.clock.get(self.q, self.delay)
+            else:
+                vals = self.q.get_nowait()
+        except Empty:
+            return items
+        while True:
+            if isinstance(vals, SampleBlock) or type(vals[0]) is datetime:
+                items.append(vals)
             else:
                 for val in vals:
                     print(val)
                 # print(self.name, vals)
+            try:
+                vals = self.q.get_nowait()
+            except Empty:
+                return items
+
+    def _commit(self, items):
+        """Append a batch of samples and its derived values to the data.
+
+        """
+        parts = []
+        rows = []
+        blocks = []
+        for item in items:
+            if isinstance(item, SampleBlock):
+                if rows:
+                    parts.append(_rows_to_columns(rows))
+                    rows = []
+                blocks.append(item)
+            else:
+                if blocks:
+                    parts.append(_blocks_to_columns(blocks))
+                    blocks = []
+                rows.append(item)
+        if rows:
+            parts.append(_rows_to_columns(rows))
+        if blocks:
+            parts.append(_blocks_to_columns(blocks))
+        if len(parts) == 1:
+            batch = parts[0]
+        else:
+            batch = dict((chan_name, np.concatenate([p[chan_name]
+                                                     for p in parts]))
+                         for chan_name in parts[0])
+
+        with self.lock:
+            for chan in self.derived:
+                batch[chan.name] = chan.update(batch)
+            start = self.n_rows
+            stop = start + len(batch['timestamp'])
+            self._reserve(stop)
+            for chan_name, arr in self._arrays.items():
+                if chan_name in batch:
+                    # Keep the declared dtype of the channel
+                    arr[start:stop] = batch[chan_name]
+                elif arr.dtype.kind == 'f':
+                    arr[start:stop] = np.nan
+            self.n_rows = stop
+            for chan_name, arr in self._arrays.items():
+                self.dev_data[chan_name] = arr[:stop]
+
+        with self.listeners_lock:
+            for listener in list(self.listeners):
+                listener.update(batch)
+
+    def _reserve(self, n_rows):
+        """Grow the arrays of all channels to hold at least n_rows."""
+        capacity = len(self._arrays['timestamp'])
+        if n_rows <= capacity:
+            return
+        capacity = max(n_rows, 2 * capacity, 1024)
+        for chan_name, arr in self._arrays.items():
+            grown = np.empty(capacity, dtype=arr.dtype)
+            grown[:self.n_rows] = arr[:self.n_rows]
+            self._arrays[chan_name] = grown
+
+    def add_derived_channel(self, channel):
+        """Register a derived channel and backfill its history with NaN.
+
+        """
+        with self.lock:
+            capacity = len(self._arrays['timestamp'])
+            self._arrays[channel.name] = np.full(capacity, np.nan)
+            self.dev_data[channel.name] = \
+                self._arrays[channel.name][:self.n_rows]
+            self.derived.append(channel)
 
     def stop_thread(self):
         self.stop = True
+        self.clock.wake(self)
 
 
-class BufferRecordThread(Thread):
+class SharedCollectionThread(Thread):
+    """A single thread collecting the samples of all devices.
+
+    It takes the place of one BufferCollectionThread per device, which are
+    then only used for their state and never started: every 'delay' seconds
+    it commits whatever each device has queued.
+
+    Parameters
+    ----------
+    threads : list
+        The BufferCollectionThread of every device.
+    delay : float, optional
+        The time, in seconds, between two rounds over the queues.
+        DEFAULT: 0.01
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the delay, by default RunMeas.Clock.get_clock().
 
-    def __init__(self, dev_data, measurement_name, data_folder, delay=0.1):
+    """
+
+    def __init__(self, threads, delay=0.01, clock=None):
+        super(SharedCollectionThread, self).__init__()
+        self.name = 'SharedCollection'
+        self.threads = threads
+        self.delay = delay
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.attach(self)
+        self.stop = False
+
+    def run(self):
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            self.collect()
+        # Commit what the devices queued before they stopped
+        self.collect()
+
+    def collect(self):
+        """Commit the queued samples of every device."""
+        for t in self.threads:
+            batch = t._get_batch(wait=False)
+            if batch:
+                t._commit(batch)
+            t._check_drops()
+
+    def stop_thread(self):
+        self.stop = True
+        self.clock.wake(self)
+
+
+class BufferRecordThread(Thread):
+    """The thread appending the collected data to the HDF5 recording.
+
+    Parameters
+    ----------
+    deadband : dict, optional
+        A RunMeas.Compression.DeadbandFilter per device name. Rows of these
+        devices that do not change by more than the resolutions are not
+        written. A RunMeas.Trigger.Decimator may be given instead, to write
+        only every n-th row.
+    packed : bool, optional
+        If True, the data is written XOR/delta encoded to packed/<device>
+        (see RunMeas.Compression.read_packed) instead of to raw/<device>.
+        DEFAULT: False
+    levels : tuple, optional
+        The bin widths, in seconds, of the downsampled levels written next
+        to the data, see RunMeas.Pyramid. None writes no levels.
+        DEFAULT: RunMeas.Pyramid.LEVELS
+    rotate_size : int, optional
+        Start a new segment once the current one holds this many bytes.
+    rotate_interval : float, optional
+        Start a new segment after this many seconds.
+    catalog : RunMeas.Catalog.RunCatalog, optional
+        The catalog in which the run is registered when the thread starts
+        and indexed when it stops.
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the delays, the rotation interval and the file name,
+        by default RunMeas.Clock.get_clock().
+    captures : dict, optional
+        A RunMeas.Trigger.EventCapture per device name. Their completed
+        events are written at full resolution to events/<device>.
+
+    With either of the rotation limits the recording is split into
+    segments listed in a manifest, see RunMeas.Manifest. To resume such a
+    recording, pass the path of its manifest as 'file_name'.
+
+    """
+
+    def __init__(self, dev_data, measurement_name, data_folder, delay=0.1,
+                 segments=None, locks=None, file_name=None, journal=True,
+                 deadband=None, packed=False, levels=LEVELS,
+                 rotate_size=None, rotate_interval=None, catalog=None,
+                 clock=None, captures=None):
         super(BufferRecordThread, self).__init__()
         self.delay = delay
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.attach(self)
         self.stop = False
         self.dev_data = dev_data
+        self.segments = segments if segments is not None else []
+        self.locks = locks if locks is not None else {}
         self.meas_name = measurement_name
         self.data_folder = data_folder
-        self.start_time = datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+        self.start_time = datetime.fromtimestamp(self.clock.time()).strftime(
+            "%Y-%m-%dT%H-%M-%S")
         # print(self.data_folder, self.start_time, self.meas_name)
-        self.file_name = self._generate_file_name()
+        if file_name is None:
+            file_name = self._generate_file_name()
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.catalog = catalog
+        self.manifest = None
+        if file_name.endswith(MANIFEST_SUFFIX) or rotate_size or \
+                rotate_interval:
+            self.base_name = re.sub(r'(\.h5|{})$'.format(
+                re.escape(MANIFEST_SUFFIX)), '', file_name)
+            self.manifest = Manifest(self.base_name + MANIFEST_SUFFIX)
+            if self.manifest.segments:
+                file_name = self.manifest.path_of(self.manifest.segments[-1])
+            else:
+                file_name = self._segment_file_name(0)
+        self.file_name = file_name
+        self.use_journal = journal
+        self.deadband = deadband if deadband is not None else {}
+        self.captures = captures if captures is not None else {}
+        self.packed = packed
+        self.pyramid = PyramidBuilder(levels) if levels else None
+        self.journal = None
+        self.store = None
+        # Rows of each device already taken from the buffer and already in
+        # the file. They differ when a resumed recording appends to a file.
+        self.written = dict((dev_name, 0) for dev_name in self.dev_data)
+        self.file_rows = {}
+        self.n_segments = 0
+        self._lock = Lock()
 
     def _generate_file_name(self):
         basename = '_'.join((self.start_time, self.meas_name))
@@ -63,39 +346,210 @@ class BufferRecordThread(Thread):
         fullpath = os.path.join(self.data_folder, fullname)
         return fullpath
 
-    def run(self):
+    def _segment_file_name(self, index):
+        return '{}.{:04d}.h5'.format(self.base_name, index)
 
-        while not self.stop:
-            # Sometime the recording thread pulls the data before it has
-            # all been added to the data dictionary. This raises a
-            # ValueError which is caught here.
-            try:
-                df = {}
-                for k, v in self.dev_data.items():
-                    key = 'raw/'+k
-                    df[k] = pd.DataFrame(data=v)
-                    df[k] = df[k].set_index('timestamp')
-                    df[k].to_hdf(self.file_name, key, format='table')
-            except ValueError:
-                pass
-            time.sleep(self.delay)
+    @property
+    def run_path(self):
+        """The path of the recording, i.e. of its manifest if segmented."""
+        if self.manifest is not None:
+            return self.manifest.path
+        return self.file_name
+
+    def run(self):
+        if self.store is None:
+            self.open()
+        if self.catalog is not None:
+            channels = dict((dev_name, [k for k in dev_data
+                                        if k != 'timestamp'])
+                            for dev_name, dev_data in self.dev_data.items())
+            self._update_catalog(self.catalog.register_start, self.run_path,
+                                 self.meas_name, channels)
+        try:
+            while not self.stop:
+                self.write_new_rows()
+                self.clock.sleep(self.delay)
+            self.write_new_rows()
+        finally:
+            self.close()
+            if self.catalog is not None:
+                self._update_catalog(self.catalog.register_stop,
+                                     self.run_path)
+
+    def _update_catalog(self, method, *args):
+        # The recording must not fail because of the catalog
+        try:
+            method(*args)
+        except Exception as e:
+            print("Could not update the run catalog: {}".format(e))
+
+    def open(self):
+        """Open the file, replaying the journal of an interrupted run."""
+        folder = os.path.dirname(self.file_name)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        if self.manifest is not None and not self.manifest.segments:
+            self.manifest.add_segment(self.file_name)
+        replay_journal(self.file_name, packed=self.packed)
+        self.store = open_recording(self.file_name)
+        self.opened = self.clock.time()
+        self.span = [None, None]
+        for dev_name in self.dev_data:
+            key = 'raw/' + dev_name
+            if self.packed:
+                self.file_rows[dev_name] = packed_rows(self.store, dev_name)
+            elif key in self.store:
+                storer = self.store.get_storer(key)
+                self.file_rows[dev_name] = int(storer.nrows)
+            else:
+                self.file_rows[dev_name] = 0
+        if self.use_journal:
+            self.journal = Journal(journal_path(self.file_name))
+
+    def close(self):
+        if self.pyramid is not None:
+            self.pyramid.flush(self.store)
+        self.store.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.manifest is not None:
+            self.manifest.update_segment(self.span[0], self.span[1],
+                                         self.file_rows)
+
+    def rotate(self):
+        """Close the current segment and continue in a new one."""
+        self.close()
+        self.file_name = self._segment_file_name(len(self.manifest.segments))
+        self.manifest.add_segment(self.file_name)
+        self.n_segments = 0
+        self.open()
+
+    def _rotation_due(self):
+        if self.manifest is None:
+            return False
+        if self.rotate_size and \
+                os.path.getsize(self.file_name) >= self.rotate_size:
+            return True
+        return bool(self.rotate_interval and
+                    self.clock.time() - self.opened >= self.rotate_interval)
+
+    def _take_new_rows(self, dev_name):
+        """Return the rows of a device not yet written, as one consistent cut.
+
+        """
+        with self.locks.get(dev_name, self._lock):
+            dev_data = self.dev_data[dev_name]
+            start = self.written[dev_name]
+            stop = len(dev_data['timestamp'])
+            return dict((k, v[start:stop]) for k, v in dev_data.items())
+
+    def write_new_rows(self):
+        """Append everything collected since the last call to the file.
+
+        Each batch goes to the journal first and the journal is truncated
+        once the file has been flushed. Only then are the rows added to the
+        pyramid, so that it is never ahead of the raw data.
+
+        """
+        new_rows = []
+        span = list(self.span)
+        for dev_name in self.dev_data:
+            rows = self._take_new_rows(dev_name)
+            n = len(rows['timestamp'])
+            if not n:
+                continue
+            self.written[dev_name] += n
+            new_rows.append((dev_name, rows))
+            if dev_name in self.deadband:
+                rows = self.deadband[dev_name].filter(rows)
+                if not len(rows['timestamp']):
+                    continue
+            if self.journal is not None:
+                self.journal.append(dev_name, self.file_rows[dev_name], rows)
+            append_rows(self.store, dev_name, rows, self.packed)
+            self.file_rows[dev_name] += len(rows['timestamp'])
+            self._widen_span(rows['timestamp'])
+        for dev_name, capture in self.captures.items():
+            write_events(self.store, dev_name, capture.take_events())
+        if len(self.segments) > self.n_segments:
+            self.n_segments = len(self.segments)
+            segs = pd.DataFrame(list(self.segments), columns=SEGMENT_COLUMNS)
+            self.store.put('sweep/segments', segs, format='table')
+        self.store.flush(fsync=self.journal is not None and self.journal.sync)
+        if self.journal is not None:
+            self.journal.checkpoint()
+        if self.manifest is not None and self.span != span:
+            # Readers skip segments by their span, so it has to follow the
+            # rows that are safely in the file
+            self.manifest.update_segment(self.span[0], self.span[1],
+                                         self.file_rows)
+        if self.pyramid is not None:
+            # The bins are flushed with the next rows or on close
+            for (dev_name, rows) in new_rows:
+                self.pyramid.update(self.store, dev_name, rows)
+        if self._rotation_due():
+            self.rotate()
+
+    def _widen_span(self, timestamps):
+        (start, stop) = (int(timestamps[0]), int(timestamps[-1]))
+        if self.span[0] is None:
+            self.span = [start, stop]
+        else:
+            self.span = [min(self.span[0], start), max(self.span[1], stop)]
 
     def stop_thread(self):
         self.stop = True
+        self.clock.wake(self)
 
 
 class Buffer(object):
-
-    def __init__(self, devices):
+    """The in-memory data of all devices and the threads filling it.
+
+    Parameters
+    ----------
+    devices : list
+        The (name, device, measurement thread) of every device.
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of all threads, by default RunMeas.Clock.get_clock().
+    delay : float, optional
+        How long the collection waits for new samples at a time.
+        DEFAULT: 0.01
+    workers : int, optional
+        If given, the devices are sampled by a RunMeas.Pool.DevicePool with
+        this many threads instead of their own measurement threads, and one
+        SharedCollectionThread collects them all. The number of threads
+        then does not grow with the number of devices.
+
+    """
+
+    def __init__(self, devices, clock=None, delay=0.01, workers=None):
         if not isinstance(devices, list):
             raise TypeError("The devices passed to the manager needs to be a "
                             "list of tuples")
         if not isinstance(devices[0], tuple):
             raise TypeError("Each unit of the devices list need to be a tuple")
 
+        self.clock = clock if clock is not None else get_clock()
+        # How long the collection threads wait for new samples at a time
+        self.delay = delay
         self.devices = self._generate_device_dictionary(devices)
         self.data = self._generate_data_dictionary()
+        self.derived = dict((dev_name, []) for dev_name in self.devices)
+        self.listeners = dict((dev_name, []) for dev_name in self.devices)
+        self.captures = {}
+        self.segments = []
+        self.shared = {}
         self.collection_threads = self._generate_collection_threads()
+        self.pool = None
+        self.collector = None
+        if workers is not None:
+            self.pool = DevicePool([(dev_name, dev_obj['thread'])
+                                    for (dev_name, dev_obj)
+                                    in self.devices.items()],
+                                   workers=workers, clock=self.clock)
+            self.collector = SharedCollectionThread(self.collection_threads,
+                                                    delay=self.delay,
+                                                    clock=self.clock)
         self.measurement_name = None
         self.record_thread = None
         self.data_folder = os.path.join(os.getcwd(), 'temp_data')
@@ -113,7 +567,11 @@ class Buffer(object):
         col_ts = []
         for dev_name, dev_obj in self.devices.items():
             t = BufferCollectionThread(dev_name, dev_obj['thread'].q,
-                                       self.data[dev_name], delay=0.01)
+                                       self.data[dev_name],
+                                       delay=self.delay,
+                                       derived=self.derived[dev_name],
+                                       listeners=self.listeners[dev_name],
+                                       clock=self.clock)
             col_ts.append(t)
         return col_ts
 
@@ -122,13 +580,182 @@ class Buffer(object):
 
         for dev_name in self.devices.keys():
             d[dev_name] = {}
-            d[dev_name]['timestamp'] = np.array([], dtype='datetime64[ns]')
-            for chan_name in self.devices[dev_name]['thread'].chan_list:
-                d[dev_name][chan_name] = np.array([])
+            d[dev_name]['timestamp'] = np.array([], dtype='int64')
+            chan_list = self.devices[dev_name]['thread'].chan_list
+            for (chan_name, dtype) in parse_channels(chan_list):
+                d[dev_name][chan_name] = np.array([], dtype=dtype)
 
         return d
 
+    def add_derived_channel(self, dev_name, channel):
+        """Add a channel that is computed on-line from a device's channels.
+
+        The derived channel is updated with every committed batch and is
+        stored, recorded and plotted just like the raw channels.
+
+        Parameters
+        ----------
+        dev_name : str
+            The name of the device whose channels the derived channel uses.
+        channel : RunMeas.Derived.DerivedChannel
+            The derived channel, e.g. Rate('dTHe3/dt', 'THe3').
+
+        """
+        if dev_name not in self.devices:
+            raise KeyError("There is no device named {}".format(dev_name))
+        if channel.name in self.data[dev_name]:
+            raise ValueError("The channel {} already exists for {}".format(
+                channel.name, dev_name))
+        self._collection_thread(dev_name).add_derived_channel(channel)
+
+    def add_listener(self, dev_name, listener):
+        """Add an object that is notified of every committed batch.
+
+        Parameters
+        ----------
+        dev_name : str
+            The name of the device whose batches the listener receives.
+        listener : object
+            Any object with an 'update(batch)' method, e.g. a
+            RunMeas.Stability.StabilityDetector. It is called from the
+            collection thread and should return quickly.
+
+        """
+        if dev_name not in self.devices:
+            raise KeyError("There is no device named {}".format(dev_name))
+        with self._collection_thread(dev_name).listeners_lock:
+            self.listeners[dev_name].append(listener)
+
+    def remove_listener(self, dev_name, listener):
+        """Stop notifying a listener added with add_listener.
+
+        Once this returns, the listener is not being updated anymore.
+
+        """
+        with self._collection_thread(dev_name).listeners_lock:
+            self.listeners[dev_name].remove(listener)
+
+    def _collection_thread(self, dev_name):
+        for t in self.collection_threads:
+            if t.name == dev_name:
+                return t
+        raise KeyError("There is no device named {}".format(dev_name))
+
+    def add_trigger(self, dev_name, capture):
+        """Capture events of a device at full resolution.
+
+        The capture is fed every committed batch of the device, and the
+        recording writes its events to events/<device>, see
+        RunMeas.Trigger.
+
+        Parameters
+        ----------
+        dev_name : str
+            The name of the device, e.g. 'AH'.
+        capture : RunMeas.Trigger.EventCapture
+            The capture with its trigger conditions.
+
+        """
+        if dev_name in self.captures:
+            raise ValueError("There already is a trigger on {}".format(
+                dev_name))
+        self.add_listener(dev_name, capture)
+        self.captures[dev_name] = capture
+
+    def remove_trigger(self, dev_name):
+        """Stop capturing events of a device."""
+        capture = self.captures.pop(dev_name)
+        self.remove_listener(dev_name, capture)
+
+    def queue_stats(self):
+        """Return the fill level and drop counts of every device queue.
+
+        Returns
+        -------
+        stats : dict
+            Per device the dictionary of RunMeas.Samples.SampleQueue.stats,
+            or only the size for plain queues.
+
+        """
+        stats = {}
+        for dev_name, dev_obj in self.devices.items():
+            q = dev_obj['thread'].q
+            if hasattr(q, 'stats'):
+                stats[dev_name] = q.stats()
+            else:
+                stats[dev_name] = {'size': q.qsize()}
+        return stats
+
+    def add_segment(self, step, dev_name, setpoint, start, stop):
+        """Tag a stretch of a device's data with the sweep step it belongs to.
+
+        Parameters
+        ----------
+        step : int
+            The index of the sweep step.
+        dev_name : str
+            The name of the device whose data is tagged.
+        setpoint : float
+            The setpoint of the sweep step.
+        start, stop : int
+            The timestamps of the first and the last sample of the segment,
+            in nanoseconds since the epoch.
+
+        """
+        self.segments.append((step, dev_name, setpoint, start, stop))
+
+    def publish_shared(self, dev_name, capacity=100000, name=None):
+        """Publish a device's channels in shared memory for other processes.
+
+        Other local processes can then attach read-only with
+        RunMeas.SharedBuffer.SharedBufferReader(name) and see every committed
+        batch without touching the recording file. Add derived channels
+        before publishing, as the set of channels is fixed from here on.
+
+        Parameters
+        ----------
+        dev_name : str
+            The name of the device to publish.
+        capacity : int, optional
+            The number of most recent rows kept in shared memory.
+            DEFAULT: 100000
+        name : str, optional
+            The name of the shared memory block.
+            DEFAULT: 'runmeas_' followed by the device name
+
+        Returns
+        -------
+        name : str
+            The name of the shared memory block.
+
+        """
+        from RunMeas.SharedBuffer import SharedBufferWriter
+
+        if dev_name not in self.devices:
+            raise KeyError("There is no device named {}".format(dev_name))
+        if name is None:
+            name = 'runmeas_' + re.sub(r'\W', '_', dev_name)
+        columns = [(chan_name, vals.dtype)
+                   for (chan_name, vals) in self.data[dev_name].items()]
+        writer = SharedBufferWriter(name, columns, capacity)
+        self.shared[dev_name] = writer
+        self.add_listener(dev_name, writer)
+        return name
+
+    def unpublish_shared(self, dev_name):
+        """Stop publishing a device and remove its shared memory."""
+        writer = self.shared.pop(dev_name)
+        # Only close the writer once no batch is being written to it
+        self.remove_listener(dev_name, writer)
+        writer.close()
+
     def start_collection(self):
+        if self.pool is not None:
+            print('Starting {} pool workers for {} devices'.format(
+                len(self.pool.workers), len(self.devices)))
+            self.pool.start()
+            self.collector.start()
+            return
         # Make sure that all the device threads are started
         for k, v in self.devices.items():
             print('Starting device thread: {}'.format(k))
@@ -141,6 +768,13 @@ class Buffer(object):
             t.start()
 
     def stop_collection(self):
+        if self.pool is not None:
+            print('Stopping the pool workers')
+            self.pool.stop_thread()
+            self.pool.join()
+            self.collector.stop_thread()
+            self.collector.join()
+            return
         for t in self.collection_threads:
             print('Stopping collection thread for', t.name)
             t.stop_thread()
@@ -154,10 +788,54 @@ class Buffer(object):
                 print('Stopping device thread: {}'.format(k))
                 v['thread'].stop_thread()
 
-    def start_recording(self):
+    def start_recording(self, resume=None, deadband=None, packed=False,
+                        rotate_size=None, rotate_interval=None,
+                        catalog=True, delay=0.1):
+        """Start recording the buffer to a file in the data folder.
+
+        Parameters
+        ----------
+        resume : str, optional
+            The path of an earlier recording, e.g. of a run that crashed. Its
+            journal is replayed and the new data is appended to it, so that
+            it continues as the same logical measurement.
+        deadband : dict, optional
+            A RunMeas.Compression.DeadbandFilter or a
+            RunMeas.Trigger.Decimator per device name, see
+            BufferRecordThread.
+        packed : bool, optional
+            Record in the XOR/delta encoded packed format.
+            DEFAULT: False
+        rotate_size, rotate_interval : optional
+            Split the recording into segments of this many bytes or
+            seconds, see BufferRecordThread.
+        catalog : bool, optional
+            Register the run in the catalog of the data folder, see
+            RunMeas.Catalog.
+            DEFAULT: True
+        delay : float, optional
+            The time, in seconds, between writes to the file.
+            DEFAULT: 0.1 s
+
+        """
         assert type(self.data_folder) is not None
-        self.record_thread = BufferRecordThread(self.data, 'Test_Measurement',
-                                                self.data_folder)
+        meas_name = self.measurement_name or 'Test_Measurement'
+        locks = dict((t.name, t.lock) for t in self.collection_threads)
+        run_catalog = None
+        if catalog:
+            if not os.path.isdir(self.data_folder):
+                os.makedirs(self.data_folder)
+            run_catalog = RunCatalog(os.path.join(self.data_folder,
+                                                  CATALOG_NAME))
+        self.record_thread = BufferRecordThread(
+            self.data, meas_name, self.data_folder, delay=delay,
+            segments=self.segments, locks=locks, file_name=resume,
+            deadband=deadband, packed=packed,
+            rotate_size=rotate_size, rotate_interval=rotate_interval,
+            catalog=run_catalog, clock=self.clock, captures=self.captures)
+        # Opened here, so that a recording that can not be resumed raises
+        # in the caller instead of in the thread
+        self.record_thread.open()
         self.record_thread.start()
 
     def stop_recording(self):
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Cache Module.
+
+This module contains the read-through cache that sits between the getters of
+a device and its bus. The measurement thread, the GUI and scripts all read
+the same values, e.g. the setpoint or the heater output, often within
+milliseconds of each other. With the cache
+
+- a reply younger than the freshness window of its command is reused,
+- identical queries issued while one is on the bus wait for its reply
+  instead of queueing another bus transaction,
+- every command without a freshness window, i.e. every setting, goes to the
+  device and forgets all cached replies, so no stale value is read back
+  after a change.
+
+"""
+
+from threading import Event, Lock
+
+from RunMeas.Clock import get_clock
+
+
+class _Flight(object):
+    """A query on the bus that other threads may wait for."""
+
+    def __init__(self, time):
+        self.done = Event()
+        self.time = time
+        self.reply = None
+        self.error = None
+
+
+class QueryCache(object):
+    """Per-command freshness cache with collapsing of concurrent queries.
+
+    Parameters
+    ----------
+    freshness : dict
+        The seconds a reply stays valid per cacheable command, e.g.
+        {'R0': 1.0, 'R1': 0.1}. A window of 0 only collapses concurrent
+        queries. All other commands pass through and clear the cache.
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the freshness windows, by default
+        RunMeas.Clock.get_clock().
+
+    Attributes
+    ----------
+    hits : int
+        The queries answered from the cache.
+    misses : int
+        The queries sent to the device.
+    coalesced : int
+        The queries that waited for an identical query already on the bus.
+    passed : int
+        The commands passed through without caching, i.e. the settings.
+
+    Methods
+    -------
+    query(command, fetch)
+    query_with_age(command, fetch)
+    invalidate(command=None)
+    stats
+
+    """
+
+    def __init__(self, freshness, clock=None):
+        super(QueryCache, self).__init__()
+        self.freshness = dict(freshness)
+        self.clock = clock if clock is not None else get_clock()
+        self.lock = Lock()
+        self.entries = {}
+        self.in_flight = {}
+        # Bumped by every setting, so that replies fetched across a setting
+        # are not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.passed = 0
+
+    def query(self, command, fetch):
+        """Return the reply to a command, from the cache if it is fresh.
+
+        Parameters
+        ----------
+        command : str
+            The command, e.g. "R1".
+        fetch : callable
+            Sends the command to the device and returns the reply.
+
+        Returns
+        -------
+        reply : str
+            The reply of the device.
+
+        """
+        return self.query_with_age(command, fetch)[0]
+
+    def query_with_age(self, command, fetch):
+        """Return the reply to a command and how old it was when asked for.
+
+        Parameters
+        ----------
+        command : str
+            The command, e.g. "R1".
+        fetch : callable
+            Sends the command to the device and returns the reply.
+
+        Returns
+        -------
+        tuple : (str, float)
+            The reply and its age in seconds, i.e. how long before this
+            call it was queried. The age is 0 if this call queried the
+            device.
+
+        """
+        window = self.freshness.get(command)
+        if window is None:
+            return (self._pass(command, fetch), 0.0)
+        with self.lock:
+            now = self.clock.time()
+            entry = self.entries.get(command)
+            if entry is not None and now - entry[0] < window:
+                self.hits += 1
+                return (entry[1], now - entry[0])
+            flight = self.in_flight.get(command)
+            owner = flight is None
+            if owner:
+                self.misses += 1
+                flight = self.in_flight[command] = _Flight(now)
+                generation = self.generation
+            else:
+                self.coalesced += 1
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return (flight.reply, now - flight.time)
+        try:
+            flight.reply = fetch(command)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[command]
+                if flight.error is None and generation == self.generation:
+                    self.entries[command] = (now, flight.reply)
+            flight.done.set()
+        return (flight.reply, 0.0)
+
+    def _pass(self, command, fetch):
+        """Send a setting and forget everything it may have changed."""
+        with self.lock:
+            self.passed += 1
+            self.generation += 1
+            self.entries.clear()
+        try:
+            return fetch(command)
+        finally:
+            with self.lock:
+                self.generation += 1
+                self.entries.clear()
+
+    def invalidate(self, command=None):
+        """Forget the cached reply of a command, or of all commands."""
+        with self.lock:
+            if command is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(command, None)
+
+    def stats(self):
+        """Return the hit and miss counts and the saved bus transactions.
+
+        Returns
+        -------
+        stats : dict
+            With the keys 'hits', 'misses', 'coalesced', 'passed', 'saved',
+            i.e. the hits and coalesced queries that did not reach the bus,
+            and 'hit_ratio', the saved share of the cacheable queries.
+
+        """
+        with self.lock:
+            saved = self.hits + self.coalesced
+            total = saved + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'coalesced': self.coalesced, 'passed': self.passed,
+                    'saved': saved,
+                    'hit_ratio': saved / total if total else 0.0}
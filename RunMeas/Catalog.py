@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Catalog Module.
+
+This module contains the SQLite catalog of the recordings in a data folder.
+For every run the catalog holds its name, file, time span and status, the
+min, max, mean and count of every channel of every device, and the sweep
+segments. The recording thread registers a run when it starts and indexes
+it when it stops, and existing recordings are added with
+
+    python -m RunMeas.Catalog backfill <data folder> [processes]
+
+Searching for e.g. the runs in which THe3 went below 0.3 K is then a single
+indexed query, instead of opening every file.
+
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Compression import packed_group, read_packed
+from RunMeas.Manifest import MANIFEST_SUFFIX, Manifest
+from RunMeas.Pyramid import LEVELS, level_key
+
+CATALOG_NAME = 'catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT,
+    start INTEGER,
+    stop INTEGER,
+    status TEXT,
+    segments INTEGER,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    device TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    min REAL,
+    max REAL,
+    mean REAL,
+    count INTEGER
+);
+CREATE TABLE IF NOT EXISTS sweeps (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    step INTEGER,
+    device TEXT,
+    setpoint REAL,
+    start INTEGER,
+    stop INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_start ON runs(start);
+CREATE INDEX IF NOT EXISTS runs_name ON runs(name);
+CREATE INDEX IF NOT EXISTS channels_min ON channels(channel, min);
+CREATE INDEX IF NOT EXISTS channels_max ON channels(channel, max);
+CREATE INDEX IF NOT EXISTS channels_run ON channels(run_id);
+CREATE INDEX IF NOT EXISTS sweeps_run ON sweeps(run_id);
+"""
+
+# A recording is either a single file or the manifest of its segments
+_SEGMENT = re.compile(r'\.\d{4}\.h5$')
+
+
+def run_name(path):
+    """Return the measurement name of a recording from its file name.
+
+    The files are named <start time>_<measurement name>.h5, see
+    BufferRecordThread.
+
+    """
+    base = os.path.basename(path)
+    base = re.sub(r'({}|\.h5)$'.format(re.escape(MANIFEST_SUFFIX)), '', base)
+    parts = base.split('_', 1)
+    return parts[1] if len(parts) == 2 else base
+
+
+def find_recordings(folder):
+    """Return the paths of all recordings in a folder."""
+    paths = []
+    for entry in sorted(os.listdir(folder)):
+        path = os.path.join(folder, entry)
+        if entry.endswith(MANIFEST_SUFFIX):
+            paths.append(path)
+        elif entry.endswith('.h5') and not _SEGMENT.search(entry):
+            paths.append(path)
+    return paths
+
+
+def _devices(store):
+    devices = set()
+    for key in store.keys():
+        parts = key.strip('/').split('/')
+        if parts[0] in ('raw', 'pyramid') and len(parts) > 1:
+            devices.add(parts[1])
+    group = packed_group(store)
+    if group is not None:
+        devices.update(group._v_children)
+    return sorted(devices)
+
+
+def _file_stats(path):
+    """Return the span, channel aggregates and sweeps of one file.
+
+    The aggregates are taken from the coarsest pyramid level if there is
+    one, which makes indexing a long run about as cheap as a short one.
+
+    """
+    span = [None, None]
+    stats = {}
+    sweeps = []
+    missing = []
+
+    def widen(first, last):
+        span[0] = first if span[0] is None else min(span[0], first)
+        span[1] = last if span[1] is None else max(span[1], last)
+
+    with pd.HDFStore(path, mode='r') as store:
+        for dev_name in _devices(store):
+            levels = [lvl for lvl in LEVELS
+                      if level_key(dev_name, lvl) in store]
+            raw_key = 'raw/' + dev_name
+            if raw_key in store:
+                storer = store.get_storer(raw_key)
+                if storer.nrows:
+                    widen(int(store.select(raw_key, stop=1).index[0]),
+                          int(store.select(raw_key,
+                                           start=storer.nrows - 1).index[0]))
+            if levels:
+                df = store.select(level_key(dev_name, levels[-1]))
+                if raw_key not in store and len(df):
+                    # Packed recordings have their span from the levels
+                    widen(int(df.index[0]),
+                          int(df.index[-1] + levels[-1] * 1e9) - 1)
+                for col in df.columns:
+                    (chan_name, agg) = col.rsplit('_', 1)
+                    if agg != 'count':
+                        continue
+                    count = df[col].values
+                    mean = df[chan_name + '_mean'].fillna(0).values
+                    stats[(dev_name, chan_name)] = (
+                        np.nanmin(df[chan_name + '_min'].values),
+                        np.nanmax(df[chan_name + '_max'].values),
+                        (mean * count).sum(), int(count.sum()))
+            else:
+                missing.append(dev_name)
+        if 'sweep/segments' in store:
+            sweeps = store.select('sweep/segments').values.tolist()
+    # Devices without any levels are aggregated from their rows
+    for dev_name in missing:
+        df = _read_rows(path, dev_name)
+        if df is None or not len(df):
+            continue
+        widen(int(df.index[0]), int(df.index[-1]))
+        for chan_name in df.columns:
+            vals = df[chan_name].values.astype(float)
+            valid = ~np.isnan(vals)
+            if not valid.any():
+                continue
+            stats[(dev_name, chan_name)] = (
+                vals[valid].min(), vals[valid].max(), vals[valid].sum(),
+                int(valid.sum()))
+    return span, stats, sweeps
+
+
+def _read_rows(path, dev_name):
+    with pd.HDFStore(path, mode='r') as store:
+        if 'raw/' + dev_name in store:
+            return store.select('raw/' + dev_name)
+        packed = packed_group(store, dev_name) is not None
+    return read_packed(path, dev_name) if packed else None
+
+
+def summarize(path):
+    """Collect what the catalog holds about a recording.
+
+    Parameters
+    ----------
+    path : str
+        The path of a recording or of the manifest of a segmented one.
+
+    Returns
+    -------
+    summary : dict
+        With the keys 'path', 'name', 'start', 'stop', 'segments', 'mtime',
+        'channels' (a list of (device, channel, min, max, mean, count)) and
+        'sweeps' (a list of rows of sweep/segments).
+
+    """
+    files = _files_of(path)
+    span = [None, None]
+    totals = {}
+    sweeps = []
+    for file_name in files:
+        if not os.path.exists(file_name):
+            continue
+        (file_span, stats, file_sweeps) = _file_stats(file_name)
+        for i, pick in ((0, min), (1, max)):
+            if file_span[i] is not None:
+                span[i] = (file_span[i] if span[i] is None
+                           else pick(span[i], file_span[i]))
+        for key, (lo, hi, total, count) in stats.items():
+            if key in totals:
+                (lo0, hi0, total0, count0) = totals[key]
+                totals[key] = (min(lo, lo0), max(hi, hi0), total + total0,
+                               count + count0)
+            else:
+                totals[key] = (lo, hi, total, count)
+        # Every segment holds all sweep segments up to its end
+        if len(file_sweeps) >= len(sweeps):
+            sweeps = file_sweeps
+    channels = []
+    for (dev_name, chan_name), (lo, hi, total, count) in sorted(
+            totals.items()):
+        mean = total / count if count else None
+        channels.append((dev_name, chan_name, float(lo), float(hi),
+                         None if mean is None else float(mean), int(count)))
+    return {'path': os.path.abspath(path), 'name': run_name(path),
+            'start': span[0], 'stop': span[1], 'segments': len(files),
+            'mtime': _mtime(files), 'channels': channels, 'sweeps': sweeps}
+
+
+def _mtime(files):
+    times = [os.path.getmtime(f) for f in files if os.path.exists(f)]
+    return max(times) if times else None
+
+
+class RunCatalog(object):
+    """The catalog of the recordings in a data folder.
+
+    Every call opens its own connection, so that the catalog can be used
+    from the recording thread and the user interface alike.
+
+    Parameters
+    ----------
+    path : str
+        The path of the SQLite database, created if needed.
+
+    Methods
+    -------
+    register_start(path, name, channels)
+    register_stop(path)
+    add(summary)
+    find(channel, below, above, device, name, after, before)
+    sweeps(path)
+    backfill(folder, processes)
+
+    """
+
+    def __init__(self, path):
+        super(RunCatalog, self).__init__()
+        self.path = path
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA foreign_keys = ON')
+        return _Closing(db)
+
+    def register_start(self, path, name, channels):
+        """Register a run that starts recording.
+
+        Parameters
+        ----------
+        path : str
+            The path of the recording or of its manifest.
+        name : str
+            The measurement name.
+        channels : dict
+            The channel names of every device.
+
+        """
+        with self._connect() as db:
+            db.execute('DELETE FROM runs WHERE path = ?',
+                       (os.path.abspath(path),))
+            cursor = db.execute(
+                'INSERT INTO runs (path, name, status) VALUES (?, ?, ?)',
+                (os.path.abspath(path), name, 'recording'))
+            db.executemany(
+                'INSERT INTO channels (run_id, device, channel) '
+                'VALUES (?, ?, ?)',
+                [(cursor.lastrowid, dev_name, chan_name)
+                 for dev_name, chan_names in sorted(channels.items())
+                 for chan_name in chan_names])
+
+    def register_stop(self, path):
+        """Index a run that has stopped recording."""
+        self.add(summarize(path))
+
+    def add(self, summary, db=None):
+        """Add or replace a run, see summarize."""
+        if db is None:
+            with self._connect() as db:
+                return self.add(summary, db)
+        db.execute('DELETE FROM runs WHERE path = ?', (summary['path'],))
+        cursor = db.execute(
+            'INSERT INTO runs (path, name, start, stop, status, segments, '
+            'mtime) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (summary['path'], summary['name'], summary['start'],
+             summary['stop'], 'complete', summary['segments'],
+             summary['mtime']))
+        run_id = cursor.lastrowid
+        db.executemany(
+            'INSERT INTO channels (run_id, device, channel, min, max, mean, '
+            'count) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(run_id,) + tuple(c) for c in summary['channels']])
+        db.executemany(
+            'INSERT INTO sweeps (run_id, step, device, setpoint, start, '
+            'stop) VALUES (?, ?, ?, ?, ?, ?)',
+            [(run_id,) + tuple(s) for s in summary['sweeps']])
+
+    def find(self, channel=None, below=None, above=None, device=None,
+             name=None, after=None, before=None):
+        """Find runs.
+
+        Parameters
+        ----------
+        channel : str, optional
+            Only runs that recorded this channel.
+        below, above : float, optional
+            Only runs in which 'channel' went below or above this value.
+        device : str, optional
+            Only runs that recorded this device.
+        name : str, optional
+            An SQL LIKE pattern of the measurement name, e.g. 'Cooldown%'.
+        after, before : int, optional
+            Only runs overlapping this range, in nanoseconds since the
+            epoch.
+
+        Returns
+        -------
+        runs : list
+            One dict per run with the columns of the runs table, latest
+            first.
+
+        """
+        conditions = []
+        params = []
+        if channel is not None or device is not None:
+            sub = []
+            if channel is not None:
+                sub.append('c.channel = ?')
+                params.append(channel)
+            if device is not None:
+                sub.append('c.device = ?')
+                params.append(device)
+            if below is not None:
+                sub.append('c.min < ?')
+                params.append(below)
+            if above is not None:
+                sub.append('c.max > ?')
+                params.append(above)
+            conditions.append('r.id IN (SELECT c.run_id FROM channels c '
+                              'WHERE {})'.format(' AND '.join(sub)))
+        if name is not None:
+            conditions.append('r.name LIKE ?')
+            params.append(name)
+        if after is not None:
+            conditions.append('r.stop >= ?')
+            params.append(after)
+        if before is not None:
+            conditions.append('r.start < ?')
+            params.append(before)
+        sql = 'SELECT r.* FROM runs r'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY r.start DESC'
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            return [dict(row) for row in db.execute(sql, params)]
+
+    def channels(self, path):
+        """Return the channel statistics of a run as a DataFrame."""
+        with self._connect() as db:
+            return pd.read_sql_query(
+                'SELECT device, channel, min, max, mean, count FROM channels '
+                'WHERE run_id = (SELECT id FROM runs WHERE path = ?)', db,
+                params=(os.path.abspath(path),))
+
+    def sweeps(self, path):
+        """Return the sweep segments of a run as a DataFrame."""
+        with self._connect() as db:
+            return pd.read_sql_query(
+                'SELECT step, device, setpoint, start, stop FROM sweeps '
+                'WHERE run_id = (SELECT id FROM runs WHERE path = ?)', db,
+                params=(os.path.abspath(path),))
+
+    def backfill(self, folder, processes=None):
+        """Index all recordings of a folder that are new or have changed.
+
+        The files are summarized in parallel by a pool of processes.
+
+        Parameters
+        ----------
+        folder : str
+            The data folder.
+        processes : int, optional
+            The number of processes, by default one per CPU.
+
+        Returns
+        -------
+        n : int
+            The number of runs indexed.
+
+        """
+        with self._connect() as db:
+            known = dict(db.execute('SELECT path, mtime FROM runs '
+                                    "WHERE status = 'complete'"))
+        paths = [p for p in find_recordings(folder)
+                 if known.get(os.path.abspath(p)) != _mtime(_files_of(p))]
+        if not paths:
+            return 0
+        n = 0
+        with Pool(processes) as pool, self._connect() as db:
+            for summary in pool.imap_unordered(_try_summarize, paths):
+                if summary is not None:
+                    self.add(summary, db)
+                    n += 1
+        return n
+
+
+def _files_of(path):
+    if path.endswith(MANIFEST_SUFFIX):
+        manifest = Manifest(path)
+        return [manifest.path_of(s) for s in manifest.segments]
+    return [path]
+
+
+def _try_summarize(path):
+    try:
+        return summarize(path)
+    except Exception as e:
+        print("Could not index {}: {}".format(path, e))
+        return None
+
+
+class _Closing(object):
+    """Commit and close a connection at the end of a with block."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.db.commit()
+        self.db.close()
+
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv
+
+    if len(argv) < 3 or argv[1] != 'backfill':
+        print("Usage: python -m RunMeas.Catalog backfill <folder> "
+              "[processes]")
+        return 1
+    folder = argv[2]
+    processes = int(argv[3]) if len(argv) > 3 else None
+    catalog = RunCatalog(os.path.join(folder, CATALOG_NAME))
+    start = time.time()
+    n = catalog.backfill(folder, processes)
+    print("Indexed {} runs in {:.1f} s".format(n, time.time() - start))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Clock Module.
+
+All timestamps of the acquisition pipeline are int64 nanoseconds since the
+epoch. They are taken from the monotonic clock plus an offset fixed at
+start-up, so that they never jump backwards when the system clock is
+adjusted, and they are only converted to dates for display and export.
+
+The threads of the pipeline take their time from a clock object, so that it
+can be replaced. RealClock reads the system clock, and VirtualClock is a
+discrete-event clock for simulations, in which hours of acquisition,
+recording, rotation and sweeping run as fast as the work itself, e.g.
+
+    clock = VirtualClock()
+    itc_thread = ITCMeasurementThread(itc, ['THe3'], delay=0.2, clock=clock)
+    buffer = Buffer([('ITC503', itc, itc_thread)], clock=clock)
+    buffer.start_collection()
+    clock.advance(12 * 3600)
+
+"""
+
+import time
+import heapq
+import itertools
+from queue import Empty
+from threading import Condition, current_thread
+
+import numpy as np
+
+# The offset between the monotonic clock and the epoch, fixed at start-up
+_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def now_ns():
+    """Return the current time in nanoseconds since the epoch.
+
+    Returns
+    -------
+    int
+
+    """
+    return time.monotonic_ns() + _OFFSET_NS
+
+
+def from_datetime(dt):
+    """Convert a datetime to nanoseconds since the epoch.
+
+    Naive datetimes are taken to be in local time, like datetime.now().
+
+    """
+    return int(round(dt.timestamp() * 1e6)) * 1000
+
+
+def to_datetime64(timestamps):
+    """Convert epoch nanoseconds to numpy datetime64[ns] (UTC).
+
+    Parameters
+    ----------
+    timestamps : int or array_like
+        The timestamps in nanoseconds since the epoch.
+
+    Returns
+    -------
+    numpy.datetime64 or numpy.ndarray
+
+    """
+    return np.asarray(timestamps, dtype='int64').astype('datetime64[ns]')
+
+
+def to_seconds(timestamps):
+    """Convert epoch nanoseconds to float seconds since the epoch."""
+    return np.asarray(timestamps).astype('int64') / 1e9
+
+
+class RealClock(object):
+    """The system clock.
+
+    Methods
+    -------
+    now_ns
+    time
+    sleep(seconds)
+    get(q, timeout)
+    wait(event, timeout)
+    attach(thread)
+    wake(thread)
+
+    """
+
+    def now_ns(self):
+        """Return the current time in nanoseconds since the epoch."""
+        return now_ns()
+
+    def time(self):
+        """Return the current time in seconds since the epoch."""
+        return now_ns() / 1e9
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def get(self, q, timeout):
+        """Return the next item of a queue, raising Empty on timeout."""
+        return q.get(timeout=timeout)
+
+    def wait(self, event, timeout):
+        """Wait for a threading.Event, returning whether it is set."""
+        return event.wait(timeout)
+
+    def attach(self, thread):
+        """Declare a thread that takes its time from this clock."""
+        pass
+
+    def wake(self, thread):
+        """End the current or next sleep of a thread, e.g. to stop it."""
+        pass
+
+
+class VirtualClock(RealClock):
+    """A discrete-event clock.
+
+    The time only moves on when advance or run_until is called. The clock
+    then jumps from one wake-up of the sleeping threads to the next, and
+    before each jump it waits until all the attached threads that are alive
+    are asleep again, so that the threads run in the same order as in real
+    time while the idle time between their steps costs nothing. Threads due
+    at the same time run one after the other, so a simulation is
+    deterministic.
+
+    Threads are attached when they sleep for the first time. Threads taking
+    their time from the clock should be attached when they are created,
+    so that the clock also waits for them before their first sleep. The
+    clock is advanced from a thread that is not attached, e.g. the main
+    thread of a test.
+
+    Parameters
+    ----------
+    start : int, optional
+        The start time in nanoseconds since the epoch, by default now.
+    settle : float, optional
+        The wall time, in seconds, the clock waits for the attached threads
+        to fall asleep before it gives up with a RuntimeError, e.g. because
+        one of them waits for something else than the clock.
+        DEFAULT: 10.0 s
+
+    Methods
+    -------
+    advance(seconds)
+    run_until(stop)
+
+    """
+
+    def __init__(self, start=None, settle=10.0):
+        super(VirtualClock, self).__init__()
+        self._now = now_ns() if start is None else int(start)
+        self.settle = settle
+        self._cond = Condition()
+        # The sleeping threads as [wake-up, sequence, thread, woken]
+        self._sleepers = []
+        self._asleep = {}
+        self._woken = set()
+        self._threads = []
+        self._seq = itertools.count()
+
+    def now_ns(self):
+        return self._now
+
+    def time(self):
+        return self._now / 1e9
+
+    def attach(self, thread):
+        with self._cond:
+            if thread not in self._threads:
+                self._threads.append(thread)
+
+    def sleep(self, seconds):
+        thread = current_thread()
+        with self._cond:
+            if thread not in self._threads:
+                self._threads.append(thread)
+            if thread in self._woken:
+                self._woken.discard(thread)
+                return
+            entry = [self._now + max(int(seconds * 1e9), 0),
+                     next(self._seq), thread, False]
+            heapq.heappush(self._sleepers, entry)
+            self._asleep[thread] = entry
+            self._cond.notify_all()
+            while not entry[3]:
+                self._cond.wait()
+
+    def get(self, q, timeout):
+        try:
+            return q.get_nowait()
+        except Empty:
+            self.sleep(timeout)
+        return q.get_nowait()
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            self.sleep(timeout)
+        return event.is_set()
+
+    def wake(self, thread):
+        with self._cond:
+            entry = self._asleep.pop(thread, None)
+            if entry is None:
+                self._woken.add(thread)
+                return
+            entry[3] = True
+            self._sleepers.remove(entry)
+            heapq.heapify(self._sleepers)
+            self._cond.notify_all()
+
+    def _settled(self):
+        self._threads = [t for t in self._threads
+                         if t.is_alive() or t.ident is None]
+        return all(t in self._asleep for t in self._threads
+                   if t.is_alive())
+
+    def _wait_settled(self):
+        deadline = time.monotonic() + self.settle
+        while not self._settled():
+            if time.monotonic() > deadline:
+                raise RuntimeError("The threads on the virtual clock did "
+                                   "not fall asleep within {} s".format(
+                                       self.settle))
+            # Threads that end do not notify, so wake up regularly
+            self._cond.wait(0.01)
+
+    def run_until(self, stop):
+        """Run the attached threads until the time 'stop' in nanoseconds.
+
+        """
+        with self._cond:
+            while True:
+                self._wait_settled()
+                if not self._sleepers or self._sleepers[0][0] > stop:
+                    break
+                # Threads due at the same time are woken one at a time, in
+                # the order in which they fell asleep
+                entry = heapq.heappop(self._sleepers)
+                self._now = max(self._now, entry[0])
+                entry[3] = True
+                del self._asleep[entry[2]]
+                self._cond.notify_all()
+            self._now = max(self._now, int(stop))
+
+    def advance(self, seconds):
+        """Run the attached threads for 'seconds' of virtual time."""
+        self.run_until(self._now + int(seconds * 1e9))
+
+
+_clock = RealClock()
+
+
+def get_clock():
+    """Return the clock used by threads that are not given one."""
+    return _clock
+
+
+def set_clock(clock):
+    """Set the clock used by threads that are not given one.
+
+    It is taken when a thread is created, so set it before creating them.
+
+    """
+    global _clock
+    _clock = clock
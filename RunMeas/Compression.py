@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Compression Module.
+
+This module contains the optional compression stage of the recording.
+
+The deadband filter drops rows in which no channel has changed by more than
+its resolution since the last stored row, while still storing a row at least
+every 'max_gap' seconds as a heartbeat. Reading the stored rows back with
+hold() gives the full series to within the resolutions.
+
+The packed format stores every channel of a device as a column of encoded
+chunks, one chunk per recorded batch, in the group packed/<device> of the
+recording. Floats are XORed with their predecessor, so that slowly changing
+readings turn into mostly zero bits, and timestamps are stored as the
+differences of their differences; both are then deflated. This is lossless
+and read_packed returns exactly the recorded rows.
+
+"""
+
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Clock import to_seconds
+
+_UINTS = {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}
+
+
+def xor_encode(values):
+    """Encode an array losslessly by XORing each value with its predecessor.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        A one dimensional array of any numeric or boolean dtype.
+
+    Returns
+    -------
+    encoded : bytes
+
+    """
+    values = np.ascontiguousarray(values)
+    bits = values.view(_UINTS[values.dtype.itemsize])
+    xored = bits.copy()
+    xored[1:] ^= bits[:-1]
+    return zlib.compress(xored.tobytes(), 6, wbits=-15)
+
+
+def xor_decode(encoded, dtype):
+    """Decode the output of xor_encode.
+
+    Parameters
+    ----------
+    encoded : bytes
+    dtype : numpy.dtype
+        The dtype of the encoded values.
+
+    Returns
+    -------
+    values : numpy.ndarray
+
+    """
+    dtype = np.dtype(dtype)
+    xored = np.frombuffer(zlib.decompress(encoded, wbits=-15),
+                          dtype=_UINTS[dtype.itemsize])
+    # A running XOR undoes the encoding
+    bits = np.bitwise_xor.accumulate(xored)
+    return bits.view(dtype)
+
+
+def delta_encode(timestamps):
+    """Encode int64 timestamps as deflated differences of differences."""
+    ts = np.ascontiguousarray(timestamps, dtype='int64')
+    dod = np.diff(ts, n=1, prepend=0)
+    dod[1:] = np.diff(dod)
+    return zlib.compress(dod.tobytes(), 6, wbits=-15)
+
+
+def delta_decode(encoded):
+    """Decode the output of delta_encode."""
+    dod = np.frombuffer(zlib.decompress(encoded, wbits=-15), dtype='int64')
+    return np.cumsum(np.cumsum(dod))
+
+
+class DeadbandFilter(object):
+    """Drop rows that do not change by more than the sensor resolution.
+
+    Parameters
+    ----------
+    resolutions : dict
+        The resolution of each channel, e.g. {'THe3': 1e-3}. A row is kept if
+        any channel differs from its last stored value by more than its
+        resolution. Channels that are not listed are kept on any change.
+    max_gap : float, optional
+        The longest time, in seconds, between two stored rows.
+        DEFAULT: 60 s
+
+    Methods
+    -------
+    filter(rows)
+    reset
+
+    """
+
+    def __init__(self, resolutions, max_gap=60.0):
+        super(DeadbandFilter, self).__init__()
+        assert type(resolutions) is dict, ('The resolutions need to be a dict '
+                                           'of channel names and values')
+        self.resolutions = resolutions
+        self.max_gap = max_gap
+        self.reset()
+
+    def reset(self):
+        self._last = None
+        self._last_t = None
+
+    def filter(self, rows):
+        """Return the rows of a batch that need to be stored.
+
+        Parameters
+        ----------
+        rows : dict
+            The rows of a batch, one array per channel and 'timestamp'.
+
+        Returns
+        -------
+        rows : dict
+            The rows to store.
+
+        """
+        names = [k for k in rows if k != 'timestamp']
+        n = len(rows['timestamp'])
+        if not n:
+            return rows
+        values = np.column_stack([np.asarray(rows[k], dtype=float)
+                                  for k in names])
+        res = np.array([self.resolutions.get(k, 0.0) for k in names])
+        times = to_seconds(rows['timestamp'])
+        keep = np.zeros(n, dtype=bool)
+        last = self._last
+        last_t = self._last_t
+        for i in range(n):
+            if last is None or times[i] - last_t >= self.max_gap or \
+                    np.any(np.abs(values[i] - last) > res) or \
+                    np.any(np.isnan(values[i]) != np.isnan(last)):
+                keep[i] = True
+                last = values[i]
+                last_t = times[i]
+        self._last = last
+        self._last_t = last_t
+        return dict((k, np.asarray(v)[keep]) for k, v in rows.items())
+
+
+def hold(df, timestamps):
+    """Reconstruct deadband filtered data at the given timestamps.
+
+    Every timestamp gets the values of the last stored row at or before it.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The stored rows, indexed by timestamp.
+    timestamps : array_like
+        The timestamps at which to reconstruct the data.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    return df.reindex(pd.Index(timestamps), method='ffill')
+
+
+def _group_path(dev_name):
+    return '/packed/' + dev_name
+
+
+def packed_group(store, dev_name=None):
+    """Return the group of a device in the packed format.
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        The open recording.
+    dev_name : str, optional
+        The name of the device. If None, the group holding the groups of all
+        packed devices is returned.
+
+    Returns
+    -------
+    group : tables.Group
+        The group, or None if the recording has none.
+
+    """
+    return store.get_node('/packed' if dev_name is None
+                          else _group_path(dev_name))
+
+
+def packed_rows(store, dev_name):
+    """Return the number of rows of a device in the packed format."""
+    group = packed_group(store, dev_name)
+    if group is None:
+        return 0
+    return int(group.chunks[:, 0].sum())
+
+
+def append_packed(store, dev_name, rows):
+    """Append a batch of rows of a device to the packed format.
+
+    The encoded bytes of the timestamps and of every channel are appended to
+    one byte array each. The array 'chunks' holds one line per batch with
+    its number of rows followed by the number of bytes of every column.
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        The open recording.
+    dev_name : str
+        The name of the device.
+    rows : dict
+        One array per channel and 'timestamp'.
+
+    """
+    import tables
+    names = [k for k in rows if k != 'timestamp']
+    group = packed_group(store, dev_name)
+    if group is None:
+        h5 = store.get_node('/')._v_file
+        group = h5.create_group('/packed', dev_name, createparents=True)
+        group._v_attrs.channels = [(k, np.asarray(rows[k]).dtype.str)
+                                   for k in names]
+        h5.create_earray(group, 'chunks', tables.Int64Atom(),
+                         (0, len(names) + 2))
+        for i in range(len(names) + 1):
+            h5.create_earray(group, 'c{}'.format(i), tables.UInt8Atom(),
+                             (0,))
+    channels = group._v_attrs.channels
+    if [k for (k, dt) in channels] != names:
+        # The chunks have one column per channel, so a changed channel set,
+        # e.g. a derived channel added while recording, rewrites the device
+        # as a single chunk
+        old = _read_group(group)
+        group._f_remove(recursive=True)
+        append_packed(store, dev_name, merge_rows(old, rows))
+        return
+    encoded = [delta_encode(rows['timestamp'])]
+    for (chan_name, dtype) in channels:
+        vals = np.asarray(rows[chan_name]).astype(dtype, copy=False)
+        encoded.append(xor_encode(vals))
+    for i, buf in enumerate(encoded):
+        getattr(group, 'c{}'.format(i)).append(
+            np.frombuffer(buf, dtype=np.uint8))
+    group.chunks.append([[len(rows['timestamp'])] +
+                         [len(buf) for buf in encoded]])
+
+
+def _read_group(group):
+    """Decode all chunks of a packed group into one array per column."""
+    channels = group._v_attrs.channels
+    chunks = group.chunks.read()
+    columns = [('timestamp', None)] + list(channels)
+    data = {}
+    for i, (chan_name, dtype) in enumerate(columns):
+        buf = getattr(group, 'c{}'.format(i)).read().tobytes()
+        stops = np.cumsum(chunks[:, i + 1])
+        parts = []
+        for (start, stop) in zip(stops - chunks[:, i + 1], stops):
+            if dtype is None:
+                parts.append(delta_decode(buf[start:stop]))
+            else:
+                parts.append(xor_decode(buf[start:stop], dtype))
+        if not parts:
+            parts = [np.array([], dtype=dtype or 'int64')]
+        data[chan_name] = np.concatenate(parts)
+    return data
+
+
+def iter_packed(file_name, dev_name):
+    """Read a device from the packed format one recorded chunk at a time.
+
+    Only the bytes of the chunk being decoded are read from the file, so
+    that the memory used does not depend on the length of the recording.
+
+    Yields
+    ------
+    pandas.DataFrame
+        The rows of one chunk indexed by timestamp, in recorded order.
+
+    """
+    with pd.HDFStore(file_name, mode='r') as store:
+        group = packed_group(store, dev_name)
+        columns = [('timestamp', None)] + list(group._v_attrs.channels)
+        chunks = group.chunks.read()
+        stops = np.cumsum(chunks[:, 1:], axis=0)
+        starts = stops - chunks[:, 1:]
+        for k in range(len(chunks)):
+            data = {}
+            for i, (chan_name, dtype) in enumerate(columns):
+                buf = getattr(group, 'c{}'.format(i))[
+                    starts[k, i]:stops[k, i]].tobytes()
+                if dtype is None:
+                    data[chan_name] = delta_decode(buf)
+                else:
+                    data[chan_name] = xor_decode(buf, dtype)
+            yield pd.DataFrame(data=data).set_index('timestamp')
+
+
+def read_packed(file_name, dev_name):
+    """Read a device from the packed format of a recording.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The rows indexed by timestamp, exactly as they were recorded.
+
+    """
+    with pd.HDFStore(file_name, mode='r') as store:
+        data = _read_group(packed_group(store, dev_name))
+    return pd.DataFrame(data=data).set_index('timestamp')
+
+
+def merge_rows(old, new):
+    """Concatenate two batches of rows whose channels differ.
+
+    A channel missing from one of the batches is NaN in its rows, the
+    channels of 'old' come first.
+
+    Parameters
+    ----------
+    old, new : dict
+        One array per channel and 'timestamp'.
+
+    Returns
+    -------
+    rows : dict
+
+    """
+    df = pd.concat([pd.DataFrame(data=old), pd.DataFrame(data=new)],
+                   ignore_index=True)
+    return dict((k, df[k].to_numpy()) for k in df.columns)
+
+
+def append_rows(store, dev_name, rows, packed=False):
+    """Append a batch of rows of a device to a recording.
+
+    The rows go to the table raw/<device>, or to the packed format. If the
+    channels differ from those already stored, e.g. because a derived
+    channel was added while recording, the stored rows are rewritten with
+    the new set of channels, NaN where a channel was missing.
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        The open recording.
+    dev_name : str
+        The name of the device.
+    rows : dict
+        One array per channel and 'timestamp'.
+    packed : bool, optional
+        Whether the recording is in the packed format.
+        DEFAULT: False
+
+    """
+    if packed:
+        append_packed(store, dev_name, rows)
+        return
+    append_table(store, 'raw/' + dev_name,
+                 pd.DataFrame(data=rows).set_index('timestamp'))
+
+
+def append_table(store, key, df, fill=None):
+    """Append a frame to a table, rewriting the table if the columns differ.
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        The open recording.
+    key : str
+        The key of the table.
+    df : pandas.DataFrame
+        The rows to append.
+    fill : dict, optional
+        The value of a column in the stored rows that lack it, NaN for the
+        columns that are not listed.
+
+    """
+    try:
+        store.append(key, df, format='table')
+    except ValueError:
+        # pytables can not append to a table with other columns
+        old = store.select(key)
+        if set(old.columns) == set(df.columns):
+            raise
+        merged = pd.concat([old, df])
+        if fill:
+            merged = merged.fillna(dict((k, v) for k, v in fill.items()
+                                        if k in merged))
+        # Keep the dtypes of the new rows, so that the next append matches
+        for col in df.columns:
+            if merged[col].dtype != df[col].dtype and \
+                    not merged[col].isna().any():
+                merged[col] = merged[col].astype(df[col].dtype)
+        store.put(key, merged, format='table')
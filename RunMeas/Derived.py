@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Derived Channels Module.
+
+This module contains the channels that the buffer computes on-line from the
+raw channels of a device, e.g. the rate of change of a temperature or a
+smoothed capacitance.
+Each derived channel keeps only the little bit of history it needs, so that
+updating it with a newly committed batch costs O(batch) and not O(history).
+
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import lfilter
+
+from RunMeas.Clock import to_seconds
+
+
+def _windows(vals, window):
+    """Return a read-only view of all full windows of length 'window'."""
+    n = len(vals) - window + 1
+    stride = vals.strides[0]
+    return as_strided(vals, shape=(n, window), strides=(stride, stride))
+
+
+class DerivedChannel(object):
+    """The base class of all derived channels.
+
+    Parameters
+    ----------
+    name : str
+        The name under which the derived channel is stored in the buffer.
+    source : str
+        The name of the raw channel from which this channel is derived.
+
+    Attributes
+    ----------
+    name : str
+        The name under which the derived channel is stored in the buffer.
+    source : str
+        The name of the raw channel from which this channel is derived.
+
+    Methods
+    -------
+    update(batch)
+    reset
+
+    """
+
+    def __init__(self, name, source):
+        super(DerivedChannel, self).__init__()
+        self.name = name
+        self.source = source
+
+    def update(self, batch):
+        """Compute the derived values for a newly committed batch.
+
+        Parameters
+        ----------
+        batch : dict
+            The committed batch with a 'timestamp' array and one array per
+            channel, all of the same length.
+
+        Returns
+        -------
+        values : numpy.ndarray
+            The derived values, one per row of the batch.
+
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        """Forget all history, e.g. after the buffer has been cleared."""
+        pass
+
+
+class RollingMean(DerivedChannel):
+    """The moving average over the last 'window' samples of a channel.
+
+    Until 'window' samples have arrived, the average of all samples so far is
+    returned.
+
+    """
+
+    def __init__(self, name, source, window):
+        super(RollingMean, self).__init__(name, source)
+        assert type(window) is int and window > 0, ('The window needs to be a '
+                                                    'positive int')
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self._tail = np.array([])
+
+    def update(self, batch):
+        x = np.asarray(batch[self.source], dtype=float)
+        vals = np.concatenate((self._tail, x))
+        csum = np.concatenate(([0.0], np.cumsum(vals)))
+        stop = np.arange(len(self._tail), len(vals)) + 1
+        start = np.maximum(stop - self.window, 0)
+        self._tail = vals[-(self.window - 1):] if self.window > 1 else vals[:0]
+        return (csum[stop] - csum[start]) / (stop - start)
+
+
+class RollingMedian(DerivedChannel):
+    """The moving median over the last 'window' samples of a channel.
+
+    Until 'window' samples have arrived, the median of all samples so far is
+    returned.
+
+    """
+
+    def __init__(self, name, source, window):
+        super(RollingMedian, self).__init__(name, source)
+        assert type(window) is int and window > 0, ('The window needs to be a '
+                                                    'positive int')
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self._tail = np.array([])
+
+    def update(self, batch):
+        x = np.asarray(batch[self.source], dtype=float)
+        vals = np.concatenate((self._tail, x))
+        n_tail = len(self._tail)
+        out = np.empty(len(x))
+        # The first few samples of a run do not fill a whole window yet
+        n_short = min(max(self.window - 1 - n_tail, 0), len(x))
+        for i in range(n_short):
+            out[i] = np.median(vals[:n_tail + i + 1])
+        if len(vals) >= self.window and n_short < len(x):
+            win = _windows(vals, self.window)
+            out[n_short:] = np.median(win[n_tail + n_short -
+                                          (self.window - 1):], axis=1)
+        self._tail = vals[-(self.window - 1):] if self.window > 1 else vals[:0]
+        return out
+
+
+class ExponentialSmoothing(DerivedChannel):
+    """Exponential smoothing of a channel.
+
+    y[i] = alpha * x[i] + (1 - alpha) * y[i-1], starting from y[0] = x[0].
+
+    """
+
+    def __init__(self, name, source, alpha):
+        super(ExponentialSmoothing, self).__init__(name, source)
+        assert 0 < alpha <= 1, 'The smoothing factor needs to be in (0, 1]'
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self._last = None
+
+    def update(self, batch):
+        x = np.asarray(batch[self.source], dtype=float)
+        if not len(x):
+            return x
+        last = x[0] if self._last is None else self._last
+        zi = [(1 - self.alpha) * last]
+        y, _ = lfilter([self.alpha], [1, self.alpha - 1], x, zi=zi)
+        self._last = y[-1]
+        return y
+
+
+class Rate(DerivedChannel):
+    """The finite-difference rate of change of a channel per second.
+
+    The very first sample of a run has no predecessor and gets NaN.
+
+    """
+
+    def __init__(self, name, source):
+        super(Rate, self).__init__(name, source)
+        self.reset()
+
+    def reset(self):
+        self._last_t = np.array([])
+        self._last_x = np.array([])
+
+    def update(self, batch):
+        x = np.asarray(batch[self.source], dtype=float)
+        t = to_seconds(batch['timestamp'])
+        if not len(x):
+            return x
+        xs = np.concatenate((self._last_x, x))
+        ts = np.concatenate((self._last_t, t))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.diff(xs) / np.diff(ts)
+        if not len(self._last_x):
+            rate = np.concatenate(([np.nan], rate))
+        self._last_t = t[-1:]
+        self._last_x = x[-1:]
+        return rate
+
+
+class Expression(DerivedChannel):
+    """A user defined NumPy expression over the channels of a device.
+
+    Parameters
+    ----------
+    name : str
+        The name under which the derived channel is stored in the buffer.
+    expression : str or callable
+        Either a string that is evaluated with the channels of the batch and
+        'np' in its namespace, e.g. "THe3 - T1K", or a callable taking the
+        batch dictionary. Either way it must return one value per row.
+
+    """
+
+    def __init__(self, name, expression):
+        super(Expression, self).__init__(name, None)
+        if isinstance(expression, str):
+            self._code = compile(expression, '<{}>'.format(name), 'eval')
+        elif callable(expression):
+            self._code = None
+        else:
+            raise TypeError("The expression needs to be a string or a "
+                            "callable.")
+        self.expression = expression
+
+    def update(self, batch):
+        if self._code is None:
+            vals = self.expression(batch)
+        else:
+            vals = eval(self._code, {'np': np, '__builtins__': {}},
+                        dict(batch))
+        vals = np.asarray(vals, dtype=float)
+        if vals.ndim == 0:
+            vals = np.repeat(vals, len(batch['timestamp']))
+        return vals
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Export Module.
+
+This module converts recordings to CSV or Parquet files, one file per run
+and device, e.g.
+
+    python -m RunMeas.Export exported temp_data/*.h5 --format csv \\
+        --channels THe3,T1K --start 2016-03-01T12:00 --resample 1s
+
+Many runs are converted concurrently by a pool of processes, and every run
+is streamed in chunks, so that the memory used does not depend on the
+length of a run. Parquet needs pyarrow. The times are written in UTC with
+their offset, while --start and --stop are taken as local times unless they
+have an offset themselves.
+
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+from datetime import datetime
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Clock import from_datetime, to_datetime64
+from RunMeas.Compression import iter_packed, packed_group
+from RunMeas.Manifest import MANIFEST_SUFFIX, SegmentedRun
+from RunMeas.Pyramid import where_range
+
+FORMATS = ('csv', 'parquet')
+
+
+def _run_base(path):
+    return re.sub(r'({}|\.h5)$'.format(re.escape(MANIFEST_SUFFIX)), '',
+                  os.path.basename(path))
+
+
+def recording_files(path):
+    """Return the files of a recording and the devices recorded in them."""
+    if path.endswith(MANIFEST_SUFFIX):
+        files = SegmentedRun(path).touching()
+    else:
+        files = [path]
+    devices = set()
+    for file_name in files:
+        if not os.path.exists(file_name):
+            continue
+        with pd.HDFStore(file_name, mode='r') as store:
+            for key in store.keys():
+                parts = key.strip('/').split('/')
+                if parts[0] == 'raw':
+                    devices.add(parts[1])
+            group = packed_group(store)
+            if group is not None:
+                devices.update(group._v_children)
+    return [f for f in files if os.path.exists(f)], sorted(devices)
+
+
+def iter_chunks(files, dev_name, channels=None, start=None, stop=None,
+                chunksize=100000):
+    """Yield the rows of a device from the files of a recording in chunks.
+
+    Parameters
+    ----------
+    files : list
+        The files of the recording in time order.
+    dev_name : str
+        The name of the device.
+    channels : list, optional
+        The channels to read, by default all.
+    start, stop : int, optional
+        The time range in nanoseconds since the epoch.
+    chunksize : int, optional
+        The number of rows per chunk.
+        DEFAULT: 100000
+
+    Yields
+    ------
+    pandas.DataFrame
+
+    """
+    where = where_range(start, stop)
+    for file_name in files:
+        with pd.HDFStore(file_name, mode='r') as store:
+            key = 'raw/' + dev_name
+            if key in store:
+                for chunk in store.select(key, where=where, columns=channels,
+                                          iterator=True, chunksize=chunksize):
+                    if len(chunk):
+                        yield chunk
+                continue
+            packed = packed_group(store, dev_name) is not None
+        if not packed:
+            continue
+        # The packed format is decoded one recorded chunk at a time
+        for df in iter_packed(file_name, dev_name):
+            ts = df.index.values
+            if stop is not None and len(ts) and ts[0] >= stop:
+                break
+            keep = np.ones(len(df), dtype=bool)
+            if start is not None:
+                keep &= ts >= start
+            if stop is not None:
+                keep &= ts < stop
+            df = df[keep]
+            if channels is not None:
+                df = df[channels]
+            for i in range(0, len(df), chunksize):
+                yield df.iloc[i:i + chunksize]
+
+
+def resample_chunks(chunks, width):
+    """Average streamed chunks in bins of 'width' nanoseconds.
+
+    The last bin of a chunk may continue in the next chunk, so its rows are
+    held back until the next chunk arrives.
+
+    """
+    held = None
+    for chunk in chunks:
+        if held is not None:
+            chunk = pd.concat((held, chunk))
+        bins = chunk.index.values // width
+        last = bins[-1]
+        held = chunk[bins == last]
+        done = chunk[bins != last]
+        if len(done):
+            yield done.groupby(bins[bins != last] * width).mean()
+    if held is not None and len(held):
+        yield held.groupby(held.index.values // width * width).mean()
+
+
+class _Writer(object):
+    """Append chunks to a CSV or Parquet file."""
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self._parquet = None
+        self._first = True
+
+    def write(self, df):
+        df = df.copy()
+        times = to_datetime64(df.index.values)
+        # The times are marked as UTC, so that they are unambiguous
+        if self.fmt == 'csv':
+            # In one fixed format, e.g. 2016-03-01T11:00:00.100000000Z
+            df.index = pd.Index(np.datetime_as_string(times, unit='ns',
+                                                      timezone='UTC'),
+                                name='time')
+            df.to_csv(self.path, mode='w' if self._first else 'a',
+                      header=self._first)
+        else:
+            df.index = pd.DatetimeIndex(times, name='time').tz_localize('UTC')
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.Table.from_pandas(df)
+            if self._parquet is None:
+                self._parquet = pyarrow.parquet.ParquetWriter(self.path,
+                                                              table.schema)
+            self._parquet.write_table(table)
+        self._first = False
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+
+
+def export_run(path, out_folder, fmt='csv', devices=None, channels=None,
+               start=None, stop=None, resample=None, chunksize=100000):
+    """Export a recording, one file per device.
+
+    Parameters
+    ----------
+    path : str
+        The path of the recording, or of the manifest of a segmented one.
+    out_folder : str
+        The folder the files are written to, as <run>_<device>.<fmt>.
+    fmt : str, optional
+        'csv' or 'parquet'.
+        DEFAULT: 'csv'
+    devices : list, optional
+        The devices to export, by default all.
+    channels : list, optional
+        The channels to export. Devices without any of them are skipped.
+    start, stop : int, optional
+        The time range in nanoseconds since the epoch.
+    resample : str, optional
+        Average in bins of this width, e.g. '1s' or '10min'.
+    chunksize : int, optional
+        The number of rows read at a time.
+        DEFAULT: 100000
+
+    Returns
+    -------
+    stats : dict
+        The 'path', the 'outputs', and the 'bytes_in' and 'bytes_out'.
+
+    """
+    if fmt not in FORMATS:
+        raise ValueError("The format needs to be one of "
+                         "{}".format(', '.join(FORMATS)))
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ImportError("Exporting to Parquet needs pyarrow")
+    width = pd.Timedelta(resample).value if resample else None
+    (files, all_devices) = recording_files(path)
+    outputs = []
+    for dev_name in all_devices:
+        if devices is not None and dev_name not in devices:
+            continue
+        dev_channels = channels
+        if channels is not None:
+            recorded = [c for (c, dtype) in recorded_channels(files,
+                                                              dev_name)]
+            dev_channels = [c for c in channels if c in recorded]
+            if not dev_channels:
+                continue
+        out = os.path.join(out_folder, '{}_{}.{}'.format(
+            _run_base(path), re.sub(r'\W', '_', dev_name), fmt))
+        chunks = iter_chunks(files, dev_name, dev_channels, start, stop,
+                             chunksize)
+        if width:
+            chunks = resample_chunks(chunks, width)
+        writer = _Writer(out, fmt)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+        finally:
+            writer.close()
+        if os.path.exists(out):
+            outputs.append(out)
+    return {'path': path, 'outputs': outputs,
+            'bytes_in': sum(os.path.getsize(f) for f in files),
+            'bytes_out': sum(os.path.getsize(f) for f in outputs)}
+
+
+def recorded_channels(files, dev_name):
+    """Return the channels of a device in a recording.
+
+    Returns
+    -------
+    channels : list
+        A list of (name, numpy.dtype) tuples in the order they are stored.
+
+    """
+    for file_name in files:
+        with pd.HDFStore(file_name, mode='r') as store:
+            key = 'raw/' + dev_name
+            if key in store:
+                dtypes = store.select(key, stop=1).dtypes
+                return [(chan_name, np.dtype(dtype))
+                        for chan_name, dtype in dtypes.items()]
+            group = packed_group(store, dev_name)
+            if group is not None:
+                return [(chan_name, np.dtype(dtype)) for (chan_name, dtype)
+                        in group._v_attrs.channels]
+    return []
+
+
+def _export_one(args):
+    (path, out_folder, kwargs) = args
+    try:
+        return export_run(path, out_folder, **kwargs)
+    except Exception as e:
+        print("Could not export {}: {}".format(path, e))
+        return None
+
+
+def export_runs(paths, out_folder, processes=None, **kwargs):
+    """Export many recordings concurrently, see export_run.
+
+    Parameters
+    ----------
+    paths : list
+        The paths of the recordings.
+    out_folder : str
+        The folder the files are written to.
+    processes : int, optional
+        The number of processes, by default one per CPU.
+
+    Returns
+    -------
+    stats : dict
+        The number of 'runs' and 'files' written, the 'bytes_in' and
+        'bytes_out', the 'seconds' taken, and 'files_per_s' (written),
+        'runs_per_s' and 'mb_per_s' (of recorded data read).
+
+    """
+    if not os.path.isdir(out_folder):
+        os.makedirs(out_folder)
+    start = time.perf_counter()
+    results = []
+    with Pool(processes) as pool:
+        for result in pool.imap_unordered(
+                _export_one, [(p, out_folder, kwargs) for p in paths]):
+            if result is not None:
+                results.append(result)
+    seconds = time.perf_counter() - start
+    bytes_in = sum(r['bytes_in'] for r in results)
+    files = sum(len(r['outputs']) for r in results)
+    return {'runs': len(results),
+            'files': files,
+            'bytes_in': bytes_in,
+            'bytes_out': sum(r['bytes_out'] for r in results),
+            'seconds': seconds,
+            'files_per_s': files / seconds,
+            'runs_per_s': len(results) / seconds,
+            'mb_per_s': bytes_in / seconds / 1e6}
+
+
+def _parse_time(text):
+    if text is None:
+        return None
+    return from_datetime(datetime.fromisoformat(text))
+
+
+def _split(text):
+    return text.split(',') if text else None
+
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        prog='python -m RunMeas.Export',
+        description='Export recordings to CSV or Parquet.')
+    parser.add_argument('out_folder')
+    parser.add_argument('paths', nargs='+',
+                        help='recordings or manifests of segmented ones')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--devices', help='comma separated device names')
+    parser.add_argument('--channels', help='comma separated channel names')
+    parser.add_argument('--start', help='ISO date and time, local time '
+                        'unless it has a UTC offset')
+    parser.add_argument('--stop', help='ISO date and time, local time '
+                        'unless it has a UTC offset')
+    parser.add_argument('--resample', help="bin width, e.g. '1s' or '1min'")
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args(argv[1:])
+
+    stats = export_runs(args.paths, args.out_folder,
+                        processes=args.processes, fmt=args.format,
+                        devices=_split(args.devices),
+                        channels=_split(args.channels),
+                        start=_parse_time(args.start),
+                        stop=_parse_time(args.stop),
+                        resample=args.resample, chunksize=args.chunksize)
+    print("Exported {runs} runs to {files} files in {seconds:.1f} s: "
+          "{files_per_s:.1f} files/s, {runs_per_s:.1f} runs/s, "
+          "{mb_per_s:.1f} MB/s".format(**stats))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,10 +16,21 @@ import os
 import visa
 import time
 from datetime import datetime
-from threading import Thread
-from queue import Queue
+from threading import Thread, RLock
+
+from RunMeas.Cache import QueryCache
+from RunMeas.Clock import get_clock
+from RunMeas.Polling import DELAY_CHANNEL
+from RunMeas.Recovery import GapRecorder, recover
+from RunMeas.Samples import SampleWriter, SampleQueue, channel_names
 
 SENSORS = {"1": "TSorp", "2": "THe3", "3": "T1K"}
+CHANNEL_COMMANDS = {"TSorp": "R1", "THe3": "R2", "T1K": "R3"}
+# The freshness windows, in seconds, of the readings and status queries for
+# RunMeas.Cache.QueryCache. The temperatures are shorter than any polling
+# delay, the settings only change through this driver.
+FRESHNESS = {"R0": 1.0, "R1": 0.1, "R2": 0.1, "R3": 0.1, "R5": 0.5,
+             "X": 0.5, "XH": 0.5, "XA": 0.5, "XL": 0.5}
 
 
 class ITCDevice(object):
@@ -37,6 +48,9 @@ class ITCDevice(object):
     read_term : str, optional
         The reading terminatin character of the device
         DEFUALT: "\r"
+    policy : RunMeas.Recovery.RetryPolicy, optional
+        If given, the timeout of the queries and how failed queries are
+        retried. Otherwise a failed query raises at once.
 
     Attributes
     ----------
@@ -56,9 +70,18 @@ class ITCDevice(object):
         Whether the auto PID option is turned on. This uses pre-programmed PID
         tables stored in the device.
 
+    cache : RunMeas.Cache.QueryCache
+        The cache the queries go through, if one was set.
+    open_resource : method
+        The method that opened the resource, kept to re-open it.
+
     Methods
     -------
     set_resource(resource=, resource_address)
+    set_cache(cache)
+    reopen
+    read_float(command)
+    read_float_with_age(command)
     get_tsorp
     get_the3
     get_t1k
@@ -78,7 +101,7 @@ class ITCDevice(object):
     """
 
     def __init__(self, address, read_term="\r",
-                 write_term="\r"):
+                 write_term="\r", policy=None):
         super(ITCDevice, self).__init__()
         self.resource = None
         self.address = address
@@ -87,6 +110,10 @@ class ITCDevice(object):
         self.heater_set = False
         self.auto_heat = False
         self.auto_pid = False
+        self.lock = RLock()
+        self.cache = None
+        self.policy = policy
+        self.open_resource = None
 
     def set_resource(self, resource):
         """Set the VISA resource for the device.
@@ -101,9 +128,105 @@ class ITCDevice(object):
             the subsequent address attribute of the class as a parameter.
 
         """
+        self.open_resource = resource
         self.resource = resource(self.address,
                                  read_termination=self.read_term,
                                  write_termination=self.write_term)
+        if self.policy is not None:
+            # pyvisa takes the timeout in milliseconds
+            self.resource.timeout = self.policy.timeout * 1000
+
+    def reopen(self):
+        """Close the resource and open it again, e.g. after a bus error."""
+        with self.lock:
+            try:
+                self.resource.close()
+            except Exception as e:
+                print('Closing {} failed: {}'.format(self.address, e))
+            self.set_resource(self.open_resource)
+
+    def set_cache(self, cache=None):
+        """Let the queries go through a read-through cache.
+
+        The measurement thread, the GUI and scripts then share the readings
+        of the device instead of each querying the bus.
+
+        Parameters
+        ----------
+        cache : RunMeas.Cache.QueryCache, optional
+            The cache, by default one with the windows of FRESHNESS.
+
+        """
+        self.cache = cache if cache is not None else QueryCache(FRESHNESS)
+
+    def _query(self, command):
+        """Query the device, through the cache if one is set."""
+        if self.cache is not None:
+            return self.cache.query(command, self._bus_query)
+        return self._bus_query(command)
+
+    def _bus_query(self, command):
+        """Query the device, retried under the policy if one is set."""
+        if self.policy is None:
+            return self._locked_query(command)
+        return recover(lambda: self._checked_query(command), self.policy,
+                       self.reopen, '{} {}'.format(self.address, command))
+
+    def _locked_query(self, command):
+        """Query the device, serialising access from several threads.
+
+        The measurement thread polls the device while scripts and the GUI
+        change its settings, so every query holds the device lock.
+
+        """
+        with self.lock:
+            return self.resource.query(command)
+
+    def _checked_query(self, command):
+        """Query the device and raise ValueError on a garbled reading."""
+        reply = self._locked_query(command)
+        if command.startswith("R"):
+            float(reply.lstrip("R"))
+        return reply
+
+    def read_float(self, command):
+        """Query a reading, e.g. "R1", and return its value as a float.
+
+        Parameters
+        ----------
+        command : str
+            The read command, "R" followed by the parameter number.
+
+        Returns
+        -------
+        value : float
+            The value of the reading.
+
+        """
+        return float(self._query(command).lstrip("R"))
+
+    def read_float_with_age(self, command):
+        """Query a reading and return its value and how old it is.
+
+        A reading served from the cache was queried before this call, see
+        RunMeas.Cache.QueryCache.query_with_age.
+
+        Parameters
+        ----------
+        command : str
+            The read command, "R" followed by the parameter number.
+
+        Returns
+        -------
+        tuple : (float, float)
+            The value of the reading and its age in seconds, 0 if it was
+            queried by this call.
+
+        """
+        if self.cache is None:
+            return (self.read_float(command), 0.0)
+        (reply, age) = self.cache.query_with_age(command, self._bus_query)
+        return (float(reply.lstrip("R")), age)
 
     def get_tsorp(self):
         """Get the temperature at the sorption pump.
@@ -115,8 +238,7 @@ class ITCDevice(object):
             Kelvin
 
         """
-        tsorp_str = self.resource.query("R1")
-        tsorp_flt = float(tsorp_str.lstrip("R"))
+        tsorp_flt = self.read_float("R1")
         return ('TSorp', tsorp_flt)
 
     def get_the3(self):
@@ -129,8 +251,7 @@ class ITCDevice(object):
             Kelvin.
 
         """
-        the3_str = self.resource.query("R2")
-        the3_flt = float(the3_str.lstrip("R"))
+        the3_flt = self.read_float("R2")
         return ('THe3', the3_flt)
 
     def get_t1k(self):
@@ -142,8 +263,7 @@ class ITCDevice(object):
             A tuple with the name of the value ('T1K') and the value in Kelvin.
 
         """
-        t1k_str = self.resource.query("R3")
-        t1k_flt = float(t1k_str.lstrip("R"))
+        t1k_flt = self.read_float("R3")
         return ('T1K', t1k_flt)
 
     def _set_heater_to_tsrop(self):
@@ -153,7 +273,7 @@ class ITCDevice(object):
         helium-3 sorption pump sensor.
 
         """
-        self.resource.query("H1")
+        self._query("H1")
         self.heater_set = True
 
     def get_heater_sensor(self):
@@ -166,9 +286,9 @@ class ITCDevice(object):
             control.
 
         """
-        status_byte = self.resource.query("X")
+        status_byte = self._query("X")
         if status_byte == 'ERROR':
-            status_byte = self.resource.query("XH")
+            status_byte = self._query("XH")
         sensor_nr = status_byte.split("H")[-1][0]
         return SENSORS[sensor_nr]
 
@@ -186,7 +306,7 @@ class ITCDevice(object):
                             "or an int.")
         if not self.heater_set:
             self._set_heater_to_tsrop()
-        self.resource.query("T{:.3f}".format(setpoint))
+        self._query("T{:.3f}".format(setpoint))
 
     def get_setpoint(self):
         """Get the setpoint of the sorption pump heater.
@@ -198,18 +318,18 @@ class ITCDevice(object):
             the value in Kelvin
 
         """
-        setpoint_str = self.resource.query("R0")
+        setpoint_str = self._query("R0")
         setpoint_flt = float(setpoint_str.lstrip("R"))
         return ('Setpoint', setpoint_flt)
 
     def auto_heat_on(self):
         "Turn on the auto heat control."
-        self.resource.query("A1")
+        self._query("A1")
         self.auto_heat = True
 
     def auto_heat_off(self):
         "Turn on the auto heat control."
-        self.resource.query("A0")
+        self._query("A0")
         self.auto_heat = False
 
     def get_auto_heat_status(self):
@@ -222,9 +342,9 @@ class ITCDevice(object):
             second is either 'On' for automatic control on or 'Off'.
 
         """
-        sensor_nr = self.resource.query("X")
+        sensor_nr = self._query("X")
         if sensor_nr == 'ERROR':
-            sensor_nr = self.resource.query("XA")
+            sensor_nr = self._query("XA")
 
         sensor_nr = sensor_nr.split("A")[-1][0]
 
@@ -235,12 +355,12 @@ class ITCDevice(object):
 
     def auto_pid_on(self):
         "Turn on the auto pid for temperature control"
-        self.resource.query("L1")
+        self._query("L1")
         self.auto_pid = True
 
     def auto_pid_off(self):
         "Turn off the auto pid for temperature control"
-        self.resource.query("L0")
+        self._query("L0")
         self.auto_pid = False
 
     def get_auto_pid_status(self):
@@ -253,9 +373,9 @@ class ITCDevice(object):
             second is either 'On' for automatic control on or 'Off'.
 
         """
-        status_byte = self.resource.query("X")
+        status_byte = self._query("X")
         if status_byte == 'ERROR':
-            status_byte = self.resource.query("XL")
+            status_byte = self._query("XL")
 
         sensor_nr = status_byte.split("L")[-1][0]
 
@@ -276,7 +396,7 @@ class ITCDevice(object):
         if not isinstance(output, (float, int)):
             raise TypeError("The output provided needs to be a float "
                             "or an int.")
-        self.resource.query("O{:.1f}".format(output))
+        self._query("O{:.1f}".format(output))
 
     def get_heater_output(self):
         """Get the current heater output
@@ -288,7 +408,7 @@ class ITCDevice(object):
             value returned is a float representing the heater output in %.
 
         """
-        heater_output_str = self.resource.query("R5")
+        heater_output_str = self._query("R5")
         heater_output_flt = float(heater_output_str.lstrip("R"))
         return ('HeaterOutput', heater_output_flt)
 
@@ -328,10 +448,32 @@ class ITCMeasurementThread(Thread):
         A list of strings giving name to the channels that will be queried.
         This is necessary so that the collection buffer can setup its data
         before collection starts.
+        A channel may also be given as a (name, dtype) tuple, e.g.
+        ('THe3', 'f4'), to store it with less precision than float64.
         The order does not matter.
     delay : float, optional
         The delay, in seconds, between queries to the device.
         DEFAULT: 0.2 s
+    block_size : int, optional
+        The number of samples handed to the queue at once, see
+        RunMeas.Samples.SampleWriter.
+        DEFAULT: 64
+    maxsize : int, optional
+        The maximum number of blocks in the queue, unbounded if 0. The
+        default holds about half an hour of samples at 0.1 s per sample.
+        DEFAULT: 256
+    overflow : str, optional
+        What to do when the queue is full, one of 'block', 'drop_oldest',
+        'drop_newest' or 'decimate', see RunMeas.Samples.SampleQueue.
+        DEFAULT: 'block'
+    rate_controller : RunMeas.Polling.RateController, optional
+        If given, it decides the delay before each next query instead of the
+        fixed 'delay'. Its decisions are recorded in the extra channel
+        'PollDelay', which is added to chan_list.
+    clock : RunMeas.Clock.RealClock, optional
+        The clock giving the delays and the timestamps, by default
+        RunMeas.Clock.get_clock(). With a RunMeas.Clock.VirtualClock the
+        device is queried on the simulated schedule.
 
     Attributes
     ----------
@@ -339,7 +481,7 @@ class ITCMeasurementThread(Thread):
         The stop flag. When true the thread loop will end.
     device : ITCDevice
         The instance of the device that shall be queried for data.
-    q : queue.Queue
+    q : RunMeas.Samples.SampleQueue
         The communications queue into which the queried data is insered for
         other process to access.
     delay : float
@@ -349,15 +491,26 @@ class ITCMeasurementThread(Thread):
         This is necessary so that the collection buffer can setup its data
         before collection starts.
         The order does not matter.
+    writer : RunMeas.Samples.SampleWriter
+        The writer filling in the sample blocks that are put on the queue.
+    gaps : RunMeas.Recovery.GapRecorder
+        The spans without samples. A sample whose query fails is written
+        as a row of NaN and the thread carries on.
+    next_delay : float
+        The delay before the next sample, 'delay' unless a rate controller
+        changes it.
 
     Methods
     -------
     run
+    sample
     stop_thread
 
     """
 
-    def __init__(self, device, chan_list, delay=0.2):
+    def __init__(self, device, chan_list, delay=0.2, block_size=64,
+                 maxsize=256, overflow='block', rate_controller=None,
+                 clock=None):
         super(ITCMeasurementThread, self).__init__()
         assert type(chan_list) is list, ('The chan_list parameter needs to be '
                                          'a list of strings naming the '
@@ -366,9 +519,23 @@ class ITCMeasurementThread(Thread):
                                       'thread needs to be a float')
         self.stop = False
         self.device = device
-        self.q = Queue()
+        self.q = SampleQueue(maxsize, overflow)
         self.delay = delay
         self.chan_list = chan_list
+        names = channel_names(chan_list)
+        for chan_name in names:
+            if chan_name not in CHANNEL_COMMANDS:
+                raise ValueError("Unknown ITC channel {}".format(chan_name))
+        self.commands = [CHANNEL_COMMANDS[c] for c in names]
+        self.rate_controller = rate_controller
+        if rate_controller is not None:
+            self.chan_list = chan_list + [(DELAY_CHANNEL, 'f4')]
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.attach(self)
+        self.writer = SampleWriter(self.q, self.chan_list,
+                                   block_size=block_size, clock=self.clock)
+        self.gaps = GapRecorder(device.address)
+        self.next_delay = delay
 
     def run(self):
         """Method representing the thread's activity
@@ -378,14 +545,55 @@ class ITCMeasurementThread(Thread):
         threading.Thread
 
         """
+        clock = self.clock
         while not self.stop:
-            time.sleep(self.delay)
-            temps = self.device.get_all_temperatures()
-            self.q.put(temps)
+            clock.sleep(self.next_delay)
+            self.sample()
+        self.writer.flush()
+
+    def sample(self):
+        """Take one sample of all channels.
+
+        This is the body of the thread's loop. A RunMeas.Pool.DevicePool
+        calls it directly instead of starting the thread.
+
+        Returns
+        -------
+        delay : float
+            The delay, in seconds, before the next sample.
+
+        """
+        controller = self.rate_controller
+        block = self.writer.block
+        i = block.n
+        cols = block.columns
+        cols[0][i] = self.clock.now_ns()
+        try:
+            age = 0.0
+            for j, command in enumerate(self.commands, 1):
+                (cols[j][i], read_age) = self.device.read_float_with_age(
+                    command)
+                age = max(age, read_age)
+            # A reading from the cache is stamped with when it was queried
+            cols[0][i] -= int(age * 1e9)
+        except Exception as e:
+            # Keep polling, the NaN row marks the gap in the data
+            for j in range(1, len(self.commands) + 1):
+                cols[j][i] = float('nan')
+            self.gaps.failed(cols[0][i], e)
+        else:
+            self.gaps.succeeded(cols[0][i])
+            if controller is not None:
+                self.next_delay = controller.update(cols[0][i], block.data[i])
+        if controller is not None:
+            cols[-1][i] = self.next_delay
+        self.writer.commit(self.next_delay)
+        return self.next_delay
 
     def stop_thread(self):
         """Method to call to halt the thread's activity."""
         self.stop = True
+        self.clock.wake(self)
 
 
 def main():
@@ -406,7 +614,7 @@ def main():
     time.sleep(0.5)
     itc_thread.stop_thread()
     while not itc_thread.q.empty():
-        print(itc_thread.q.get())
+        print(itc_thread.q.get().to_columns())
 
 if __name__ == "__main__":
     main()
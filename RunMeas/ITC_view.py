@@ -17,7 +17,7 @@ import sys
 
 from PyQt4.QtCore import (SIGNAL)
 from PyQt4.QtGui import (QApplication, QMainWindow, QSizePolicy, QAction,
-                         QIcon)
+                         QIcon, QTabWidget, QWidget, QVBoxLayout)
 from tzlocal import get_localzone
 import matplotlib as mpl
 from matplotlib.figure import Figure
@@ -61,8 +61,27 @@ class MyMainWindow(QMainWindow, MainWindow):
         self.axes2 = axes1.twinx()
         self.axes2.grid(False)
 
-        self.graphLayout.insertWidget(0, self.canvas)
-        self.graphLayout.insertWidget(1, mpl_toolbar)
+        # The live spectrum, see RunMeas.Spectrum
+        spectrum_fig, self.spectrumAxes = plt.subplots()
+        spectrum_fig.set_dpi(120)
+        self.spectrumCanvas = FigureCanvas(spectrum_fig)
+        self.spectrumCanvas.setSizePolicy(QSizePolicy.Expanding,
+                                          QSizePolicy.Expanding)
+        spectrum_toolbar = NavigationToolbar(self.spectrumCanvas,
+                                             self.spectrumCanvas)
+
+        # One tab for the time traces and one for the spectrum
+        self.graphTabs = QTabWidget()
+        for (name, canvas, toolbar) in (
+                ("Time", self.canvas, mpl_toolbar),
+                ("Spectrum", self.spectrumCanvas, spectrum_toolbar)):
+            tab = QWidget()
+            layout = QVBoxLayout(tab)
+            layout.addWidget(canvas)
+            layout.addWidget(toolbar)
+            self.graphTabs.addTab(tab, name)
+
+        self.graphLayout.insertWidget(0, self.graphTabs)
 
         # Adjust the offset spinbox range and significant digits
         # self.offsetSpinBox.setDecimals(10)
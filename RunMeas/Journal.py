@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Journal Module.
+
+This module contains the write-ahead journal of the recording.
+Before the recording thread appends a batch of rows to the HDF5 file, it
+writes the batch to a small append-only binary journal next to the file.
+Once the HDF5 file has been flushed the journal is truncated again. If the
+process dies in between, replaying the journal brings the HDF5 file back to
+the last journaled batch.
+
+Every record of the journal is laid out as
+
+    MAGIC | header length (uint32) | JSON header | column data | CRC32
+
+where the header names the device, the number of rows, the number of rows of
+the device already in the HDF5 file before this batch, and the name and
+dtype of every column. A truncated or corrupt record ends the replay.
+
+"""
+
+import os
+import json
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Compression import append_rows, packed_rows
+
+MAGIC = b'RMJ1'
+_UINT32 = struct.Struct('<I')
+
+
+class Journal(object):
+    """The append-only write-ahead journal of a recording.
+
+    Parameters
+    ----------
+    path : str
+        The path of the journal file.
+    sync : boolean, optional
+        Whether every record is forced to disk with os.fsync before the
+        batch is committed to the HDF5 file.
+        DEFAULT: True
+
+    Attributes
+    ----------
+    path : str
+        The path of the journal file.
+    sync : boolean
+        Whether every record is forced to disk.
+
+    Methods
+    -------
+    append(dev_name, start, rows)
+    checkpoint
+    close
+
+    """
+
+    def __init__(self, path, sync=True):
+        super(Journal, self).__init__()
+        self.path = path
+        self.sync = sync
+        self._file = open(path, 'ab')
+
+    def append(self, dev_name, start, rows):
+        """Write a batch of rows to the journal.
+
+        Parameters
+        ----------
+        dev_name : str
+            The name of the device the rows belong to.
+        start : int
+            The number of rows of the device in the HDF5 file before this
+            batch.
+        rows : dict
+            One numpy array per column, all of the same length.
+
+        """
+        self._file.write(encode_record(dev_name, start, rows))
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def checkpoint(self):
+        """Drop all records, once they are safely in the HDF5 file."""
+        self._file.seek(0)
+        self._file.truncate()
+
+    def close(self, remove=True):
+        """Close the journal and, by default, remove its file."""
+        self._file.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def encode_record(dev_name, start, rows):
+    """Encode a batch of rows as a journal record.
+
+    Returns
+    -------
+    record : bytes
+
+    """
+    columns = []
+    payload = []
+    n_rows = None
+    for chan_name, vals in rows.items():
+        vals = np.ascontiguousarray(vals)
+        n_rows = len(vals)
+        columns.append((chan_name, vals.dtype.str))
+        payload.append(vals.tobytes())
+    header = json.dumps({'device': dev_name, 'start': int(start),
+                         'rows': n_rows or 0,
+                         'columns': columns}).encode('utf-8')
+    body = _UINT32.pack(len(header)) + header + b''.join(payload)
+    return MAGIC + body + _UINT32.pack(zlib.crc32(body) & 0xffffffff)
+
+
+def read_records(path):
+    """Iterate over the intact records of a journal file.
+
+    Yields
+    ------
+    (dev_name, start, rows) : (str, int, dict)
+        The same values that were passed to Journal.append.
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + len(MAGIC) + _UINT32.size <= len(data):
+        if data[pos:pos + len(MAGIC)] != MAGIC:
+            return
+        body_start = pos + len(MAGIC)
+        (header_len,) = _UINT32.unpack_from(data, body_start)
+        header_end = body_start + _UINT32.size + header_len
+        if header_end > len(data):
+            return
+        try:
+            header = json.loads(data[body_start + _UINT32.size:
+                                     header_end].decode('utf-8'))
+        except ValueError:
+            return
+        dtypes = [(name, np.dtype(dt)) for (name, dt) in header['columns']]
+        body_end = header_end + sum(dt.itemsize * header['rows']
+                                    for (name, dt) in dtypes)
+        if body_end + _UINT32.size > len(data):
+            return
+        (crc,) = _UINT32.unpack_from(data, body_end)
+        if zlib.crc32(data[body_start:body_end]) & 0xffffffff != crc:
+            return
+        rows = {}
+        offset = header_end
+        for (name, dt) in dtypes:
+            size = dt.itemsize * header['rows']
+            rows[name] = np.frombuffer(data[offset:offset + size], dtype=dt)
+            offset += size
+        yield (header['device'], header['start'], rows)
+        pos = body_end + _UINT32.size
+
+
+def journal_path(file_name):
+    """Return the path of the journal belonging to a recording."""
+    return file_name + '.journal'
+
+
+def open_recording(file_name):
+    """Open a recording for appending, creating it if it does not exist.
+
+    Raises
+    ------
+    IOError
+        If the file exists but can not be opened, e.g. because the process
+        died while writing it. The file is left untouched.
+
+    """
+    try:
+        return pd.HDFStore(file_name, mode='a')
+    except Exception as e:
+        raise IOError("The recording {} can not be opened and is left "
+                      "untouched, the rows since its last checkpoint are in "
+                      "its journal {}: {}".format(
+                          file_name, journal_path(file_name), e)) from e
+
+
+def replay_journal(file_name, packed=False):
+    """Bring a recording up to date with its journal.
+
+    Rows that are in the journal but not yet in the HDF5 file are appended.
+    The journal only holds the batches since the last checkpoint, so it can
+    not stand in for an HDF5 file that can not be opened at all: in that
+    case an IOError is raised and both files are left untouched, for
+    salvaging by hand.
+
+    Parameters
+    ----------
+    file_name : str
+        The path of the HDF5 recording.
+    packed : bool, optional
+        Whether the recording is in the packed format of
+        RunMeas.Compression.
+        DEFAULT: False
+
+    Returns
+    -------
+    replayed : dict
+        The number of rows appended per device.
+
+    Raises
+    ------
+    IOError
+        If the HDF5 file exists but can not be opened.
+
+    """
+    path = journal_path(file_name)
+    replayed = {}
+    if not os.path.exists(path):
+        return replayed
+    store = open_recording(file_name)
+    with store:
+        for (dev_name, start, rows) in read_records(path):
+            key = 'raw/' + dev_name
+            if packed:
+                n_file = packed_rows(store, dev_name)
+            else:
+                n_file = store.get_storer(key).nrows if key in store else 0
+            skip = max(n_file - start, 0)
+            if skip >= len(rows['timestamp']):
+                continue
+            rows = dict((k, v[skip:]) for k, v in rows.items())
+            append_rows(store, dev_name, rows, packed)
+            replayed[dev_name] = (replayed.get(dev_name, 0) +
+                                  len(rows['timestamp']))
+        store.flush(fsync=True)
+    os.remove(path)
+    return replayed
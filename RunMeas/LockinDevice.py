@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Lock-in Module.
+
+This module contains the driver for the Stanford Research SR830 lock-in
+amplifiers used for the current and the voltage (I_Lockin and V_Lockin).
+Polling them point by point with ASCII queries costs a bus transaction per
+value, which can not keep up with their time constants. Instead the driver
+uses the internal data buffer of the instrument: it is armed at a sample
+rate of up to 512 Hz, fills at that rate on its own, and the new points are
+transferred in binary blocks with TRCB?, four bytes per point.
+
+The measurement thread hands these blocks to the Buffer in bulk, with the
+timestamp of every point reconstructed from the start of the acquisition
+and the sample rate.
+
+Additionally included is SimulatedSR830, a model of the instrument and its
+bus timing to run the driver without hardware.
+
+"""
+
+import math
+from threading import Thread, RLock
+
+import numpy as np
+
+from RunMeas.Clock import get_clock
+from RunMeas.Recovery import GapRecorder, recover
+from RunMeas.Samples import SampleWriter, SampleQueue, channel_names
+
+# The points per channel the internal buffer holds
+BUFFER_SIZE = 16383
+# The sample rates of the buffer in Hz, their index is the SRAT argument
+RATES = tuple(2.0 ** (i - 4) for i in range(14))
+# The display, i.e. buffer, and the DDEF argument of each channel
+DISPLAYS = {"X": (1, 0), "R": (1, 1), "Y": (2, 0), "Theta": (2, 1)}
+
+
+class SR830Device(object):
+    """The SR830 Driver Object
+
+    This provides access to the internal data buffer and the outputs of the
+    SR830 lock-in amplifier.
+    The device is directly accessable via the resource attribute.
+
+    Parameters
+    ----------
+    address : str
+        The visa address of the lock-in.
+        Example: "GPIB1::9::INSTR"
+    read_term : str, optional
+        The reading termination character of the device
+        DEFAULT: "\n"
+    write_term : str, optional
+        The writing termination character of the device
+        DEFAULT: "\n"
+    policy : RunMeas.Recovery.RetryPolicy, optional
+        If given, the timeout of the queries and how failed queries are
+        retried. Otherwise a failed query raises at once.
+
+    Attributes
+    ----------
+    resource : pyvisa.resources.gpib.GPIBInstrument
+        The instance of the gpib instrument giving direct access to the device.
+    address : str
+        The visa address of the device
+    open_resource : method
+        The method that opened the resource, kept to re-open it.
+
+    Methods
+    -------
+    set_resource(resource)
+    reopen
+    set_displays(channels)
+    set_sample_rate(rate)
+    get_sample_rate
+    arm(rate, channels)
+    start
+    pause
+    reset
+    get_points
+    read_buffer(display, start, n)
+    get_output(chan_name)
+
+    """
+
+    def __init__(self, address, read_term="\n", write_term="\n",
+                 policy=None):
+        super(SR830Device, self).__init__()
+        self.resource = None
+        self.address = address
+        self.read_term = read_term
+        self.write_term = write_term
+        self.policy = policy
+        self.open_resource = None
+        self.lock = RLock()
+
+    def set_resource(self, resource):
+        """Set the VISA resource for the device.
+
+        Parameters
+        ----------
+        resource : method
+            This is the method from
+            pyvisa.highlevel.ResourceManager.open_resource() and it will take
+            the subsequent address attribute of the class as a parameter.
+
+        """
+        self.open_resource = resource
+        self.resource = resource(self.address,
+                                 read_termination=self.read_term,
+                                 write_termination=self.write_term)
+        if self.policy is not None:
+            # pyvisa takes the timeout in milliseconds
+            self.resource.timeout = self.policy.timeout * 1000
+
+    def reopen(self):
+        """Close the resource and open it again, e.g. after a bus error."""
+        with self.lock:
+            try:
+                self.resource.close()
+            except Exception as e:
+                print('Closing {} failed: {}'.format(self.address, e))
+            self.set_resource(self.open_resource)
+
+    def _call(self, name, func, *args, **kwargs):
+        """Call a resource method, retried under the policy if one is set."""
+        def call():
+            with self.lock:
+                return getattr(self.resource, func)(*args, **kwargs)
+        if self.policy is None:
+            return call()
+        return recover(call, self.policy, self.reopen,
+                       '{} {}'.format(self.address, name))
+
+    def _write(self, command):
+        self._call(command, 'write', command)
+
+    def _query(self, command):
+        return self._call(command, 'query', command)
+
+    def set_displays(self, channels):
+        """Store the given channels in the buffers.
+
+        Parameters
+        ----------
+        channels : list
+            At most one of 'X' and 'R', stored in buffer 1, and one of 'Y'
+            and 'Theta', stored in buffer 2.
+
+        """
+        displays = [DISPLAYS[c][0] for c in channels]
+        if len(set(displays)) != len(displays):
+            raise ValueError("Only one channel per display can be buffered, "
+                             "not {}".format(', '.join(channels)))
+        for chan_name in channels:
+            (display, source) = DISPLAYS[chan_name]
+            # Ratio off, the buffer stores the display
+            self._write("DDEF {},{},0".format(display, source))
+
+    def set_sample_rate(self, rate):
+        """Set the rate at which the buffer fills.
+
+        Parameters
+        ----------
+        rate : float
+            The rate in Hz, one of RATES, i.e. a power of two from 62.5 mHz
+            to 512 Hz.
+
+        """
+        if rate not in RATES:
+            raise ValueError("The sample rate needs to be one of {}".format(
+                ', '.join('{:g}'.format(r) for r in RATES)))
+        self._write("SRAT {:d}".format(RATES.index(rate)))
+
+    def get_sample_rate(self):
+        """Get the rate at which the buffer fills.
+
+        Returns
+        -------
+        tuple : (str, float)
+            A tuple with the name of the value ('SampleRate') and the value
+            in Hz.
+
+        """
+        return ('SampleRate', RATES[int(self._query("SRAT?"))])
+
+    def arm(self, rate, channels):
+        """Prepare a single shot acquisition into an empty buffer.
+
+        Parameters
+        ----------
+        rate : float
+            The sample rate in Hz, see set_sample_rate.
+        channels : list
+            The channels to store, see set_displays.
+
+        """
+        self.set_displays(channels)
+        self.set_sample_rate(rate)
+        # Single shot, the buffer stops when it is full
+        self._write("SEND 0")
+        self.reset()
+
+    def start(self):
+        "Start filling the buffer."
+        self._write("STRT")
+
+    def pause(self):
+        "Stop filling the buffer."
+        self._write("PAUS")
+
+    def reset(self):
+        "Empty the buffer."
+        self._write("REST")
+
+    def get_points(self):
+        """Get the number of points stored in the buffer.
+
+        Returns
+        -------
+        int
+
+        """
+        return int(self._query("SPTS?"))
+
+    def read_buffer(self, display, start, n):
+        """Transfer points of a buffer as binary floats.
+
+        Parameters
+        ----------
+        display : int
+            The buffer, 1 or 2.
+        start : int
+            The index of the first point.
+        n : int
+            The number of points.
+
+        Returns
+        -------
+        numpy.ndarray
+            The points as float32.
+
+        """
+        # TRCB? sends little-endian IEEE floats without a header or a
+        # termination
+        return self._call(
+            "TRCB?", 'query_binary_values',
+            "TRCB? {:d},{:d},{:d}".format(display, start, n), datatype='f',
+            is_big_endian=False, header_fmt='empty', data_points=n,
+            expect_termination=False, container=np.array)
+
+    def get_output(self, chan_name):
+        """Get a single value of an output with an ASCII query.
+
+        Parameters
+        ----------
+        chan_name : str
+            One of 'X', 'Y', 'R' and 'Theta'.
+
+        Returns
+        -------
+        tuple : (str, float)
+            The name and the value of the output.
+
+        """
+        index = ["X", "Y", "R", "Theta"].index(chan_name) + 1
+        return (chan_name, float(self._query("OUTP? {:d}".format(index))))
+
+
+class LockinMeasurementThread(Thread):
+    """Thread for the continuous buffered acquisition of a lock-in.
+
+    Once started, the thread arms the buffer of the lock-in and, every
+    'delay' seconds, transfers the points stored since the last transfer.
+    Shortly before the buffer is full it is emptied and started again, which
+    leaves a gap of a few transfers in the data.
+
+    Parameters
+    ----------
+    device : SR830Device
+        The instance of the device that shall be read out.
+    chan_list : list
+        The channels to acquire, at most one of 'X' and 'R' and one of 'Y'
+        and 'Theta'. A channel may also be given as a (name, dtype) tuple,
+        e.g. ('X', 'f4'), the buffer holds float32 anyway.
+    rate : float, optional
+        The sample rate of the buffer in Hz, see RATES.
+        DEFAULT: 512.0
+    delay : float, optional
+        The delay, in seconds, between transfers.
+        DEFAULT: 0.5 s
+    block_size : int, optional
+        The number of samples handed to the queue at once, see
+        RunMeas.Samples.SampleWriter.
+        DEFAULT: 1024
+    maxsize : int, optional
+        The maximum number of blocks in the queue, unbounded if 0. The
+        default holds about eight minutes of samples at 512 Hz.
+        DEFAULT: 256
+    overflow : str, optional
+        What to do when the queue is full, see RunMeas.Samples.SampleQueue.
+        DEFAULT: 'block'
+    clock : RunMeas.Clock.RealClock, optional
+        The clock giving the delays and the timestamps, by default
+        RunMeas.Clock.get_clock().
+
+    Attributes
+    ----------
+    stop : boolean
+        The stop flag. When true the thread loop will end.
+    device : SR830Device
+        The instance of the device that shall be read out.
+    q : RunMeas.Samples.SampleQueue
+        The communications queue into which the data is inserted.
+    writer : RunMeas.Samples.SampleWriter
+        The writer filling in the sample blocks that are put on the queue.
+    gaps : RunMeas.Recovery.GapRecorder
+        The spans in which transfers failed. The acquisition is then armed
+        again.
+    start_ns : int or None
+        The time at which the current acquisition started.
+    read : int
+        The points of the current acquisition transferred so far.
+    transfers : int
+        The number of binary transfers.
+
+    Methods
+    -------
+    run
+    sample
+    stop_thread
+
+    """
+
+    def __init__(self, device, chan_list, rate=512.0, delay=0.5,
+                 block_size=1024, maxsize=256, overflow='block', clock=None):
+        super(LockinMeasurementThread, self).__init__()
+        assert type(chan_list) is list, ('The chan_list parameter needs to be '
+                                         'a list of strings naming the '
+                                         'from which data will be collected.')
+        self.stop = False
+        self.device = device
+        self.q = SampleQueue(maxsize, overflow)
+        self.rate = rate
+        self.delay = delay
+        self.chan_list = chan_list
+        self.names = channel_names(chan_list)
+        for chan_name in self.names:
+            if chan_name not in DISPLAYS:
+                raise ValueError("Unknown lock-in channel {}".format(
+                    chan_name))
+        if len(set(DISPLAYS[c][0] for c in self.names)) != len(self.names):
+            raise ValueError("Only one channel per display can be buffered")
+        if rate not in RATES:
+            raise ValueError("Unknown sample rate {}".format(rate))
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.attach(self)
+        self.writer = SampleWriter(self.q, self.chan_list,
+                                   block_size=block_size, clock=self.clock)
+        self.gaps = GapRecorder(device.address)
+        # Restart while a transfer's worth of room is left
+        self.restart_at = BUFFER_SIZE - 2 * int(math.ceil(rate * delay))
+        self.start_ns = None
+        self.read = 0
+        self.transfers = 0
+
+    def run(self):
+        """Method representing the thread's activity
+
+        See Also
+        --------
+        threading.Thread
+
+        """
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            self.sample()
+        self.finish()
+
+    def sample(self):
+        """Transfer the points stored since the last call.
+
+        This is the body of the thread's loop. A RunMeas.Pool.DevicePool
+        calls it directly instead of starting the thread.
+
+        Returns
+        -------
+        delay : float
+            The delay, in seconds, before the next transfer.
+
+        """
+        now = self.clock.now_ns()
+        try:
+            if self.start_ns is None:
+                self._start()
+            else:
+                self._transfer(self.device.get_points())
+                if self.read >= self.restart_at:
+                    self._restart()
+        except Exception as e:
+            self.gaps.failed(now, e)
+            # The state of the buffer is unknown, so start over
+            self.start_ns = None
+        else:
+            self.gaps.succeeded(now)
+        return self.delay
+
+    def _start(self):
+        self.device.arm(self.rate, self.names)
+        self.read = 0
+        self.device.start()
+        # The first point is taken when STRT arrives, not when it is sent
+        self.start_ns = self.clock.now_ns()
+
+    def _restart(self):
+        self.device.pause()
+        self._transfer(self.device.get_points())
+        self.device.reset()
+        self.read = 0
+        self.device.start()
+        self.start_ns = self.clock.now_ns()
+
+    def _transfer(self, stored):
+        """Hand the points from 'read' up to 'stored' to the writer."""
+        n = stored - self.read
+        if n <= 0:
+            return
+        index = np.arange(self.read, stored)
+        columns = [self.start_ns + np.round(index * (1e9 / self.rate))
+                   .astype('int64')]
+        for chan_name in self.names:
+            columns.append(self.device.read_buffer(DISPLAYS[chan_name][0],
+                                                   self.read, n))
+        self.transfers += 1
+        self.read = stored
+        self.writer.extend(columns)
+        self.writer.flush()
+
+    def finish(self):
+        """Stop the acquisition and flush the transferred points."""
+        self.writer.flush()
+        if self.start_ns is not None:
+            try:
+                self.device.pause()
+            except Exception as e:
+                print('{}: could not pause: {}'.format(self.device.address,
+                                                      e))
+
+    def stop_thread(self):
+        """Method to call to halt the thread's activity."""
+        self.stop = True
+        self.clock.wake(self)
+
+
+class SimulatedSR830(object):
+    """A model of an SR830 and its bus, in place of a VISA resource.
+
+    The buffer fills at the set rate on the given clock, and every query
+    takes 'latency' seconds plus the time to transfer its reply at
+    'bandwidth' bytes per second, slept on the clock. The outputs are
+    X = 1 mV * (1 + 0.1 sin(2 pi 0.1 Hz t)) and Y = X / 10, with t the
+    clock time of a point in seconds.
+
+    Parameters
+    ----------
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the model, by default RunMeas.Clock.get_clock().
+    latency : float, optional
+        The time of a command without its reply in seconds.
+        DEFAULT: 0.002
+    bandwidth : float, optional
+        The bytes per second of a reply.
+        DEFAULT: 100000.0
+
+    Attributes
+    ----------
+    bytes : int
+        The bytes sent in replies.
+    queries : int
+        The commands received.
+
+    """
+
+    def __init__(self, clock=None, latency=0.002, bandwidth=100e3):
+        super(SimulatedSR830, self).__init__()
+        self.clock = clock if clock is not None else get_clock()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.timeout = 2000
+        self.rate = RATES[-1]
+        self.sources = {1: 0, 2: 0}
+        self.started = None
+        self.origin = None
+        self.stored = 0
+        self.bytes = 0
+        self.queries = 0
+
+    @staticmethod
+    def signal(t):
+        """Return the X and Y of the model at times t in seconds."""
+        x = 1e-3 * (1 + 0.1 * np.sin(2 * np.pi * 0.1 * np.asarray(t)))
+        return (x, x / 10)
+
+    def _points(self):
+        if self.started is None:
+            return self.stored
+        # The first point is taken at STRT
+        n = int((self.clock.now_ns() - self.started) * self.rate / 1e9) + 1
+        return min(self.stored + n, BUFFER_SIZE)
+
+    def _bus(self, n_bytes):
+        self.queries += 1
+        self.bytes += n_bytes
+        self.clock.sleep(self.latency + n_bytes / self.bandwidth)
+
+    def write(self, command):
+        # The instrument acts on a command once it has crossed the bus
+        self._bus(0)
+        (name, _, args) = command.partition(" ")
+        if name == "STRT":
+            self.started = self.clock.now_ns()
+            if self.origin is None:
+                self.origin = self.started
+        elif name == "PAUS":
+            self.stored = self._points()
+            self.started = None
+        elif name == "REST":
+            self.stored = 0
+            self.started = None
+            self.origin = None
+        elif name == "SRAT":
+            self.rate = RATES[int(args)]
+        elif name == "DDEF":
+            (display, source) = [int(a) for a in args.split(",")[:2]]
+            self.sources[display] = source
+
+    def query(self, command):
+        (name, _, args) = command.partition(" ")
+        if name == "SPTS?":
+            reply = str(self._points())
+        elif name == "SRAT?":
+            reply = str(RATES.index(self.rate))
+        elif name == "OUTP?":
+            (x, y) = self.signal(self.clock.time())
+            reply = "{:.6e}".format([x, y, math.hypot(x, y),
+                                     math.degrees(math.atan2(y, x))]
+                                    [int(args) - 1])
+        else:
+            raise ValueError("Unknown command {}".format(command))
+        self._bus(len(reply) + 1)
+        return reply
+
+    def query_binary_values(self, command, datatype='f', is_big_endian=False,
+                            container=list, data_points=0, **kwargs):
+        (display, start, n) = [int(a) for a in
+                               command.partition(" ")[2].split(",")]
+        if start + n > self._points():
+            raise ValueError("Only {} points stored".format(self._points()))
+        # A pause leaves no gap in the timing of the points
+        (x, y) = self.signal((self.origin + np.arange(start, start + n) *
+                              (1e9 / self.rate)) / 1e9)
+        if self.sources[display] == 1:
+            values = np.hypot(x, y) if display == 1 else \
+                np.degrees(np.arctan2(y, x))
+        else:
+            values = x if display == 1 else y
+        values = values.astype('<f4')
+        self._bus(values.nbytes)
+        return container(values)
+
+    def close(self):
+        pass
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Manifest Module.
+
+This module contains the manifest of a recording that is split into
+segments, and the reader presenting all segments as one run.
+A rotating recording writes <start>_<name>.0000.h5, <start>_<name>.0001.h5,
+... and next to them <start>_<name>.manifest.json, which lists every
+segment with the time span and the number of rows per device it holds.
+Every segment is a complete recording on its own, with its raw, pyramid
+and sweep tables, so that it can be copied or opened by itself.
+
+"""
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Compression import packed_group, read_packed
+from RunMeas.Pyramid import (LEVELS, choose_level, combine_bins, level_key,
+                             where_range)
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+class Manifest(object):
+    """The list of segments of a recording.
+
+    Parameters
+    ----------
+    path : str
+        The path of the manifest. An existing manifest is loaded.
+
+    Attributes
+    ----------
+    segments : list
+        One dict per segment with the keys 'file' (relative to the folder
+        of the manifest), 'start' and 'stop' (the first and last timestamp
+        in nanoseconds, None while unknown) and 'rows' (per device).
+
+    Methods
+    -------
+    add_segment(file_name)
+    update_segment(start, stop, rows)
+    path_of(segment)
+    save
+
+    """
+
+    def __init__(self, path):
+        super(Manifest, self).__init__()
+        self.path = path
+        self.folder = os.path.dirname(path)
+        self.segments = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self.segments = json.load(f)['segments']
+
+    def add_segment(self, file_name):
+        """Append a new, empty segment and save the manifest."""
+        self.segments.append({'file': os.path.basename(file_name),
+                              'start': None, 'stop': None, 'rows': {}})
+        self.save()
+
+    def update_segment(self, start, stop, rows):
+        """Widen the time span of the last segment and set its row counts.
+
+        Parameters
+        ----------
+        start, stop : int or None
+            The first and last timestamp written to the segment.
+        rows : dict
+            The number of rows in the segment per device.
+
+        """
+        segment = self.segments[-1]
+        if start is not None:
+            segment['start'] = (start if segment['start'] is None
+                                else min(segment['start'], start))
+        if stop is not None:
+            segment['stop'] = (stop if segment['stop'] is None
+                               else max(segment['stop'], stop))
+        segment['rows'] = dict((k, int(v)) for k, v in rows.items())
+        self.save()
+
+    def path_of(self, segment):
+        return os.path.join(self.folder, segment['file'])
+
+    def save(self):
+        """Write the manifest atomically."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'segments': self.segments}, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+class SegmentedRun(object):
+    """All segments of a rotated recording as one continuous dataset.
+
+    Queries only open the segments whose time span overlaps the queried
+    range.
+
+    Parameters
+    ----------
+    path : str
+        The path of the manifest.
+
+    Methods
+    -------
+    touching(start, stop)
+    select(dev_name, start, stop)
+    read_range(dev_name, start, stop, pixels)
+
+    """
+
+    def __init__(self, path):
+        super(SegmentedRun, self).__init__()
+        self.manifest = Manifest(path)
+
+    @property
+    def start(self):
+        starts = [s['start'] for s in self.manifest.segments
+                  if s['start'] is not None]
+        return min(starts) if starts else None
+
+    @property
+    def stop(self):
+        stops = [s['stop'] for s in self.manifest.segments
+                 if s['stop'] is not None]
+        return max(stops) if stops else None
+
+    def touching(self, start=None, stop=None):
+        """Return the paths of the segments overlapping [start, stop).
+
+        A segment whose span is not known yet is always included. The stop
+        of the last segment is not trusted: the run may still be recording
+        into it, or may have crashed before the manifest caught up, so it
+        is included for any range that does not end before its start.
+
+        """
+        paths = []
+        last = len(self.manifest.segments) - 1
+        for i, segment in enumerate(self.manifest.segments):
+            if segment['start'] is not None:
+                if stop is not None and segment['start'] >= stop:
+                    continue
+                if start is not None and i != last and \
+                        segment['stop'] is not None and \
+                        segment['stop'] < start:
+                    continue
+            paths.append(self.manifest.path_of(segment))
+        return paths
+
+    def select(self, dev_name, start=None, stop=None):
+        """Return the rows of a device in [start, stop) of all segments.
+
+        Parameters
+        ----------
+        dev_name : str
+            The name of the device.
+        start, stop : int, optional
+            The range in nanoseconds since the epoch.
+
+        Returns
+        -------
+        pandas.DataFrame
+
+        """
+        where = where_range(start, stop)
+        frames = []
+        for path in self.touching(start, stop):
+            if not os.path.exists(path):
+                continue
+            with pd.HDFStore(path, mode='r') as store:
+                key = 'raw/' + dev_name
+                if key in store:
+                    frames.append(store.select(key, where=where))
+                    continue
+                packed = packed_group(store, dev_name) is not None
+            if packed:
+                df = read_packed(path, dev_name)
+                frames.append(df[_in_range(df.index.values, start, stop)])
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames)
+
+    def read_range(self, dev_name, start=None, stop=None, pixels=None):
+        """Read a range at the resolution needed to show it.
+
+        The level is chosen for the range as a whole, see
+        RunMeas.Pyramid.read_range, and read from every touched segment.
+
+        Returns
+        -------
+        level : int or None
+            The level read, None for the raw data.
+        df : pandas.DataFrame
+
+        """
+        level = None
+        if pixels:
+            first = self.start if start is None else start
+            last = self.stop if stop is None else stop
+            if first is not None and last is not None:
+                level = choose_level((last - first) / 1e9, pixels, LEVELS)
+        if level is None:
+            return None, self.select(dev_name, start, stop)
+        where = where_range(start, stop)
+        frames = []
+        for path in self.touching(start, stop):
+            if not os.path.exists(path):
+                continue
+            with pd.HDFStore(path, mode='r') as store:
+                key = level_key(dev_name, level)
+                if key in store:
+                    frames.append(store.select(key, where=where))
+        if not frames:
+            return None, self.select(dev_name, start, stop)
+        # A bin open when a segment was rotated is split across two files
+        return level, combine_bins(pd.concat(frames))
+
+
+def _in_range(timestamps, start, stop):
+    keep = np.ones(len(timestamps), dtype=bool)
+    if start is not None:
+        keep &= timestamps >= start
+    if stop is not None:
+        keep &= timestamps < stop
+    return keep
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Polling Module.
+
+This module contains the controller that lets a measurement thread adapt its
+polling rate to how fast its channels change: fast while the fridge is
+moving, slow while it sits at base temperature.
+
+"""
+
+import numpy as np
+
+from RunMeas.Clock import to_seconds
+
+# The name of the channel in which the thread records the controller's
+# decisions
+DELAY_CHANNEL = 'PollDelay'
+
+
+class RateController(object):
+    """Change-driven polling delay for one device.
+
+    After every sample the controller compares each watched channel with its
+    value at the previous sample. If any channel changes faster than its
+    threshold, the next delay is 'min_delay'. Otherwise the delay grows by
+    'backoff' per sample until it reaches 'max_delay', which is thus the
+    guaranteed heartbeat of the device.
+
+    Parameters
+    ----------
+    thresholds : dict
+        The rate of change, in units per second, above which a channel counts
+        as changing, e.g. {'THe3': 1e-4, 'TSorp': 1e-2}.
+    min_delay : float
+        The delay, in seconds, while a channel is changing.
+    max_delay : float
+        The longest delay, in seconds, i.e. the heartbeat.
+    backoff : float, optional
+        The factor by which the delay grows per quiet sample.
+        DEFAULT: 1.5
+
+    Attributes
+    ----------
+    delay : float
+        The current delay in seconds.
+
+    Methods
+    -------
+    update(timestamp, row)
+    reset
+
+    """
+
+    def __init__(self, thresholds, min_delay, max_delay, backoff=1.5):
+        super(RateController, self).__init__()
+        assert type(thresholds) is dict, ('The thresholds need to be a dict '
+                                          'of channel names and rates')
+        if not 0 < min_delay <= max_delay:
+            raise ValueError("The delays need to fulfil "
+                             "0 < min_delay <= max_delay")
+        assert backoff > 1, 'The backoff factor needs to be larger than one'
+        self.thresholds = thresholds
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.reset()
+
+    def reset(self):
+        """Start again at the fastest rate."""
+        self.delay = self.min_delay
+        self._last_t = None
+        self._last = None
+
+    def update(self, timestamp, row):
+        """Decide the delay before the next sample.
+
+        Parameters
+        ----------
+        timestamp : int
+            The timestamp of the sample in nanoseconds since the epoch.
+        row : mapping
+            The values of the sample by channel name, e.g. a row of a
+            SampleBlock.
+
+        Returns
+        -------
+        delay : float
+            The delay in seconds before the next sample.
+
+        """
+        t = float(to_seconds(timestamp))
+        values = dict((chan_name, float(row[chan_name]))
+                      for chan_name in self.thresholds)
+        changing = self._last is None
+        if not changing:
+            dt = t - self._last_t
+            for (chan_name, threshold) in self.thresholds.items():
+                dx = abs(values[chan_name] - self._last[chan_name])
+                if dt <= 0 or np.isnan(dx) or dx > threshold * dt:
+                    changing = True
+                    break
+        if changing:
+            self.delay = self.min_delay
+        else:
+            self.delay = min(self.delay * self.backoff, self.max_delay)
+        self._last_t = t
+        self._last = values
+        return self.delay
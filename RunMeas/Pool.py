@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Pool Module.
+
+This module contains the pool of worker threads that samples many devices,
+instead of one measurement thread per device. The measurement threads are
+then only used for their sample() method, which takes one sample and returns
+the delay before the next one, and are never started themselves, e.g.
+
+    itc_thread = ITCMeasurementThread(itc, ['THe3'], delay=0.2)
+    ah_thread = AHMeasurementThread(ah, ['Cap', 'Loss'], delay=1.0)
+    pool = DevicePool([('ITC503', itc_thread), ('AH2550A', ah_thread)],
+                      workers=2)
+    pool.start()
+
+Every device keeps its own schedule: it is due 'delay' seconds after its
+last sample finished, as with its own thread, and is never sampled by two
+workers at once. The number of threads stays fixed however many devices are
+added. Buffer(..., workers=n) uses a pool together with a single collection
+thread for all devices.
+
+"""
+
+import heapq
+import itertools
+from threading import Lock, Thread
+
+from RunMeas.Clock import get_clock
+
+
+class _Worker(Thread):
+    """A thread of the pool, sampling whichever device is due next."""
+
+    def __init__(self, pool, index):
+        super(_Worker, self).__init__()
+        self.name = 'DevicePool-{}'.format(index)
+        self.pool = pool
+        self.stop = False
+        pool.clock.attach(self)
+
+    def run(self):
+        pool = self.pool
+        while not self.stop:
+            (due, name) = pool._take()
+            if name is None:
+                pool.clock.sleep(due)
+                continue
+            delay = pool._sample(name)
+            pool._reschedule(name, delay)
+
+    def stop_thread(self):
+        self.stop = True
+        self.pool.clock.wake(self)
+
+
+class DevicePool(object):
+    """A fixed number of threads sampling devices on their own schedules.
+
+    Parameters
+    ----------
+    threads : list
+        The (name, measurement thread) of every device. The threads are not
+        started, their sample() method is called by the workers.
+    workers : int, optional
+        The number of worker threads. More than one only helps devices on
+        different buses, since the drivers serialise their own bus access.
+        DEFAULT: 2
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the schedules, by default RunMeas.Clock.get_clock().
+    idle : float, optional
+        The longest time, in seconds, a worker sleeps without any device
+        being due.
+        DEFAULT: 0.5
+
+    Attributes
+    ----------
+    workers : list
+        The worker threads.
+    samples : dict
+        The number of samples taken per device.
+    errors : dict
+        The number of sample() calls per device that raised.
+
+    Raises
+    ------
+    TypeError
+        If a thread has no sample() method, e.g. the ReplayThread of
+        RunMeas.Replay, which plays a recording at its own pace and needs
+        to run as its own thread.
+
+    Methods
+    -------
+    start
+    stop_thread
+    join
+    is_alive
+
+    """
+
+    def __init__(self, threads, workers=2, clock=None, idle=0.5):
+        super(DevicePool, self).__init__()
+        if workers < 1:
+            raise ValueError("A pool needs at least one worker")
+        for (name, thread) in threads:
+            if not callable(getattr(thread, 'sample', None)):
+                raise TypeError("The thread of {} has no sample() method and "
+                                "cannot be run by a pool".format(name))
+        self.clock = clock if clock is not None else get_clock()
+        self.threads = dict(threads)
+        self.idle = idle
+        self.lock = Lock()
+        self._seq = itertools.count()
+        now = self.clock.now_ns()
+        # (due, seq, name) with the due time in integer nanoseconds, so that
+        # a device is due exactly when a virtual clock wakes the worker. The
+        # seq keeps devices due at once in order.
+        self._schedule = [(now + int(thread.delay * 1e9), next(self._seq),
+                           name) for (name, thread) in threads]
+        heapq.heapify(self._schedule)
+        self.samples = dict((name, 0) for name in self.threads)
+        self.errors = dict((name, 0) for name in self.threads)
+        self.workers = [_Worker(self, i) for i in range(workers)]
+
+    def _take(self):
+        """Pop the device that is due, or return how long to sleep."""
+        with self.lock:
+            now = self.clock.now_ns()
+            if self._schedule and self._schedule[0][0] <= now:
+                return (None, heapq.heappop(self._schedule)[2])
+            if self._schedule:
+                return (min((self._schedule[0][0] - now) / 1e9, self.idle),
+                        None)
+            return (self.idle, None)
+
+    def _sample(self, name):
+        thread = self.threads[name]
+        try:
+            delay = thread.sample()
+            self.samples[name] += 1
+        except Exception as e:
+            # The measurement threads record their own failures, this only
+            # keeps a broken sample() from taking down a worker
+            self.errors[name] += 1
+            print('{}: sample failed: {}'.format(name, e))
+            delay = thread.delay
+        return delay
+
+    def _reschedule(self, name, delay):
+        # The rescheduling worker is free, so it serves the new due time
+        # itself if no other worker wakes up earlier
+        with self.lock:
+            heapq.heappush(self._schedule,
+                           (self.clock.now_ns() + int(delay * 1e9),
+                            next(self._seq), name))
+
+    def start(self):
+        """Start the worker threads."""
+        for worker in self.workers:
+            worker.start()
+
+    def stop_thread(self):
+        """Stop the workers, join() then flushes the writers."""
+        for worker in self.workers:
+            worker.stop_thread()
+
+    def join(self, timeout=None):
+        """Wait for the workers and flush the writers of the devices."""
+        for worker in self.workers:
+            worker.join(timeout)
+        for thread in self.threads.values():
+            thread.writer.flush()
+
+    def is_alive(self):
+        return any(worker.is_alive() for worker in self.workers)
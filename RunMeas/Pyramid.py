@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Pyramid Module.
+
+This module contains the multi-resolution summary of a recording.
+Next to raw/<device> the recording keeps one table per level,
+pyramid/<device>/bin_<level>s, with the min, max, mean and count of every
+channel in bins of 'level' seconds. The levels are built incrementally by
+the recording thread, so that a week of data can be plotted from a few
+thousand aggregated rows instead of from every raw row.
+
+A column of a level is named <channel>_<aggregate>, e.g. THe3_mean, and its
+index is the start of the bin in nanoseconds since the epoch.
+
+"""
+
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Compression import append_table, packed_group, read_packed
+
+# The bin widths of the levels in seconds
+LEVELS = (1, 10, 60, 600, 3600)
+AGGREGATES = ('min', 'max', 'mean', 'count')
+
+
+def level_key(dev_name, level):
+    """Return the key of a level of a device in the recording."""
+    return 'pyramid/{}/bin_{}s'.format(dev_name, level)
+
+
+def choose_level(span, pixels, levels=LEVELS):
+    """Return the coarsest level that still gives 'pixels' bins.
+
+    Parameters
+    ----------
+    span : float
+        The time span to show in seconds.
+    pixels : int
+        The number of pixels it is shown on.
+    levels : tuple, optional
+        The available levels in seconds.
+        DEFAULT: LEVELS
+
+    Returns
+    -------
+    level : int or None
+        The level, or None if even the finest level is too coarse and the
+        raw data is needed.
+
+    """
+    fitting = [level for level in levels if span / level >= pixels]
+    return max(fitting) if fitting else None
+
+
+def aggregate(timestamps, columns, level):
+    """Aggregate rows into bins of 'level' seconds.
+
+    Parameters
+    ----------
+    timestamps : numpy.ndarray
+        The sorted int64 timestamps of the rows.
+    columns : dict
+        One array per channel.
+    level : int
+        The bin width in seconds.
+
+    Returns
+    -------
+    bins : numpy.ndarray
+        The start of every bin that holds rows, in nanoseconds.
+    aggregates : dict
+        The sum, min, max and count of every channel per bin under the
+        keys (channel, 'sum'), (channel, 'min') etc. NaN values are not
+        counted.
+
+    """
+    width = int(level * 1e9)
+    ids = np.asarray(timestamps, dtype='int64') // width
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    aggregates = {}
+    for chan_name, vals in columns.items():
+        vals = np.asarray(vals, dtype=float)
+        valid = ~np.isnan(vals)
+        aggregates[(chan_name, 'sum')] = np.add.reduceat(
+            np.where(valid, vals, 0.0), starts)
+        aggregates[(chan_name, 'count')] = np.add.reduceat(
+            valid.astype('int64'), starts)
+        aggregates[(chan_name, 'min')] = np.fmin.reduceat(vals, starts)
+        aggregates[(chan_name, 'max')] = np.fmax.reduceat(vals, starts)
+    return ids[starts] * width, aggregates
+
+
+def _align(a, b):
+    """Give two sets of aggregates the same channels.
+
+    A channel missing from one of them, e.g. a derived channel added while
+    recording, gets empty bins there: a sum and count of 0 and a NaN min and
+    max.
+
+    """
+    for (x, y) in ((a, b), (b, a)):
+        n = len(next(iter(x.values()))) if x else 0
+        for (chan_name, agg) in y:
+            if (chan_name, agg) not in x:
+                if agg in ('sum', 'count'):
+                    x[(chan_name, agg)] = np.zeros(n, dtype=y[(chan_name,
+                                                               agg)].dtype)
+                else:
+                    x[(chan_name, agg)] = np.full(n, np.nan)
+
+
+def _merge(a, b):
+    """Merge the aggregates of the same bin."""
+    _align(a, b)
+    merged = {}
+    for (chan_name, agg), vals in a.items():
+        other = b[(chan_name, agg)]
+        if agg in ('sum', 'count'):
+            merged[(chan_name, agg)] = vals + other
+        elif agg == 'min':
+            merged[(chan_name, agg)] = np.fmin(vals, other)
+        else:
+            merged[(chan_name, agg)] = np.fmax(vals, other)
+    return merged
+
+
+def _to_frame(bins, aggregates):
+    data = {}
+    for (chan_name, agg), vals in aggregates.items():
+        if agg == 'sum':
+            count = aggregates[(chan_name, 'count')]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                data[chan_name + '_mean'] = vals / count
+        else:
+            data[chan_name + '_' + agg] = vals
+    df = pd.DataFrame(data=data, index=pd.Index(bins, name='timestamp'))
+    return df[sorted(df.columns)]
+
+
+def _advance(open_bins, key, timestamps, columns, level):
+    """Aggregate new rows into the open bin of a level.
+
+    Parameters
+    ----------
+    open_bins : dict
+        The open bin, (bin, aggregates), of every key, updated in place.
+    key : hashable
+        The key of the level in 'open_bins'.
+    timestamps : numpy.ndarray
+        The timestamps of the new rows.
+    columns : dict
+        One array per channel of the new rows.
+    level : int
+        The bin width in seconds.
+
+    Returns
+    -------
+    completed : tuple
+        The (bins, aggregates) of the bins completed by the new rows, or
+        None if there are none.
+
+    """
+    bins, aggs = aggregate(timestamps, columns, level)
+    pending = open_bins.get(key)
+    if pending is not None:
+        (open_bin, open_aggs) = pending
+        if open_bin == bins[0]:
+            first = dict((k, v[:1]) for k, v in aggs.items())
+            first = _merge(open_aggs, first)
+            for k in aggs:
+                aggs[k] = np.concatenate((first[k], aggs[k][1:]))
+        else:
+            _align(open_aggs, aggs)
+            bins = np.concatenate(([open_bin], bins))
+            for k in aggs:
+                aggs[k] = np.concatenate((open_aggs[k], aggs[k]))
+    open_bins[key] = (bins[-1], dict((k, v[-1:]) for k, v in aggs.items()))
+    if len(bins) < 2:
+        return None
+    return bins[:-1], dict((k, v[:-1]) for k, v in aggs.items())
+
+
+def _append_level(store, key, df):
+    # A channel that is new to the level has no rows in the earlier bins
+    append_table(store, key, df, fill=dict(
+        (col, 0) for col in df.columns if col.endswith('_count')))
+
+
+class PyramidBuilder(object):
+    """Maintain the levels of a recording while it is written.
+
+    Every bin is written once it is complete, i.e. once a row of a later bin
+    has arrived. The bin still open is kept in memory and written by flush
+    when the recording is closed.
+
+    Parameters
+    ----------
+    levels : tuple, optional
+        The bin widths of the levels in seconds.
+        DEFAULT: LEVELS
+
+    Methods
+    -------
+    update(store, dev_name, rows)
+    flush(store)
+
+    """
+
+    def __init__(self, levels=LEVELS):
+        super(PyramidBuilder, self).__init__()
+        self.levels = tuple(sorted(levels))
+        # The open bin of each device and level: (bin, aggregates)
+        self._open = {}
+
+    def update(self, store, dev_name, rows):
+        """Aggregate newly recorded rows and write the completed bins.
+
+        Parameters
+        ----------
+        store : pandas.HDFStore
+            The open recording.
+        dev_name : str
+            The name of the device.
+        rows : dict
+            The rows with 'timestamp' and one array per channel.
+
+        """
+        if not len(rows['timestamp']):
+            return
+        columns = dict((k, v) for k, v in rows.items() if k != 'timestamp')
+        for level in self.levels:
+            completed = _advance(self._open, (dev_name, level),
+                                 rows['timestamp'], columns, level)
+            if completed is not None:
+                _append_level(store, level_key(dev_name, level),
+                              _to_frame(*completed))
+
+    def flush(self, store):
+        """Write the bins that are still open."""
+        for (dev_name, level), (open_bin, aggs) in self._open.items():
+            _append_level(store, level_key(dev_name, level),
+                          _to_frame([open_bin], aggs))
+        self._open = {}
+
+
+class LivePyramid(object):
+    """Maintain the levels of a device in memory for the live plot.
+
+    The pyramid is attached to a buffer with Buffer.add_listener and
+    aggregates every committed batch into the levels, so that drawing the
+    whole history of a device costs as much as the few bins shown, not as
+    the rows collected so far.
+
+    Parameters
+    ----------
+    levels : tuple, optional
+        The bin widths of the levels in seconds.
+        DEFAULT: LEVELS
+
+    Methods
+    -------
+    update(batch)
+    downsample(chan_name, pixels)
+
+    """
+
+    def __init__(self, levels=LEVELS):
+        super(LivePyramid, self).__init__()
+        self.levels = tuple(sorted(levels))
+        self._open = {}
+        # The completed bins of each level, in chunks of (bins, aggregates)
+        self._done = dict((level, []) for level in self.levels)
+        self._span = None
+        self._lock = Lock()
+
+    def update(self, batch):
+        """Aggregate a committed batch into the levels."""
+        ts = np.asarray(batch['timestamp'], dtype='int64')
+        if not len(ts):
+            return
+        columns = dict((k, v) for k, v in batch.items() if k != 'timestamp')
+        with self._lock:
+            first = self._span[0] if self._span else int(ts[0])
+            self._span = (first, int(ts[-1]))
+            for level in self.levels:
+                completed = _advance(self._open, level, ts, columns, level)
+                if completed is not None:
+                    self._done[level].append(completed)
+
+    def downsample(self, chan_name, pixels):
+        """Return a channel at the coarsest level that fits 'pixels'.
+
+        Returns
+        -------
+        timestamps, mean, min, max : numpy.ndarray
+            The bins of the chosen level, including the open one, or None if
+            the data is too short to be reduced and is best drawn raw.
+
+        """
+        with self._lock:
+            if self._span is None:
+                return None
+            level = choose_level((self._span[1] - self._span[0]) / 1e9,
+                                 pixels, self.levels)
+            if level is None:
+                return None
+            chunks = self._done[level]
+            if len(chunks) > 1:
+                # Read from one chunk from now on
+                chunks[:] = [_concat_chunks(chunks)]
+            parts = chunks + [([self._open[level][0]], self._open[level][1])]
+            (bins, aggs) = _concat_chunks(parts)
+        n = len(bins)
+        total = aggs.get((chan_name, 'sum'), np.full(n, np.nan))
+        count = aggs.get((chan_name, 'count'), np.zeros(n))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        return (bins, mean, aggs.get((chan_name, 'min'), np.full(n, np.nan)),
+                aggs.get((chan_name, 'max'), np.full(n, np.nan)))
+
+
+def _concat_chunks(chunks):
+    """Concatenate (bins, aggregates) chunks, aligning their channels."""
+    keys = set()
+    for (bins, aggs) in chunks:
+        keys.update(aggs)
+    out = {}
+    for key in keys:
+        parts = []
+        for (bins, aggs) in chunks:
+            if key in aggs:
+                parts.append(aggs[key])
+            elif key[1] in ('sum', 'count'):
+                parts.append(np.zeros(len(bins)))
+            else:
+                parts.append(np.full(len(bins), np.nan))
+        out[key] = np.concatenate(parts)
+    bins = np.concatenate([np.asarray(b, dtype='int64') for (b, a) in chunks])
+    return bins, out
+
+
+def combine_bins(df):
+    """Combine duplicate bins, e.g. of a bin open when a run was resumed."""
+    if df.index.is_unique:
+        return df
+    grouped = df.groupby(level=0)
+    out = {}
+    for col in df.columns:
+        chan_name, agg = col.rsplit('_', 1)
+        if agg == 'min':
+            out[col] = grouped[col].min()
+        elif agg == 'max':
+            out[col] = grouped[col].max()
+        elif agg == 'count':
+            out[col] = grouped[col].sum()
+        else:
+            weighted = df[col].fillna(0) * df[chan_name + '_count']
+            out[col] = (weighted.groupby(level=0).sum() /
+                        grouped[chan_name + '_count'].sum())
+    return pd.DataFrame(out)[list(df.columns)]
+
+
+def where_range(start, stop):
+    """Return the HDFStore.select condition for the index in [start, stop).
+
+    """
+    conditions = []
+    if start is not None:
+        conditions.append('index >= {:d}'.format(int(start)))
+    if stop is not None:
+        conditions.append('index < {:d}'.format(int(stop)))
+    return ' & '.join(conditions) or None
+
+
+def read_range(file_name, dev_name, start=None, stop=None, pixels=None):
+    """Read a time range of a device at the resolution needed to show it.
+
+    Parameters
+    ----------
+    file_name : str
+        The path of the recording.
+    dev_name : str
+        The name of the device.
+    start, stop : int, optional
+        The range in nanoseconds since the epoch. By default the whole
+        recording.
+    pixels : int, optional
+        The number of pixels the range is shown on. Without it the raw
+        data is read.
+
+    Returns
+    -------
+    level : int or None
+        The level read, None for the raw data.
+    df : pandas.DataFrame
+        The raw rows, or the aggregates of the level.
+
+    """
+    raw_key = 'raw/' + dev_name
+    with pd.HDFStore(file_name, mode='r') as store:
+        where = where_range(start, stop)
+        level = None
+        available = [lvl for lvl in LEVELS
+                     if level_key(dev_name, lvl) in store]
+        if pixels and available:
+            if start is None or stop is None:
+                finest = level_key(dev_name, available[0])
+                nrows = store.get_storer(finest).nrows
+                first = store.select(finest, start=0, stop=1).index[0]
+                last = store.select(finest, start=nrows - 1).index[0]
+                if start is None:
+                    start = first
+                if stop is None:
+                    stop = last + int(available[0] * 1e9)
+            level = choose_level((stop - start) / 1e9, pixels, available)
+        if level is None:
+            if raw_key in store:
+                return None, store.select(raw_key, where=where)
+            if packed_group(store, dev_name) is None:
+                raise KeyError("No data of {} in {}".format(dev_name,
+                                                           file_name))
+        else:
+            df = store.select(level_key(dev_name, level), where=where)
+            return level, combine_bins(df)
+    # The packed format is decoded as a whole
+    df = read_packed(file_name, dev_name)
+    keep = np.ones(len(df), dtype=bool)
+    if start is not None:
+        keep &= df.index.values >= start
+    if stop is not None:
+        keep &= df.index.values < stop
+    return None, df[keep]
+
+
+def downsample(timestamps, values, pixels, levels=LEVELS):
+    """Reduce a series in memory to the coarsest level that fits 'pixels'.
+
+    Returns
+    -------
+    timestamps, mean, min, max : numpy.ndarray
+        The bins of the chosen level, or the series itself if it is too
+        short to be reduced.
+
+    """
+    timestamps = np.asarray(timestamps, dtype='int64')
+    values = np.asarray(values, dtype=float)
+    if not len(timestamps):
+        return timestamps, values, values, values
+    level = choose_level((timestamps[-1] - timestamps[0]) / 1e9, pixels,
+                         levels)
+    if level is None:
+        return timestamps, values, values, values
+    bins, aggs = aggregate(timestamps, {'x': values}, level)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = aggs[('x', 'sum')] / aggs[('x', 'count')]
+    return bins, mean, aggs[('x', 'min')], aggs[('x', 'max')]
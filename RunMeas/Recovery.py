@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Recovery Module.
+
+This module contains the pieces that let the drivers and the measurement
+threads ride out a flaky bus instead of dying on the first VISA timeout or
+garbled reply:
+
+- RetryPolicy describes the timeout of a query and how often and how late it
+  is retried,
+- recover() carries out one query under a policy: a failed query is sent
+  again at once (the hedged re-query, which fixes a single garbled or lost
+  reply without any delay), then with growing delays, and before the last
+  attempt the resource is re-opened,
+- GapRecorder keeps the spans in which a measurement thread got no sample,
+  so that an outage shows up as an explicit gap in the data.
+
+"""
+
+from RunMeas.Clock import get_clock
+
+
+class DeviceError(IOError):
+    """A query failed even after all retries of its policy."""
+
+
+class RetryPolicy(object):
+    """How a query is retried.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        The VISA timeout of a single query in seconds.
+        DEFAULT: 1.0
+    retries : int, optional
+        The number of times a failed query is sent again.
+        DEFAULT: 4
+    backoff : float, optional
+        The delay before the first delayed retry in seconds.
+        DEFAULT: 0.1
+    factor : float, optional
+        The factor by which the delay grows per retry.
+        DEFAULT: 2.0
+    max_backoff : float, optional
+        The longest delay between retries in seconds.
+        DEFAULT: 2.0
+    hedge : bool, optional
+        Whether the first retry is sent at once, without a delay.
+        DEFAULT: True
+    reopen : bool, optional
+        Whether the resource is re-opened before the last retry.
+        DEFAULT: True
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the delays, by default RunMeas.Clock.get_clock().
+
+    Methods
+    -------
+    delays
+
+    """
+
+    def __init__(self, timeout=1.0, retries=4, backoff=0.1, factor=2.0,
+                 max_backoff=2.0, hedge=True, reopen=True, clock=None):
+        super(RetryPolicy, self).__init__()
+        if retries < 0:
+            raise ValueError("The number of retries can not be negative")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.reopen = reopen
+        self.clock = clock if clock is not None else get_clock()
+
+    def delays(self):
+        """Return the delay before each retry in seconds."""
+        delays = []
+        backoff = self.backoff
+        for i in range(self.retries):
+            if i == 0 and self.hedge:
+                delays.append(0.0)
+                continue
+            delays.append(min(backoff, self.max_backoff))
+            backoff *= self.factor
+        return delays
+
+
+def recover(call, policy, reopen=None, name='query'):
+    """Call a query under a retry policy.
+
+    Parameters
+    ----------
+    call : callable
+        Carries out the query and returns its parsed reply. Any exception
+        counts as a failure, e.g. a timeout or a reply that does not parse.
+    policy : RetryPolicy
+        The policy of the retries.
+    reopen : callable, optional
+        Re-opens the resource of the device.
+    name : str, optional
+        The name of the query in the messages.
+
+    Returns
+    -------
+    The return value of 'call'.
+
+    Raises
+    ------
+    DeviceError
+        If the last retry failed as well.
+
+    """
+    delays = policy.delays()
+    for attempt in range(len(delays) + 1):
+        try:
+            return call()
+        except Exception as e:
+            error = e
+        if attempt == len(delays):
+            break
+        if delays[attempt]:
+            policy.clock.sleep(delays[attempt])
+        if attempt == len(delays) - 1 and policy.reopen and \
+                reopen is not None:
+            try:
+                reopen()
+            except Exception as e:
+                print('Re-opening for {} failed: {}'.format(name, e))
+    raise DeviceError('{} failed {} times, last with: {!r}'.format(
+        name, len(delays) + 1, error)) from error
+
+
+class GapRecorder(object):
+    """The spans in which a measurement thread got no samples.
+
+    Parameters
+    ----------
+    name : str
+        The name of the device in the messages.
+
+    Attributes
+    ----------
+    gaps : list
+        The (start, stop) timestamps of every closed gap in nanoseconds,
+        i.e. from the first failed to the next successful sample.
+    start : int or None
+        The start of the open gap, if the last sample failed.
+    failures : int
+        The number of failed samples.
+
+    Methods
+    -------
+    failed(timestamp, error)
+    succeeded(timestamp)
+
+    """
+
+    def __init__(self, name):
+        super(GapRecorder, self).__init__()
+        self.name = name
+        self.gaps = []
+        self.start = None
+        self.failures = 0
+
+    def failed(self, timestamp, error):
+        """Record a sample that could not be taken."""
+        self.failures += 1
+        if self.start is None:
+            self.start = int(timestamp)
+            print('{}: no sample, gap started: {}'.format(self.name, error))
+
+    def succeeded(self, timestamp):
+        """Record a sample that was taken, closing an open gap."""
+        if self.start is not None:
+            self.gaps.append((self.start, int(timestamp)))
+            print('{}: recovered after {:.1f} s'.format(
+                self.name, (timestamp - self.start) / 1e9))
+            self.start = None
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Replay Module.
+
+This module contains a data source that plays a recorded run back into the
+buffer. It has the same interface as the measurement threads of the real
+devices (a 'chan_list', a SampleQueue 'q', 'stop_thread'), so the buffer,
+the derived channels, the listeners, the recording and the user interface
+can be driven with real traces without the fridge, e.g.
+
+    replay = ReplayThread('temp_data/run.h5', 'ITC503', speed=60.0)
+    buffer = Buffer([('ITC503', None, replay)])
+
+"""
+
+from threading import Thread
+
+import numpy as np
+
+from RunMeas.Clock import get_clock
+from RunMeas.Export import iter_chunks, recorded_channels, recording_files
+from RunMeas.Samples import SampleQueue, SampleWriter
+
+
+class ReplayThread(Thread):
+    """Thread playing a device of a recorded run into a queue.
+
+    The replay runs as its own thread and has no sample() method, so a
+    buffer with workers, see RunMeas.Pool.DevicePool, does not take it.
+
+    Parameters
+    ----------
+    path : str
+        The path of the recording, or of the manifest of a segmented one.
+    dev_name : str
+        The name of the device to play.
+    speed : float, optional
+        1.0 plays in real time, N plays N times faster, and None plays as
+        fast as the buffer takes the samples.
+        DEFAULT: 1.0
+    start, stop : int, optional
+        The part of the run to play, in nanoseconds since the epoch.
+    retime : bool, optional
+        If True, the timestamps are shifted so that the run starts now,
+        keeping their original spacing. Otherwise the recorded timestamps
+        are played.
+        DEFAULT: True
+    block_size : int, optional
+        The number of samples per block, see RunMeas.Samples.SampleWriter.
+        DEFAULT: 100
+    maxsize : int, optional
+        The maximum number of blocks in the queue, unbounded if 0. With the
+        'block' policy a bounded queue makes the replay wait for the
+        buffer, so that speed=None measures the sustainable throughput.
+        DEFAULT: 64
+    overflow : str, optional
+        The overflow policy of the queue, see RunMeas.Samples.SampleQueue.
+        DEFAULT: 'block'
+    chunksize : int, optional
+        The number of rows read from the file at a time.
+        DEFAULT: 100000
+    clock : RunMeas.Clock.RealClock, optional
+        The clock pacing the replay and giving the retimed timestamps, by
+        default RunMeas.Clock.get_clock().
+
+    Attributes
+    ----------
+    stop : boolean
+        The stop flag. When true the thread loop will end.
+    q : RunMeas.Samples.SampleQueue
+        The queue the samples are put on.
+    chan_list : list
+        The (name, dtype) of the recorded channels.
+    played : int
+        The number of samples played so far.
+    finished : boolean
+        True once the whole run has been played.
+    elapsed : float
+        The time, in seconds of the clock, the replay took.
+
+    Methods
+    -------
+    run
+    stop_thread
+
+    """
+
+    def __init__(self, path, dev_name, speed=1.0, start=None, stop=None,
+                 retime=True, block_size=100, maxsize=64, overflow='block',
+                 chunksize=100000, clock=None):
+        super(ReplayThread, self).__init__()
+        assert speed is None or speed > 0, ('The speed needs to be positive '
+                                            'or None')
+        (self.files, devices) = recording_files(path)
+        if dev_name not in devices:
+            raise KeyError("There is no device named {} in {}".format(
+                dev_name, path))
+        self.stop = False
+        self.path = path
+        self.dev_name = dev_name
+        self.speed = speed
+        self.start_ns = start
+        self.stop_ns = stop
+        self.retime = retime
+        self.chunksize = chunksize
+        self.chan_list = [(chan_name, dtype) for (chan_name, dtype)
+                          in recorded_channels(self.files, dev_name)]
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.attach(self)
+        self.q = SampleQueue(maxsize, overflow)
+        self.writer = SampleWriter(self.q, self.chan_list,
+                                   block_size=block_size, clock=self.clock)
+        self.played = 0
+        self.finished = False
+        self.elapsed = None
+
+    def run(self):
+        """Method representing the thread's activity
+
+        See Also
+        --------
+        threading.Thread
+
+        """
+        names = [chan_name for (chan_name, dtype) in self.chan_list]
+        clock = self.clock
+        wall0 = clock.time()
+        first = None
+        offset = 0
+        for chunk in iter_chunks(self.files, self.dev_name, None,
+                                 self.start_ns, self.stop_ns,
+                                 self.chunksize):
+            ts = chunk.index.values.astype('int64')
+            if first is None:
+                first = ts[0]
+                if self.retime:
+                    offset = clock.now_ns() - first
+            columns = [ts + offset] + [chunk[c].values for c in names]
+            if self.speed is None:
+                step = self.writer.block_size
+                for i in range(0, len(ts), step):
+                    if self.stop:
+                        break
+                    self.writer.extend([c[i:i + step] for c in columns])
+                    self.played += len(columns[0][i:i + step])
+            else:
+                # The wall time, since the start, at which each row is due
+                due = (ts - first) / 1e9 / self.speed
+                i = 0
+                while i < len(ts) and not self.stop:
+                    now = clock.time() - wall0
+                    j = np.searchsorted(due, now, side='right')
+                    if j > i:
+                        self.writer.extend([c[i:j] for c in columns])
+                        self.played += j - i
+                        i = j
+                    else:
+                        # Flush so that the latency stays bounded while
+                        # waiting, and wake up regularly to check stop
+                        self.writer.flush()
+                        clock.sleep(min(due[i] - now, 0.05))
+            if self.stop:
+                break
+        self.writer.flush()
+        self.elapsed = clock.time() - wall0
+        self.finished = not self.stop
+
+    def stop_thread(self):
+        self.stop = True
+        # The buffer may have stopped taking samples already, which would
+        # leave the replay waiting on a full queue
+        self.q.close()
+        self.clock.wake(self)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Samples Module.
+
+This module contains the compact representation in which the measurement
+threads hand their samples to the buffer.
+Instead of one (datetime, (name, value), ...) tuple per sample, a
+measurement thread writes its samples straight into a preallocated block, a
+NumPy structured array whose fields are the timestamp (int64 nanoseconds
+since the epoch, see RunMeas.Clock) followed by the channels in the order
+agreed at setup. Full blocks are put on the queue as a whole, and the buffer
+returns them to the thread's pool once it has copied them, so the same few
+blocks are used over and over again.
+The queue between a measurement thread and the buffer is a SampleQueue,
+which can be bounded and decides what happens when the buffer falls behind.
+
+"""
+
+import time
+from collections import deque
+from queue import Full, Queue
+
+import numpy as np
+
+from RunMeas.Clock import get_clock
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest', 'decimate')
+
+
+def parse_channels(chan_list):
+    """Return the names and dtypes of channel declarations.
+
+    Parameters
+    ----------
+    chan_list : list
+        The channel declarations of a measurement thread. Each is either the
+        name of a float64 channel, or a (name, dtype) tuple, e.g.
+        ('TSorp', 'f4'), ('HeaterSensor', 'i1') or ('AutoHeat', bool).
+
+    Returns
+    -------
+    channels : list
+        A list of (name, numpy.dtype) tuples.
+
+    """
+    channels = []
+    for chan in chan_list:
+        if isinstance(chan, tuple):
+            (chan_name, dtype) = chan
+        else:
+            (chan_name, dtype) = (chan, 'f8')
+        channels.append((chan_name, np.dtype(dtype)))
+    return channels
+
+
+def channel_names(chan_list):
+    """Return the names of channel declarations, see parse_channels."""
+    return [chan_name for (chan_name, dtype) in parse_channels(chan_list)]
+
+
+def block_dtype(chan_list):
+    """Return the structured dtype of a block for the given channels.
+
+    Parameters
+    ----------
+    chan_list : list
+        The channel declarations, in the order in which they are written,
+        see parse_channels.
+
+    Returns
+    -------
+    numpy.dtype
+
+    """
+    return np.dtype([('timestamp', 'i8')] + parse_channels(chan_list))
+
+
+class SampleBlock(object):
+    """A preallocated block of samples.
+
+    Parameters
+    ----------
+    dtype : numpy.dtype
+        The structured dtype of the block, see block_dtype.
+    capacity : int
+        The number of samples the block holds.
+    pool : collections.deque, optional
+        The pool to which the block returns when it is released.
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+        The structured array holding the samples.
+    columns : list
+        Views of the fields of 'data' in field order, so that the producer
+        can fill in a sample without looking up any channel names.
+    n : int
+        The number of samples filled in.
+
+    Methods
+    -------
+    is_full
+    to_columns
+    release
+
+    """
+
+    __slots__ = ('data', 'columns', 'n', 'capacity', 'pool')
+
+    def __init__(self, dtype, capacity, pool=None):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.columns = [self.data[name] for name in dtype.names]
+        self.n = 0
+        self.capacity = capacity
+        self.pool = pool
+
+    def is_full(self):
+        return self.n >= self.capacity
+
+    def to_columns(self):
+        """Return a copy of the filled in samples, one array per field."""
+        return dict((name, self.data[name][:self.n].copy())
+                    for name in self.data.dtype.names)
+
+    def release(self):
+        """Empty the block and hand it back to its pool."""
+        self.n = 0
+        if self.pool is not None:
+            self.pool.append(self)
+
+
+class SampleWriter(object):
+    """The producer side of the block hand-off.
+
+    A measurement thread fills in the current block through its column
+    views and calls commit after each sample. Once the block is full, or its
+    oldest sample has waited for 'max_latency' seconds, it is put on the
+    queue and the next block is taken from the pool.
+
+    Parameters
+    ----------
+    q : queue.Queue
+        The queue the measurement thread shares with the buffer.
+    chan_list : list
+        The channel declarations, in the order in which they are written,
+        see parse_channels.
+    block_size : int, optional
+        The number of samples per block. Handing off single samples costs
+        more than the tuples it replaces, blocks of 64 are about three times
+        cheaper (see RunMeas.benchmarks.bench_samples), and 'max_latency'
+        bounds the wait of slowly polled channels.
+        DEFAULT: 64
+    n_blocks : int, optional
+        The number of blocks preallocated in the pool. Two blocks give
+        double buffering, one being filled while the other is copied.
+        DEFAULT: 2
+    max_latency : float, optional
+        The longest time, in seconds, a sample may wait in a block that is
+        not full yet.
+        DEFAULT: 0.2 s
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the latency, by default RunMeas.Clock.get_clock().
+
+    Attributes
+    ----------
+    block : SampleBlock
+        The block currently being filled in.
+
+    Methods
+    -------
+    commit(wait)
+    extend(columns)
+    flush
+
+    """
+
+    def __init__(self, q, chan_list, block_size=64, n_blocks=2,
+                 max_latency=0.2, clock=None):
+        super(SampleWriter, self).__init__()
+        self.q = q
+        self.clock = clock if clock is not None else get_clock()
+        self.dtype = block_dtype(chan_list)
+        self.block_size = block_size
+        self.max_latency = max_latency
+        # A deque, as appending and popping are thread-safe without the
+        # locking overhead of a Queue
+        self.pool = deque()
+        for i in range(n_blocks):
+            self.pool.append(SampleBlock(self.dtype, block_size, self.pool))
+        self.block = self._next_block()
+        self._first = None
+
+    def _next_block(self):
+        try:
+            return self.pool.popleft()
+        except IndexError:
+            # The consumer is behind and holds all blocks
+            return SampleBlock(self.dtype, self.block_size, self.pool)
+
+    def commit(self, wait=0.0):
+        """Mark the current row of the block as complete.
+
+        Parameters
+        ----------
+        wait : float, optional
+            The time, in seconds, until the next commit. The block is handed
+            off now if waiting for the next sample would exceed
+            'max_latency'.
+            DEFAULT: 0.0
+
+        """
+        block = self.block
+        block.n += 1
+        if block.n == 1:
+            self._first = self.clock.time()
+        if block.n >= block.capacity or \
+                self.clock.time() - self._first + wait >= self.max_latency:
+            self.flush()
+
+    def extend(self, columns):
+        """Fill in many samples at once, e.g. from a device's own buffer.
+
+        Parameters
+        ----------
+        columns : list
+            One array per field in field order, i.e. the timestamps followed
+            by the channels, all of the same length.
+
+        """
+        n = len(columns[0])
+        i = 0
+        while i < n:
+            block = self.block
+            k = min(n - i, block.capacity - block.n)
+            for (col, vals) in zip(block.columns, columns):
+                col[block.n:block.n + k] = vals[i:i + k]
+            if block.n == 0:
+                self._first = self.clock.time()
+            block.n += k
+            i += k
+            if block.n >= block.capacity or \
+                    self.clock.time() - self._first >= self.max_latency:
+                self.flush()
+
+    def flush(self):
+        """Hand the current block to the queue, if it holds any samples."""
+        if self.block.n:
+            self.q.put(self.block)
+            self.block = self._next_block()
+
+
+class SampleQueue(Queue):
+    """The queue between a measurement thread and the buffer.
+
+    With a maxsize the queue is bounded, and the overflow policy decides what
+    happens when the buffer does not keep up:
+
+    - 'block': the measurement thread waits until there is room again,
+    - 'drop_oldest': the oldest queued item is dropped,
+    - 'drop_newest': the new item is dropped,
+    - 'decimate': every 'decimation'-th queued item is kept and the others
+      are dropped, so that the queued data keeps covering the whole stall at
+      a lower resolution.
+
+    Dropped sample blocks are returned to their pool. Every drop is counted.
+    Once the consumer has stopped, close() makes every later put, and every
+    put waiting for room, drop its item, so that no producer blocks forever.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of queued items, unbounded if 0.
+        DEFAULT: 0
+    policy : str, optional
+        One of 'block', 'drop_oldest', 'drop_newest' or 'decimate'.
+        DEFAULT: 'block'
+    decimation : int, optional
+        The decimation factor of the 'decimate' policy.
+        DEFAULT: 2
+
+    Attributes
+    ----------
+    dropped : int
+        The number of queue items dropped.
+    dropped_samples : int
+        The number of samples dropped, i.e. counting every row of a block.
+
+    Methods
+    -------
+    put(item, block, timeout)
+    close
+    stats
+
+    """
+
+    def __init__(self, maxsize=0, policy='block', decimation=2):
+        if policy not in POLICIES:
+            raise ValueError("The overflow policy needs to be one of "
+                             "{}".format(', '.join(POLICIES)))
+        assert type(decimation) is int and decimation > 1, (
+            'The decimation factor needs to be an int larger than one')
+        Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.decimation = decimation
+        self.dropped = 0
+        self.dropped_samples = 0
+        self.closed = False
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == 'block' or self.maxsize <= 0:
+            return self._put_blocking(item, block, timeout)
+        with self.not_full:
+            if self.closed:
+                self._drop(item)
+                return
+            if self._qsize() >= self.maxsize:
+                if self.policy == 'drop_newest':
+                    self._drop(item)
+                    return
+                elif self.policy == 'decimate':
+                    items = list(self.queue)
+                    self.queue.clear()
+                    self.unfinished_tasks -= len(items)
+                    for i, old in enumerate(items):
+                        if i % self.decimation:
+                            self._drop(old)
+                        else:
+                            self._put(old)
+                            self.unfinished_tasks += 1
+                if self._qsize() >= self.maxsize:
+                    self._drop(self._get())
+                    self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put_blocking(self, item, block, timeout):
+        """Queue.put, giving up on the item once the queue is closed."""
+        with self.not_full:
+            if timeout is not None:
+                deadline = time.monotonic() + timeout
+            while 0 < self.maxsize <= self._qsize() and not self.closed:
+                if not block:
+                    raise Full
+                if timeout is None:
+                    self.not_full.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Full
+                    self.not_full.wait(remaining)
+            if self.closed:
+                self._drop(item)
+                return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def close(self):
+        """Drop all items put from now on and release waiting producers.
+
+        The items already queued can still be taken.
+
+        """
+        with self.not_full:
+            self.closed = True
+            self.not_full.notify_all()
+
+    def _drop(self, item):
+        self.dropped += 1
+        if isinstance(item, SampleBlock):
+            self.dropped_samples += item.n
+            item.release()
+        else:
+            self.dropped_samples += 1
+
+    def stats(self):
+        """Return the fill level and the drop counts of the queue.
+
+        Returns
+        -------
+        stats : dict
+            With the keys 'size', 'maxsize', 'policy', 'dropped' and
+            'dropped_samples'.
+
+        """
+        return {'size': self.qsize(), 'maxsize': self.maxsize,
+                'policy': self.policy, 'dropped': self.dropped,
+                'dropped_samples': self.dropped_samples}
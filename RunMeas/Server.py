@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Server Module.
+
+This module contains a TCP server that streams the live data of a buffer to
+viewers on other machines. The server only reads the committed batches of
+the buffer, so the viewers add no load on the devices or the recording, e.g.
+
+    server = StreamServer(buffer, host='0.0.0.0', port=5555)
+    server.start()
+
+and on another machine
+
+    client = StreamClient('fridge-pc', 5555, 'ITC503', ['THe3', 'T1K'])
+    (kind, columns, dropped) = client.read_frame()
+
+The protocol is one JSON line each way followed by binary frames:
+
+- the client sends its subscription, {"device": ..., "channels": [...],
+  "history": seconds, "points": n},
+- the server answers with {"device": ..., "channels": [[name, dtype], ...]}
+  or with {"error": ...} and closes,
+- then the server sends frames, each a FRAME header (magic, kind, number of
+  rows, number of frames dropped so far) followed by the columns, the int64
+  timestamps first and then the subscribed channels, little-endian.
+
+The first frame, of kind HISTORY, holds the last 'history' seconds averaged
+onto the coarsest level of RunMeas.Pyramid giving at least 'points' rows,
+with the channels as float64. All following frames, of kind LIVE, hold the
+new rows of each batch at the channels' dtypes.
+Every client has its own bounded queue of frames. When a client does not
+keep up, its oldest frames are dropped and counted, without slowing down the
+collection or the other clients.
+
+"""
+
+import json
+import socket
+import struct
+from queue import Empty
+from threading import Lock, Thread
+
+import numpy as np
+
+from RunMeas.Pyramid import downsample
+from RunMeas.Samples import SampleQueue
+
+MAGIC = b'RMSB'
+FRAME = struct.Struct('<4sBIQ')
+HISTORY = 0
+LIVE = 1
+# The longest subscription line a client may send, in bytes
+MAX_LINE = 65536
+
+
+def encode_frame(kind, columns, dropped=0):
+    """Return the bytes of a frame.
+
+    Parameters
+    ----------
+    kind : int
+        HISTORY or LIVE.
+    columns : list
+        The arrays of the frame in order, timestamps first, already at the
+        dtypes announced to the client.
+    dropped : int, optional
+        The number of frames dropped so far for the client.
+
+    """
+    n = len(columns[0])
+    return FRAME.pack(MAGIC, kind, n, dropped) + b''.join(
+        np.ascontiguousarray(col).astype(col.dtype.newbyteorder('<'),
+                                         copy=False).tobytes()
+        for col in columns)
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError('The connection was closed')
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_line(sock, limit=MAX_LINE):
+    line = b''
+    while not line.endswith(b'\n'):
+        if len(line) >= limit:
+            raise ValueError('The line is longer than {} bytes'.format(limit))
+        char = sock.recv(1)
+        if not char:
+            raise ConnectionError('The connection was closed')
+        line += char
+    return json.loads(line.decode('utf-8'))
+
+
+def _parse_request(request):
+    """Check a subscription and return (device, channels, history, points).
+
+    Raises
+    ------
+    ValueError
+        If the subscription is malformed.
+
+    """
+    if not isinstance(request, dict):
+        raise ValueError('The subscription needs to be a JSON object')
+    channels = request.get('channels')
+    if channels is not None and (
+            not isinstance(channels, list) or
+            not all(isinstance(c, str) for c in channels)):
+        raise ValueError('The channels need to be a list of names')
+    try:
+        history = float(request.get('history') or 0)
+        points = int(request.get('points') or 1000)
+    except (TypeError, ValueError):
+        raise ValueError('The history and points need to be numbers')
+    if not np.isfinite(history) or history < 0 or points < 1:
+        raise ValueError('The history and points need to be positive')
+    return (request.get('device'), channels, history, points)
+
+
+def _send_line(sock, obj):
+    sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+
+class _Client(Thread):
+    """The thread sending the frames of one client."""
+
+    def __init__(self, sock, address, dev_name, channels, dtypes, maxsize):
+        super(_Client, self).__init__()
+        self.daemon = True
+        self.stop = False
+        self.sock = sock
+        self.address = address
+        self.dev_name = dev_name
+        self.channels = channels
+        self.dtypes = dtypes
+        self.q = SampleQueue(maxsize, 'drop_oldest')
+        # Rows up to this timestamp were sent with the history
+        self.since = None
+        # The batches arriving before the history is queued
+        self.held = []
+        self.lock = Lock()
+        self.closed = False
+
+    def send_batch(self, batch):
+        """Queue the new rows of a committed batch."""
+        with self.lock:
+            if self.held is not None:
+                self.held.append(batch)
+                return
+        self._queue_batch(batch)
+
+    def send_history(self, columns):
+        """Queue the history and then the batches held back meanwhile."""
+        if columns is not None:
+            self.q.put((HISTORY, columns))
+        with self.lock:
+            for batch in self.held:
+                self._queue_batch(batch)
+            self.held = None
+
+    def _queue_batch(self, batch):
+        ts = batch['timestamp']
+        if self.since is not None:
+            first = np.searchsorted(ts, self.since, side='right')
+            if first >= len(ts):
+                return
+            batch = dict((k, v[first:]) for k, v in batch.items())
+            ts = batch['timestamp']
+        if not len(ts):
+            return
+        columns = [np.asarray(ts, dtype='int64')]
+        for (chan_name, dtype) in zip(self.channels, self.dtypes[1:]):
+            columns.append(np.asarray(batch[chan_name], dtype=dtype))
+        self.q.put((LIVE, columns))
+
+    def run(self):
+        try:
+            while not self.stop:
+                try:
+                    (kind, columns) = self.q.get(timeout=0.2)
+                except Empty:
+                    continue
+                self.sock.sendall(encode_frame(kind, columns, self.q.dropped))
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.sock.close()
+
+    def stop_thread(self):
+        self.stop = True
+
+
+class _DeviceStream(object):
+    """The buffer listener handing the batches of a device to its clients.
+
+    """
+
+    def __init__(self):
+        self.clients = []
+        self.lock = Lock()
+
+    def update(self, batch):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            if client.closed:
+                with self.lock:
+                    self.clients.remove(client)
+            else:
+                client.send_batch(batch)
+
+
+class StreamServer(Thread):
+    """Thread accepting viewers and streaming the buffer to them.
+
+    Parameters
+    ----------
+    buffer : RunMeas.Buffer.Buffer
+        The buffer whose devices are streamed.
+    host : str, optional
+        The address to listen on, '0.0.0.0' for the whole LAN.
+        DEFAULT: '127.0.0.1'
+    port : int, optional
+        The port to listen on, any free port if 0.
+        DEFAULT: 0
+    maxsize : int, optional
+        The number of frames queued per client before the oldest are
+        dropped.
+        DEFAULT: 256
+    send_timeout : float, optional
+        The seconds a client may stop reading before it is disconnected.
+        DEFAULT: 10.0
+
+    Attributes
+    ----------
+    stop : boolean
+        The stop flag. When true the thread loop will end.
+    address : tuple
+        The (host, port) the server listens on.
+
+    Methods
+    -------
+    run
+    client_stats
+    stop_thread
+
+    """
+
+    def __init__(self, buffer, host='127.0.0.1', port=0, maxsize=256,
+                 send_timeout=10.0):
+        super(StreamServer, self).__init__()
+        self.stop = False
+        self.buffer = buffer
+        self.maxsize = maxsize
+        self.send_timeout = send_timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(8)
+        # Wake up regularly to check the stop flag
+        self.sock.settimeout(0.2)
+        self.address = self.sock.getsockname()
+        self.streams = {}
+        for dev_name in buffer.devices:
+            self.streams[dev_name] = _DeviceStream()
+            buffer.add_listener(dev_name, self.streams[dev_name])
+
+    def run(self):
+        """Method representing the thread's activity
+
+        See Also
+        --------
+        threading.Thread
+
+        """
+        try:
+            while not self.stop:
+                try:
+                    (sock, address) = self.sock.accept()
+                except socket.timeout:
+                    continue
+                # A slow or silent client may not hold up the others
+                Thread(target=self._handshake, args=(sock, address),
+                       daemon=True).start()
+        finally:
+            self.stop = True
+            self.sock.close()
+            for (dev_name, stream) in self.streams.items():
+                self.buffer.remove_listener(dev_name, stream)
+                with stream.lock:
+                    for client in stream.clients:
+                        client.stop_thread()
+
+    def _handshake(self, sock, address):
+        try:
+            self._subscribe(sock, address)
+        except Exception as e:
+            # Nothing a client sends may stop the server
+            print('Could not subscribe {}: {}'.format(address, e))
+            sock.close()
+
+    def _subscribe(self, sock, address):
+        sock.settimeout(5.0)
+        try:
+            (dev_name, channels, history, points) = _parse_request(
+                _recv_line(sock))
+        except ValueError as e:
+            _send_line(sock, {'error': str(e)})
+            raise
+        if not isinstance(dev_name, str) or dev_name not in self.streams:
+            _send_line(sock, {'error': 'Unknown device {}'.format(dev_name)})
+            raise KeyError(dev_name)
+        data = self.buffer.data[dev_name]
+        channels = channels or [c for c in data if c != 'timestamp']
+        unknown = [c for c in channels if c not in data]
+        if unknown:
+            _send_line(sock, {'error': 'Unknown channels {}'.format(
+                ', '.join(unknown))})
+            raise KeyError(unknown)
+        dtypes = [np.dtype('int64')] + [data[c].dtype for c in channels]
+        # A client that stops reading for this long is disconnected
+        sock.settimeout(self.send_timeout)
+        client = _Client(sock, address, dev_name, channels, dtypes,
+                         self.maxsize)
+        # Take the history and register for the new batches at once, so
+        # that no batch is missed. Rows in both are cut by 'since'.
+        with self._lock_of(dev_name):
+            data = self.buffer.data[dev_name]
+            n = len(data['timestamp'])
+            snapshot = dict((c, data[c][:n]) for c in ['timestamp'] +
+                            channels)
+            if n:
+                client.since = int(snapshot['timestamp'][-1])
+            with self.streams[dev_name].lock:
+                if self.stop:
+                    raise ConnectionError('The server is stopping')
+                self.streams[dev_name].clients.append(client)
+        try:
+            _send_line(sock, {'device': dev_name,
+                              'channels': [[c, d.str] for (c, d)
+                                           in zip(channels, dtypes[1:])]})
+            columns = None
+            if history and n:
+                ts = snapshot['timestamp']
+                keep = ts >= ts[-1] - int(history * 1e9)
+                columns = []
+                for chan_name in channels:
+                    (bins, mean, low, high) = downsample(
+                        ts[keep], snapshot[chan_name][keep], points)
+                    columns.append(np.asarray(mean, dtype='float64'))
+                columns.insert(0, np.asarray(bins, dtype='int64'))
+            client.send_history(columns)
+            client.start()
+        except Exception:
+            # Unregister, or the held batches would grow forever
+            client.closed = True
+            with self.streams[dev_name].lock:
+                self.streams[dev_name].clients.remove(client)
+            raise
+        print('Streaming {} to {}'.format(dev_name, address))
+
+    def _lock_of(self, dev_name):
+        for t in self.buffer.collection_threads:
+            if t.name == dev_name:
+                return t.lock
+        return Lock()
+
+    def client_stats(self):
+        """Return per client the device, the queue fill and the drops."""
+        return [dict(client.q.stats(), device=dev_name,
+                     address=client.address)
+                for (dev_name, stream) in self.streams.items()
+                for client in stream.clients if not client.closed]
+
+    def stop_thread(self):
+        """Method to call to halt the thread's activity."""
+        self.stop = True
+
+
+class StreamClient(object):
+    """Subscribe to a StreamServer and read its frames.
+
+    Parameters
+    ----------
+    host : str
+        The host of the server.
+    port : int
+        The port of the server.
+    dev_name : str
+        The device to subscribe to.
+    channels : list, optional
+        The channels to receive, by default all.
+    history : float, optional
+        The seconds of history to receive first.
+        DEFAULT: 0
+    points : int, optional
+        The number of rows the history is at least averaged down to.
+        DEFAULT: 1000
+
+    Attributes
+    ----------
+    channels : list
+        The (name, dtype) of the received channels.
+
+    Methods
+    -------
+    read_frame
+    close
+
+    """
+
+    def __init__(self, host, port, dev_name, channels=None, history=0,
+                 points=1000, timeout=10.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        _send_line(self.sock, {'device': dev_name, 'channels': channels,
+                               'history': history, 'points': points})
+        reply = _recv_line(self.sock)
+        if 'error' in reply:
+            self.sock.close()
+            raise KeyError(reply['error'])
+        self.channels = [(name, np.dtype(dtype))
+                         for (name, dtype) in reply['channels']]
+
+    def read_frame(self):
+        """Return the next frame.
+
+        Returns
+        -------
+        kind : int
+            HISTORY or LIVE.
+        columns : dict
+            The 'timestamp' and one array per channel.
+        dropped : int
+            The number of frames dropped so far by the server.
+
+        """
+        (magic, kind, n, dropped) = FRAME.unpack(
+            _recv_exactly(self.sock, FRAME.size))
+        if magic != MAGIC:
+            raise ValueError('Not a frame of a StreamServer')
+        columns = {'timestamp': np.frombuffer(_recv_exactly(self.sock, 8 * n),
+                                              dtype='<i8')}
+        for (name, dtype) in self.channels:
+            if kind == HISTORY:
+                dtype = np.dtype('<f8')
+            columns[name] = np.frombuffer(
+                _recv_exactly(self.sock, dtype.itemsize * n), dtype=dtype)
+        return (kind, columns, dropped)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Shared Buffer Module.
+
+This module publishes the channels of a buffer device in shared memory, so
+that other local processes (analysis notebooks, a second plotting window)
+can read the live data without going through the recording file.
+
+The shared memory block of a device starts with a fixed size header
+
+    MAGIC | capacity | committed rows | descriptor length | sequence |
+    JSON descriptor
+
+followed by one column per channel of 'capacity' rows. The columns are used
+as ring buffers: row i of the stream is stored at i % capacity. The sequence
+is a seqlock: the writer raises it to an odd number before it touches the
+rings and to the next even number once the rows and the committed row count
+are written. A reader copies the rows between two reads of the sequence and
+retries if it was odd or changed, so it never returns torn rows.
+
+"""
+
+import os
+import json
+import time
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+MAGIC = b'RMSHM002'
+HEADER_SIZE = 4096
+_HEADER = struct.Struct('<8sqqqq')
+
+
+def _column_offsets(columns, capacity):
+    offsets = []
+    offset = HEADER_SIZE
+    for (name, dtype) in columns:
+        offsets.append(offset)
+        size = np.dtype(dtype).itemsize * capacity
+        offset += size + (-size) % 8
+    return offsets, offset
+
+
+class SharedBufferWriter(object):
+    """Publish the channels of one device in shared memory.
+
+    The writer is attached to a buffer with Buffer.add_listener and copies
+    every committed batch into the shared ring buffers.
+
+    Parameters
+    ----------
+    name : str
+        The name of the shared memory block, by which readers attach.
+    columns : list
+        A list of (channel name, dtype) tuples, including the timestamp.
+    capacity : int
+        The number of rows kept in shared memory.
+
+    Methods
+    -------
+    update(batch)
+    close
+
+    """
+
+    def __init__(self, name, columns, capacity):
+        super(SharedBufferWriter, self).__init__()
+        self.name = name
+        self.columns = [(c, np.dtype(dt).str) for (c, dt) in columns]
+        self.capacity = capacity
+        descriptor = json.dumps({'columns': self.columns}).encode('utf-8')
+        if _HEADER.size + len(descriptor) > HEADER_SIZE:
+            raise ValueError("Too many channels for the shared memory header")
+        offsets, size = _column_offsets(self.columns, capacity)
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=size)
+        _HEADER.pack_into(self.shm.buf, 0, MAGIC, capacity, 0,
+                          len(descriptor), 0)
+        self.shm.buf[_HEADER.size:_HEADER.size + len(descriptor)] = descriptor
+        self._committed = np.ndarray((1,), dtype='<i8', buffer=self.shm.buf,
+                                     offset=16)
+        self._seq = np.ndarray((1,), dtype='<i8', buffer=self.shm.buf,
+                               offset=32)
+        self._arrays = dict(
+            (c, np.ndarray((capacity,), dtype=dt, buffer=self.shm.buf,
+                           offset=off))
+            for ((c, dt), off) in zip(self.columns, offsets))
+
+    def update(self, batch):
+        """Copy a committed batch into shared memory.
+
+        Parameters
+        ----------
+        batch : dict
+            The committed batch with one array per channel. Channels
+            missing from it are written as NaN, or 0 if they are not
+            floats.
+
+        """
+        n = len(batch['timestamp'])
+        if not n:
+            return
+        start = int(self._committed[0])
+        # Only the last 'capacity' rows of an oversized batch survive anyway
+        skip = max(n - self.capacity, 0)
+        idx = (start + skip + np.arange(n - skip)) % self.capacity
+        # Odd while the rings are being written
+        self._seq[0] += 1
+        for (chan_name, arr) in self._arrays.items():
+            if chan_name in batch:
+                arr[idx] = np.asarray(batch[chan_name])[skip:]
+            else:
+                # Do not leave the rows of an older batch under the count
+                arr[idx] = np.nan if arr.dtype.kind == 'f' else 0
+        self._committed[0] = start + n
+        self._seq[0] += 1
+
+    def close(self):
+        """Remove the shared memory block."""
+        self._committed = None
+        self._seq = None
+        self._arrays = {}
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedBufferReader(object):
+    """Attach read-only to the shared memory of a device.
+
+    Parameters
+    ----------
+    name : str
+        The name of the shared memory block.
+
+    Attributes
+    ----------
+    columns : list
+        A list of (channel name, dtype) tuples.
+    capacity : int
+        The number of rows kept in shared memory.
+
+    Methods
+    -------
+    committed
+    latest(n)
+    close
+
+    """
+
+    def __init__(self, name):
+        super(SharedBufferReader, self).__init__()
+        # The reader must not remove the block when its process ends
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching always registers the block, on
+            # POSIX under its name with a leading slash
+            self.shm = shared_memory.SharedMemory(name=name)
+            if os.name == 'posix':
+                resource_tracker.unregister('/' + self.shm.name,
+                                            'shared_memory')
+        (magic, capacity, committed, desc_len, seq) = _HEADER.unpack_from(
+            self.shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a RunMeas shared buffer".format(name))
+        descriptor = bytes(self.shm.buf[_HEADER.size:_HEADER.size + desc_len])
+        self.columns = [tuple(c) for c in
+                        json.loads(descriptor.decode('utf-8'))['columns']]
+        self.capacity = capacity
+        offsets, size = _column_offsets(self.columns, capacity)
+        self._committed = np.ndarray((1,), dtype='<i8', buffer=self.shm.buf,
+                                     offset=16)
+        self._seq = np.ndarray((1,), dtype='<i8', buffer=self.shm.buf,
+                               offset=32)
+        self._arrays = {}
+        for ((c, dt), off) in zip(self.columns, offsets):
+            arr = np.ndarray((capacity,), dtype=dt, buffer=self.shm.buf,
+                             offset=off)
+            arr.flags.writeable = False
+            self._arrays[c] = arr
+
+    def committed(self):
+        """Return the total number of rows committed by the writer."""
+        return int(self._committed[0])
+
+    def columns_view(self):
+        """Return the raw ring buffers, zero-copy.
+
+        Row i of the stream is at i % capacity, for the last 'capacity' rows
+        below committed().
+
+        """
+        return self._arrays
+
+    def latest(self, n=None):
+        """Return a consistent copy of the last n committed rows.
+
+        Parameters
+        ----------
+        n : int, optional
+            The number of rows. All rows still in shared memory if None.
+
+        Returns
+        -------
+        rows : dict
+            One array per channel, oldest row first.
+
+        """
+        while True:
+            seq = int(self._seq[0])
+            if seq % 2:
+                # The writer is in the middle of a batch
+                time.sleep(0)
+                continue
+            stop = self.committed()
+            n_rows = min(stop, self.capacity if n is None else
+                         min(n, self.capacity))
+            idx = np.arange(stop - n_rows, stop) % self.capacity
+            rows = dict((c, arr[idx]) for (c, arr) in self._arrays.items())
+            # If the writer started a batch meanwhile, the copy may be torn
+            if int(self._seq[0]) == seq:
+                return rows
+
+    def close(self):
+        """Detach from the shared memory block."""
+        self._committed = None
+        self._seq = None
+        self._arrays = {}
+        self.shm.close()
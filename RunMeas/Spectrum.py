@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Spectrum Module.
+
+This module contains a streaming estimate of the power spectral density of a
+channel, to diagnose vibrations and pickup, e.g. on the capacitance of the
+AH bridge, while the measurement runs. The estimator is attached to a
+buffer with Buffer.add_listener, e.g.
+
+    psd = WelchPSD('Cap', rate=5.0, segment=256)
+    buffer.add_listener('AH2500A', psd)
+    (freqs, density) = psd.spectrum()
+
+"""
+
+from threading import Lock
+
+import numpy as np
+
+
+class WelchPSD(object):
+    """Incremental Welch estimate of a channel's power spectral density.
+
+    The samples are first resampled onto a uniform grid of 'rate' Hz by
+    linear interpolation, as the devices are polled at slightly irregular
+    times. Each time a full segment has been collected it is detrended
+    (mean removed), windowed with a Hann window and Fourier transformed, and
+    its periodogram is averaged into the estimate, so that the work per
+    segment is one FFT of 'segment' points whatever the length of the run.
+    With averages=None the estimate equals scipy.signal.welch with the same
+    segment and overlap.
+
+    Parameters
+    ----------
+    channel : str
+        The name of the channel, e.g. 'Cap'.
+    rate : float
+        The sampling rate, in Hz, of the uniform grid. It should be about
+        the polling rate of the device.
+    segment : int, optional
+        The number of samples per segment. The frequency resolution is
+        rate / segment.
+        DEFAULT: 1024
+    overlap : float, optional
+        The fraction by which consecutive segments overlap.
+        DEFAULT: 0.5
+    averages : int, optional
+        The number of segments of the exponential average, so that the
+        spectrum follows changes. None averages all segments equally.
+        DEFAULT: 16
+    max_gap : float, optional
+        The longest time, in seconds, between two samples that is
+        interpolated. At a longer gap the partial segment is dropped and the
+        grid starts anew.
+        DEFAULT: 10 / rate
+
+    Attributes
+    ----------
+    freqs : numpy.ndarray
+        The frequencies, in Hz, of the estimate.
+    n_segments : int
+        The number of segments averaged so far.
+
+    Methods
+    -------
+    update(batch)
+    spectrum
+    reset
+
+    """
+
+    def __init__(self, channel, rate, segment=1024, overlap=0.5, averages=16,
+                 max_gap=None):
+        super(WelchPSD, self).__init__()
+        assert 0 <= overlap < 1, 'The overlap needs to be in [0, 1)'
+        self.channel = channel
+        self.rate = float(rate)
+        self.segment = segment
+        self.step = max(int(round(segment * (1 - overlap))), 1)
+        self.averages = averages
+        self.max_gap = max_gap if max_gap is not None else 10 / self.rate
+        # The periodic Hann window, as used by scipy.signal.welch
+        self.window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(segment) /
+                                         segment)
+        self._scale = 1 / (self.rate * np.sum(self.window ** 2))
+        self.freqs = np.fft.rfftfreq(segment, 1 / self.rate)
+        self._period = 1e9 / self.rate
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all samples and segments."""
+        self._psd = np.zeros(len(self.freqs))
+        self.n_segments = 0
+        self._pending = np.empty(self.segment)
+        self._n = 0
+        self._next = None
+        self._last = None
+
+    def update(self, batch):
+        """Feed a committed batch of the device to the estimator.
+
+        Parameters
+        ----------
+        batch : dict
+            The committed batch with a 'timestamp' array and one array per
+            channel.
+
+        """
+        if self.channel not in batch:
+            return
+        t = np.asarray(batch['timestamp'], dtype='int64')
+        v = np.asarray(batch[self.channel], dtype=float)
+        keep = np.isfinite(v)
+        (t, v) = (t[keep], v[keep])
+        if not len(t):
+            return
+        with self._lock:
+            if self._last is None:
+                self._next = int(t[0])
+            else:
+                t = np.concatenate(([self._last[0]], t))
+                v = np.concatenate(([self._last[1]], v))
+            self._last = (int(t[-1]), v[-1])
+            # Contiguous pieces between gaps that are too long
+            gaps = np.flatnonzero(np.diff(t) > self.max_gap * 1e9) + 1
+            bounds = [0] + gaps.tolist() + [len(t)]
+            for (i, (lo, hi)) in enumerate(zip(bounds[:-1], bounds[1:])):
+                if i:
+                    self._n = 0
+                    self._next = int(t[lo])
+                self._resample(t[lo:hi], v[lo:hi])
+
+    def _resample(self, t, v):
+        """Interpolate the grid points up to the last sample of a piece."""
+        if t[-1] < self._next:
+            return
+        n = int((t[-1] - self._next) // self._period) + 1
+        grid = (self._next - t[0]) + np.arange(n) * self._period
+        self._push(np.interp(grid, (t - t[0]).astype(float), v))
+        self._next += int(round(n * self._period))
+
+    def _push(self, values):
+        i = 0
+        segment = self.segment
+        while i < len(values):
+            k = min(segment - self._n, len(values) - i)
+            self._pending[self._n:self._n + k] = values[i:i + k]
+            self._n += k
+            i += k
+            if self._n == segment:
+                self._add_segment(self._pending)
+                keep = segment - self.step
+                self._pending[:keep] = self._pending[self.step:]
+                self._n = keep
+
+    def _add_segment(self, x):
+        spectrum = np.fft.rfft((x - x.mean()) * self.window)
+        power = np.abs(spectrum) ** 2 * self._scale
+        # One-sided: all but the DC and the Nyquist bin count twice
+        if self.segment % 2:
+            power[1:] *= 2
+        else:
+            power[1:-1] *= 2
+        self.n_segments += 1
+        weight = 1.0 / self.n_segments
+        if self.averages is not None:
+            weight = max(weight, 1.0 / self.averages)
+        self._psd += weight * (power - self._psd)
+
+    def spectrum(self):
+        """Return the current estimate.
+
+        Returns
+        -------
+        freqs : numpy.ndarray
+            The frequencies in Hz.
+        density : numpy.ndarray
+            The power spectral density in units**2 / Hz. Both are empty
+            until the first segment is complete.
+
+        """
+        with self._lock:
+            if not self.n_segments:
+                return (np.array([]), np.array([]))
+            return (self.freqs.copy(), self._psd.copy())
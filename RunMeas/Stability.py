@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Stability Module.
+
+This module contains the detector which tells a scripted measurement when a
+temperature has settled after a setpoint change, so that the next
+measurement step can start as soon as it safely can instead of after a fixed
+waiting time.
+
+"""
+
+from collections import deque
+from threading import Event, Lock
+
+import numpy as np
+
+from RunMeas.Clock import to_seconds
+
+
+class StabilityDetector(object):
+    """Incremental detector for a channel settling at its setpoint.
+
+    The detector is attached to a buffer with Buffer.add_listener and is fed
+    every committed batch of its device. It keeps the samples of the last
+    'window' seconds together with their running sums, so that the mean,
+    standard deviation and least-squares slope over the window are updated in
+    constant time per sample.
+    The channel is stable once, for a continuous 'hold_time', the window is
+    full and
+    - the window mean is within 'tolerance' of the target (if one is set),
+    - the standard deviation is below 'max_std' and
+    - the absolute slope is below 'max_slope'.
+
+    Parameters
+    ----------
+    channel : str
+        The name of the channel to watch, e.g. 'TSorp'.
+    tolerance : float
+        The allowed deviation of the window mean from the target.
+    window : float, optional
+        The length of the sliding window in seconds.
+        DEFAULT: 60 s
+    hold_time : float, optional
+        How long, in seconds, the conditions need to hold continuously.
+        DEFAULT: 30 s
+    max_slope : float, optional
+        The allowed absolute slope in units per second.
+        DEFAULT: tolerance / window
+    max_std : float, optional
+        The allowed standard deviation in the window.
+        DEFAULT: tolerance
+    target : float, optional
+        The value the channel should settle at. Without a target only the
+        slope and the noise are judged.
+
+    Attributes
+    ----------
+    stable : threading.Event
+        Set while the channel is stable.
+
+    Methods
+    -------
+    update(batch)
+    reset(target)
+    wait_until_stable(timeout)
+    is_stable
+
+    """
+
+    def __init__(self, channel, tolerance, window=60.0, hold_time=30.0,
+                 max_slope=None, max_std=None, target=None):
+        super(StabilityDetector, self).__init__()
+        self.channel = channel
+        self.tolerance = tolerance
+        self.window = window
+        self.hold_time = hold_time
+        self.max_slope = (max_slope if max_slope is not None
+                          else tolerance / window)
+        self.max_std = max_std if max_std is not None else tolerance
+        self.stable = Event()
+        self._lock = Lock()
+        self.reset(target)
+
+    def reset(self, target=None):
+        """Start judging afresh, e.g. right after a setpoint change.
+
+        Parameters
+        ----------
+        target : float, optional
+            The new value the channel should settle at.
+
+        """
+        with self._lock:
+            self.target = target
+            self._samples = deque()
+            self._t0 = None
+            self._sums = np.zeros(6)
+            self._stable_since = None
+            self.stable.clear()
+
+    def update(self, batch):
+        """Feed a committed batch of the device to the detector.
+
+        Parameters
+        ----------
+        batch : dict
+            The committed batch with a 'timestamp' array and one array per
+            channel.
+
+        """
+        if self.channel not in batch:
+            return
+        times = to_seconds(batch['timestamp'])
+        values = np.asarray(batch[self.channel], dtype=float)
+        with self._lock:
+            for t, y in zip(times.tolist(), values.tolist()):
+                self._add_sample(t, y)
+
+    def _add_sample(self, t, y):
+        if self._t0 is None:
+            self._t0 = t
+        t = t - self._t0
+        self._samples.append((t, y))
+        self._sums += (1, t, y, t * t, t * y, y * y)
+        while self._samples and self._samples[0][0] < t - self.window:
+            (t_old, y_old) = self._samples.popleft()
+            self._sums -= (1, t_old, y_old, t_old * t_old, t_old * y_old,
+                           y_old * y_old)
+
+        if self._conditions_hold(t):
+            if self._stable_since is None:
+                self._stable_since = t
+            if t - self._stable_since >= self.hold_time:
+                self.stable.set()
+        else:
+            self._stable_since = None
+            self.stable.clear()
+
+    def _conditions_hold(self, t):
+        (n, st, sy, stt, sty, syy) = self._sums
+        # The window needs to be covered since the reset before it is judged
+        if n < 2 or t < self.window:
+            return False
+        mean = sy / n
+        var = max(syy / n - mean * mean, 0.0)
+        denom = n * stt - st * st
+        slope = (n * sty - st * sy) / denom if denom > 0 else 0.0
+        if self.target is not None and abs(mean - self.target) > \
+                self.tolerance:
+            return False
+        return abs(slope) <= self.max_slope and var <= self.max_std ** 2
+
+    def is_stable(self):
+        """Return whether the channel is currently stable."""
+        return self.stable.is_set()
+
+    def wait_until_stable(self, timeout=None):
+        """Block until the channel is stable.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time to wait in seconds. Wait forever if None.
+
+        Returns
+        -------
+        bool
+            True if the channel became stable, False on timeout.
+
+        """
+        return self.stable.wait(timeout)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Sweep Module.
+
+This module contains the engine for running scripted temperature sweeps,
+i.e. stepping the sorption pump setpoint of an ITC through a list of values,
+waiting at each step until the temperature is stable and then recording a
+given number of readings from the other devices.
+
+"""
+
+from threading import Thread
+
+from RunMeas.Stability import StabilityDetector
+
+
+class TemperatureSweep(Thread):
+    """Thread running a temperature sweep on top of a buffer.
+
+    The sweep drives the ITC through set_setpoint, auto_heat_on and
+    auto_pid_on, and only reads data from the buffer. All devices keep being
+    collected during the sweep, so while the ITC settles the other devices
+    keep acquiring, and at each step the readings of all recorded devices are
+    taken at the same time.
+    Each recorded stretch is tagged with its sweep step via
+    Buffer.add_segment, which ends up in the recording next to the data.
+
+    Parameters
+    ----------
+    buffer : RunMeas.Buffer.Buffer
+        The buffer collecting from the ITC and the recorded devices. Its
+        collection needs to be running.
+    itc_name : str
+        The name of the ITC in the buffer.
+    setpoints : list
+        The setpoints, in Kelvin, to step through.
+    record_devices : list
+        The names of the devices in the buffer whose readings are recorded at
+        each step, e.g. ['AH'].
+    n_readings : int
+        The number of readings to record per device at each step.
+    detector : RunMeas.Stability.StabilityDetector, optional
+        The detector deciding when the ITC is stable.
+        DEFAULT: a detector on 'TSorp' with a tolerance of 0.01 K
+    settle_timeout : float, optional
+        The maximum time, in seconds, to wait for the temperature to settle.
+        On timeout the readings are taken anyway. Wait forever if None.
+    poll : float, optional
+        How often, in seconds, the sweep checks whether it has been stopped.
+        DEFAULT: 0.1 s
+    clock : RunMeas.Clock.RealClock, optional
+        The clock of the waits, by default the clock of the buffer.
+
+    Attributes
+    ----------
+    stop : boolean
+        The stop flag. When true the sweep ends after the current wait.
+    step : int
+        The index of the current sweep step, None before the sweep started.
+    finished : boolean
+        Whether all steps have been completed.
+
+    Methods
+    -------
+    run
+    stop_thread
+
+    """
+
+    def __init__(self, buffer, itc_name, setpoints, record_devices,
+                 n_readings, detector=None, settle_timeout=None, poll=0.1,
+                 clock=None):
+        super(TemperatureSweep, self).__init__()
+        assert type(setpoints) is list, 'The setpoints need to be a list'
+        assert type(record_devices) is list, ('The recorded devices need to '
+                                              'be a list of device names')
+        for dev_name in [itc_name] + record_devices:
+            if dev_name not in buffer.devices:
+                raise KeyError("There is no device named {}".format(dev_name))
+        self.buffer = buffer
+        self.itc_name = itc_name
+        self.setpoints = setpoints
+        self.record_devices = record_devices
+        self.n_readings = n_readings
+        if detector is None:
+            detector = StabilityDetector('TSorp', tolerance=0.01)
+        self.detector = detector
+        self.settle_timeout = settle_timeout
+        self.poll = poll
+        self.clock = clock if clock is not None else buffer.clock
+        self.clock.attach(self)
+        self.stop = False
+        self.step = None
+        self.finished = False
+
+    def run(self):
+        """Method representing the thread's activity
+
+        See Also
+        --------
+        threading.Thread
+
+        """
+        itc = self.buffer.devices[self.itc_name]['device']
+        self.buffer.add_listener(self.itc_name, self.detector)
+        try:
+            itc.auto_pid_on()
+            itc.auto_heat_on()
+            for step, setpoint in enumerate(self.setpoints):
+                self.step = step
+                itc.set_setpoint(setpoint)
+                self.detector.reset(setpoint)
+                if not self._wait_until_stable():
+                    if self.stop:
+                        return
+                    print('Setpoint {} K not stable after {} s, recording '
+                          'anyway'.format(setpoint, self.settle_timeout))
+                if not self._record(step, setpoint):
+                    return
+            self.finished = True
+        finally:
+            self.buffer.remove_listener(self.itc_name, self.detector)
+
+    def _wait_until_stable(self):
+        start = self.clock.time()
+        while not self.stop:
+            if self.clock.wait(self.detector.stable, self.poll):
+                return True
+            if (self.settle_timeout is not None and
+                    self.clock.time() - start > self.settle_timeout):
+                return False
+        return False
+
+    def _record(self, step, setpoint):
+        """Wait for n_readings new rows of every recorded device and tag them.
+
+        """
+        data = self.buffer.data
+        starts = dict((dev_name, len(data[dev_name]['timestamp']))
+                      for dev_name in self.record_devices)
+        pending = list(self.record_devices)
+        while pending:
+            if self.stop:
+                return False
+            for dev_name in list(pending):
+                timestamps = data[dev_name]['timestamp']
+                stop = starts[dev_name] + self.n_readings
+                if len(timestamps) >= stop:
+                    self.buffer.add_segment(step, dev_name, setpoint,
+                                            timestamps[starts[dev_name]],
+                                            timestamps[stop - 1])
+                    pending.remove(dev_name)
+            if pending:
+                self.clock.sleep(self.poll)
+        return True
+
+    def stop_thread(self):
+        """Method to call to halt the sweep."""
+        self.stop = True
+        self.clock.wake(self)
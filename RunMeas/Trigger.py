@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The Trigger Module.
+
+This module contains the event capture for sudden changes of a channel,
+e.g. flux jumps or phase transitions seen in the capacitance of the AH
+bridge. An EventCapture is attached to a buffer with Buffer.add_trigger. It
+keeps the last samples of the device in a fixed-size pre-trigger ring,
+evaluates its trigger conditions on every committed batch at once, and on a
+trigger keeps the samples before and after it at full resolution. The
+recording writes these windows to events/<device>, so that the continuous
+stream can be decimated without losing the events, e.g.
+
+    capture = EventCapture([Slope('Cap', 0.05)], pre=500, post=2000)
+    buffer.add_trigger('AH2500A', capture)
+    buffer.start_recording(deadband={'AH2500A': Decimator(10)})
+
+"""
+
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Clock import to_seconds
+
+DIRECTIONS = ('rising', 'falling', 'both')
+# The width of the recorded cause, in bytes; longer causes are cut
+CAUSE_SIZE = 80
+
+
+class Threshold(object):
+    """Trigger when a channel crosses a level.
+
+    Parameters
+    ----------
+    channel : str
+        The name of the channel, e.g. 'Cap'.
+    level : float
+        The level to cross.
+    direction : str, optional
+        'rising', 'falling' or 'both'.
+        DEFAULT: 'rising'
+
+    Methods
+    -------
+    fire(timestamps, values)
+    reset
+
+    """
+
+    def __init__(self, channel, level, direction='rising'):
+        super(Threshold, self).__init__()
+        assert direction in DIRECTIONS, ('The direction needs to be one of '
+                                         '{}'.format(', '.join(DIRECTIONS)))
+        self.channel = channel
+        self.level = level
+        self.direction = direction
+        self.name = '{} {} through {}'.format(channel, direction, level)
+        self.reset()
+
+    def reset(self):
+        self._last = None
+
+    def fire(self, timestamps, values):
+        """Return which samples of a batch cross the level.
+
+        The first sample is compared with the last one of the previous
+        batch.
+
+        """
+        values = np.asarray(values, dtype=float)
+        prev = np.empty_like(values)
+        prev[1:] = values[:-1]
+        prev[0] = self._last if self._last is not None else values[0]
+        self._last = values[-1]
+        rising = (prev < self.level) & (values >= self.level)
+        falling = (prev > self.level) & (values <= self.level)
+        if self.direction == 'rising':
+            return rising
+        if self.direction == 'falling':
+            return falling
+        return rising | falling
+
+
+class Slope(object):
+    """Trigger when a channel changes faster than a rate.
+
+    Parameters
+    ----------
+    channel : str
+        The name of the channel, e.g. 'Cap'.
+    rate : float
+        The rate, in units per second, between two consecutive samples.
+    direction : str, optional
+        'rising', 'falling' or 'both'.
+        DEFAULT: 'both'
+
+    Methods
+    -------
+    fire(timestamps, values)
+    reset
+
+    """
+
+    def __init__(self, channel, rate, direction='both'):
+        super(Slope, self).__init__()
+        assert direction in DIRECTIONS, ('The direction needs to be one of '
+                                         '{}'.format(', '.join(DIRECTIONS)))
+        self.channel = channel
+        self.rate = rate
+        self.direction = direction
+        self.name = '{} {} faster than {}/s'.format(channel, direction, rate)
+        self.reset()
+
+    def reset(self):
+        self._last = None
+
+    def fire(self, timestamps, values):
+        """Return which samples of a batch change faster than the rate.
+
+        The first sample is compared with the last one of the previous
+        batch.
+
+        """
+        times = to_seconds(timestamps)
+        values = np.asarray(values, dtype=float)
+        if self._last is not None:
+            times = np.concatenate(([self._last[0]], times))
+            values = np.concatenate(([self._last[1]], values))
+        else:
+            times = np.concatenate((times[:1], times))
+            values = np.concatenate((values[:1], values))
+        self._last = (times[-1], values[-1])
+        dt = np.diff(times)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(dt > 0, np.diff(values) / dt, 0.0)
+        if self.direction == 'rising':
+            return slope >= self.rate
+        if self.direction == 'falling':
+            return slope <= -self.rate
+        return np.abs(slope) >= self.rate
+
+
+class Decimator(object):
+    """Keep every 'factor'-th row of a device's continuous stream.
+
+    It has the interface of RunMeas.Compression.DeadbandFilter and is passed
+    to the recording in the same way. The rows are counted across batches.
+
+    Parameters
+    ----------
+    factor : int
+        The decimation factor.
+
+    Methods
+    -------
+    filter(rows)
+    reset
+
+    """
+
+    def __init__(self, factor):
+        super(Decimator, self).__init__()
+        assert factor >= 1, 'The decimation factor needs to be at least 1'
+        self.factor = int(factor)
+        self.reset()
+
+    def reset(self):
+        self._count = 0
+
+    def filter(self, rows):
+        n = len(rows['timestamp'])
+        first = (-self._count) % self.factor
+        self._count += n
+        return dict((k, v[first::self.factor]) for k, v in rows.items())
+
+
+class _Ring(object):
+    """A fixed number of the latest rows, in a preallocated array."""
+
+    def __init__(self, dtype, capacity):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.n = 0
+        self.i = 0
+
+    def extend(self, batch):
+        n = len(batch['timestamp'])
+        cap = self.capacity
+        if not cap:
+            return
+        skip = max(n - cap, 0)
+        k = n - skip
+        first = min(k, cap - self.i)
+        for name in self.data.dtype.names:
+            vals = batch[name][skip:]
+            self.data[name][self.i:self.i + first] = vals[:first]
+            self.data[name][:k - first] = vals[first:]
+        self.i = (self.i + k) % cap
+        self.n = min(self.n + k, cap)
+
+    def last(self, k):
+        """Return the last k rows, oldest first, one array per field."""
+        k = min(k, self.n)
+        idx = (self.i - k + np.arange(k)) % max(self.capacity, 1)
+        rows = self.data[idx]
+        return dict((name, rows[name]) for name in self.data.dtype.names)
+
+
+class EventCapture(object):
+    """Capture the samples around triggers at full resolution.
+
+    The capture is attached with Buffer.add_trigger and is fed every
+    committed batch of its device. A trigger opens an event holding the
+    'pre' samples before it, from the ring and the batch, and the 'post'
+    samples from the trigger on, collected from the following batches if
+    needed. Triggers while an event is open, and for 'holdoff' seconds
+    after it, are ignored, so that a burst of samples over a slope gives a
+    single event.
+
+    Parameters
+    ----------
+    conditions : list
+        The trigger conditions, e.g. Threshold or Slope. Any of them
+        triggers.
+    pre : int, optional
+        The number of samples kept before the trigger.
+        DEFAULT: 1000
+    post : int, optional
+        The number of samples kept from the trigger on.
+        DEFAULT: 1000
+    holdoff : float, optional
+        The dead time, in seconds, after an event.
+        DEFAULT: 0 s
+
+    Attributes
+    ----------
+    events : list
+        The completed events not yet taken by the recording, as
+        dictionaries with the 'trigger' timestamp, its 'cause' and the
+        'rows', one array per channel.
+    n_events : int
+        The number of events completed so far.
+
+    Methods
+    -------
+    update(batch)
+    take_events
+    reset
+
+    """
+
+    def __init__(self, conditions, pre=1000, post=1000, holdoff=0.0):
+        super(EventCapture, self).__init__()
+        assert post >= 1, 'The post-trigger window needs at least one sample'
+        self.conditions = conditions
+        self.pre = pre
+        self.post = post
+        self.holdoff = holdoff
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget the ring, the open event and the untaken events."""
+        self.events = []
+        self.n_events = 0
+        self._ring = None
+        self._open = None
+        self._holdoff_until = None
+        for condition in self.conditions:
+            condition.reset()
+
+    def update(self, batch):
+        """Feed a committed batch of the device to the capture.
+
+        Parameters
+        ----------
+        batch : dict
+            The committed batch with a 'timestamp' array and one array per
+            channel.
+
+        """
+        ts = batch['timestamp']
+        n = len(ts)
+        if not n:
+            return
+        with self._lock:
+            if self._ring is None:
+                dtype = [(name, np.asarray(vals).dtype)
+                         for name, vals in batch.items()]
+                self._ring = _Ring(dtype, self.pre)
+            names = self._ring.data.dtype.names
+            batch = dict((name, np.asarray(batch[name])) for name in names)
+            # The index of the first condition firing at each sample, or -1
+            cause = np.full(n, -1)
+            for j, condition in reversed(list(enumerate(self.conditions))):
+                if condition.channel in batch:
+                    fired = condition.fire(ts, batch[condition.channel])
+                    cause[fired] = j
+            start = 0
+            if self._open is not None:
+                start = self._fill(batch, 0)
+            candidates = np.flatnonzero(cause >= 0)
+            k = 0
+            while True:
+                k = max(k, np.searchsorted(candidates, start))
+                if self._holdoff_until is not None:
+                    k = max(k, np.searchsorted(ts[candidates],
+                                               self._holdoff_until))
+                if k >= len(candidates):
+                    break
+                i = candidates[k]
+                parts = []
+                if i < self.pre:
+                    parts.append(self._ring.last(self.pre - i))
+                lo = max(i - self.pre, 0)
+                parts.append(dict((name, batch[name][lo:i])
+                                  for name in names))
+                self._open = {'trigger': int(ts[i]),
+                              'cause': self.conditions[cause[i]].name,
+                              'parts': parts, 'needed': self.post}
+                start = self._fill(batch, i)
+            self._ring.extend(batch)
+
+    def _fill(self, batch, i):
+        """Add the post-trigger samples from index i on to the open event.
+
+        Returns the index after the samples taken.
+
+        """
+        event = self._open
+        stop = min(i + event['needed'], len(batch['timestamp']))
+        event['parts'].append(dict((name, vals[i:stop])
+                                   for name, vals in batch.items()))
+        event['needed'] -= stop - i
+        if not event['needed']:
+            rows = dict((name, np.concatenate([p[name]
+                                               for p in event['parts']]))
+                        for name in batch)
+            self.events.append({'trigger': event['trigger'],
+                                'cause': event['cause'], 'rows': rows})
+            self.n_events += 1
+            self._holdoff_until = (rows['timestamp'][-1] +
+                                   int(self.holdoff * 1e9))
+            self._open = None
+        return stop
+
+    def take_events(self):
+        """Return the completed events and forget them."""
+        with self._lock:
+            events = self.events
+            self.events = []
+        return events
+
+
+def events_key(dev_name):
+    return 'events/' + dev_name
+
+
+def write_events(store, dev_name, events):
+    """Append captured events to a recording.
+
+    The samples go to events/<device>/windows with the trigger timestamp of
+    their event in the column 'trigger', and one row per event to
+    events/<device>/triggers. The cause is cut to CAUSE_SIZE bytes, as the
+    channel names in it may be of any length.
+
+    Parameters
+    ----------
+    store : pandas.HDFStore
+        The open recording.
+    dev_name : str
+        The name of the device.
+    events : list
+        The events, see EventCapture.take_events.
+
+    """
+    if not events:
+        return
+    windows = []
+    for event in events:
+        df = pd.DataFrame(data=event['rows']).set_index('timestamp')
+        df['trigger'] = np.int64(event['trigger'])
+        windows.append(df)
+    key = events_key(dev_name)
+    store.append(key + '/windows', pd.concat(windows), format='table')
+    triggers = pd.DataFrame(
+        {'cause': [_fit_cause(event['cause']) for event in events],
+         'rows': [len(event['rows']['timestamp']) for event in events]},
+        index=pd.Index([event['trigger'] for event in events],
+                       dtype='int64', name='trigger'))
+    store.append(key + '/triggers', triggers, format='table',
+                 min_itemsize={'cause': CAUSE_SIZE})
+
+
+def _fit_cause(cause):
+    # Cut on the encoded bytes without splitting a character
+    return cause.encode('utf-8')[:CAUSE_SIZE].decode('utf-8', 'ignore')
+
+
+def read_events(file_name, dev_name):
+    """Read the events of a device from a recording.
+
+    Returns
+    -------
+    events : list
+        One dictionary per event with the 'trigger' timestamp, its 'cause'
+        and the 'data', a DataFrame indexed by timestamp.
+
+    """
+    key = events_key(dev_name)
+    with pd.HDFStore(file_name, mode='r') as store:
+        if key + '/triggers' not in store:
+            return []
+        triggers = store.select(key + '/triggers')
+        windows = store.select(key + '/windows')
+    groups = dict(list(windows.groupby('trigger')))
+    return [{'trigger': int(trigger), 'cause': cause,
+             'data': groups[trigger].drop(columns='trigger')}
+            for trigger, cause in zip(triggers.index, triggers['cause'])]
@@ -0,0 +1,999 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""The benchmark script.
+
+Small benchmarks of the acquisition and recording pipeline. Run e.g.
+
+    python -m RunMeas.benchmarks journal
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+from queue import Queue
+from threading import Lock, Thread, active_count
+
+from RunMeas.Alarm import AlarmEngine, Above, RateAbove, Stale
+from RunMeas.Buffer import (Buffer, BufferCollectionThread,
+                            BufferRecordThread)
+from RunMeas.Clock import RealClock, VirtualClock, now_ns
+from RunMeas.Compression import DeadbandFilter, read_packed
+from RunMeas.Pyramid import read_range
+from RunMeas.Recovery import RetryPolicy
+from RunMeas.Cache import QueryCache
+from RunMeas.Catalog import CATALOG_NAME, RunCatalog
+from RunMeas.Derived import Rate, RollingMean
+from RunMeas.LockinDevice import (SR830Device, LockinMeasurementThread,
+                                  SimulatedSR830)
+from RunMeas.Replay import ReplayThread
+from RunMeas.Samples import SampleQueue, SampleWriter, parse_channels
+from RunMeas.Server import StreamClient, StreamServer
+from RunMeas.Spectrum import WelchPSD
+from RunMeas.Trigger import Decimator, EventCapture, Slope, read_events
+
+
+def _fake_device_data(n_rows, start=0):
+    timestamps = (np.arange(start, start + n_rows, dtype='int64') *
+                  int(1e8))
+    return {'timestamp': timestamps,
+            'TSorp': np.random.normal(30, 0.01, n_rows),
+            'THe3': np.random.normal(0.3, 0.001, n_rows),
+            'T1K': np.random.normal(1.5, 0.001, n_rows)}
+
+
+def bench_journal(n_batches=200, batch_size=10):
+    """Compare recording with and without the write-ahead journal.
+
+    The recording thread is driven by hand, one write_new_rows call per
+    batch, just as its loop would do every 'delay' seconds.
+
+    """
+    results = {}
+    for (label, journal, sync) in (('plain', False, False),
+                                   ('journal', True, False),
+                                   ('journal+fsync', True, True)):
+        folder = tempfile.mkdtemp()
+        try:
+            dev_data = {'ITC503': _fake_device_data(0)}
+            t = BufferRecordThread(dev_data, 'bench', folder, journal=journal)
+            t.open()
+            if t.journal is not None:
+                t.journal.sync = sync
+            start = time.time()
+            for i in range(n_batches):
+                new = _fake_device_data(batch_size, i * batch_size)
+                for k, v in new.items():
+                    dev_data['ITC503'][k] = np.append(dev_data['ITC503'][k],
+                                                      v)
+                t.write_new_rows()
+            elapsed = time.time() - start
+            t.close()
+        finally:
+            shutil.rmtree(folder)
+        results[label] = elapsed
+        print('{:>14}: {:7.1f} ms per batch of {} rows'.format(
+            label, 1e3 * elapsed / n_batches, batch_size))
+    return results
+
+
+def _empty_device_data(chan_list):
+    dev_data = {'timestamp': np.array([], dtype='int64')}
+    for chan_name in chan_list:
+        dev_data[chan_name] = np.array([])
+    return dev_data
+
+
+def bench_samples(n_samples=20000, rate=1000,
+                  block_sizes=(1, 4, 16, 64, 256)):
+    """Compare handing samples over as tuples and as sample blocks.
+
+    A simulated device produces 'rate' samples per second, and the collector
+    commits every 0.1 s worth of samples. Both run in the calling thread, so
+    the CPU time per sample of the whole hand-off is measured, for blocks of
+    every size in 'block_sizes'.
+
+    """
+    chan_list = ['TSorp', 'THe3', 'T1K']
+    values = (249.2, 7.0, 7.0)
+    chunk = rate // 10
+    results = {}
+
+    def run(label, produce):
+        q = Queue()
+        t = BufferCollectionThread('bench', q, _empty_device_data(chan_list))
+        start = time.process_time()
+        produce(q, t)
+        elapsed = time.process_time() - start
+        assert len(t.dev_data['TSorp']) == n_samples
+        results[label] = elapsed
+        per_sample = 1e6 * elapsed / n_samples
+        print('{:>16}: {:6.2f} us per sample, {:5.1f} % of one core at '
+              '{} Hz'.format(label, per_sample, per_sample * rate / 1e4,
+                             rate))
+
+    def tuples(q, t):
+        for i in range(0, n_samples, chunk):
+            for j in range(chunk):
+                q.put((datetime.now(), ('TSorp', values[0]),
+                       ('THe3', values[1]), ('T1K', values[2])))
+            t._commit(t._get_batch())
+
+    def blocks(block_size):
+        def produce(q, t):
+            writer = SampleWriter(q, chan_list, block_size=block_size,
+                                  max_latency=1.0)
+            for i in range(0, n_samples, chunk):
+                for j in range(chunk):
+                    block = writer.block
+                    k = block.n
+                    cols = block.columns
+                    cols[0][k] = now_ns()
+                    for m, val in enumerate(values, 1):
+                        cols[m][k] = val
+                    writer.commit()
+                writer.flush()
+                t._commit(t._get_batch())
+        return produce
+
+    run('tuples', tuples)
+    for block_size in block_sizes:
+        run('blocks of {}'.format(block_size), blocks(block_size))
+    return results
+
+
+def bench_dtypes(hours=24, rate=10):
+    """Compare buffer memory and file size of float64 and typed channels.
+
+    Simulates 'hours' of an ITC polled at 'rate' Hz with its three
+    temperatures, the heater sensor id and the auto heat flag, and records
+    it in hourly batches.
+
+    """
+    n_rows = int(hours * 3600 * rate)
+    declarations = {
+        'float64': ['TSorp', 'THe3', 'T1K', 'HeaterSensor', 'AutoHeat'],
+        'typed': [('TSorp', 'f4'), ('THe3', 'f4'), ('T1K', 'f4'),
+                  ('HeaterSensor', 'i1'), ('AutoHeat', bool)]}
+    values = {'TSorp': np.random.normal(30, 0.01, n_rows),
+              'THe3': np.random.normal(0.3, 0.001, n_rows),
+              'T1K': np.random.normal(1.5, 0.001, n_rows),
+              'HeaterSensor': np.ones(n_rows),
+              'AutoHeat': np.random.rand(n_rows) > 0.5}
+    timestamps = np.arange(n_rows, dtype='int64') * int(1e9 / rate)
+    results = {}
+    for label, chan_list in sorted(declarations.items()):
+        dev_data = {'timestamp': timestamps}
+        for (chan_name, dtype) in parse_channels(chan_list):
+            dev_data[chan_name] = values[chan_name].astype(dtype)
+        memory = sum(v.nbytes for v in dev_data.values())
+        folder = tempfile.mkdtemp()
+        try:
+            data = {'ITC503': dict((k, v[:0]) for k, v in dev_data.items())}
+            t = BufferRecordThread(data, 'bench', folder, journal=False)
+            t.open()
+            step = 3600 * rate
+            for i in range(0, n_rows, step):
+                data['ITC503'] = dict((k, v[:i + step])
+                                      for k, v in dev_data.items())
+                t.write_new_rows()
+            t.close()
+            disk = os.path.getsize(t.file_name)
+        finally:
+            shutil.rmtree(folder)
+        results[label] = (memory, disk)
+        print('{:>8}: {:6.1f} MB in memory, {:6.1f} MB on disk for {} h at '
+              '{} Hz'.format(label, memory / 1e6, disk / 1e6, hours, rate))
+    return results
+
+
+def _traces(n_rows, rate):
+    """Simulate ITC and AH readings as the instruments report them.
+
+    The temperatures cool down exponentially with some noise and are rounded
+    to the 0.1 mK of the ITC read-out, the capacitance bridge reports seven
+    digits of a slowly drifting capacitance.
+
+    """
+    t = np.arange(n_rows) / rate
+    timestamps = (np.arange(n_rows, dtype='int64') * int(1e9 / rate) +
+                  np.random.randint(0, int(1e6), n_rows))
+    itc = {'timestamp': timestamps,
+           'TSorp': np.round(4 + 26 * np.exp(-t / 1800) +
+                             np.random.normal(0, 2e-4, n_rows), 4),
+           'THe3': np.round(0.3 + 1.2 * np.exp(-t / 3600) +
+                            np.random.normal(0, 5e-5, n_rows), 4),
+           'T1K': np.round(1.5 + np.random.normal(0, 5e-5, n_rows), 4)}
+    ah = {'timestamp': timestamps,
+          'Cap': np.round(1.5 + 1e-6 * t / 60 +
+                          np.random.normal(0, 2e-7, n_rows), 7),
+          'Loss': np.round(np.random.normal(1e-4, 1e-6, n_rows), 7),
+          'Volt': np.repeat(0.75, n_rows)}
+    return {'ITC503': itc, 'AH2500A': ah}
+
+
+def bench_compression(hours=1, rate=10, batch_size=50):
+    """Compare the file size and throughput of the recording formats.
+
+    Records 'hours' of simulated ITC and AH traces at 'rate' Hz in batches
+    of 'batch_size' rows, as plain tables, in the packed format, and each
+    of them behind a deadband of the read-out resolution with a 60 s
+    heartbeat.
+
+    """
+    n_rows = int(hours * 3600 * rate)
+    traces = _traces(n_rows, rate)
+    raw_bytes = sum(v.nbytes for dev in traces.values() for v in dev.values())
+    resolutions = {'TSorp': 1e-3, 'THe3': 2e-4, 'T1K': 2e-4,
+                   'Cap': 1e-6, 'Loss': 1e-5, 'Volt': 0.0}
+    results = {}
+    for (label, deadband, packed) in (('table', False, False),
+                                      ('packed', False, True),
+                                      ('deadband table', True, False),
+                                      ('deadband packed', True, True)):
+        folder = tempfile.mkdtemp()
+        try:
+            data = dict((dev_name, dict((k, v[:0]) for k, v in dev.items()))
+                        for dev_name, dev in traces.items())
+            filters = None
+            if deadband:
+                filters = dict((dev_name, DeadbandFilter(resolutions, 60.0))
+                               for dev_name in traces)
+            t = BufferRecordThread(data, 'bench', folder, journal=False,
+                                   deadband=filters, packed=packed)
+            t.open()
+            start = time.perf_counter()
+            for i in range(0, n_rows, batch_size):
+                for dev_name, dev in traces.items():
+                    data[dev_name] = dict((k, v[:i + batch_size])
+                                          for k, v in dev.items())
+                t.write_new_rows()
+            t.close()
+            write = time.perf_counter() - start
+            disk = os.path.getsize(t.file_name)
+            start = time.perf_counter()
+            for dev_name in traces:
+                if packed:
+                    read_packed(t.file_name, dev_name)
+                else:
+                    pd.read_hdf(t.file_name, 'raw/' + dev_name)
+            read = time.perf_counter() - start
+            stored = sum(t.file_rows.values())
+        finally:
+            shutil.rmtree(folder)
+        results[label] = (disk, write, read)
+        print('{:>16}: {:6.2f} MB on disk (ratio {:5.1f}), {:6d} of {} rows, '
+              'write {:6.1f} MB/s, read {:6.1f} MB/s'.format(
+                  label, disk / 1e6, raw_bytes / disk, stored, 2 * n_rows,
+                  raw_bytes / write / 1e6, raw_bytes / read / 1e6))
+    return results
+
+
+class _PolledThread(Thread):
+    """A device thread whose queries take 'latency' seconds of I/O."""
+
+    def __init__(self, delay, latency):
+        super(_PolledThread, self).__init__()
+        self.stop = False
+        self.clock = RealClock()
+        self.delay = delay
+        self.latency = latency
+        self.chan_list = ['THe3', 'TSorp']
+        self.q = SampleQueue()
+        self.writer = SampleWriter(self.q, self.chan_list, clock=self.clock)
+
+    def sample(self):
+        block = self.writer.block
+        block.columns[0][block.n] = self.clock.now_ns()
+        time.sleep(self.latency)
+        block.columns[1][block.n] = 0.3
+        block.columns[2][block.n] = 20.0
+        self.writer.commit(self.delay)
+        return self.delay
+
+    def run(self):
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            self.sample()
+        self.writer.flush()
+
+    def stop_thread(self):
+        self.stop = True
+
+
+class _Latency(object):
+    """A listener recording the time from sample to commit."""
+
+    def __init__(self):
+        self.latencies = []
+
+    def update(self, batch):
+        self.latencies.extend((now_ns() - batch['timestamp']) / 1e9)
+
+
+def bench_pool(devices=(1, 7, 21, 42), seconds=3.0, delay=0.1,
+               latency=0.002, workers=2):
+    """Compare a thread per device with a pool of workers.
+
+    Polls 'devices' simulated instruments, each every 'delay' seconds with
+    'latency' seconds of I/O per sample, once with a measurement and a
+    collection thread per device and once with a DevicePool and a single
+    collection thread. Reports the threads, the CPU time, the samples per
+    device and the time from sample to commit.
+
+    """
+    results = {}
+    for n_devices in devices:
+        for mode in ('threads', 'pool'):
+            threads = [_PolledThread(delay, latency)
+                       for i in range(n_devices)]
+            buffer = Buffer([('dev{}'.format(i), None, t)
+                             for (i, t) in enumerate(threads)],
+                            workers=workers if mode == 'pool' else None)
+            listener = _Latency()
+            for dev_name in buffer.devices:
+                buffer.add_listener(dev_name, listener)
+            n_threads = active_count()
+            cpu = time.process_time()
+            buffer.start_collection()
+            time.sleep(seconds)
+            n_threads = active_count() - n_threads
+            buffer.stop_collection()
+            if mode == 'threads':
+                for t in threads:
+                    t.join()
+            cpu = time.process_time() - cpu
+            samples = np.mean([len(d['timestamp'])
+                               for d in buffer.data.values()])
+            lat = np.array(listener.latencies)
+            results[(n_devices, mode)] = {'threads': n_threads, 'cpu': cpu,
+                                          'latency': np.median(lat)}
+            print('{:2d} devices, {:7s}: {:3d} threads, CPU {:5.2f} s, '
+                  '{:5.1f} samples per device, sample to commit median '
+                  '{:5.1f} ms, p99 {:5.1f} ms'.format(
+                      n_devices, mode, n_threads, cpu, samples,
+                      np.median(lat) * 1e3,
+                      np.percentile(lat, 99) * 1e3))
+    return results
+
+
+def bench_pyramid(hours=24, rate=10, pixels=1000):
+    """Compare plotting a whole recording from the raw rows and the levels.
+
+    Records 'hours' of simulated ITC traces at 'rate' Hz in batches of one
+    minute and reads the whole of it for a plot 'pixels' wide.
+
+    """
+    n_rows = int(hours * 3600 * rate)
+    itc = _traces(n_rows, rate)['ITC503']
+    folder = tempfile.mkdtemp()
+    try:
+        data = {'ITC503': dict((k, v[:0]) for k, v in itc.items())}
+        t = BufferRecordThread(data, 'bench', folder, journal=False)
+        t.open()
+        step = 60 * rate
+        start = time.perf_counter()
+        for i in range(0, n_rows, step):
+            data['ITC503'] = dict((k, v[:i + step]) for k, v in itc.items())
+            t.write_new_rows()
+        t.close()
+        write = time.perf_counter() - start
+        start = time.perf_counter()
+        raw = read_range(t.file_name, 'ITC503')[1]
+        read_raw = time.perf_counter() - start
+        start = time.perf_counter()
+        (level, df) = read_range(t.file_name, 'ITC503', pixels=pixels)
+        read_level = time.perf_counter() - start
+    finally:
+        shutil.rmtree(folder)
+    print('{} h at {} Hz written in {:.1f} s'.format(hours, rate, write))
+    print('     raw: {:8d} rows in {:7.1f} ms'.format(len(raw),
+                                                       read_raw * 1e3))
+    print('{:>6}s: {:8d} rows in {:7.1f} ms'.format(level, len(df),
+                                                     read_level * 1e3))
+    return (read_raw, read_level)
+
+
+def bench_cache(seconds=3.0, latency=0.005):
+    """Measure the bus load that the query cache saves.
+
+    A poller reads the three temperatures every 0.1 s while the GUI and two
+    scripts read the setpoint, the heater output, the status and a
+    temperature every 20 to 50 ms, on a bus taking 'latency' seconds per
+    query. Reports the bus transactions and the mean query time with and
+    without the cache.
+
+    """
+    freshness = {'R0': 1.0, 'R1': 0.1, 'R2': 0.1, 'R3': 0.1, 'R5': 0.5,
+                 'X': 0.5}
+    readers = [(0.1, ['R1', 'R2', 'R3']), (0.05, ['R0', 'R5', 'R1']),
+               (0.02, ['R0', 'R5', 'X']), (0.02, ['R0', 'R5', 'R1'])]
+    results = {}
+    for cached in (False, True):
+        lock = Lock()
+        bus = []
+        cache = QueryCache(freshness)
+        times = []
+
+        def fetch(command):
+            with lock:
+                time.sleep(latency)
+                bus.append(command)
+                return command
+
+        def query(command):
+            if cached:
+                return cache.query(command, fetch)
+            return fetch(command)
+
+        def read(delay, commands, end):
+            while time.perf_counter() < end:
+                for command in commands:
+                    start = time.perf_counter()
+                    query(command)
+                    times.append(time.perf_counter() - start)
+                time.sleep(delay)
+
+        end = time.perf_counter() + seconds
+        threads = [Thread(target=read, args=(delay, commands, end))
+                   for (delay, commands) in readers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        name = 'cached' if cached else 'direct'
+        results[name] = len(bus) / seconds
+        print('{}: {} queries, {} on the bus ({:.0f}/s), mean query '
+              '{:.1f} ms'.format(name, len(times), len(bus),
+                                 results[name], np.mean(times) * 1e3))
+        if cached:
+            print('  {hits} hits, {coalesced} coalesced, {misses} misses, '
+                  'hit ratio {hit_ratio:.2f}'.format(**cache.stats()))
+    return results
+
+
+def bench_catalog(n_runs=5000, n_files=40):
+    """Time catalog queries over many runs and a parallel backfill.
+
+    Fills a catalog with 'n_runs' synthetic runs of an ITC and an AH and
+    times typical searches, then records 'n_files' runs of simulated traces
+    and times indexing them with one and with several processes.
+
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        catalog = RunCatalog(os.path.join(folder, CATALOG_NAME))
+        week = int(7 * 24 * 3600 * 1e9)
+        with catalog._connect() as db:
+            for i in range(n_runs):
+                low = np.random.uniform(0.25, 4)
+                catalog.add({
+                    'path': os.path.join(folder, 'run{}.h5'.format(i)),
+                    'name': 'Run{}'.format(i), 'start': i * week,
+                    'stop': i * week + week // 2, 'segments': 1,
+                    'mtime': 0.0, 'sweeps': [],
+                    'channels': [('ITC503', 'THe3', low, 30.0, 1.0, 1000),
+                                 ('ITC503', 'TSorp', 4.0, 40.0, 10.0, 1000),
+                                 ('ITC503', 'T1K', 1.4, 4.0, 1.5, 1000),
+                                 ('AH2500A', 'Cap', 1.0, 2.0, 1.5, 1000)]},
+                    db)
+        queries = {'THe3 below 0.3 K': dict(channel='THe3', below=0.3),
+                   'by name': dict(name='Run42%'),
+                   'by time': dict(after=100 * week, before=110 * week)}
+        for label, query in sorted(queries.items()):
+            start = time.perf_counter()
+            for i in range(20):
+                runs = catalog.find(**query)
+            took = (time.perf_counter() - start) / 20
+            print('{:>18}: {:5d} of {} runs in {:6.2f} ms'.format(
+                label, len(runs), n_runs, took * 1e3))
+        os.remove(catalog.path)
+        traces = _traces(36000, 10)
+        for i in range(n_files):
+            data = dict((dev_name, dict(dev)) for dev_name, dev in
+                        traces.items())
+            t = BufferRecordThread(data, 'bench{}'.format(i), folder,
+                                   journal=False)
+            t.file_name = os.path.join(folder, 'T_bench{}.h5'.format(i))
+            t.open()
+            t.write_new_rows()
+            t.close()
+        for processes in (1, 4):
+            catalog = RunCatalog(os.path.join(folder, CATALOG_NAME))
+            start = time.perf_counter()
+            n = catalog.backfill(folder, processes)
+            took = time.perf_counter() - start
+            print('backfill with {:2d} processes: {} runs in {:.2f} s '
+                  '({:.1f} runs/s)'.format(processes, n, took, n / took))
+            os.remove(catalog.path)
+    finally:
+        shutil.rmtree(folder)
+
+
+def bench_replay(hours=6, rate=10, block_sizes=(10, 100, 1000)):
+    """Measure the sustainable throughput of the pipeline with a replay.
+
+    Records 'hours' of simulated ITC traces and plays them as fast as
+    possible into a buffer with two derived channels, timing until every
+    sample has been committed.
+
+    """
+    n_rows = int(hours * 3600 * rate)
+    itc = _traces(n_rows, rate)['ITC503']
+    folder = tempfile.mkdtemp()
+    results = {}
+    try:
+        t = BufferRecordThread({'ITC503': itc}, 'bench', folder,
+                               journal=False)
+        t.open()
+        t.write_new_rows()
+        t.close()
+        for block_size in block_sizes:
+            replay = ReplayThread(t.file_name, 'ITC503', speed=None,
+                                  block_size=block_size)
+            buffer = Buffer([('ITC503', None, replay)])
+            buffer.add_derived_channel('ITC503', Rate('dTHe3/dt', 'THe3'))
+            buffer.add_derived_channel('ITC503',
+                                       RollingMean('THe3_avg', 'THe3', 50))
+            start = time.perf_counter()
+            buffer.start_collection()
+            while len(buffer.data['ITC503']['timestamp']) < n_rows:
+                time.sleep(0.01)
+            took = time.perf_counter() - start
+            buffer.stop_collection()
+            results[block_size] = n_rows / took
+            print('blocks of {:5d}: {} samples in {:6.2f} s, {:9.0f} '
+                  'samples/s'.format(block_size, n_rows, took,
+                                     n_rows / took))
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+class _SimulatedThread(Thread):
+    """A device thread sampling a drifting trace on a clock."""
+
+    def __init__(self, clock, delay):
+        super(_SimulatedThread, self).__init__()
+        self.stop = False
+        self.clock = clock
+        self.delay = delay
+        self.chan_list = ['THe3', 'TSorp']
+        self.q = SampleQueue()
+        self.writer = SampleWriter(self.q, self.chan_list, clock=clock)
+        clock.attach(self)
+
+    def run(self):
+        rng = np.random.default_rng(0)
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            block = self.writer.block
+            block.columns[0][block.n] = self.clock.now_ns()
+            block.columns[1][block.n] = 0.3 + 1e-3 * rng.standard_normal()
+            block.columns[2][block.n] = 20.0 + rng.standard_normal()
+            self.writer.commit(self.delay)
+        self.writer.flush()
+
+    def stop_thread(self):
+        self.stop = True
+        self.clock.wake(self)
+
+
+def bench_clock(hours=12, rate=1, rotate_interval=3600):
+    """Simulate a long acquisition and recording on a virtual clock.
+
+    Reports how much faster than real time the simulation runs, the memory
+    held by the buffer, the segments written, and the scheduling drift of
+    the samples.
+
+    """
+    start_ns = now_ns()
+    clock = VirtualClock(start=start_ns)
+    thread = _SimulatedThread(clock, 1.0 / rate)
+    buffer = Buffer([('ITC503', None, thread)], clock=clock, delay=1.0)
+    folder = tempfile.mkdtemp()
+    try:
+        buffer.set_data_folder(folder)
+        buffer.start_collection()
+        buffer.start_recording(rotate_interval=rotate_interval,
+                               catalog=False, delay=60.0)
+        start = time.perf_counter()
+        for hour in range(hours):
+            clock.advance(3600)
+            memory = sum(v.nbytes for v in buffer.data['ITC503'].values())
+            print('hour {:3d}: {:8d} rows, buffer {:6.2f} MB'.format(
+                hour + 1, len(buffer.data['ITC503']['timestamp']),
+                memory / 1e6))
+        buffer.stop_recording()
+        buffer.stop_collection()
+        took = time.perf_counter() - start
+        timestamps = buffer.data['ITC503']['timestamp']
+        ideal = start_ns + np.arange(1, len(timestamps) + 1) * \
+            int(1e9 / rate)
+        drift = np.abs(timestamps - ideal).max() / 1e9
+        n_segments = len(buffer.record_thread.manifest.segments)
+        print('{} h simulated in {:.1f} s ({:.0f}x real time), {} segments, '
+              'drift {:.3f} s'.format(hours, took, hours * 3600 / took,
+                                      n_segments, drift))
+    finally:
+        shutil.rmtree(folder)
+    return {'seconds': took, 'segments': n_segments, 'drift': drift}
+
+
+class _FlakyITCResource(object):
+    """A simulated ITC on a bad cable, timing out on a virtual clock."""
+
+    def __init__(self, clock, outages, garble, seed=0):
+        self.clock = clock
+        self.outages = outages
+        self.garble = garble
+        self.rng = np.random.default_rng(seed)
+        self.timeout = 2000
+        self.garbled = 0
+
+    def query(self, command):
+        t = self.clock.time()
+        if any(start <= t < stop for (start, stop) in self.outages):
+            self.clock.sleep(self.timeout / 1000)
+            raise IOError('VI_ERROR_TMO')
+        if self.rng.random() < self.garble:
+            self.garbled += 1
+            return 'R2?9.'
+        return 'R{:.3f}'.format(0.3 + 1e-3 * self.rng.standard_normal())
+
+    def close(self):
+        pass
+
+
+def bench_recovery(hours=6, delay=1.0, n_outages=12, garble=0.01):
+    """Measure how fast the ITC thread recovers from a flaky bus.
+
+    Simulates 'hours' of polling on a virtual clock with 'n_outages' bus
+    outages of 5 to 120 s and a share 'garble' of garbled replies, once
+    without and once with a RetryPolicy. Reports the samples lost, the gaps
+    and the time from the end of an outage to the next sample.
+
+    """
+    # Imported here, so that the other benchmarks run without pyvisa
+    from RunMeas.ITCDevice import ITCDevice, ITCMeasurementThread
+
+    rng = np.random.default_rng(1)
+    start_s = now_ns() / 1e9
+    period = hours * 3600 / n_outages
+    starts = np.arange(n_outages) * period + \
+        rng.uniform(60, period - 180, n_outages)
+    outages = [(start_s + t, start_s + t + rng.uniform(5, 120))
+               for t in starts]
+    results = {}
+    for name in ('none', 'policy'):
+        clock = VirtualClock(start=int(start_s * 1e9))
+        policy = None
+        if name == 'policy':
+            policy = RetryPolicy(timeout=0.5, retries=3, backoff=0.2,
+                                 clock=clock)
+        itc = ITCDevice('GPIB0::24::INSTR', policy=policy)
+        itc.set_resource(lambda address, **kwargs:
+                         _FlakyITCResource(clock, outages, garble))
+        # Nothing takes the blocks before the end, so the queue must hold
+        # them all
+        thread = ITCMeasurementThread(itc, ['TSorp', 'THe3', 'T1K'],
+                                      delay=delay, maxsize=0, clock=clock)
+        thread.start()
+        clock.advance(hours * 3600)
+        thread.stop_thread()
+        thread.join()
+        columns = []
+        while not thread.q.empty():
+            columns.append(thread.q.get().to_columns())
+        ts = np.concatenate([c['timestamp'] for c in columns]) / 1e9
+        good = ~np.isnan(np.concatenate([c['TSorp'] for c in columns]))
+        # From the end of each outage to the next good sample
+        recovery = [ts[good][np.searchsorted(ts[good], stop)] - stop
+                    for (start, stop) in outages]
+        lost = int((~good).sum())
+        in_outages = sum(((ts >= start) & (ts < stop)).sum()
+                         for (start, stop) in outages)
+        results[name] = {'lost': lost, 'gaps': len(thread.gaps.gaps),
+                         'recovery': max(recovery)}
+        print('{:6s}: {} samples, {} lost ({} in outages), {} gaps, '
+              'recovery after an outage mean {:.2f} s, max {:.2f} '
+              's'.format(name, len(ts), lost, in_outages,
+                         len(thread.gaps.gaps), np.mean(recovery),
+                         max(recovery)))
+    return results
+
+
+def bench_trigger(minutes=10, rate=1000, batch_size=100, n_jumps=20,
+                  decimation=100):
+    """Compare recording the full AH stream with a decimated one plus events.
+
+    Simulates capacitance noise with 'n_jumps' flux jumps, times the event
+    capture per batch, and records the stream once in full and once
+    decimated with the captured windows.
+
+    """
+    n_rows = int(minutes * 60 * rate)
+    rng = np.random.default_rng(0)
+    cap = 922.5 + 1e-4 * rng.standard_normal(n_rows)
+    jumps = np.sort(rng.choice(n_rows, n_jumps, replace=False))
+    cap += 0.05 * np.searchsorted(jumps, np.arange(n_rows), side='right')
+    rows = {'timestamp': (now_ns() + np.arange(n_rows) *
+                          int(1e9 / rate)).astype('int64'),
+            'Cap': cap,
+            'Loss': 1e-3 * rng.standard_normal(n_rows)}
+    capture = EventCapture([Slope('Cap', 0.02 * rate)], pre=rate // 2,
+                           post=2 * rate, holdoff=1.0)
+    start = time.perf_counter()
+    for i in range(0, n_rows, batch_size):
+        capture.update(dict((k, v[i:i + batch_size])
+                            for k, v in rows.items()))
+    took = time.perf_counter() - start
+    print('capture: {} batches of {} in {:.2f} s, {:.0f} us per batch, {} '
+          'events of {} jumps'.format(n_rows // batch_size, batch_size, took,
+                                      took / (n_rows / batch_size) * 1e6,
+                                      capture.n_events, n_jumps))
+    events = capture.take_events()
+    folder = tempfile.mkdtemp()
+    sizes = {}
+    try:
+        decimated = {'deadband': {'AH2500A': Decimator(decimation)},
+                     'captures': {'AH2500A': capture}}
+        for name, kwargs in (('full', {}), ('decimated', decimated)):
+            capture.events = list(events)
+            t = BufferRecordThread({'AH2500A': rows}, 'bench', folder,
+                                   journal=False, levels=None,
+                                   file_name=os.path.join(folder,
+                                                          name + '.h5'),
+                                   **kwargs)
+            t.open()
+            t.write_new_rows()
+            t.close()
+            sizes[name] = os.path.getsize(t.file_name)
+            print('{:9s}: {:7.2f} MB'.format(name, sizes[name] / 1e6))
+        found = len(read_events(os.path.join(folder, 'decimated.h5'),
+                                'AH2500A'))
+        print('{} events at full resolution, {:.0f}% of the full size'.format(
+            found, 100.0 * sizes['decimated'] / sizes['full']))
+    finally:
+        shutil.rmtree(folder)
+    return sizes
+
+
+def bench_spectrum(minutes=10, rate=1000, batch_size=100,
+                   segments=(256, 1024, 4096)):
+    """Measure the cost of the streaming PSD in the collection thread.
+
+    Feeds jittered samples of a noisy sine batch by batch, as the
+    collection thread does, and reports the time per batch and per
+    segment.
+
+    """
+    n_rows = int(minutes * 60 * rate)
+    rng = np.random.default_rng(0)
+    period = int(1e9 / rate)
+    t = now_ns() + np.cumsum(rng.integers(period // 2, 3 * period // 2,
+                                          n_rows))
+    x = np.sin(2 * np.pi * 50.0 * (t - t[0]) / 1e9) + \
+        0.1 * rng.standard_normal(n_rows)
+    results = {}
+    for segment in segments:
+        psd = WelchPSD('Cap', rate, segment=segment)
+        start = time.perf_counter()
+        for i in range(0, n_rows, batch_size):
+            psd.update({'timestamp': t[i:i + batch_size],
+                        'Cap': x[i:i + batch_size]})
+        took = time.perf_counter() - start
+        (freqs, density) = psd.spectrum()
+        results[segment] = took / (n_rows / batch_size)
+        print('segment {:5d}: {:6.1f} us per batch of {}, {:6.1f} us per '
+              'segment, peak at {:.2f} Hz'.format(
+                  segment, results[segment] * 1e6, batch_size,
+                  took / psd.n_segments * 1e6, freqs[np.argmax(density)]))
+    return results
+
+
+def bench_alarm(n_rules=20, batch_size=100, seconds=5.0, rate=100):
+    """Measure the cost of the alarm rules and the latency of the actions.
+
+    Times the evaluation of 'n_rules' rules per committed batch, then runs
+    a simulated device at 'rate' Hz with real time for 'seconds' and
+    reports the latency from the sample raising an alarm to its action.
+
+    """
+    n_rows = 100000
+    rng = np.random.default_rng(0)
+    batch = {'timestamp': now_ns() + np.arange(n_rows) * int(1e7),
+             'TSorp': 20.0 + rng.standard_normal(n_rows)}
+    engine = AlarmEngine(Buffer([('ITC503', None,
+                                  _SimulatedThread(RealClock(), 0.01))]))
+    for i in range(n_rules):
+        rule = (Above('TSorp', 22.0 + i * 0.01, clear=20.0) if i % 2 else
+                RateAbove('TSorp', 50.0, window=0.5))
+        engine.add_rule('ITC503', rule)
+    device = engine._devices['ITC503']
+    start = time.perf_counter()
+    for i in range(0, n_rows, batch_size):
+        device.update(dict((k, v[i:i + batch_size])
+                           for k, v in batch.items()))
+    took = time.perf_counter() - start
+    print('{} rules: {:.1f} us per batch of {}, {:.2f} us per sample and '
+          'rule'.format(n_rules, took / (n_rows / batch_size) * 1e6,
+                        batch_size, took / n_rows / n_rules * 1e6))
+
+    thread = _SimulatedThread(RealClock(), 1.0 / rate)
+    buffer = Buffer([('ITC503', None, thread)])
+    engine = AlarmEngine(buffer, period=0.5)
+    engine.add_rule('ITC503', Above('TSorp', 21.5, clear=20.0),
+                    lambda alarm: None)
+    engine.add_rule('ITC503', Stale(1.0))
+    buffer.start_collection()
+    engine.start()
+    time.sleep(seconds)
+    engine.stop_thread()
+    buffer.stop_collection()
+    engine.join()
+    stats = engine.latency_stats()
+    print('{count} alarms, latency mean {mean:.4f} s, max {max:.4f} '
+          's'.format(**stats))
+    return stats
+
+
+def bench_server(n_batches=2000, batch_size=100, clients=(0, 1, 4, 16)):
+    """Measure the load that streaming viewers add to the collection.
+
+    Hands 'n_batches' batches to the server's listener at once, as a
+    collection thread catching up does, with a number of reading clients
+    and one client that never reads. Reports the time per batch spent in
+    the collection thread, the rows the slowest reader received and the
+    frames dropped for the readers and the stalled client.
+
+    """
+    results = {}
+    t0 = now_ns()
+    last = t0 + (n_batches * batch_size - 1) * int(1e7)
+    for n_clients in clients:
+        buffer = Buffer([('ITC503', None,
+                          _SimulatedThread(RealClock(), 0.01))])
+        server = StreamServer(buffer, maxsize=64)
+        server.start()
+        stalled = StreamClient(*server.address, 'ITC503')
+        readers = [StreamClient(*server.address, 'ITC503')
+                   for i in range(n_clients)]
+        received = [0] * n_clients
+        dropped = [0] * n_clients
+
+        def read(i):
+            while True:
+                (kind, columns, dropped[i]) = readers[i].read_frame()
+                received[i] += len(columns['timestamp'])
+                if columns['timestamp'][-1] == last:
+                    break
+
+        threads = [Thread(target=read, args=(i,)) for i in range(n_clients)]
+        for t in threads:
+            t.start()
+        # Wait for all subscriptions to be registered
+        while len(server.client_stats()) < n_clients + 1:
+            time.sleep(0.01)
+        stream = server.streams['ITC503']
+        start = time.perf_counter()
+        for i in range(n_batches):
+            ts = t0 + (i * batch_size + np.arange(batch_size)) * int(1e7)
+            stream.update({'timestamp': ts,
+                           'THe3': np.full(batch_size, 0.3),
+                           'TSorp': np.full(batch_size, 20.0)})
+        took = time.perf_counter() - start
+        for t in threads:
+            t.join()
+        stalled_dropped = max(s['dropped'] for s in server.client_stats())
+        for client in readers + [stalled]:
+            client.close()
+        server.stop_thread()
+        server.join()
+        results[n_clients] = took / n_batches
+        print('{:2d} readers: {:6.1f} us per batch of {} in the collection '
+              'thread, slowest reader got {} of {} rows ({} frames '
+              'dropped), {} frames dropped for the stalled client'.format(
+                  n_clients, results[n_clients] * 1e6, batch_size,
+                  min(received, default=0), n_batches * batch_size,
+                  max(dropped, default=0), stalled_dropped))
+    return results
+
+
+def bench_lockin(seconds=60.0, rate=512.0, delays=(0.1, 0.5, 2.0),
+                 latency=0.005, bandwidth=100e3):
+    """Compare polling a lock-in point by point with its internal buffer.
+
+    Simulates 'seconds' of an SR830 on a virtual clock with 'latency'
+    seconds per command and 'bandwidth' bytes per second, once polling X
+    and Y with OUTP? as fast as the bus allows and once reading the buffer
+    filled at 'rate' with TRCB? every delay in 'delays'. Reports the points
+    per second and channel and the share of the time the bus was busy.
+
+    """
+    results = {}
+    start = now_ns()
+    for delay in (None,) + tuple(delays):
+        clock = VirtualClock(start=start)
+        sim = SimulatedSR830(clock, latency=latency, bandwidth=bandwidth)
+        device = SR830Device('GPIB1::9::INSTR')
+        device.set_resource(lambda address, **kwargs: sim)
+        if delay is None:
+            name = 'OUTP?'
+            points = [0]
+            stop = [False]
+
+            def poll():
+                while not stop[0]:
+                    device.get_output('X')
+                    device.get_output('Y')
+                    points[0] += 1
+
+            thread = Thread(target=poll)
+            clock.attach(thread)
+            thread.start()
+            clock.advance(seconds)
+            stop[0] = True
+            clock.advance(1.0)
+            thread.join()
+            n = points[0]
+        else:
+            name = 'TRCB? {:g} s'.format(delay)
+            # Nothing takes the blocks before the end, so the queue must
+            # hold them all
+            thread = LockinMeasurementThread(device, ['X', 'Y'], rate=rate,
+                                             delay=delay, maxsize=0,
+                                             clock=clock)
+            thread.start()
+            clock.advance(seconds)
+            thread.stop_thread()
+            clock.advance(delay + 1.0)
+            thread.join()
+            n = sum(thread.q.get().n for i in range(thread.q.qsize()))
+        busy = (sim.queries * latency + sim.bytes / bandwidth) / \
+            (clock.time() - start / 1e9)
+        results[name] = n / seconds
+        print('{:12s}: {:7.1f} points/s per channel, {:5d} commands, '
+              'bus busy {:4.0%}'.format(name, n / seconds, sim.queries,
+                                        busy))
+    return results
+
+
+BENCHMARKS = {'alarm': bench_alarm,
+              'cache': bench_cache,
+              'catalog': bench_catalog,
+              'clock': bench_clock,
+              'compression': bench_compression,
+              'dtypes': bench_dtypes,
+              'journal': bench_journal,
+              'lockin': bench_lockin,
+              'pool': bench_pool,
+              'pyramid': bench_pyramid,
+              'recovery': bench_recovery,
+              'replay': bench_replay,
+              'samples': bench_samples,
+              'server': bench_server,
+              'spectrum': bench_spectrum,
+              'trigger': bench_trigger}
+
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv
+
+    names = argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print('--- {} ---'.format(name))
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
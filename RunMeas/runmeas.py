@@ -20,10 +20,11 @@ import visa
 from PyQt4.QtGui import (QApplication)
 from PyQt4.QtCore import (QTimer)
 
-import numpy as np
 import seaborn as sns
 
 from RunMeas.ITC_view import MyMainWindow
+from RunMeas.Pyramid import LivePyramid
+from RunMeas.Spectrum import WelchPSD
 
 
 RESOURCES = {'GPIB1::24':
@@ -33,12 +34,12 @@ RESOURCES = {'GPIB1::24':
                          'T1K']},
              # 'GPIB1::28':
              # {'AH': []},
-             # 'GPIB1::9':
-             # {'I_Lockin': []},
+             'GPIB1::9':
+             {'I_Lockin': ['timestamp', 'X', 'Y']},
              # 'GPIB1::17':
              # {'Lakeshore': ['TSample_LS']},
-             # 'GPIB1::8':
-             # {'V_Lockin': []},
+             'GPIB1::8':
+             {'V_Lockin': ['timestamp', 'X', 'Y']},
              # 'GPIB1::3':
              # {'Yokogawa': []},
              # 'GPIB::25':
@@ -67,6 +68,8 @@ class Presenter(object):
         self.channelsList = None
         self.deviceList = None
         self.buffer = None
+        self.spectra = []
+        self.pyramid = None
 
         self.fileMenu = None
         self.fileMenuActions = None
@@ -122,12 +125,32 @@ class Presenter(object):
 
     def setBuffer(self, buffer):
         self.buffer = buffer
+        # The plot is drawn from levels kept up to date with every batch
+        self.pyramid = LivePyramid()
+        self.buffer.add_listener('ITC503', self.pyramid)
 
         self.view.connectDevice.clicked.connect(self.startCollection)
         self.view.disconnectDevice.clicked.connect(self.stopCollection)
         self.view.recordData.clicked.connect(self.buffer.start_recording)
         self.view.stopRecording.clicked.connect(self.buffer.stop_recording)
 
+    def setSpectra(self, spectra):
+        """Set the channels whose spectrum is shown in the spectrum tab.
+
+        Parameters
+        ----------
+        spectra : list
+            A list of (device name, RunMeas.Spectrum.WelchPSD) tuples. The
+            estimators are fed by the collection threads, and the tab only
+            reads their current estimate.
+
+        """
+        for (dev_name, psd) in self.spectra:
+            self.buffer.remove_listener(dev_name, psd)
+        self.spectra = spectra
+        for (dev_name, psd) in spectra:
+            self.buffer.add_listener(dev_name, psd)
+
     def startCollection(self):
         self.buffer.start_collection()
         self.timer.start(200)
@@ -138,20 +161,53 @@ class Presenter(object):
 
     def updateGraph(self):
 
-        x = self.buffer.data['ITC503']['timestamp']
+        # Only the visible tab is drawn
+        if self.view.graphTabs.currentWidget() is \
+                self.view.spectrumCanvas.parentWidget():
+            self.updateSpectrum()
+            return
+
+        data = self.buffer.data['ITC503']
+        x = data['timestamp']
+        # One point per pixel is all the canvas can show
+        pixels = self.view.canvas.width()
+
+        if not len(x):
+            return
+
+        def plot(axes, chan_name, **kwargs):
+            reduced = self.pyramid.downsample(chan_name, pixels)
+            if reduced is None:
+                # Too short to be reduced, the raw data is drawn
+                (bins, mean) = (x, data[chan_name])
+            else:
+                (bins, mean, low, high) = reduced
+            # The timestamps are nanoseconds since the epoch
+            axes.plot((bins - x[0]) / 1e9, mean, **kwargs)
+
+        plot(self.view.axes1, 'TSorp', color=sns.xkcd_rgb['pale red'])
+        plot(self.view.axes2, 'T1K', color=sns.xkcd_rgb['medium green'])
+        plot(self.view.axes2, 'THe3', color=sns.xkcd_rgb['denim blue'])
+        for chan in self.buffer.derived['ITC503']:
+            plot(self.view.axes2, chan.name)
 
-        tsorp = self.buffer.data['ITC503']['TSorp']
-        t1k = self.buffer.data['ITC503']['T1K']
-        the3 = self.buffer.data['ITC503']['THe3']
+        self.view.canvas.draw()
 
-        self.view.axes1.plot((x-x[0])/np.timedelta64(1, 's'), tsorp,
-                             color=sns.xkcd_rgb['pale red'])
-        self.view.axes2.plot((x-x[0])/np.timedelta64(1, 's'), t1k,
-                             color=sns.xkcd_rgb['medium green'])
-        self.view.axes2.plot((x-x[0])/np.timedelta64(1, 's'), the3,
-                             color=sns.xkcd_rgb['denim blue'])
+    def updateSpectrum(self):
 
-        self.view.canvas.draw()
+        axes = self.view.spectrumAxes
+        axes.cla()
+        for (dev_name, psd) in self.spectra:
+            (freqs, density) = psd.spectrum()
+            if len(freqs):
+                # Without the DC bin, which the log axis cannot show
+                axes.loglog(freqs[1:], density[1:],
+                            label='{} {}'.format(dev_name, psd.channel))
+        if axes.lines:
+            axes.legend()
+        axes.set_xlabel('Frequency (Hz)')
+        axes.set_ylabel('PSD (units$^2$/Hz)')
+        self.view.spectrumCanvas.draw()
 
 
 def main(argv=None):
@@ -161,6 +217,7 @@ def main(argv=None):
 
     from RunMeas.Buffer import Buffer
     from RunMeas.ITCDevice import ITCDevice, ITCMeasurementThread
+    from RunMeas.LockinDevice import SR830Device, LockinMeasurementThread
 
     meas_thread_register = []
     device_register = []
@@ -192,15 +249,35 @@ def main(argv=None):
                     itc_device = ITCDevice(address=resource)
                     itc_device.set_resource(rm.open_resource)
                 print(resource_addy)
+                # The GUI reads the same values as the measurement thread
+                itc_device.set_cache()
                 device_register.append((resource_name, itc_device))
 
-                itc_measurement_thread = ITCMeasurementThread(itc_device,
-                                                              ['TSorp', 'THe3',
-                                                               'T1K'],
-                                                              delay=0.1)
+                # A stalled GUI thins out the queued samples instead of
+                # holding up the polling
+                itc_measurement_thread = ITCMeasurementThread(
+                    itc_device, ['TSorp', 'THe3', 'T1K'], delay=0.1,
+                    maxsize=256, overflow='decimate')
 
                 meas_thread_register.append((resource_name, itc_device,
                                              itc_measurement_thread))
+            elif 'Lockin' in resource_name:
+                if sys.platform == 'win32':
+                    resource_addy = addy_prefix + '::INSTR'
+                elif sys.platform == 'linux':
+                    resource_addy = resource
+                lockin_device = SR830Device(address=resource_addy)
+                lockin_device.set_resource(rm.open_resource)
+                print(resource_addy)
+                device_register.append((resource_name, lockin_device))
+
+                # The buffer fills at 512 Hz and is read out twice a second
+                lockin_measurement_thread = LockinMeasurementThread(
+                    lockin_device, RESOURCES[addy_prefix][resource_name][1:],
+                    rate=512.0, delay=0.5, maxsize=256, overflow='decimate')
+
+                meas_thread_register.append((resource_name, lockin_device,
+                                             lockin_measurement_thread))
 
         except KeyError:
             pass
@@ -218,6 +295,13 @@ def main(argv=None):
 
     presenter.setView(Main())
     presenter.setBuffer(my_buffer)
+    # Only the ITC has these channels, sampled once per poll delay
+    presenter.setSpectra([(dev_name, WelchPSD(chan_name,
+                                              rate=1.0 / thread.delay,
+                                              segment=256))
+                          for (dev_name, dev, thread) in meas_thread_register
+                          if 'ITC' in dev_name
+                          for chan_name in ('THe3', 'TSorp')])
     presenter.view.show()
 
     sys.exit(app.exec_())
@@ -7,7 +7,7 @@ from queue import Queue
 from datetime import datetime
 
 
-from RunMeas.AHDevice import AHDevice  # , AHMeasurementThread
+from RunMeas.AHDevice import AHDevice, AHMeasurementThread
 
 DEVPATH = os.path.join(os.getcwd(), 'test', 'devices.yaml')
 # DEVPATH = '/home/chris/Programming/github/RunMeas/test/devices.yaml'
@@ -70,6 +70,42 @@ class DeviceTestCase(unittest.TestCase):
         self.assertEqual(loss, 13.4108)
         self.assertEqual(volt, 1.5)
 
+    def test_get_all_values(self):
+        "Test collecting a timestamped measurement"
+        (datetimestamp, cap, loss, volt) = self.ah.get_all_values()
+        self.assertIsInstance(datetimestamp, datetime)
+        self.assertEqual(cap, ('Cap', 922.5934))
+        self.assertEqual(loss, ('Loss', 13.4108))
+        self.assertEqual(volt, ('Volt', 1.5))
+
+
+class ThreadTestCase(unittest.TestCase):
+    """Test the thread class."""
+
+    def setUp(self):
+        rm = visa.ResourceManager('{}@sim'.format(DEVPATH))
+        for resource_address in rm.list_resources():
+            if 'GPIB' in resource_address and '28' in resource_address:
+                self.ah = AHDevice(resource_address)
+                self.ah.set_resource(rm.open_resource)
+
+        self.delay = 0.1
+        self.ah_thread = AHMeasurementThread(self.ah, ['Cap', 'Loss', 'Volt'],
+                                             delay=self.delay)
+
+    def test_thread_has_queue(self):
+        self.assertIsInstance(self.ah_thread.q, Queue)
+
+    def test_thread_start_stop(self):
+        self.assertFalse(self.ah_thread.is_alive())
+        self.ah_thread.start()
+        self.assertTrue(self.ah_thread.is_alive())
+        time.sleep(3*self.delay)
+        self.ah_thread.stop_thread()
+        self.ah_thread.join()
+        self.assertFalse(self.ah_thread.is_alive())
+        self.assertFalse(self.ah_thread.q.empty())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,193 @@
+import unittest
+
+from threading import Thread
+
+import numpy as np
+
+from RunMeas.Alarm import (AlarmEngine, Above, Below, HeaterOff, RateAbove,
+                           Stale, log)
+from RunMeas.Buffer import Buffer
+from RunMeas.Clock import VirtualClock
+from RunMeas.Polling import DELAY_CHANNEL
+from RunMeas.Samples import SampleQueue, SampleWriter
+
+
+def split(rule, values, size, step=int(1e9)):
+    """Evaluate a rule in batches and return the (sample, active) changes."""
+    ts = np.arange(len(values)) * step
+    changes = []
+    for i in range(0, len(values), size):
+        changes += [(i + j, active) for (j, active)
+                    in rule.evaluate(ts[i:i + size], values[i:i + size])]
+    return changes
+
+
+class RuleTestCase(unittest.TestCase):
+    """Test the vectorised rules."""
+
+    def test_hysteresis(self):
+        values = np.array([1.0, 2.5, 1.9, 2.1, 1.7, 1.9, 2.2, np.nan, 1.0])
+        for size in (1, 4, 9):
+            self.assertEqual(split(Above('T1K', 2.0, clear=1.8), values,
+                                   size),
+                             [(1, True), (4, False), (6, True), (8, False)])
+        self.assertEqual(split(Below('T1K', 1.5), values, 3),
+                         [(0, True), (1, False), (8, True)])
+
+    def test_debounce(self):
+        values = np.array([3.0, 3.0, 1.0, 3.0, 3.0, 3.0, 3.0, 1.0])
+        for size in (1, 3, 8):
+            self.assertEqual(split(Above('T1K', 2.0, debounce=2.0), values,
+                                   size),
+                             [(5, True), (7, False)])
+
+    def test_rate(self):
+        # Flat, then rising by 1 per second
+        values = np.concatenate((np.zeros(20), np.arange(1.0, 21.0)))
+        for size in (1, 7, 40):
+            self.assertEqual(split(RateAbove('TSorp', 0.5, window=4.0),
+                                   values, size),
+                             [(22, True)])
+
+
+class MockITC(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def auto_heat_off(self):
+        self.calls.append('auto_heat_off')
+
+    def set_heater_output(self, output):
+        self.calls.append(('set_heater_output', output))
+
+
+class MockMeasurementThread(Thread):
+    """A device thread sampling a given T1K trace on a clock."""
+
+    def __init__(self, clock, delay, values):
+        super(MockMeasurementThread, self).__init__()
+        self.stop = False
+        self.clock = clock
+        self.delay = delay
+        self.values = list(values)
+        self.chan_list = ['T1K']
+        self.q = SampleQueue()
+        self.writer = SampleWriter(self.q, self.chan_list, clock=clock)
+        clock.attach(self)
+
+    def run(self):
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            if not self.values:
+                continue
+            block = self.writer.block
+            block.columns[0][block.n] = self.clock.now_ns()
+            block.columns[1][block.n] = self.values.pop(0)
+            self.writer.commit()
+
+    def stop_thread(self):
+        self.stop = True
+        self.clock.wake(self)
+
+
+class BrokenBusThread(MockMeasurementThread):
+    """A device thread whose device stops answering, like an ITC thread.
+
+    Once the values run out, every sample is a row of NaNs marking the gap,
+    while the recorded poll delay stays finite.
+
+    """
+
+    def __init__(self, clock, delay, values):
+        super(BrokenBusThread, self).__init__(clock, delay, values)
+        self.chan_list = ['T1K', (DELAY_CHANNEL, 'f4')]
+        self.writer = SampleWriter(self.q, self.chan_list, clock=clock)
+
+    def run(self):
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            block = self.writer.block
+            block.columns[0][block.n] = self.clock.now_ns()
+            block.columns[1][block.n] = (self.values.pop(0) if self.values
+                                         else float('nan'))
+            block.columns[2][block.n] = self.delay
+            self.writer.commit(self.delay)
+
+
+class AlarmEngineTestCase(unittest.TestCase):
+    """Test the engine on a buffer."""
+
+    def run_engine(self, values, *rules, seconds=60,
+                   thread_class=MockMeasurementThread, **kwargs):
+        clock = VirtualClock(start=0)
+        thread = thread_class(clock, 1.0, values)
+        buffer = Buffer([('ITC', None, thread)], clock=clock, delay=0.5)
+        engine = AlarmEngine(buffer, period=1.0, **kwargs)
+        for (rule, actions) in rules:
+            engine.add_rule('ITC', rule, *actions)
+        buffer.start_collection()
+        engine.start()
+        clock.advance(seconds)
+        engine.stop_thread()
+        buffer.stop_collection()
+        engine.join()
+        return engine
+
+    def test_heater_off(self):
+        itc = MockITC()
+        called = []
+        values = [1.5] * 10 + [2.5] * 10 + [1.5] * 10
+        engine = self.run_engine(values,
+                                 (Above('T1K', 2.0, debounce=3.0),
+                                  [called.append, HeaterOff(itc)]))
+        self.assertEqual(itc.calls, ['auto_heat_off',
+                                     ('set_heater_output', 0.0)])
+        self.assertEqual([a['active'] for a in engine.alarms], [True, False])
+        # Raised by the 4th sample above the limit, at t = 14 s
+        self.assertEqual(called[0]['timestamp'], int(14e9))
+        self.assertEqual(called[0]['value'], 2.5)
+        stats = engine.latency_stats()
+        self.assertEqual(stats['count'], 1)
+        # At most the collection delay of the buffer
+        self.assertLessEqual(stats['max'], 0.5)
+        self.assertEqual(engine.active(), [])
+
+    def test_failing_action(self):
+        def fail(alarm):
+            raise IOError('GPIB timeout')
+        called = []
+        engine = self.run_engine([3.0] * 5, (Above('T1K', 2.0),
+                                             [fail, called.append]))
+        self.assertEqual(len(called), 1)
+        self.assertEqual(engine.active(), [('ITC', 'T1K above 2.0')])
+
+    def test_stale(self):
+        called = []
+        engine = self.run_engine([1.5] * 10, (Stale(5.0), [called.append]),
+                                 seconds=30)
+        self.assertEqual(len(called), 1)
+        # The last sample was taken at 10 s
+        self.assertEqual(called[0]['timestamp'], int(15e9))
+        self.assertLessEqual(engine.latency_stats()['max'], 1.0)
+        self.assertEqual(engine.active(), [('ITC', 'no sample for 5.0 s')])
+
+    def test_stale_when_bus_breaks(self):
+        called = []
+        values = [1.5] * 10
+        engine = self.run_engine(values, (Stale(5.0), [called.append]),
+                                 (Above('T1K', 2.0, debounce=3.0), []),
+                                 (Below('T1K', 1.0), []), seconds=30,
+                                 thread_class=BrokenBusThread)
+        # The gap rows keep coming, but the last reading was at 10 s
+        self.assertEqual(len(called), 1)
+        self.assertEqual(called[0]['timestamp'], int(15e9))
+        self.assertEqual(engine.active(), [('ITC', 'no sample for 5.0 s')])
+
+    def test_log(self):
+        log({'device': 'ITC', 'rule': 'T1K above 2.0', 'timestamp': 0,
+             'value': 2.5})
+
+
+if __name__ == "__main__":
+    unittest.main()
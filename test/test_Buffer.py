@@ -2,14 +2,19 @@ import unittest
 
 import os
 import time
+import shutil
+import tempfile
 from datetime import datetime
 from queue import Queue
 from threading import Thread
 import numpy as np
-from pandas import DataFrame
+from pandas import DataFrame, read_hdf
 
 from RunMeas.Buffer import (Buffer, BufferCollectionThread,
                             BufferRecordThread)
+from RunMeas.Derived import RollingMean
+from RunMeas.Clock import now_ns
+from RunMeas.Samples import SampleWriter, SampleQueue
 
 
 class MockResource(object):
@@ -140,8 +145,7 @@ class BufferTestCase(unittest.TestCase):
     def test_init_buffer_collection_thread(self):
         name = 'TestCollector'
         q = Queue()
-        dev_data = {'Device1': {'timestamp': np.array([],
-                                                      dtype='datetime64[ns]'),
+        dev_data = {'Device1': {'timestamp': np.array([], dtype='int64'),
                                 'channel1': np.array([]),
                                 'channel2': np.array([])}}
         t = BufferCollectionThread(name, q, dev_data['Device1'],
@@ -179,11 +183,141 @@ class BufferTestCase(unittest.TestCase):
                               np.ndarray)
         self.assertIsInstance(self.buffer.data['Mock Device 01']
                               ['timestamp'][0],
-                              np.datetime64)
+                              np.int64)
         self.assertIn('value', self.buffer.data['Mock Device 01'])
         self.assertIsInstance(self.buffer.data['Mock Device 01']['value'],
                               np.ndarray)
 
+    def test_buffer_derived_channel(self):
+        self.buffer.add_derived_channel('Mock Device 01',
+                                        RollingMean('mean', 'value', 3))
+        self.assertIn('mean', self.buffer.data['Mock Device 01'])
+        self.buffer.start_collection()
+        time.sleep(0.1)
+        self.buffer.stop_collection()
+        dev_data = self.buffer.data['Mock Device 01']
+        self.assertEqual(len(dev_data['mean']), len(dev_data['value']))
+        self.assertTrue(np.all(dev_data['mean'] == 42))
+
+    def test_buffer_derived_channel_exists(self):
+        with self.assertRaises(ValueError):
+            self.buffer.add_derived_channel('Mock Device 01',
+                                            RollingMean('value', 'value', 3))
+
+    def test_buffer_listener(self):
+        batches = []
+
+        class Listener(object):
+            def update(self, batch):
+                batches.append(batch)
+
+        self.buffer.add_listener('Mock Device 01', Listener())
+        self.buffer.start_collection()
+        time.sleep(0.1)
+        self.buffer.stop_collection()
+        self.assertTrue(batches)
+        self.assertEqual(sum(len(b['value']) for b in batches),
+                         len(self.buffer.data['Mock Device 01']['value']))
+
+    def test_buffer_publish_shared(self):
+        from RunMeas.SharedBuffer import SharedBufferReader
+
+        name = self.buffer.publish_shared('Mock Device 01', capacity=1000,
+                                          name='runmeas_test_buffer')
+        reader = SharedBufferReader(name)
+        self.buffer.start_collection()
+        time.sleep(0.1)
+        self.buffer.stop_collection()
+        rows = reader.latest()
+        self.assertEqual(reader.committed(),
+                         len(self.buffer.data['Mock Device 01']['value']))
+        self.assertTrue(np.all(rows['value'] == 42))
+        reader.close()
+        self.buffer.unpublish_shared('Mock Device 01')
+        self.assertEqual(self.buffer.listeners['Mock Device 01'], [])
+
+    def test_unpublish_while_collecting(self):
+        from RunMeas.SharedBuffer import SharedBufferReader
+
+        batches = []
+
+        class Listener(object):
+            def update(self, batch):
+                batches.append(batch)
+
+        self.buffer.add_listener('Mock Device 01', Listener())
+        self.buffer.start_collection()
+        for i in range(20):
+            name = self.buffer.publish_shared('Mock Device 01', capacity=10,
+                                              name='runmeas_test_buffer')
+            time.sleep(0.005)
+            self.buffer.unpublish_shared('Mock Device 01')
+        n = len(batches)
+        time.sleep(0.05)
+        # The collection thread survived and still notifies the listener
+        self.assertTrue(self.buffer.collection_threads[0].is_alive())
+        self.assertGreater(len(batches), n)
+        self.buffer.stop_collection()
+        with self.assertRaises(FileNotFoundError):
+            SharedBufferReader(name)
+
+    def test_collection_of_sample_blocks(self):
+        q = Queue()
+        writer = SampleWriter(q, ['channel1', 'channel2'], block_size=2)
+        for i in range(5):
+            block = writer.block
+            block.columns[0][block.n] = now_ns()
+            block.columns[1][block.n] = i
+            block.columns[2][block.n] = 2 * i
+            writer.commit()
+        writer.flush()
+        dev_data = {'timestamp': np.array([], dtype='int64'),
+                    'channel1': np.array([]),
+                    'channel2': np.array([])}
+        t = BufferCollectionThread('TestCollector', q, dev_data, delay=0.01)
+        t._commit(t._get_batch())
+        np.testing.assert_array_equal(dev_data['channel1'], np.arange(5))
+        np.testing.assert_array_equal(dev_data['channel2'],
+                                      2 * np.arange(5))
+        self.assertEqual(len(dev_data['timestamp']), 5)
+        # The blocks went back to the writer's pool, including the one that
+        # was allocated because the collector had not caught up yet
+        self.assertEqual(len(writer.pool), 3)
+
+    def test_commit_grows_in_place(self):
+        dev_data = {'timestamp': np.array([], dtype='int64'),
+                    'channel1': np.array([], dtype='f4')}
+        t = BufferCollectionThread('TestCollector', Queue(), dev_data)
+        bases = set()
+        for i in range(3000):
+            t._commit([(datetime.now(), ('channel1', i))])
+            bases.add(dev_data['channel1'].base.__array_interface__['data'])
+        # The history is only copied when the capacity doubles
+        self.assertLessEqual(len(bases), 3)
+        self.assertEqual(len(dev_data['timestamp']), 3000)
+        self.assertEqual(dev_data['channel1'].dtype, np.dtype('f4'))
+        np.testing.assert_array_equal(dev_data['channel1'], np.arange(3000))
+
+    def test_buffer_channel_dtypes(self):
+        thread = MockDeviceMeasurementThread(self.itc01, [('value', 'i1')],
+                                             delay=self.delay)
+        my_buffer = Buffer([('Mock Device 01', self.itc01, thread)])
+        self.assertEqual(my_buffer.data['Mock Device 01']['value'].dtype,
+                         np.dtype('i1'))
+        my_buffer.start_collection()
+        time.sleep(0.1)
+        my_buffer.stop_collection()
+        values = my_buffer.data['Mock Device 01']['value']
+        self.assertEqual(values.dtype, np.dtype('i1'))
+        self.assertTrue(np.all(values == 42))
+
+    def test_buffer_queue_stats(self):
+        self.itc01_thread.q = SampleQueue(5, 'drop_oldest')
+        stats = self.buffer.queue_stats()
+        self.assertEqual(stats['Mock Device 01']['policy'], 'drop_oldest')
+        self.assertEqual(stats['Mock Device 01']['dropped'], 0)
+        self.assertEqual(stats['Mock Device 02'], {'size': 0})
+
     def test_create_record_thread(self):
         dev_data = {'Device1': {'timestamp': np.array([1, 2, 3],
                                                       dtype='datetime64[ns]'),
@@ -214,6 +348,25 @@ class BufferTestCase(unittest.TestCase):
         self.buffer.stop_recording()
         self.assertFalse(self.buffer.record_thread.is_alive())
 
+    def test_derived_channel_while_recording(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.buffer.set_data_folder(folder)
+        self.buffer.start_collection()
+        self.buffer.start_recording(delay=0.02)
+        time.sleep(0.1)
+        self.buffer.add_derived_channel('Mock Device 01',
+                                        RollingMean('mean', 'value', 3))
+        time.sleep(0.1)
+        self.assertTrue(self.buffer.record_thread.is_alive())
+        self.buffer.stop_collection()
+        self.buffer.stop_recording()
+        file_name = self.buffer.record_thread.file_name
+        df = read_hdf(file_name, 'raw/Mock Device 01')
+        self.assertEqual(len(df),
+                         len(self.buffer.data['Mock Device 01']['value']))
+        self.assertTrue(np.all(df['mean'].dropna() == 42))
+
     def test_set_measurement_name(self):
         meas_name = 'Test_Measurement'
         self.buffer.set_measurement_name(meas_name)
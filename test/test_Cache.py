@@ -0,0 +1,134 @@
+import unittest
+
+import time
+from threading import Event, Thread
+
+from RunMeas.Cache import QueryCache
+
+
+class MockClock(object):
+
+    def __init__(self):
+        self.t = 0.0
+
+    def time(self):
+        return self.t
+
+
+class MockBus(object):
+    """Answers every query with the command and a running number."""
+
+    def __init__(self):
+        self.queries = []
+        self.release = Event()
+        self.release.set()
+
+    def query(self, command):
+        self.queries.append(command)
+        self.release.wait()
+        return '{}:{}'.format(command, len(self.queries))
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    """Test the freshness windows and the collapsing of queries."""
+
+    def setUp(self):
+        self.clock = MockClock()
+        self.bus = MockBus()
+        self.cache = QueryCache({'R0': 1.0, 'R1': 0.1, 'X': 0},
+                                clock=self.clock)
+
+    def query(self, command):
+        return self.cache.query(command, self.bus.query)
+
+    def test_freshness(self):
+        self.assertEqual(self.query('R0'), 'R0:1')
+        self.assertEqual(self.query('R1'), 'R1:2')
+        self.clock.t = 0.5
+        self.assertEqual(self.query('R0'), 'R0:1')
+        self.assertEqual(self.query('R1'), 'R1:3')
+        self.clock.t = 1.5
+        self.assertEqual(self.query('R0'), 'R0:4')
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 1, 'misses': 4, 'coalesced': 0,
+                          'passed': 0, 'saved': 1, 'hit_ratio': 0.2})
+
+    def test_age(self):
+        self.assertEqual(self.cache.query_with_age('R0', self.bus.query),
+                         ('R0:1', 0.0))
+        self.clock.t = 0.75
+        self.assertEqual(self.cache.query_with_age('R0', self.bus.query),
+                         ('R0:1', 0.75))
+        self.assertEqual(self.cache.query_with_age('X', self.bus.query),
+                         ('X:2', 0.0))
+
+    def test_settings_invalidate(self):
+        self.query('R0')
+        self.assertEqual(self.query('T30.000'), 'T30.000:2')
+        self.assertEqual(self.query('R0'), 'R0:3')
+        self.assertEqual(self.cache.passed, 1)
+        self.cache.invalidate('R0')
+        self.assertEqual(self.query('R0'), 'R0:4')
+
+    def test_coalescing(self):
+        self.bus.release.clear()
+        replies = []
+        threads = [Thread(target=lambda: replies.append(self.query('X')))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        while self.cache.misses + self.cache.coalesced < 5:
+            time.sleep(0.001)
+        self.bus.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(replies, ['X:1'] * 5)
+        self.assertEqual(self.bus.queries, ['X'])
+        self.assertEqual(self.cache.coalesced, 4)
+        # A window of 0 only collapses concurrent queries
+        self.assertEqual(self.query('X'), 'X:2')
+
+    def test_errors_are_shared_not_cached(self):
+        started = Event()
+        release = Event()
+        errors = []
+
+        def fail(command):
+            started.set()
+            release.wait()
+            raise IOError('VI_ERROR_TMO')
+
+        def query():
+            try:
+                self.cache.query('R0', fail)
+            except IOError as e:
+                errors.append(e)
+
+        threads = [Thread(target=query) for i in range(3)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        while self.cache.coalesced < 2:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(self.query('R0'), 'R0:1')
+
+    def test_setting_during_query(self):
+        # The reply may predate the setting, so it is not kept
+        self.bus.release.clear()
+        t = Thread(target=self.query, args=('R0',))
+        t.start()
+        while not self.bus.queries:
+            time.sleep(0.001)
+        self.cache._pass('T30.000', lambda command: '')
+        self.bus.release.set()
+        t.join()
+        self.assertEqual(self.query('R0'), 'R0:2')
+
+
+if __name__ == "__main__":
+    unittest.main()
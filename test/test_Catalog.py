@@ -0,0 +1,103 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from RunMeas.Buffer import BufferRecordThread
+from RunMeas.Catalog import (CATALOG_NAME, RunCatalog, find_recordings,
+                             run_name, summarize)
+from RunMeas.Manifest import MANIFEST_SUFFIX
+
+
+def make_rows(n, low, start=0):
+    """Rows at 10 Hz of THe3 cooling from 1.5 K to 'low'."""
+    i = np.arange(start, start + n)
+    return {'timestamp': (i * int(1e8)).astype('int64'),
+            'THe3': np.linspace(1.5, low, n),
+            'T1K': np.repeat(1.5, n)}
+
+
+class CatalogTestCase(unittest.TestCase):
+    """Test the run catalog."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.catalog = RunCatalog(os.path.join(self.folder, CATALOG_NAME))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def record(self, name, low, start=0, **kwargs):
+        data = {'ITC': make_rows(100, low, start)}
+        file_name = os.path.join(self.folder, '2016-03-01T12-00-0{}_{}.h5'
+                                 .format(start // 1000, name))
+        t = BufferRecordThread(data, name, self.folder, delay=0.01,
+                               file_name=file_name, **kwargs)
+        t.segments.append((0, 'ITC', 0.3, 0, int(5e9)))
+        t.start()
+        t.stop_thread()
+        t.join()
+        return t
+
+    def test_name(self):
+        self.assertEqual(run_name('/d/2016-03-01T12-00-00_Cool_down.h5'),
+                         'Cool_down')
+        self.assertEqual(run_name('/d/2016-03-01T12-00-00_Cool'
+                                  + MANIFEST_SUFFIX), 'Cool')
+
+    def test_summarize(self):
+        t = self.record('Cooldown', 0.25, catalog=None)
+        summary = summarize(t.file_name)
+        self.assertEqual(summary['name'], 'Cooldown')
+        self.assertEqual((summary['start'], summary['stop']),
+                         (0, int(99e8)))
+        the3 = [c for c in summary['channels'] if c[1] == 'THe3'][0]
+        self.assertEqual(the3[:4], ('ITC', 'THe3', 0.25, 1.5))
+        self.assertAlmostEqual(the3[4], 0.875)
+        self.assertEqual(the3[5], 100)
+        self.assertEqual(summary['sweeps'], [[0, 'ITC', 0.3, 0, int(5e9)]])
+
+    def test_recording_registers_run(self):
+        t = self.record('Cooldown', 0.25, catalog=self.catalog)
+        runs = self.catalog.find()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0]['status'], 'complete')
+        self.assertEqual(runs[0]['path'], os.path.abspath(t.file_name))
+        self.assertEqual(len(self.catalog.sweeps(t.file_name)), 1)
+
+    def test_register_start(self):
+        self.catalog.register_start('run.h5', 'Test', {'ITC': ['THe3']})
+        runs = self.catalog.find(channel='THe3')
+        self.assertEqual(runs[0]['status'], 'recording')
+
+    def test_find(self):
+        self.record('Cooldown', 0.25, catalog=self.catalog)
+        self.record('Warmup', 0.35, start=1000, catalog=self.catalog)
+        names = lambda runs: sorted(r['name'] for r in runs)
+        self.assertEqual(names(self.catalog.find(channel='THe3',
+                                                 below=0.3)),
+                         ['Cooldown'])
+        self.assertEqual(names(self.catalog.find(channel='THe3',
+                                                 above=1.0)),
+                         ['Cooldown', 'Warmup'])
+        self.assertEqual(names(self.catalog.find(name='Warm%')), ['Warmup'])
+        self.assertEqual(names(self.catalog.find(after=int(50e9))),
+                         ['Warmup'])
+        self.assertEqual(names(self.catalog.find(device='AH')), [])
+
+    def test_backfill(self):
+        self.record('Cooldown', 0.25, catalog=None)
+        self.record('Warmup', 0.35, start=1000, catalog=None,
+                    rotate_size=1)
+        self.assertEqual(len(find_recordings(self.folder)), 2)
+        self.assertEqual(self.catalog.backfill(self.folder, processes=2), 2)
+        self.assertEqual(len(self.catalog.find(channel='T1K')), 2)
+        # Unchanged files are not indexed again
+        self.assertEqual(self.catalog.backfill(self.folder, processes=2), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+import unittest
+
+import os
+import json
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from queue import Empty, Queue
+from threading import Event, Thread
+
+import numpy as np
+
+from RunMeas.Buffer import Buffer
+from RunMeas.Clock import (now_ns, from_datetime, to_datetime64, to_seconds,
+                           RealClock, VirtualClock, get_clock, set_clock)
+from RunMeas.Samples import SampleQueue, SampleWriter
+
+
+class ClockTestCase(unittest.TestCase):
+    """Test the epoch nanosecond timestamps."""
+
+    def test_now_ns_is_epoch_nanoseconds(self):
+        self.assertIsInstance(now_ns(), int)
+        self.assertAlmostEqual(now_ns() / 1e9, time.time(), delta=1.0)
+
+    def test_now_ns_is_monotonic(self):
+        stamps = [now_ns() for i in range(1000)]
+        self.assertTrue(np.all(np.diff(stamps) >= 0))
+
+    def test_from_datetime(self):
+        dt = datetime(2015, 4, 1, 12, 30, 15, 250000)
+        self.assertEqual(from_datetime(dt), int(dt.timestamp() * 1e6) * 1000)
+
+    def test_to_datetime64(self):
+        ts = to_datetime64([0, 1500000000 * 10**9])
+        self.assertEqual(ts.dtype, np.dtype('datetime64[ns]'))
+        self.assertEqual(ts[1], np.datetime64('2017-07-14T02:40:00'))
+
+    def test_to_seconds(self):
+        np.testing.assert_allclose(to_seconds([0, 1500000000]), [0, 1.5])
+
+
+class Sleeper(Thread):
+    """Note the virtual time of every wake-up."""
+
+    def __init__(self, clock, period):
+        super(Sleeper, self).__init__()
+        self.clock = clock
+        self.period = period
+        self.stop = False
+        self.times = []
+        clock.attach(self)
+
+    def run(self):
+        while not self.stop:
+            self.clock.sleep(self.period)
+            self.times.append(self.clock.now_ns())
+
+    def stop_thread(self):
+        self.stop = True
+        self.clock.wake(self)
+
+
+class MockMeasurementThread(Thread):
+    """A device thread sampling a slow ramp on the clock's schedule."""
+
+    def __init__(self, clock, delay):
+        super(MockMeasurementThread, self).__init__()
+        self.stop = False
+        self.clock = clock
+        self.delay = delay
+        self.chan_list = ['THe3']
+        self.q = SampleQueue()
+        self.writer = SampleWriter(self.q, self.chan_list, clock=clock)
+        clock.attach(self)
+
+    def run(self):
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            block = self.writer.block
+            block.columns[0][block.n] = self.clock.now_ns()
+            block.columns[1][block.n] = 0.3 + block.n
+            self.writer.commit(self.delay)
+        self.writer.flush()
+
+    def stop_thread(self):
+        self.stop = True
+        self.clock.wake(self)
+
+
+class VirtualClockTestCase(unittest.TestCase):
+    """Test the discrete-event clock."""
+
+    def setUp(self):
+        self.clock = VirtualClock(start=0)
+
+    def test_default_clock(self):
+        self.assertIsInstance(get_clock(), RealClock)
+        try:
+            set_clock(self.clock)
+            self.assertIs(SampleWriter(Queue(), ['THe3']).clock, self.clock)
+        finally:
+            set_clock(RealClock())
+
+    def test_schedule(self):
+        threads = [Sleeper(self.clock, 1.0), Sleeper(self.clock, 2.5)]
+        for t in threads:
+            t.start()
+        start = time.time()
+        self.clock.advance(10.0)
+        self.assertEqual(self.clock.now_ns(), int(10e9))
+        self.assertEqual(threads[0].times, [int(i * 1e9)
+                                            for i in range(1, 11)])
+        self.assertEqual(threads[1].times, [int(2.5e9), int(5e9),
+                                            int(7.5e9), int(10e9)])
+        for t in threads:
+            t.stop_thread()
+            t.join(1)
+            self.assertFalse(t.is_alive())
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_wake_before_sleep(self):
+        t = Sleeper(self.clock, 1.0)
+        # The next sleep is skipped, without the time moving on
+        self.clock.wake(t)
+        t.start()
+        deadline = time.time() + 1
+        while not t.times and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(t.times, [0])
+        t.stop_thread()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+
+    def test_get_and_wait(self):
+        q = Queue()
+        q.put(1)
+        self.assertEqual(self.clock.get(q, 1.0), 1)
+        event = Event()
+        event.set()
+        self.assertTrue(self.clock.wait(event, 1.0))
+
+        def waiting():
+            with self.assertRaises(Empty):
+                self.clock.get(q, 0.5)
+
+        t = Thread(target=waiting)
+        self.clock.attach(t)
+        t.start()
+        self.clock.advance(1.0)
+        t.join(1)
+        self.assertFalse(t.is_alive())
+
+    def test_unsettled(self):
+        clock = VirtualClock(settle=0.1)
+        release = Event()
+        t = Thread(target=release.wait)
+        clock.attach(t)
+        t.start()
+        with self.assertRaises(RuntimeError):
+            clock.advance(1.0)
+        release.set()
+        t.join()
+
+
+class SimulatedRunTestCase(unittest.TestCase):
+    """Simulate hours of acquisition and recording on a virtual clock."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_hours_with_rotation(self):
+        clock = VirtualClock(start=int(1.5e18))
+        thread = MockMeasurementThread(clock, 10.0)
+        buffer = Buffer([('ITC', None, thread)], clock=clock, delay=1.0)
+        buffer.set_data_folder(self.folder)
+        buffer.start_collection()
+        buffer.start_recording(rotate_interval=3600, catalog=False,
+                               delay=60.0)
+        start = time.time()
+        clock.advance(3 * 3600 - 30)
+        buffer.stop_recording()
+        buffer.stop_collection()
+        self.assertLess(time.time() - start, 60.0)
+
+        timestamps = buffer.data['ITC']['timestamp']
+        self.assertEqual(len(timestamps), 3 * 360 - 3)
+        # Sampled on schedule, without any drift
+        np.testing.assert_array_equal(np.diff(timestamps), int(10e9))
+        with open(buffer.record_thread.run_path) as f:
+            segments = json.load(f)['segments']
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(sum(s['rows']['ITC'] for s in segments),
+                         3 * 360 - 3)
+        self.assertTrue(all(os.path.exists(os.path.join(self.folder,
+                                                        s['file']))
+                            for s in segments))
+        self.assertTrue(os.path.basename(buffer.record_thread.run_path)
+                        .startswith(datetime.fromtimestamp(1.5e9).strftime(
+                            '%Y-%m-%dT%H-%M-%S')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Buffer import BufferRecordThread
+from RunMeas.Journal import Journal, journal_path, replay_journal
+from RunMeas.Compression import (DeadbandFilter, hold, xor_encode,
+                                 xor_decode, delta_encode, delta_decode,
+                                 packed_group, packed_rows, read_packed)
+
+
+def make_rows(start, n):
+    return {'timestamp': np.arange(start, start + n, dtype='int64') *
+            int(1e9),
+            'THe3': np.round(np.linspace(0.3, 0.31, n), 4),
+            'HeaterSensor': np.ones(n, dtype='i1')}
+
+
+class EncodingTestCase(unittest.TestCase):
+    """Test the lossless encodings."""
+
+    def test_xor_round_trip(self):
+        for dtype in ('f8', 'f4', 'i1', bool):
+            vals = (np.random.normal(0, 10, 100)).astype(dtype)
+            np.testing.assert_array_equal(
+                xor_decode(xor_encode(vals), dtype), vals)
+
+    def test_xor_keeps_nan(self):
+        vals = np.array([1.0, np.nan, np.inf, -0.0])
+        decoded = xor_decode(xor_encode(vals), 'f8')
+        self.assertEqual(decoded.tobytes(), vals.tobytes())
+
+    def test_xor_compresses_repeated_values(self):
+        vals = np.repeat(0.3, 1000)
+        self.assertLess(len(xor_encode(vals)), vals.nbytes / 50)
+
+    def test_delta_round_trip(self):
+        ts = (np.arange(100, dtype='int64') * int(1e8) +
+              np.random.randint(0, 1000, 100) + 1700000000 * int(1e9))
+        np.testing.assert_array_equal(delta_decode(delta_encode(ts)), ts)
+
+
+class DeadbandTestCase(unittest.TestCase):
+    """Test the deadband filter."""
+
+    def setUp(self):
+        self.filter = DeadbandFilter({'THe3': 0.01}, max_gap=10.0)
+
+    def rows(self, t, vals):
+        return {'timestamp': np.asarray(t, dtype='int64') * int(1e9),
+                'THe3': np.asarray(vals, dtype=float)}
+
+    def test_drops_small_changes(self):
+        rows = self.filter.filter(self.rows([0, 1, 2, 3],
+                                            [0.3, 0.305, 0.315, 0.316]))
+        np.testing.assert_array_equal(rows['THe3'], [0.3, 0.315])
+
+    def test_state_spans_batches(self):
+        self.filter.filter(self.rows([0], [0.3]))
+        rows = self.filter.filter(self.rows([1], [0.305]))
+        self.assertEqual(len(rows['timestamp']), 0)
+
+    def test_heartbeat(self):
+        rows = self.filter.filter(self.rows(range(25), np.repeat(0.3, 25)))
+        np.testing.assert_array_equal(rows['timestamp'] // int(1e9),
+                                      [0, 10, 20])
+
+    def test_unlisted_channels_keep_changes(self):
+        rows = self.rows([0, 1, 2], [0.3, 0.3, 0.3])
+        rows['T1K'] = np.array([1.5, 1.5, 1.6])
+        rows = self.filter.filter(rows)
+        np.testing.assert_array_equal(rows['T1K'], [1.5, 1.6])
+
+    def test_hold_reconstructs_within_resolution(self):
+        t = np.arange(100)
+        vals = 0.3 + 0.001 * t
+        rows = self.filter.filter(self.rows(t, vals))
+        df = pd.DataFrame(data=rows).set_index('timestamp')
+        full = hold(df, t * int(1e9))
+        self.assertTrue(np.all(np.abs(full['THe3'].values - vals) <= 0.01))
+
+
+class PackedRecordingTestCase(unittest.TestCase):
+    """Test recording in the packed format."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.folder, 'run.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_packed_is_lossless(self):
+        rows = make_rows(0, 10)
+        data = {'ITC': dict((k, v[:4]) for k, v in rows.items())}
+        t = BufferRecordThread(data, 'run', self.folder, packed=True,
+                               file_name=self.file_name)
+        t.open()
+        t.write_new_rows()
+        data['ITC'] = rows
+        t.write_new_rows()
+        t.close()
+        df = read_packed(self.file_name, 'ITC')
+        np.testing.assert_array_equal(df.index.values, rows['timestamp'])
+        np.testing.assert_array_equal(df['THe3'].values, rows['THe3'])
+        self.assertEqual(df['HeaterSensor'].dtype, np.dtype('i1'))
+        with pd.HDFStore(self.file_name, mode='r') as store:
+            self.assertEqual(list(packed_group(store)._v_children), ['ITC'])
+            self.assertEqual(packed_rows(store, 'ITC'), 10)
+            self.assertIsNone(packed_group(store, 'AH'))
+            self.assertEqual(packed_rows(store, 'AH'), 0)
+
+    def test_packed_channel_added(self):
+        rows = make_rows(0, 10)
+        data = {'ITC': dict((k, v[:4]) for k, v in rows.items())}
+        t = BufferRecordThread(data, 'run', self.folder, packed=True,
+                               file_name=self.file_name, levels=None)
+        t.open()
+        t.write_new_rows()
+        data['ITC'] = dict(rows, dTHe3=np.arange(10.0))
+        t.write_new_rows()
+        t.close()
+        df = read_packed(self.file_name, 'ITC')
+        np.testing.assert_array_equal(df['THe3'].values, rows['THe3'])
+        np.testing.assert_array_equal(df['dTHe3'].values[4:],
+                                      np.arange(4.0, 10.0))
+        self.assertTrue(np.all(np.isnan(df['dTHe3'].values[:4])))
+
+    def test_deadband_recording(self):
+        rows = make_rows(0, 10)
+        t = BufferRecordThread({'ITC': rows}, 'run', self.folder,
+                               file_name=self.file_name,
+                               deadband={'ITC': DeadbandFilter(
+                                   {'THe3': 0.005, 'HeaterSensor': 0})})
+        t.open()
+        t.write_new_rows()
+        t.close()
+        df = pd.read_hdf(self.file_name, 'raw/ITC')
+        self.assertEqual(t.written['ITC'], 10)
+        self.assertEqual(t.file_rows['ITC'], len(df))
+        self.assertLess(len(df), 10)
+
+    def test_replay_packed(self):
+        journal = Journal(journal_path(self.file_name), sync=False)
+        journal.append('ITC', 0, make_rows(0, 3))
+        journal.close(remove=False)
+        self.assertEqual(replay_journal(self.file_name, packed=True),
+                         {'ITC': 3})
+        self.assertEqual(len(read_packed(self.file_name, 'ITC')), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Derived import (RollingMean, RollingMedian, ExponentialSmoothing,
+                             Rate, Expression)
+
+
+def make_batches(values, sizes, period_ns=int(1e8)):
+    timestamps = np.arange(len(values), dtype='int64') * period_ns
+    timestamps = timestamps.astype('datetime64[ns]')
+    batches = []
+    start = 0
+    for size in sizes:
+        batches.append({'timestamp': timestamps[start:start+size],
+                        'THe3': values[start:start+size],
+                        'T1K': 2 * values[start:start+size]})
+        start += size
+    return batches
+
+
+class DerivedTestCase(unittest.TestCase):
+    """Test the incremental derived channels."""
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.values = rng.normal(size=50).cumsum()
+        self.sizes = [1, 2, 7, 1, 13, 26]
+        self.batches = make_batches(self.values, self.sizes)
+
+    def run_batches(self, chan):
+        return np.concatenate([chan.update(b) for b in self.batches])
+
+    def test_rolling_mean(self):
+        chan = RollingMean('mean', 'THe3', 5)
+        expected = pd.Series(self.values).rolling(5, min_periods=1).mean()
+        np.testing.assert_allclose(self.run_batches(chan), expected.values)
+
+    def test_rolling_median(self):
+        chan = RollingMedian('median', 'THe3', 4)
+        expected = pd.Series(self.values).rolling(4, min_periods=1).median()
+        np.testing.assert_allclose(self.run_batches(chan), expected.values)
+
+    def test_exponential_smoothing(self):
+        chan = ExponentialSmoothing('smooth', 'THe3', 0.3)
+        expected = pd.Series(self.values).ewm(alpha=0.3, adjust=False).mean()
+        np.testing.assert_allclose(self.run_batches(chan), expected.values)
+
+    def test_rate(self):
+        chan = Rate('dTHe3/dt', 'THe3')
+        result = self.run_batches(chan)
+        self.assertTrue(np.isnan(result[0]))
+        np.testing.assert_allclose(result[1:], np.diff(self.values) / 0.1)
+
+    def test_expression_string(self):
+        chan = Expression('diff', 'T1K - THe3')
+        np.testing.assert_allclose(self.run_batches(chan), self.values)
+
+    def test_expression_callable(self):
+        chan = Expression('sq', lambda b: np.square(b['THe3']))
+        np.testing.assert_allclose(self.run_batches(chan), self.values ** 2)
+
+    def test_expression_type_error(self):
+        with self.assertRaises(TypeError):
+            Expression('bad', 42)
+
+    def test_reset(self):
+        chan = RollingMean('mean', 'THe3', 3)
+        first = chan.update(self.batches[-1])
+        chan.reset()
+        np.testing.assert_allclose(chan.update(self.batches[-1]), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
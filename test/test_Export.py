@@ -0,0 +1,147 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Buffer import BufferRecordThread
+from RunMeas.Clock import from_datetime
+from RunMeas.Export import (_parse_time, export_run, export_runs,
+                            iter_chunks, recording_files, resample_chunks)
+from RunMeas.Manifest import MANIFEST_SUFFIX
+
+try:
+    import pyarrow  # noqa: F401
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+
+def make_rows(n):
+    """Rows at 10 Hz."""
+    i = np.arange(n)
+    return {'timestamp': (i * int(1e8)).astype('int64'),
+            'THe3': i.astype(float),
+            'T1K': np.repeat(1.5, n)}
+
+
+class ExportTestCase(unittest.TestCase):
+    """Test exporting recordings."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.out = os.path.join(self.folder, 'out')
+        os.makedirs(self.out)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def record(self, name, n=1000, **kwargs):
+        rows = make_rows(n)
+        data = {'ITC': dict((k, v[:0]) for k, v in rows.items()),
+                'AH': {'timestamp': rows['timestamp'][:0],
+                       'Cap': rows['THe3'][:0]}}
+        t = BufferRecordThread(data, name, self.folder, levels=None,
+                               file_name=os.path.join(self.folder,
+                                                      name + '.h5'),
+                               **kwargs)
+        t.open()
+        for stop in range(100, n + 1, 100):
+            data['ITC'] = dict((k, v[:stop]) for k, v in rows.items())
+            data['AH'] = {'timestamp': rows['timestamp'][:stop],
+                          'Cap': rows['THe3'][:stop] * 2}
+            t.write_new_rows()
+        t.close()
+        return t.run_path
+
+    def read(self, name):
+        return pd.read_csv(os.path.join(self.out, name), index_col='time',
+                           parse_dates=True)
+
+    def test_export_all(self):
+        path = self.record('run')
+        stats = export_run(path, self.out, chunksize=64)
+        self.assertEqual(sorted(os.path.basename(f)
+                                for f in stats['outputs']),
+                         ['run_AH.csv', 'run_ITC.csv'])
+        df = self.read('run_ITC.csv')
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(1000.0))
+        self.assertEqual(df.index[1] - df.index[0], pd.Timedelta('100ms'))
+        self.assertEqual(str(df.index.tz), 'UTC')
+        self.assertEqual(df.index[0].value, make_rows(1)['timestamp'][0])
+
+    def test_channels_and_range(self):
+        path = self.record('run')
+        stats = export_run(path, self.out, channels=['THe3'],
+                           start=int(10e9), stop=int(20e9))
+        self.assertEqual(len(stats['outputs']), 1)
+        df = self.read('run_ITC.csv')
+        self.assertEqual(list(df.columns), ['THe3'])
+        np.testing.assert_array_equal(df['THe3'].values,
+                                      np.arange(100.0, 200.0))
+
+    def test_resample(self):
+        path = self.record('run')
+        export_run(path, self.out, devices=['ITC'], resample='1s',
+                   chunksize=33)
+        df = self.read('run_ITC.csv')
+        self.assertEqual(len(df), 100)
+        np.testing.assert_array_equal(df['THe3'].values,
+                                      np.arange(100) * 10 + 4.5)
+
+    def test_parse_time(self):
+        # An offset is honoured, a naive time is local time
+        self.assertEqual(_parse_time('2017-07-14T02:40:00+00:00'),
+                         int(1.5e18))
+        self.assertEqual(_parse_time('2017-07-14T02:40:00'),
+                         from_datetime(datetime(2017, 7, 14, 2, 40)))
+
+    def test_resample_chunks(self):
+        df = pd.DataFrame({'x': np.arange(10.0)},
+                          index=np.arange(10) * 3)
+        chunks = [df.iloc[i:i + 4] for i in range(0, 10, 4)]
+        out = pd.concat(resample_chunks(chunks, 10))
+        np.testing.assert_array_equal(out['x'].values, [1.5, 5.0, 8.0])
+        np.testing.assert_array_equal(out.index.values, [0, 10, 20])
+
+    def test_segmented_and_packed(self):
+        path = self.record('seg', rotate_size=1, packed=True)
+        self.assertTrue(path.endswith(MANIFEST_SUFFIX))
+        export_run(path, self.out, devices=['ITC'])
+        df = self.read('seg_ITC.csv')
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(1000.0))
+
+    def test_packed_chunks_are_bounded(self):
+        path = self.record('run', packed=True)
+        (files, devices) = recording_files(path)
+        chunks = list(iter_chunks(files, 'ITC', ['THe3'], start=int(5e9),
+                                  stop=int(95e9)))
+        # One recorded batch of 100 rows at a time, not the whole run
+        self.assertLessEqual(max(len(c) for c in chunks), 100)
+        np.testing.assert_array_equal(
+            pd.concat(chunks)['THe3'].values, np.arange(50.0, 950.0))
+
+    def test_export_runs(self):
+        paths = [self.record('run{}'.format(i), n=200) for i in range(3)]
+        stats = export_runs(paths, self.out, processes=2)
+        self.assertEqual(stats['runs'], 3)
+        self.assertEqual(stats['files'], 6)
+        self.assertAlmostEqual(stats['files_per_s'],
+                               2 * stats['runs_per_s'])
+        self.assertGreater(stats['mb_per_s'], 0)
+
+    @unittest.skipUnless(HAVE_PYARROW, 'pyarrow is not installed')
+    def test_parquet(self):
+        path = self.record('run')
+        export_run(path, self.out, fmt='parquet', chunksize=300)
+        df = pd.read_parquet(os.path.join(self.out, 'run_ITC.parquet'))
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(1000.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
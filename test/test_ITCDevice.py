@@ -6,7 +6,11 @@ import time
 from queue import Queue
 from datetime import datetime
 
-from RunMeas.ITCDevice import ITCDevice, ITCMeasurementThread
+from RunMeas.Cache import QueryCache
+from RunMeas.Clock import VirtualClock
+from RunMeas.ITCDevice import FRESHNESS, ITCDevice, ITCMeasurementThread
+from RunMeas.Polling import RateController
+from RunMeas.Recovery import RetryPolicy
 
 DEVPATH = os.path.join(os.getcwd(), 'test', 'devices.yaml')
 # DEVPATH = '/home/chris/Programming/github/RunMeas/test/devices.yaml'
@@ -109,6 +113,54 @@ class DeviceTestCase(unittest.TestCase):
         self.assertEqual(THe3, ('THe3', 7.000))
         self.assertEqual(T1K, ('T1K', 7.000))
 
+    def test_cache(self):
+        "Repeated readings share one query, settings are read back"
+        queries = []
+        query = self.itc01.resource.query
+
+        def counting_query(command):
+            queries.append(command)
+            return query(command)
+
+        self.itc01.resource.query = counting_query
+        self.itc01.set_cache()
+        self.itc01.set_heater_output(20)
+        for i in range(3):
+            self.assertEqual(self.itc01.get_heater_output(),
+                             ('HeaterOutput', 20.0))
+            self.assertEqual(self.itc01.get_tsorp(), ('TSorp', 249.2))
+        self.itc01.set_heater_output(30)
+        self.assertEqual(self.itc01.get_heater_output(),
+                         ('HeaterOutput', 30.0))
+        self.assertEqual(queries, ['O20.0', 'R5', 'R1', 'O30.0', 'R5'])
+        self.assertEqual(self.itc01.cache.stats()['hits'], 4)
+
+
+class FlakyResource(object):
+    """A resource whose queries time out during an outage."""
+
+    def __init__(self, resource, outage):
+        self.resource = resource
+        self.outage = outage
+
+    def query(self, command):
+        if self.outage:
+            raise pyvisa.errors.VisaIOError(
+                pyvisa.constants.StatusCode.error_timeout)
+        return self.resource.query(command)
+
+    def close(self):
+        self.resource.close()
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def __setattr__(self, name, value):
+        if name in ('resource', 'outage'):
+            super(FlakyResource, self).__setattr__(name, value)
+        else:
+            setattr(self.resource, name, value)
+
 
 class ThreadTestCase(unittest.TestCase):
     """Test the thread class."""
@@ -116,7 +168,7 @@ class ThreadTestCase(unittest.TestCase):
     def setUp(self):
         self.rm = visa.ResourceManager('{}@sim'.format(DEVPATH))
         for resource_address in self.rm.list_resources():
-            if 'GPIB' in resource_address:
+            if 'GPIB' in resource_address and '24' in resource_address:
                 self.itc01 = ITCDevice(resource_address)
                 self.itc01.set_resource(self.rm.open_resource)
 
@@ -141,6 +193,76 @@ class ThreadTestCase(unittest.TestCase):
         self.itc_thread.join()
         self.assertFalse(self.itc_thread.is_alive())
 
+    def test_thread_records_poll_delay(self):
+        controller = RateController({'THe3': 0.01}, min_delay=0.05,
+                                    max_delay=0.2)
+        itc_thread = ITCMeasurementThread(self.itc01, ['THe3'], delay=0.05,
+                                          rate_controller=controller)
+        self.assertEqual(itc_thread.chan_list[-1], ('PollDelay', 'f4'))
+        itc_thread.start()
+        time.sleep(0.5)
+        itc_thread.stop_thread()
+        itc_thread.join()
+        delays = []
+        while not itc_thread.q.empty():
+            delays.extend(itc_thread.q.get().to_columns()['PollDelay'])
+        self.assertAlmostEqual(delays[0], 0.05)
+        self.assertGreater(delays[-1], delays[0])
+
+    def test_thread_survives_outage(self):
+        clock = VirtualClock(start=0)
+        outage = []
+        opened = []
+
+        def open_resource(address, **kwargs):
+            opened.append(address)
+            return FlakyResource(self.rm.open_resource(address, **kwargs),
+                                 outage)
+
+        policy = RetryPolicy(timeout=0.5, retries=2, backoff=0.1,
+                             clock=clock)
+        itc = ITCDevice(self.itc01.address, policy=policy)
+        itc.set_resource(open_resource)
+        self.assertEqual(itc.resource.timeout, 500)
+        itc_thread = ITCMeasurementThread(itc, ['TSorp'], delay=1.0,
+                                          clock=clock)
+        itc_thread.start()
+        clock.advance(5.5)
+        outage.append(True)
+        clock.advance(3)
+        outage.clear()
+        clock.advance(5)
+        itc_thread.stop_thread()
+        itc_thread.join()
+        values = []
+        while not itc_thread.q.empty():
+            values.extend(itc_thread.q.get().to_columns()['TSorp'])
+        # Three samples in the outage are NaN, the others read through
+        self.assertEqual(sum(v != v for v in values), 3)
+        self.assertEqual(values[-1], 249.2)
+        self.assertEqual(len(itc_thread.gaps.gaps), 1)
+        (start, stop) = itc_thread.gaps.gaps[0]
+        self.assertLessEqual((stop - start) / 1e9, 4.5)
+        # Re-opened once per failed sample
+        self.assertEqual(len(opened), 4)
+
+    def test_cached_reading_keeps_its_time(self):
+        clock = VirtualClock(start=0)
+        self.itc01.set_cache(QueryCache(FRESHNESS, clock=clock))
+        itc_thread = ITCMeasurementThread(self.itc01, ['TSorp'], delay=1.0,
+                                          clock=clock)
+        itc_thread.start()
+        clock.advance(0.95)
+        # The GUI reads the value just before the thread samples it
+        self.itc01.get_tsorp()
+        clock.advance(1.5)
+        itc_thread.stop_thread()
+        itc_thread.join()
+        ts = []
+        while not itc_thread.q.empty():
+            ts.extend(itc_thread.q.get().to_columns()['timestamp'])
+        self.assertEqual(ts[:2], [int(0.95e9), int(2e9)])
+
     def test_number_elements_in_queue(self):
         wait = 5
         self.assertTrue(self.itc_thread.q.empty())
@@ -0,0 +1,139 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Buffer import BufferRecordThread
+from RunMeas.Journal import (Journal, read_records, journal_path,
+                             replay_journal)
+
+
+def make_rows(start, n):
+    timestamps = (np.arange(start, start + n, dtype='int64') *
+                  int(1e8)).astype('datetime64[ns]')
+    return {'timestamp': timestamps,
+            'THe3': np.arange(start, start + n, dtype=float)}
+
+
+class JournalTestCase(unittest.TestCase):
+    """Test the write-ahead journal."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.folder, 'run.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        journal = Journal(journal_path(self.file_name), sync=False)
+        journal.append('ITC', 0, make_rows(0, 3))
+        journal.append('ITC', 3, make_rows(3, 2))
+        journal.close(remove=False)
+        records = list(read_records(journal_path(self.file_name)))
+        self.assertEqual([(r[0], r[1]) for r in records],
+                         [('ITC', 0), ('ITC', 3)])
+        np.testing.assert_array_equal(records[1][2]['THe3'], [3.0, 4.0])
+        self.assertEqual(records[0][2]['timestamp'].dtype,
+                         np.dtype('datetime64[ns]'))
+
+    def test_truncated_record_is_ignored(self):
+        journal = Journal(journal_path(self.file_name), sync=False)
+        journal.append('ITC', 0, make_rows(0, 3))
+        journal.append('ITC', 3, make_rows(3, 2))
+        journal.close(remove=False)
+        with open(journal_path(self.file_name), 'r+b') as f:
+            f.truncate(os.path.getsize(journal_path(self.file_name)) - 5)
+        records = list(read_records(journal_path(self.file_name)))
+        self.assertEqual(len(records), 1)
+
+    def test_checkpoint_empties_journal(self):
+        journal = Journal(journal_path(self.file_name), sync=False)
+        journal.append('ITC', 0, make_rows(0, 3))
+        journal.checkpoint()
+        journal.close(remove=False)
+        self.assertEqual(list(read_records(journal_path(self.file_name))), [])
+
+    def test_replay_appends_missing_rows(self):
+        df = pd.DataFrame(data=make_rows(0, 3)).set_index('timestamp')
+        df.to_hdf(self.file_name, key='raw/ITC', format='table')
+        journal = Journal(journal_path(self.file_name), sync=False)
+        # The first batch made it into the file, the second did not
+        journal.append('ITC', 0, make_rows(0, 3))
+        journal.append('ITC', 3, make_rows(3, 4))
+        journal.close(remove=False)
+        self.assertEqual(replay_journal(self.file_name), {'ITC': 4})
+        self.assertFalse(os.path.exists(journal_path(self.file_name)))
+        df = pd.read_hdf(self.file_name, 'raw/ITC')
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(7.0))
+
+    def test_replay_corrupt_file(self):
+        with open(self.file_name, 'wb') as f:
+            f.write(b'not an hdf5 file')
+        journal = Journal(journal_path(self.file_name), sync=False)
+        journal.append('ITC', 0, make_rows(0, 3))
+        journal.close(remove=False)
+        # The journal alone would only give the last rows, so nothing is
+        # rebuilt and both files are kept for salvaging
+        with self.assertRaises(IOError):
+            replay_journal(self.file_name)
+        with open(self.file_name, 'rb') as f:
+            self.assertEqual(f.read(), b'not an hdf5 file')
+        self.assertEqual(len(list(read_records(journal_path(
+            self.file_name)))), 1)
+
+    def test_resume_corrupt_file_without_journal(self):
+        with open(self.file_name, 'wb') as f:
+            f.write(b'not an hdf5 file')
+        t = BufferRecordThread({'ITC': make_rows(0, 3)}, 'run', self.folder,
+                               file_name=self.file_name)
+        with self.assertRaises(IOError):
+            t.open()
+
+    def test_resumed_recording_continues_file(self):
+        dev_data = {'ITC': make_rows(0, 5)}
+        t = BufferRecordThread(dev_data, 'run', self.folder,
+                               file_name=self.file_name)
+        t.open()
+        t.write_new_rows()
+        t.close()
+        # A new process with a fresh buffer resumes into the same file
+        dev_data = {'ITC': make_rows(5, 3)}
+        t = BufferRecordThread(dev_data, 'run', self.folder,
+                               file_name=self.file_name)
+        t.open()
+        self.assertEqual(t.file_rows, {'ITC': 5})
+        t.write_new_rows()
+        t.close()
+        df = pd.read_hdf(self.file_name, 'raw/ITC')
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(8.0))
+        self.assertFalse(os.path.exists(journal_path(self.file_name)))
+
+    def test_channel_added_while_recording(self):
+        rows = make_rows(0, 5)
+        dev_data = {'ITC': rows}
+        t = BufferRecordThread(dev_data, 'run', self.folder,
+                               file_name=self.file_name, levels=None)
+        t.open()
+        t.write_new_rows()
+        # As Buffer.add_derived_channel does, backfilled with NaN
+        more = make_rows(5, 3)
+        more['dTHe3'] = np.ones(3)
+        dev_data['ITC'] = dict((k, np.concatenate([rows[k], more[k]]))
+                               for k in ('timestamp', 'THe3'))
+        dev_data['ITC']['dTHe3'] = np.concatenate([np.repeat(np.nan, 5),
+                                                   more['dTHe3']])
+        t.write_new_rows()
+        t.close()
+        df = pd.read_hdf(self.file_name, 'raw/ITC')
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(8.0))
+        np.testing.assert_array_equal(df['dTHe3'].values,
+                                      [np.nan] * 5 + [1.0] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
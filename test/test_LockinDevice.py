@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+from RunMeas.Clock import VirtualClock
+from RunMeas.LockinDevice import (BUFFER_SIZE, SR830Device,
+                                  LockinMeasurementThread, SimulatedSR830)
+
+
+class LockinTestCase(unittest.TestCase):
+    """Test the buffered acquisition against the simulated SR830."""
+
+    def setUp(self):
+        self.clock = VirtualClock(start=0)
+        self.sim = SimulatedSR830(clock=self.clock)
+        self.device = SR830Device("GPIB1::9::INSTR")
+        self.device.set_resource(lambda address, **kwargs: self.sim)
+
+    def run_thread(self, seconds, **kwargs):
+        thread = LockinMeasurementThread(self.device, ['X', 'Y'],
+                                         clock=self.clock, **kwargs)
+        thread.start()
+        self.clock.advance(seconds)
+        thread.stop_thread()
+        # The last transfer and the pause still take bus time
+        self.clock.advance(1.0)
+        thread.join()
+        blocks = [thread.q.get().to_columns()
+                  for i in range(thread.q.qsize())]
+        data = dict((name, np.concatenate([b[name] for b in blocks]))
+                    for name in ('timestamp', 'X', 'Y'))
+        return (thread, data)
+
+    def test_reconstructed_timestamps(self):
+        (thread, data) = self.run_thread(10.0, rate=512.0, delay=0.5)
+        ts = data['timestamp']
+        self.assertGreater(len(ts), 4500)
+        np.testing.assert_array_equal(np.diff(ts), int(1e9 / 512))
+        # The values belong to the times they are stamped with
+        (x, y) = SimulatedSR830.signal(ts / 1e9)
+        np.testing.assert_array_equal(data['X'], x.astype('f4'))
+        np.testing.assert_array_equal(data['Y'], y.astype('f4'))
+        self.assertEqual(thread.gaps.gaps, [])
+        # One binary transfer per channel and delay, not one query per point
+        self.assertLess(self.sim.queries, 200)
+
+    def test_restart_when_full(self):
+        (thread, data) = self.run_thread(40.0, rate=512.0, delay=0.5)
+        ts = data['timestamp']
+        self.assertGreater(len(ts), BUFFER_SIZE)
+        steps = np.diff(ts)
+        self.assertTrue(np.all(steps > 0))
+        # A single restart, which loses only the points during the restart
+        restarts = np.nonzero(steps != int(1e9 / 512))[0]
+        self.assertEqual(len(restarts), 1)
+        self.assertLess(steps[restarts[0]], 1e8)
+        (x, y) = SimulatedSR830.signal(ts / 1e9)
+        np.testing.assert_array_equal(data['X'], x.astype('f4'))
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            self.device.set_sample_rate(500.0)
+        with self.assertRaises(ValueError):
+            LockinMeasurementThread(self.device, ['X', 'R'],
+                                    clock=self.clock)
+        with self.assertRaises(ValueError):
+            LockinMeasurementThread(self.device, ['X', 'Y'], rate=3.0,
+                                    clock=self.clock)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from RunMeas.Buffer import BufferRecordThread
+from RunMeas.Manifest import MANIFEST_SUFFIX, Manifest, SegmentedRun
+
+
+def make_rows(start, n):
+    """Rows at 10 Hz starting at sample 'start'."""
+    i = np.arange(start, start + n)
+    return {'timestamp': (i * int(1e8)).astype('int64'),
+            'THe3': i.astype(float)}
+
+
+class ManifestTestCase(unittest.TestCase):
+    """Test the manifest of a segmented recording."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'run' + MANIFEST_SUFFIX)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        manifest = Manifest(self.path)
+        manifest.add_segment(os.path.join(self.folder, 'run.0000.h5'))
+        manifest.update_segment(5, 10, {'ITC': 3})
+        manifest.update_segment(2, 8, {'ITC': 4})
+        manifest = Manifest(self.path)
+        self.assertEqual(manifest.segments,
+                         [{'file': 'run.0000.h5', 'start': 2, 'stop': 10,
+                           'rows': {'ITC': 4}}])
+
+
+class SegmentedRecordingTestCase(unittest.TestCase):
+    """Test recording into rotating segments."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.base = os.path.join(self.folder, 'run')
+        self.rows = make_rows(0, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def record(self, batch=100, **kwargs):
+        data = {'ITC': dict((k, v[:0]) for k, v in self.rows.items())}
+        t = BufferRecordThread(data, 'run', self.folder,
+                               file_name=self.base + '.h5', levels=(1,),
+                               **kwargs)
+        t.open()
+        for stop in range(batch, len(self.rows['timestamp']) + 1, batch):
+            data['ITC'] = dict((k, v[:stop]) for k, v in self.rows.items())
+            t.write_new_rows()
+        t.close()
+        return t
+
+    def test_rotation_by_size(self):
+        t = self.record(rotate_size=1)
+        self.assertEqual(len(t.manifest.segments), 11)
+        for i, segment in enumerate(t.manifest.segments[:-1]):
+            self.assertEqual(segment['file'], 'run.{:04d}.h5'.format(i))
+            self.assertEqual(segment['rows'], {'ITC': 100})
+            self.assertEqual(segment['start'], int(i * 100 * 1e8))
+        # The last segment was opened after the last write and is empty
+        self.assertEqual(t.manifest.segments[-1]['start'], None)
+
+    def test_rotation_by_time(self):
+        t = self.record(rotate_interval=1e-9)
+        self.assertEqual(len(t.manifest.segments), 11)
+
+    def test_continuous_view(self):
+        self.record(rotate_size=1)
+        run = SegmentedRun(self.base + MANIFEST_SUFFIX)
+        df = run.select('ITC')
+        np.testing.assert_array_equal(df['THe3'].values, self.rows['THe3'])
+        df = run.select('ITC', start=int(250e8), stop=int(450e8))
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(250, 450))
+
+    def test_only_touched_segments_are_opened(self):
+        self.record(rotate_size=1)
+        run = SegmentedRun(self.base + MANIFEST_SUFFIX)
+        paths = run.touching(int(250e8), int(450e8))
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ['run.0002.h5', 'run.0003.h5', 'run.0004.h5',
+                          'run.0010.h5'])
+        # Removing the untouched segments does not affect the query
+        for i in (0, 1, 5, 6):
+            os.remove('{}.{:04d}.h5'.format(self.base, i))
+        df = run.select('ITC', start=int(250e8), stop=int(450e8))
+        self.assertEqual(len(df), 200)
+
+    def test_live_segment_is_found(self):
+        data = {'ITC': dict((k, v[:100]) for k, v in self.rows.items())}
+        t = BufferRecordThread(data, 'run', self.folder,
+                               file_name=self.base + '.h5', levels=(1,),
+                               rotate_size=1 << 30)
+        t.open()
+        t.write_new_rows()
+        data['ITC'] = self.rows
+        t.write_new_rows()
+        # The process dies without closing the segment
+        t.store.close()
+        t.journal.close()
+        run = SegmentedRun(self.base + MANIFEST_SUFFIX)
+        # The manifest follows every write, not only the first and the close
+        self.assertEqual(run.stop, int(999e8))
+        self.assertEqual(len(run.select('ITC', int(50e9), int(100e9))), 500)
+        # A crash can leave the manifest behind the last segment
+        run.manifest.segments[-1]['stop'] = int(9e9)
+        self.assertEqual(len(run.select('ITC', int(50e9), int(100e9))), 500)
+
+    def test_levels_across_segments(self):
+        self.record(batch=25, rotate_size=1)
+        run = SegmentedRun(self.base + MANIFEST_SUFFIX)
+        (level, df) = run.read_range('ITC', pixels=50)
+        self.assertEqual(level, 1)
+        self.assertEqual(list(df['THe3_count']), [10] * 100)
+
+    def test_resume_from_manifest(self):
+        self.rows = make_rows(0, 200)
+        self.record(rotate_size=1)
+        data = {'ITC': make_rows(200, 100)}
+        t = BufferRecordThread(data, 'run', self.folder,
+                               file_name=self.base + MANIFEST_SUFFIX)
+        t.open()
+        t.write_new_rows()
+        t.close()
+        df = SegmentedRun(self.base + MANIFEST_SUFFIX).select('ITC')
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(300.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from RunMeas.Polling import RateController
+
+
+class RateControllerTestCase(unittest.TestCase):
+    """Test the change-driven polling rate."""
+
+    def setUp(self):
+        self.controller = RateController({'THe3': 0.01}, min_delay=0.1,
+                                         max_delay=1.0, backoff=2.0)
+        self.t = 0
+
+    def sample(self, value, dt=1.0):
+        self.t += int(dt * 1e9)
+        return self.controller.update(self.t, {'THe3': value, 'T1K': 1.5})
+
+    def test_first_sample_is_fast(self):
+        self.assertEqual(self.sample(0.3), 0.1)
+
+    def test_backs_off_to_heartbeat(self):
+        delays = [self.sample(0.3) for i in range(8)]
+        self.assertEqual(delays[:5], [0.1, 0.2, 0.4, 0.8, 1.0])
+        self.assertEqual(delays[-1], 1.0)
+
+    def test_change_resets_to_fast(self):
+        for i in range(8):
+            self.sample(0.3)
+        self.assertEqual(self.sample(0.35), 0.1)
+
+    def test_slow_drift_is_quiet(self):
+        delays = [self.sample(0.3 + 0.001 * i) for i in range(5)]
+        self.assertEqual(delays[-1], 1.0)
+
+    def test_reset(self):
+        for i in range(8):
+            self.sample(0.3)
+        self.controller.reset()
+        self.assertEqual(self.controller.delay, 0.1)
+
+    def test_invalid_delays(self):
+        with self.assertRaises(ValueError):
+            RateController({'THe3': 0.01}, min_delay=1.0, max_delay=0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+
+from threading import Thread
+
+import numpy as np
+
+from RunMeas.Buffer import Buffer
+from RunMeas.Clock import VirtualClock
+from RunMeas.Pool import DevicePool
+from RunMeas.Samples import SampleQueue, SampleWriter
+
+
+class MockMeasurementThread(Thread):
+    """A device thread counting its samples, never started by a pool."""
+
+    def __init__(self, clock, delay, fail=False):
+        super(MockMeasurementThread, self).__init__()
+        self.stop = False
+        self.clock = clock
+        self.delay = delay
+        self.fail = fail
+        self.chan_list = ['THe3']
+        self.q = SampleQueue()
+        self.writer = SampleWriter(self.q, self.chan_list, block_size=4,
+                                   clock=clock)
+        self.n = 0
+
+    def sample(self):
+        if self.fail:
+            raise IOError('VI_ERROR_TMO')
+        block = self.writer.block
+        block.columns[0][block.n] = self.clock.now_ns()
+        block.columns[1][block.n] = self.n
+        self.n += 1
+        self.writer.commit()
+        return self.delay
+
+    def run(self):
+        while not self.stop:
+            self.clock.sleep(self.delay)
+            self.sample()
+
+    def stop_thread(self):
+        self.stop = True
+
+
+class DevicePoolTestCase(unittest.TestCase):
+    """Test sampling devices on their own schedules."""
+
+    def setUp(self):
+        self.clock = VirtualClock(start=0)
+
+    def test_schedules(self):
+        threads = [('fast', MockMeasurementThread(self.clock, 0.5)),
+                   ('slow', MockMeasurementThread(self.clock, 2.0)),
+                   ('ITC', MockMeasurementThread(self.clock, 1.0))]
+        pool = DevicePool(threads, workers=1, clock=self.clock)
+        pool.start()
+        self.clock.advance(10.25)
+        pool.stop_thread()
+        pool.join()
+        self.assertEqual(pool.samples, {'fast': 20, 'slow': 5, 'ITC': 10})
+        for (name, thread) in threads:
+            ts = np.concatenate([thread.q.get().to_columns()['timestamp']
+                                 for i in range(thread.q.qsize())])
+            self.assertEqual(len(ts), pool.samples[name])
+            np.testing.assert_array_equal(np.diff(ts), int(thread.delay * 1e9))
+            self.assertFalse(thread.is_alive())
+
+    def test_failing_device(self):
+        threads = [('ITC', MockMeasurementThread(self.clock, 1.0)),
+                   ('AH', MockMeasurementThread(self.clock, 1.0, fail=True))]
+        pool = DevicePool(threads, workers=2, clock=self.clock)
+        pool.start()
+        self.clock.advance(5.5)
+        pool.stop_thread()
+        pool.join()
+        self.assertEqual(pool.samples, {'ITC': 5, 'AH': 0})
+        self.assertEqual(pool.errors, {'ITC': 0, 'AH': 5})
+
+    def test_no_workers(self):
+        with self.assertRaises(ValueError):
+            DevicePool([], workers=0)
+
+
+class PooledBufferTestCase(unittest.TestCase):
+    """Test a buffer with a pool and a single collection thread."""
+
+    def test_collects_all_devices(self):
+        clock = VirtualClock(start=0)
+        devices = [('dev{}'.format(i), None,
+                    MockMeasurementThread(clock, 0.1 * (i + 1)))
+                   for i in range(7)]
+        buffer = Buffer(devices, clock=clock, delay=0.05, workers=2)
+        buffer.start_collection()
+        clock.advance(7.05)
+        # Two workers and the collector, however many devices there are
+        self.assertEqual(sum(t.is_alive() for t in buffer.pool.workers), 2)
+        self.assertTrue(buffer.collector.is_alive())
+        self.assertFalse(any(t.is_alive()
+                             for t in buffer.collection_threads))
+        buffer.stop_collection()
+        for i in range(7):
+            values = buffer.data['dev{}'.format(i)]['THe3']
+            np.testing.assert_array_equal(values,
+                                          np.arange(70 // (i + 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Buffer import BufferRecordThread
+from RunMeas.Pyramid import (LivePyramid, PyramidBuilder, aggregate,
+                             choose_level, downsample, level_key, read_range)
+
+
+def make_rows(start, n, rate=10):
+    """Rows at 'rate' Hz starting at sample 'start'."""
+    i = np.arange(start, start + n)
+    return {'timestamp': (i * int(1e9 / rate)).astype('int64'),
+            'THe3': i.astype(float)}
+
+
+class AggregateTestCase(unittest.TestCase):
+    """Test the binning of rows."""
+
+    def test_aggregate(self):
+        rows = make_rows(0, 25)
+        bins, aggs = aggregate(rows['timestamp'], {'THe3': rows['THe3']}, 1)
+        np.testing.assert_array_equal(bins, [0, int(1e9), int(2e9)])
+        np.testing.assert_array_equal(aggs[('THe3', 'min')], [0, 10, 20])
+        np.testing.assert_array_equal(aggs[('THe3', 'max')], [9, 19, 24])
+        np.testing.assert_array_equal(aggs[('THe3', 'count')], [10, 10, 5])
+
+    def test_nan_is_not_counted(self):
+        bins, aggs = aggregate(np.array([0, 1, 2]),
+                               {'x': np.array([1.0, np.nan, 3.0])}, 1)
+        self.assertEqual(aggs[('x', 'count')][0], 2)
+        self.assertEqual(aggs[('x', 'sum')][0], 4.0)
+        self.assertEqual(aggs[('x', 'max')][0], 3.0)
+
+    def test_choose_level(self):
+        self.assertEqual(choose_level(7 * 24 * 3600, 1000), 600)
+        self.assertEqual(choose_level(3600, 1000), 1)
+        self.assertIsNone(choose_level(100, 1000))
+
+    def test_downsample(self):
+        rows = make_rows(0, 1000)
+        (t, mean, low, high) = downsample(rows['timestamp'], rows['THe3'], 5)
+        self.assertEqual(len(t), 10)
+        self.assertEqual(mean[0], 49.5)
+        (t, mean, low, high) = downsample(rows['timestamp'], rows['THe3'],
+                                          1000)
+        self.assertEqual(len(t), 1000)
+
+    def test_live_pyramid(self):
+        rows = make_rows(0, 1000)
+        pyramid = LivePyramid()
+        stop = 0
+        for n in (7, 13, 1, 44, 135, 800):
+            pyramid.update(dict((k, v[stop:stop + n])
+                                for k, v in rows.items()))
+            stop += n
+            if stop == 65:
+                # 6.4 s of data are drawn raw
+                self.assertIsNone(pyramid.downsample('THe3', 10))
+        for reduced in (pyramid.downsample('THe3', 5),
+                        pyramid.downsample('THe3', 5)):
+            expected = downsample(rows['timestamp'], rows['THe3'], 5)
+            for (a, b) in zip(reduced, expected):
+                np.testing.assert_array_equal(a, b)
+        self.assertIsNone(pyramid.downsample('THe3', 1000))
+        # A channel the pyramid has not seen has no valid bins
+        self.assertTrue(np.all(np.isnan(pyramid.downsample('T1K', 5)[1])))
+
+
+class PyramidRecordingTestCase(unittest.TestCase):
+    """Test the levels written by the recording thread."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.folder, 'run.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def record(self, batches):
+        rows = make_rows(0, sum(batches))
+        data = {'ITC': dict((k, v[:0]) for k, v in rows.items())}
+        t = BufferRecordThread(data, 'run', self.folder,
+                               file_name=self.file_name, levels=(1, 10))
+        t.open()
+        stop = 0
+        for n in batches:
+            stop += n
+            data['ITC'] = dict((k, v[:stop]) for k, v in rows.items())
+            t.write_new_rows()
+        t.close()
+        return rows
+
+    def test_levels_match_raw(self):
+        # Batches that do not line up with the bins
+        rows = self.record([7, 13, 1, 44, 135])
+        raw = pd.read_hdf(self.file_name, 'raw/ITC')
+        expected = raw.groupby(raw.index // int(1e9))['THe3']
+        level = pd.read_hdf(self.file_name, level_key('ITC', 1))
+        np.testing.assert_array_equal(level['THe3_mean'].values,
+                                      expected.mean().values)
+        np.testing.assert_array_equal(level['THe3_min'].values,
+                                      expected.min().values)
+        np.testing.assert_array_equal(level['THe3_count'].values,
+                                      expected.count().values)
+        level = pd.read_hdf(self.file_name, level_key('ITC', 10))
+        self.assertEqual(level['THe3_count'].sum(), len(rows['THe3']))
+
+    def test_read_range_picks_level(self):
+        self.record([1000])
+        (level, df) = read_range(self.file_name, 'ITC', pixels=10)
+        self.assertEqual(level, 10)
+        self.assertEqual(len(df), 10)
+        (level, df) = read_range(self.file_name, 'ITC', pixels=50)
+        self.assertEqual(level, 1)
+        (level, df) = read_range(self.file_name, 'ITC', pixels=500)
+        self.assertIsNone(level)
+        self.assertEqual(len(df), 1000)
+
+    def test_read_range_window(self):
+        self.record([1000])
+        (level, df) = read_range(self.file_name, 'ITC', start=int(10e9),
+                                 stop=int(30e9), pixels=20)
+        self.assertEqual(level, 1)
+        self.assertEqual(df.index[0], int(10e9))
+        self.assertEqual(len(df), 20)
+
+    def test_read_range_packed(self):
+        rows = make_rows(0, 100)
+        t = BufferRecordThread({'ITC': rows}, 'run', self.folder,
+                               file_name=self.file_name, packed=True,
+                               levels=None)
+        t.open()
+        t.write_new_rows()
+        t.close()
+        (level, df) = read_range(self.file_name, 'ITC', start=int(2e9),
+                                 stop=int(3e9), pixels=100)
+        self.assertIsNone(level)
+        np.testing.assert_array_equal(df['THe3'].values, np.arange(20, 30))
+
+    def test_channel_added_while_recording(self):
+        rows = make_rows(0, 100)
+        data = {'ITC': dict((k, v[:45]) for k, v in rows.items())}
+        t = BufferRecordThread(data, 'run', self.folder,
+                               file_name=self.file_name, levels=(1, 10))
+        t.open()
+        t.write_new_rows()
+        # A derived channel added in the middle of a bin, with its history
+        # backfilled with NaN
+        data['ITC'] = dict(rows, dTHe3=np.where(np.arange(100) < 45, np.nan,
+                                                1.0))
+        t.write_new_rows()
+        t.close()
+        level = pd.read_hdf(self.file_name, level_key('ITC', 1))
+        self.assertEqual(list(level['THe3_count']), [10] * 10)
+        np.testing.assert_array_equal(level['dTHe3_count'].fillna(0),
+                                      [0] * 4 + [5] + [10] * 5)
+        np.testing.assert_array_equal(level['dTHe3_mean'].values[5:], 1.0)
+        level = pd.read_hdf(self.file_name, level_key('ITC', 10))
+        self.assertEqual(level['THe3_count'].sum(), 100)
+        self.assertEqual(level['dTHe3_count'].sum(), 55)
+
+    def test_resumed_bin_is_combined(self):
+        builder = PyramidBuilder((10,))
+        rows = make_rows(0, 30, rate=1)
+        with pd.HDFStore(self.file_name, mode='w') as store:
+            builder.update(store, 'ITC',
+                           dict((k, v[:15]) for k, v in rows.items()))
+            builder.flush(store)
+            builder = PyramidBuilder((10,))
+            builder.update(store, 'ITC',
+                           dict((k, v[15:]) for k, v in rows.items()))
+            builder.flush(store)
+        (level, df) = read_range(self.file_name, 'ITC', pixels=1)
+        self.assertEqual(list(df['THe3_count']), [10, 10, 10])
+        self.assertEqual(df['THe3_mean'].iloc[1], 14.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+from RunMeas.Recovery import DeviceError, GapRecorder, RetryPolicy, recover
+
+
+class MockClock(object):
+
+    def __init__(self):
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class FlakyQuery(object):
+    """Fails a given number of times before it answers."""
+
+    def __init__(self, failures, error=IOError('VI_ERROR_TMO')):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+        self.reopened = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return 'R249.2'
+
+    def reopen(self):
+        self.reopened += 1
+
+
+class RecoverTestCase(unittest.TestCase):
+    """Test retrying a query under a policy."""
+
+    def setUp(self):
+        self.clock = MockClock()
+        self.policy = RetryPolicy(retries=4, backoff=0.1, max_backoff=0.3,
+                                  clock=self.clock)
+
+    def test_delays(self):
+        self.assertEqual(self.policy.delays(), [0.0, 0.1, 0.2, 0.3])
+        policy = RetryPolicy(retries=2, backoff=0.5, hedge=False)
+        self.assertEqual(policy.delays(), [0.5, 1.0])
+        with self.assertRaises(ValueError):
+            RetryPolicy(retries=-1)
+
+    def test_hedged_requery(self):
+        # A single garbled reply is sent again at once
+        query = FlakyQuery(1, ValueError('could not convert'))
+        self.assertEqual(recover(query, self.policy, query.reopen), 'R249.2')
+        self.assertEqual(query.calls, 2)
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(query.reopened, 0)
+
+    def test_backoff_and_reopen(self):
+        query = FlakyQuery(4)
+        self.assertEqual(recover(query, self.policy, query.reopen), 'R249.2')
+        self.assertEqual(self.clock.sleeps, [0.1, 0.2, 0.3])
+        self.assertEqual(query.reopened, 1)
+
+    def test_gives_up(self):
+        query = FlakyQuery(5)
+        with self.assertRaises(DeviceError) as cm:
+            recover(query, self.policy, query.reopen, 'GPIB0::24 R1')
+        self.assertEqual(query.calls, 5)
+        self.assertIn('GPIB0::24 R1 failed 5 times', str(cm.exception))
+        self.assertIsInstance(cm.exception.__cause__, IOError)
+
+    def test_failing_reopen(self):
+        def reopen():
+            raise IOError('VI_ERROR_RSRC_NFOUND')
+        query = FlakyQuery(4)
+        self.assertEqual(recover(query, self.policy, reopen), 'R249.2')
+
+
+class GapRecorderTestCase(unittest.TestCase):
+    """Test recording the spans without samples."""
+
+    def test_gaps(self):
+        gaps = GapRecorder('ITC503')
+        gaps.succeeded(0)
+        for t in (1, 2, 3):
+            gaps.failed(t * int(1e9), IOError('VI_ERROR_TMO'))
+        self.assertEqual(gaps.start, int(1e9))
+        gaps.succeeded(int(4e9))
+        gaps.failed(int(6e9), IOError('VI_ERROR_TMO'))
+        gaps.succeeded(int(7e9))
+        self.assertEqual(gaps.gaps, [(int(1e9), int(4e9)),
+                                     (int(6e9), int(7e9))])
+        self.assertEqual(gaps.failures, 4)
+        self.assertIsNone(gaps.start)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from RunMeas.Buffer import Buffer, BufferRecordThread
+from RunMeas.Clock import now_ns
+from RunMeas.Derived import Rate
+from RunMeas.Replay import ReplayThread
+
+
+def make_rows(n):
+    """Rows at 10 Hz."""
+    i = np.arange(n)
+    return {'timestamp': (i * int(1e8) + int(1.5e18)).astype('int64'),
+            'THe3': (0.3 + i * 1e-3).astype('f4'),
+            'HeaterSensor': np.ones(n, dtype='i1')}
+
+
+class ReplayTestCase(unittest.TestCase):
+    """Test replaying a recorded run."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.rows = make_rows(300)
+        t = BufferRecordThread({'ITC': self.rows}, 'run', self.folder,
+                               file_name=os.path.join(self.folder, 'run.h5'))
+        t.open()
+        t.write_new_rows()
+        t.close()
+        self.path = t.file_name
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def play(self, replay, timeout=10):
+        buffer = Buffer([('ITC', None, replay)])
+        buffer.add_derived_channel('ITC', Rate('dTHe3/dt', 'THe3'))
+        buffer.start_collection()
+        deadline = time.time() + timeout
+        while not replay.finished and time.time() < deadline:
+            time.sleep(0.01)
+        while len(buffer.data['ITC']['timestamp']) < replay.played and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        buffer.stop_collection()
+        return buffer.data['ITC']
+
+    def test_channels_from_recording(self):
+        replay = ReplayThread(self.path, 'ITC')
+        self.assertEqual(replay.chan_list,
+                         [('THe3', np.dtype('f4')),
+                          ('HeaterSensor', np.dtype('i1'))])
+        with self.assertRaises(KeyError):
+            ReplayThread(self.path, 'AH')
+
+    def test_not_pooled(self):
+        replay = ReplayThread(self.path, 'ITC')
+        with self.assertRaises(TypeError):
+            Buffer([('ITC', None, replay)], workers=2)
+
+    def test_max_speed(self):
+        replay = ReplayThread(self.path, 'ITC', speed=None, retime=False,
+                              block_size=7)
+        data = self.play(replay)
+        self.assertTrue(replay.finished)
+        np.testing.assert_array_equal(data['timestamp'],
+                                      self.rows['timestamp'])
+        np.testing.assert_array_equal(data['THe3'], self.rows['THe3'])
+        self.assertEqual(data['THe3'].dtype, np.dtype('f4'))
+        np.testing.assert_allclose(data['dTHe3/dt'][1:], 1e-2, rtol=1e-3)
+
+    def test_accelerated(self):
+        # 30 s of data at 100x
+        replay = ReplayThread(self.path, 'ITC', speed=100.0)
+        before = now_ns()
+        data = self.play(replay)
+        self.assertGreater(replay.elapsed, 0.28)
+        self.assertLess(replay.elapsed, 1.0)
+        self.assertEqual(len(data['timestamp']), 300)
+        # Retimed to start now, with the recorded spacing
+        self.assertGreaterEqual(data['timestamp'][0], before)
+        self.assertEqual(data['timestamp'][1] - data['timestamp'][0],
+                         int(1e8))
+
+    def test_time_range_and_stop(self):
+        replay = ReplayThread(self.path, 'ITC', speed=None,
+                              start=self.rows['timestamp'][100],
+                              stop=self.rows['timestamp'][150])
+        data = self.play(replay)
+        self.assertEqual(len(data['timestamp']), 50)
+        replay = ReplayThread(self.path, 'ITC', speed=1.0)
+        replay.start()
+        time.sleep(0.1)
+        replay.stop_thread()
+        replay.join(1)
+        self.assertFalse(replay.is_alive())
+        self.assertFalse(replay.finished)
+
+    def test_stop_on_full_queue(self):
+        # Nothing takes the samples, as after Buffer.stop_collection
+        replay = ReplayThread(self.path, 'ITC', speed=None, block_size=1,
+                              maxsize=2)
+        replay.start()
+        while replay.q.qsize() < 2:
+            time.sleep(0.01)
+        replay.stop_thread()
+        replay.join(1)
+        self.assertFalse(replay.is_alive())
+        self.assertFalse(replay.finished)
+        self.assertLess(replay.played, 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
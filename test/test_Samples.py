@@ -0,0 +1,164 @@
+import unittest
+
+from queue import Queue, Full
+from threading import Thread
+
+import numpy as np
+
+from RunMeas.Clock import now_ns
+from RunMeas.Samples import (SampleBlock, SampleWriter, SampleQueue,
+                             block_dtype, parse_channels, channel_names)
+
+
+class SamplesTestCase(unittest.TestCase):
+    """Test the compact sample blocks."""
+
+    def setUp(self):
+        self.q = Queue()
+        self.writer = SampleWriter(self.q, ['TSorp', 'THe3'], block_size=3,
+                                   max_latency=60.0)
+        self.count = 0
+
+    def write(self, n):
+        for i in range(self.count, self.count + n):
+            block = self.writer.block
+            cols = block.columns
+            cols[0][block.n] = now_ns()
+            cols[1][block.n] = i
+            cols[2][block.n] = 10 * i
+            self.writer.commit()
+        self.count += n
+
+    def test_block_dtype(self):
+        dtype = block_dtype(['TSorp', 'THe3'])
+        self.assertEqual(dtype.names, ('timestamp', 'TSorp', 'THe3'))
+
+    def test_parse_channels(self):
+        channels = parse_channels(['TSorp', ('THe3', 'f4'),
+                                   ('AutoHeat', bool)])
+        self.assertEqual(channels, [('TSorp', np.dtype('f8')),
+                                    ('THe3', np.dtype('f4')),
+                                    ('AutoHeat', np.dtype(bool))])
+        self.assertEqual(channel_names(['TSorp', ('THe3', 'f4')]),
+                         ['TSorp', 'THe3'])
+
+    def test_typed_block_dtype(self):
+        dtype = block_dtype([('THe3', 'f4'), ('HeaterSensor', 'i1')])
+        self.assertEqual(dtype['timestamp'], np.dtype('i8'))
+        self.assertEqual(dtype['THe3'], np.dtype('f4'))
+        self.assertEqual(dtype['HeaterSensor'], np.dtype('i1'))
+
+    def test_full_block_is_handed_off(self):
+        self.write(2)
+        self.assertTrue(self.q.empty())
+        self.write(1)
+        block = self.q.get_nowait()
+        self.assertIsInstance(block, SampleBlock)
+        cols = block.to_columns()
+        np.testing.assert_array_equal(cols['TSorp'], [0, 1, 2])
+        np.testing.assert_array_equal(cols['THe3'], [0, 10, 20])
+        self.assertEqual(cols['timestamp'].dtype, np.dtype('int64'))
+
+    def test_blocks_are_recycled(self):
+        self.write(3)
+        first = self.q.get_nowait()
+        first.release()
+        self.assertEqual(first.n, 0)
+        self.write(3)
+        self.assertIs(self.writer.block, first)
+
+    def test_flush_partial_block(self):
+        self.write(1)
+        self.writer.flush()
+        self.assertEqual(self.q.get_nowait().n, 1)
+        self.writer.flush()
+        self.assertTrue(self.q.empty())
+
+    def test_max_latency(self):
+        writer = SampleWriter(self.q, ['TSorp'], block_size=100,
+                              max_latency=0.0)
+        writer.block.columns[0][0] = now_ns()
+        writer.commit()
+        self.assertEqual(self.q.get_nowait().n, 1)
+
+    def test_commit_before_long_wait(self):
+        writer = SampleWriter(self.q, ['TSorp'], max_latency=0.2)
+        self.assertEqual(writer.block.capacity, 64)
+        writer.block.columns[0][0] = now_ns()
+        writer.commit(0.05)
+        self.assertTrue(self.q.empty())
+        writer.block.columns[0][1] = now_ns()
+        # The next sample would come too late for the first one
+        writer.commit(0.5)
+        self.assertEqual(self.q.get_nowait().n, 2)
+
+
+class SampleQueueTestCase(unittest.TestCase):
+    """Test the bounded queue and its overflow policies."""
+
+    def fill(self, q, n):
+        for i in range(n):
+            q.put(i)
+        return [q.get_nowait() for i in range(q.qsize())]
+
+    def test_unbounded(self):
+        q = SampleQueue()
+        self.assertEqual(self.fill(q, 10), list(range(10)))
+        self.assertEqual(q.dropped, 0)
+
+    def test_block(self):
+        q = SampleQueue(2, 'block')
+        q.put(0)
+        q.put(1)
+        with self.assertRaises(Full):
+            q.put(2, timeout=0.01)
+
+    def test_close_releases_blocked_put(self):
+        q = SampleQueue(1, 'block')
+        q.put(0)
+        t = Thread(target=q.put, args=(1,))
+        t.start()
+        t.join(0.05)
+        self.assertTrue(t.is_alive())
+        q.close()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        q.put(2)
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(q.get_nowait(), 0)
+
+    def test_drop_oldest(self):
+        q = SampleQueue(3, 'drop_oldest')
+        self.assertEqual(self.fill(q, 5), [2, 3, 4])
+        self.assertEqual(q.dropped, 2)
+
+    def test_drop_newest(self):
+        q = SampleQueue(3, 'drop_newest')
+        self.assertEqual(self.fill(q, 5), [0, 1, 2])
+        self.assertEqual(q.stats()['dropped_samples'], 2)
+
+    def test_decimate(self):
+        q = SampleQueue(4, 'decimate')
+        # Every overflow keeps every second queued item
+        self.assertEqual(self.fill(q, 7), [0, 4, 6])
+        self.assertEqual(q.dropped, 4)
+
+    def test_dropped_blocks_return_to_pool(self):
+        q = SampleQueue(1, 'drop_oldest')
+        writer = SampleWriter(q, ['TSorp'], block_size=2)
+        first = writer.block
+        for i in range(4):
+            writer.block.columns[0][writer.block.n] = now_ns()
+            writer.commit()
+        self.assertEqual(q.dropped_samples, 2)
+        # The dropped first block is being filled in again
+        self.assertIs(writer.block, first)
+        self.assertEqual(first.n, 0)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            SampleQueue(2, 'ignore')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import unittest
+
+import time
+import socket
+from threading import Thread
+
+import numpy as np
+
+from RunMeas.Buffer import Buffer
+from RunMeas.Samples import SampleQueue, SampleWriter
+from RunMeas.Server import HISTORY, LIVE, StreamClient, StreamServer
+
+
+class MockMeasurementThread(Thread):
+    """A device thread whose samples are written by the test."""
+
+    def __init__(self):
+        super(MockMeasurementThread, self).__init__()
+        self.stop = False
+        self.chan_list = ['THe3', 'TSorp']
+        self.q = SampleQueue()
+        self.writer = SampleWriter(self.q, self.chan_list, block_size=10000)
+        self.n = 0
+
+    def write(self, n):
+        """Write n samples one second apart and return them."""
+        i = np.arange(self.n, self.n + n)
+        self.n += n
+        columns = [int(1.5e18) + i * int(1e9), 0.3 + 1e-3 * i, 10.0 - i]
+        self.writer.extend(columns)
+        self.writer.flush()
+        return columns
+
+    def run(self):
+        pass
+
+    def stop_thread(self):
+        self.stop = True
+
+
+class StreamServerTestCase(unittest.TestCase):
+    """Test streaming a buffer to clients."""
+
+    def setUp(self):
+        self.thread = MockMeasurementThread()
+        self.buffer = Buffer([('ITC', None, self.thread)])
+        self.buffer.start_collection()
+        self.server = StreamServer(self.buffer, maxsize=2)
+        self.server.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop_thread()
+        self.server.join()
+        self.buffer.stop_collection()
+
+    def connect(self, *args, **kwargs):
+        client = StreamClient(*self.server.address, *args, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def write(self, n):
+        columns = self.thread.write(n)
+        while len(self.buffer.data['ITC']['timestamp']) < self.thread.n:
+            time.sleep(0.01)
+        return columns
+
+    def test_late_join(self):
+        self.write(3600)
+        client = self.connect('ITC', ['TSorp'], history=600, points=50)
+        self.assertEqual(client.channels, [('TSorp', np.dtype('<f8'))])
+        (kind, columns, dropped) = client.read_frame()
+        self.assertEqual(kind, HISTORY)
+        # On the 10 s level
+        self.assertGreaterEqual(len(columns['timestamp']), 50)
+        self.assertLessEqual(len(columns['timestamp']), 61)
+        self.assertGreaterEqual(columns['timestamp'][0],
+                                int(1.5e18) + int(2990e9))
+        # The means of 10 - i over the last ten minutes
+        self.assertTrue(np.all(columns['TSorp'] < -2985))
+        self.assertTrue(np.all(columns['TSorp'] > -3600))
+        # Then only the new samples follow
+        sent = self.write(5)
+        (kind, columns, dropped) = client.read_frame()
+        self.assertEqual(kind, LIVE)
+        np.testing.assert_array_equal(columns['timestamp'], sent[0])
+        np.testing.assert_array_equal(columns['TSorp'], sent[2])
+        self.assertNotIn('THe3', columns)
+        self.assertEqual(dropped, 0)
+
+    def test_several_clients(self):
+        clients = [self.connect('ITC') for i in range(3)]
+        sent = self.write(100)
+        for client in clients:
+            (kind, columns, dropped) = client.read_frame()
+            self.assertEqual(kind, LIVE)
+            np.testing.assert_array_equal(columns['THe3'], sent[1])
+            np.testing.assert_array_equal(columns['TSorp'], sent[2])
+        self.assertEqual(len(self.server.client_stats()), 3)
+
+    def test_unknown(self):
+        with self.assertRaises(KeyError):
+            self.connect('AH2550A')
+        with self.assertRaises(KeyError):
+            self.connect('ITC', ['T1K'])
+
+    def test_malformed_requests(self):
+        for line in (b'{"device": "ITC", "history": "x"}\n',
+                     b'{"device": "ITC", "points": [1]}\n',
+                     b'{"device": "ITC", "channels": "THe3"}\n',
+                     b'["ITC"]\n', b'not json\n', b'{' * 100000):
+            with socket.create_connection(self.server.address) as sock:
+                sock.sendall(line)
+                reply = sock.makefile('rb').readline()
+                if reply:
+                    self.assertIn(b'error', reply)
+        self.assertTrue(self.server.is_alive())
+        self.assertEqual(self.server.streams['ITC'].clients, [])
+        self.write(10)
+        client = self.connect('ITC', history=60, points='5')
+        (kind, columns, dropped) = client.read_frame()
+        self.assertEqual(kind, HISTORY)
+
+    def test_silent_client(self):
+        self.write(10)
+        with socket.create_connection(self.server.address):
+            # The silent client holds no one up for its 5 s handshake
+            start = time.time()
+            client = self.connect('ITC', history=60, points=5)
+            (kind, columns, dropped) = client.read_frame()
+            self.assertEqual(kind, HISTORY)
+            self.assertLess(time.time() - start, 2.0)
+
+    def test_slow_client(self):
+        slow = self.connect('ITC')
+        fast = self.connect('ITC')
+        received = 0
+        # About 50 MB, more than the socket buffers of the slow client
+        for i in range(200):
+            self.write(10000)
+            while received < self.thread.n:
+                (kind, columns, dropped) = fast.read_frame()
+                received += len(columns['timestamp'])
+        self.assertEqual(received, 2000000)
+        self.assertEqual(dropped, 0)
+        dropped = max(s['dropped'] for s in self.server.client_stats())
+        self.assertGreater(dropped, 0)
+        # The slow client still reads whole frames and learns of the drops
+        n_frames = 0
+        while True:
+            (kind, columns, dropped) = slow.read_frame()
+            n_frames += 1
+            if columns['timestamp'][-1] == int(1.5e18) + int(1999999e9):
+                break
+        self.assertGreater(dropped, 0)
+        self.assertEqual(n_frames + dropped, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+
+import os
+from threading import Thread
+from multiprocessing import Process, Queue as MPQueue
+
+import numpy as np
+
+from RunMeas.SharedBuffer import SharedBufferWriter, SharedBufferReader
+
+
+def make_batch(start, n):
+    timestamps = (np.arange(start, start + n, dtype='int64') *
+                  int(1e8)).astype('datetime64[ns]')
+    return {'timestamp': timestamps,
+            'THe3': np.arange(start, start + n, dtype=float)}
+
+
+def read_in_child(name, q):
+    reader = SharedBufferReader(name)
+    q.put(reader.latest()['THe3'].tolist())
+    reader.close()
+
+
+class SharedBufferTestCase(unittest.TestCase):
+    """Test publishing buffer data in shared memory."""
+
+    def setUp(self):
+        self.name = 'runmeas_test_{}'.format(os.getpid())
+        self.writer = SharedBufferWriter(
+            self.name, [('timestamp', 'datetime64[ns]'), ('THe3', float)], 8)
+        self.reader = SharedBufferReader(self.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def test_reader_sees_columns(self):
+        self.assertEqual([c for (c, dt) in self.reader.columns],
+                         ['timestamp', 'THe3'])
+        self.assertEqual(self.reader.capacity, 8)
+        self.assertEqual(self.reader.committed(), 0)
+
+    def test_latest_rows(self):
+        self.writer.update(make_batch(0, 3))
+        self.writer.update(make_batch(3, 2))
+        rows = self.reader.latest()
+        self.assertEqual(self.reader.committed(), 5)
+        np.testing.assert_array_equal(rows['THe3'], np.arange(5.0))
+        np.testing.assert_array_equal(rows['timestamp'],
+                                      make_batch(0, 5)['timestamp'])
+        np.testing.assert_array_equal(self.reader.latest(2)['THe3'],
+                                      [3.0, 4.0])
+
+    def test_ring_wraps(self):
+        self.writer.update(make_batch(0, 6))
+        self.writer.update(make_batch(6, 5))
+        np.testing.assert_array_equal(self.reader.latest()['THe3'],
+                                      np.arange(3.0, 11.0))
+        self.writer.update(make_batch(11, 20))
+        np.testing.assert_array_equal(self.reader.latest()['THe3'],
+                                      np.arange(23.0, 31.0))
+
+    def test_missing_channel_is_nan(self):
+        self.writer.update(make_batch(0, 8))
+        batch = make_batch(8, 3)
+        del batch['THe3']
+        self.writer.update(batch)
+        vals = self.reader.latest(4)['THe3']
+        self.assertEqual(vals[0], 7.0)
+        self.assertTrue(np.all(np.isnan(vals[1:])))
+
+    def test_reader_waits_for_writer(self):
+        self.writer.update(make_batch(0, 8))
+        result = []
+        # As if the writer were in the middle of the next batch
+        self.writer._seq[0] += 1
+        t = Thread(target=lambda: result.append(self.reader.latest()))
+        t.start()
+        t.join(0.05)
+        self.assertTrue(t.is_alive())
+        self.writer._seq[0] += 1
+        t.join(1)
+        np.testing.assert_array_equal(result[0]['THe3'], np.arange(8.0))
+
+    def test_no_torn_rows(self):
+        stop = []
+
+        def write():
+            i = 0
+            while not stop:
+                self.writer.update(make_batch(i, 5))
+                i += 5
+
+        t = Thread(target=write)
+        t.start()
+        try:
+            for i in range(2000):
+                vals = self.reader.latest()['THe3']
+                np.testing.assert_array_equal(np.diff(vals), 1.0)
+        finally:
+            stop.append(True)
+            t.join()
+
+    def test_reader_is_read_only(self):
+        with self.assertRaises(ValueError):
+            self.reader.columns_view()['THe3'][0] = 1.0
+
+    def test_reader_in_other_process(self):
+        self.writer.update(make_batch(0, 4))
+        q = MPQueue()
+        p = Process(target=read_in_child, args=(self.name, q))
+        p.start()
+        result = q.get(timeout=10)
+        p.join()
+        self.assertEqual(result, [0.0, 1.0, 2.0, 3.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import numpy as np
+from scipy.signal import welch
+
+from RunMeas.Spectrum import WelchPSD
+
+
+def feed(psd, t, x, size):
+    for i in range(0, len(t), size):
+        psd.update({'timestamp': t[i:i + size], 'Cap': x[i:i + size]})
+
+
+class WelchPSDTestCase(unittest.TestCase):
+    """Test the streaming Welch estimate."""
+
+    def setUp(self):
+        self.rate = 100.0
+        n = 20000
+        rng = np.random.default_rng(1)
+        self.t = (int(1.5e18) + np.arange(n) * int(1e7)).astype('int64')
+        self.x = (0.3 * np.sin(2 * np.pi * 12.5 * np.arange(n) / self.rate)
+                  + 0.01 * rng.standard_normal(n))
+
+    def test_matches_scipy(self):
+        psd = WelchPSD('Cap', self.rate, segment=256, averages=None)
+        feed(psd, self.t, self.x, 37)
+        (freqs, density) = psd.spectrum()
+        (f_ref, p_ref) = welch(self.x, fs=self.rate, nperseg=256)
+        np.testing.assert_allclose(freqs, f_ref)
+        np.testing.assert_allclose(density, p_ref, rtol=1e-8)
+        self.assertEqual(psd.n_segments, (len(self.x) - 256) // 128 + 1)
+        self.assertAlmostEqual(freqs[np.argmax(density)], 12.5, delta=0.4)
+
+    def test_empty_until_first_segment(self):
+        psd = WelchPSD('Cap', self.rate, segment=256)
+        feed(psd, self.t[:100], self.x[:100], 10)
+        self.assertEqual(len(psd.spectrum()[0]), 0)
+        psd.update({'timestamp': self.t[:10]})
+        self.assertEqual(psd.n_segments, 0)
+
+    def test_irregular_times(self):
+        # Polled every 8 to 12 ms instead of every 10 ms
+        rng = np.random.default_rng(2)
+        steps = rng.integers(8000000, 12000000, len(self.t))
+        t = int(1.5e18) + np.cumsum(steps)
+        x = 0.3 * np.sin(2 * np.pi * 5.0 * (t - t[0]) / 1e9)
+        psd = WelchPSD('Cap', self.rate, segment=512, averages=None)
+        feed(psd, t, x, 50)
+        (freqs, density) = psd.spectrum()
+        self.assertAlmostEqual(freqs[np.argmax(density)], 5.0,
+                               delta=self.rate / 512)
+        # The power of the sine, 0.3**2 / 2
+        power = density.sum() * (freqs[1] - freqs[0])
+        self.assertAlmostEqual(power, 0.045, delta=0.0045)
+
+    def test_gap_restarts_segment(self):
+        psd = WelchPSD('Cap', self.rate, segment=256, overlap=0.0,
+                       averages=None)
+        t = self.t.copy()
+        t[200:] += int(60e9)
+        feed(psd, t[:1000], self.x[:1000], 100)
+        # The 200 samples before the gap do not make a segment
+        self.assertEqual(psd.n_segments, 3)
+
+    def test_exponential_average(self):
+        psd = WelchPSD('Cap', self.rate, segment=256, averages=4)
+        feed(psd, self.t[:5000], self.x[:5000], 500)
+        peak = np.argmax(psd.spectrum()[1])
+        # The signal stops, so the peak decays
+        before = psd.spectrum()[1][peak]
+        feed(psd, self.t[5000:8000], np.zeros(3000), 500)
+        self.assertLess(psd.spectrum()[1][peak], 1e-2 * before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from RunMeas.Stability import StabilityDetector
+
+
+def make_batch(times, values):
+    timestamps = (np.asarray(times) * 1e9).astype('int64')
+    return {'timestamp': timestamps.astype('datetime64[ns]'),
+            'TSorp': np.asarray(values, dtype=float)}
+
+
+class StabilityDetectorTestCase(unittest.TestCase):
+    """Test the stability detector."""
+
+    def setUp(self):
+        self.detector = StabilityDetector('TSorp', tolerance=0.05, window=10.0,
+                                          hold_time=5.0, target=30.0)
+
+    def test_not_stable_while_ramping(self):
+        times = np.arange(0, 60, 0.5)
+        self.detector.update(make_batch(times, 20 + 0.2 * times))
+        self.assertFalse(self.detector.is_stable())
+
+    def test_stable_after_hold_time(self):
+        rng = np.random.RandomState(1)
+        times = np.arange(0, 14, 0.5)
+        values = 30 + rng.normal(scale=0.005, size=len(times))
+        self.detector.update(make_batch(times, values))
+        self.assertFalse(self.detector.is_stable())
+        times = np.arange(14, 20, 0.5)
+        values = 30 + rng.normal(scale=0.005, size=len(times))
+        self.detector.update(make_batch(times, values))
+        self.assertTrue(self.detector.is_stable())
+        self.assertTrue(self.detector.wait_until_stable(timeout=0))
+
+    def test_off_target_is_not_stable(self):
+        times = np.arange(0, 30, 0.5)
+        self.detector.update(make_batch(times, np.repeat(31.0, len(times))))
+        self.assertFalse(self.detector.is_stable())
+        self.detector.reset(31.0)
+        self.detector.update(make_batch(times + 30,
+                                        np.repeat(31.0, len(times))))
+        self.assertTrue(self.detector.is_stable())
+
+    def test_excursion_clears_stable(self):
+        times = np.arange(0, 30, 0.5)
+        self.detector.update(make_batch(times, np.repeat(30.0, len(times))))
+        self.assertTrue(self.detector.is_stable())
+        self.detector.update(make_batch([30.5], [35.0]))
+        self.assertFalse(self.detector.is_stable())
+
+    def test_wait_until_stable_timeout(self):
+        self.assertFalse(self.detector.wait_until_stable(timeout=0.01))
+
+    def test_ignores_other_channels(self):
+        self.detector.update({'timestamp': np.array([0], dtype='int64'),
+                              'THe3': np.array([1.0])})
+        self.assertFalse(self.detector.is_stable())
+
+
+if __name__ == "__main__":
+    unittest.main()
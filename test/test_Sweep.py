@@ -0,0 +1,114 @@
+import unittest
+
+import time
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+
+from RunMeas.Buffer import Buffer
+from RunMeas.Stability import StabilityDetector
+from RunMeas.Sweep import TemperatureSweep
+
+
+class MockITC(object):
+
+    def __init__(self):
+        self.setpoint = 0.0
+        self.auto_heat = False
+        self.auto_pid = False
+        self.setpoints = []
+
+    def set_setpoint(self, setpoint):
+        self.setpoint = setpoint
+        self.setpoints.append(setpoint)
+
+    def auto_heat_on(self):
+        self.auto_heat = True
+
+    def auto_pid_on(self):
+        self.auto_pid = True
+
+    def get_values(self):
+        return (datetime.now(), ('TSorp', self.setpoint))
+
+
+class MockAH(object):
+
+    def get_values(self):
+        return (datetime.now(), ('Cap', 922.5934))
+
+
+class MockDeviceMeasurementThread(Thread):
+
+    def __init__(self, device, chan_list, delay=0.01):
+        super(MockDeviceMeasurementThread, self).__init__()
+        self.stop = False
+        self.device = device
+        self.q = Queue()
+        self.delay = delay
+        self.chan_list = chan_list
+
+    def run(self):
+        while not self.stop:
+            time.sleep(self.delay)
+            self.q.put(self.device.get_values())
+
+    def stop_thread(self):
+        self.stop = True
+
+
+class TemperatureSweepTestCase(unittest.TestCase):
+    """Test the temperature sweep engine."""
+
+    def setUp(self):
+        self.itc = MockITC()
+        self.ah = MockAH()
+        self.buffer = Buffer([
+            ('ITC', self.itc, MockDeviceMeasurementThread(self.itc,
+                                                          ['TSorp'])),
+            ('AH', self.ah, MockDeviceMeasurementThread(self.ah, ['Cap']))])
+        self.detector = StabilityDetector('TSorp', tolerance=0.01,
+                                          window=0.05, hold_time=0.02)
+
+    def tearDown(self):
+        if self.buffer.collection_threads[0].is_alive():
+            self.buffer.stop_collection()
+
+    def test_sweep_runs_all_steps(self):
+        sweep = TemperatureSweep(self.buffer, 'ITC', [10.0, 20.0], ['AH'], 3,
+                                 detector=self.detector, settle_timeout=5.0,
+                                 poll=0.01)
+        self.buffer.start_collection()
+        sweep.start()
+        sweep.join(10)
+        self.assertTrue(sweep.finished)
+        self.assertTrue(self.itc.auto_heat)
+        self.assertTrue(self.itc.auto_pid)
+        self.assertEqual(self.itc.setpoints, [10.0, 20.0])
+        self.assertEqual([seg[:3] for seg in self.buffer.segments],
+                         [(0, 'AH', 10.0), (1, 'AH', 20.0)])
+        for seg in self.buffer.segments:
+            self.assertLess(seg[3], seg[4])
+        self.assertEqual(self.buffer.listeners['ITC'], [])
+
+    def test_sweep_stop(self):
+        detector = StabilityDetector('TSorp', tolerance=0.01, window=100.0,
+                                     hold_time=100.0)
+        sweep = TemperatureSweep(self.buffer, 'ITC', [10.0], ['AH'], 3,
+                                 detector=detector, poll=0.01)
+        self.buffer.start_collection()
+        sweep.start()
+        time.sleep(0.05)
+        sweep.stop_thread()
+        sweep.join(1)
+        self.assertFalse(sweep.is_alive())
+        self.assertFalse(sweep.finished)
+        self.assertEqual(self.buffer.segments, [])
+
+    def test_sweep_unknown_device(self):
+        with self.assertRaises(KeyError):
+            TemperatureSweep(self.buffer, 'ITC', [10.0], ['Lockin'], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from RunMeas.Buffer import BufferRecordThread
+from RunMeas.Trigger import (CAUSE_SIZE, Decimator, EventCapture, Slope,
+                             Threshold, read_events, write_events)
+
+
+def make_rows(n, jumps=(), start=0):
+    """Capacitance at 100 Hz with a step of 1 pF at each jump index."""
+    i = np.arange(start, start + n)
+    cap = 922.5 + np.searchsorted(np.asarray(jumps), i, side='right')
+    return {'timestamp': (i * int(1e7)).astype('int64'),
+            'Cap': cap.astype(float),
+            'Loss': np.repeat(0.1, n)}
+
+
+def batches(rows, size):
+    n = len(rows['timestamp'])
+    for i in range(0, n, size):
+        yield dict((k, v[i:i + size]) for k, v in rows.items())
+
+
+class ConditionTestCase(unittest.TestCase):
+    """Test the trigger conditions."""
+
+    def test_threshold(self):
+        ts = np.arange(6) * int(1e9)
+        up = Threshold('Cap', 1.0)
+        np.testing.assert_array_equal(up.fire(ts[:3], [0, 2, 0]),
+                                      [False, True, False])
+        # Across batches
+        np.testing.assert_array_equal(up.fire(ts[3:], [1, 0, 0]),
+                                      [True, False, False])
+        both = Threshold('Cap', 1.0, direction='both')
+        np.testing.assert_array_equal(both.fire(ts[:4], [0, 2, 0, 0]),
+                                      [False, True, True, False])
+
+    def test_slope(self):
+        slope = Slope('Cap', 0.5)
+        ts = np.arange(6) * int(1e9)
+        np.testing.assert_array_equal(slope.fire(ts[:3], [0, 0.1, 1.0]),
+                                      [False, False, True])
+        np.testing.assert_array_equal(slope.fire(ts[3:], [0.0, 0.0, 0.0]),
+                                      [True, False, False])
+        rising = Slope('Cap', 0.5, direction='rising')
+        np.testing.assert_array_equal(rising.fire(ts[:3], [1.0, 0.0, 1.0]),
+                                      [False, False, True])
+
+    def test_decimator(self):
+        decimator = Decimator(3)
+        kept = [decimator.filter({'timestamp': np.arange(i, i + 4)})
+                for i in range(0, 12, 4)]
+        np.testing.assert_array_equal(
+            np.concatenate([k['timestamp'] for k in kept]), [0, 3, 6, 9])
+
+
+class EventCaptureTestCase(unittest.TestCase):
+    """Test capturing the windows around triggers."""
+
+    def capture(self, rows, size, **kwargs):
+        capture = EventCapture([Threshold('Cap', 923.0)], **kwargs)
+        for batch in batches(rows, size):
+            capture.update(batch)
+        return capture
+
+    def test_windows_across_batches(self):
+        rows = make_rows(1000, jumps=[105, 600])
+        capture = self.capture(rows, 7, pre=50, post=30)
+        events = capture.take_events()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['trigger'], rows['timestamp'][105])
+        self.assertEqual(events[0]['cause'], 'Cap rising through 923.0')
+        np.testing.assert_array_equal(events[0]['rows']['timestamp'],
+                                      rows['timestamp'][55:135])
+        np.testing.assert_array_equal(events[0]['rows']['Cap'],
+                                      rows['Cap'][55:135])
+        self.assertEqual(capture.take_events(), [])
+
+    def test_same_result_for_any_batch_size(self):
+        rows = make_rows(1000, jumps=[20, 300])
+        capture = EventCapture([Slope('Cap', 50.0)], pre=40, post=25)
+        for batch in batches(rows, 1000):
+            capture.update(batch)
+        whole = capture.take_events()
+        capture = EventCapture([Slope('Cap', 50.0)], pre=40, post=25)
+        for batch in batches(rows, 3):
+            capture.update(batch)
+        split = capture.take_events()
+        self.assertEqual([e['trigger'] for e in whole],
+                         [rows['timestamp'][20], rows['timestamp'][300]])
+        self.assertEqual(len(split), 2)
+        for (a, b) in zip(whole, split):
+            np.testing.assert_array_equal(a['rows']['timestamp'],
+                                          b['rows']['timestamp'])
+        # Only 20 samples before the first trigger
+        self.assertEqual(len(whole[0]['rows']['timestamp']), 45)
+
+    def test_holdoff(self):
+        rows = make_rows(1000, jumps=[100, 150, 400])
+        capture = EventCapture([Slope('Cap', 50.0)], pre=10, post=10,
+                               holdoff=1.0)
+        for batch in batches(rows, 64):
+            capture.update(batch)
+        self.assertEqual([e['trigger'] for e in capture.take_events()],
+                         [rows['timestamp'][100], rows['timestamp'][400]])
+
+
+class EventRecordingTestCase(unittest.TestCase):
+    """Test writing captured events next to a decimated stream."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_record_events(self):
+        rows = make_rows(2000, jumps=[500, 1500])
+        data = {'AH': dict((k, v[:0]) for k, v in rows.items())}
+        capture = EventCapture([Slope('Cap', 50.0)], pre=20, post=30)
+        t = BufferRecordThread(data, 'run', self.folder, levels=None,
+                               file_name=os.path.join(self.folder, 'run.h5'),
+                               deadband={'AH': Decimator(100)},
+                               captures={'AH': capture})
+        t.open()
+        for stop in range(250, 2001, 250):
+            new = dict((k, v[stop - 250:stop]) for k, v in rows.items())
+            capture.update(new)
+            data['AH'] = dict((k, v[:stop]) for k, v in rows.items())
+            t.write_new_rows()
+        t.close()
+        with pd.HDFStore(t.file_name, mode='r') as store:
+            self.assertEqual(len(store.select('raw/AH')), 20)
+        events = read_events(t.file_name, 'AH')
+        self.assertEqual([e['trigger'] for e in events],
+                         [rows['timestamp'][500], rows['timestamp'][1500]])
+        np.testing.assert_array_equal(events[1]['data']['Cap'].values,
+                                      rows['Cap'][1480:1530])
+        self.assertEqual(list(events[0]['data'].columns), ['Cap', 'Loss'])
+        self.assertEqual(read_events(t.file_name, 'ITC'), [])
+
+    def test_long_cause(self):
+        rows = make_rows(10)
+        file_name = os.path.join(self.folder, 'run.h5')
+        causes = ['Cap rising through 1', 'Č' * 100]
+        with pd.HDFStore(file_name, mode='w') as store:
+            for (i, cause) in enumerate(causes):
+                write_events(store, 'AH', [{'trigger': i, 'cause': cause,
+                                            'rows': rows}])
+        events = read_events(file_name, 'AH')
+        self.assertEqual(events[0]['cause'], causes[0])
+        self.assertEqual(events[1]['cause'], 'Č' * (CAUSE_SIZE // 2))
+
+
+if __name__ == "__main__":
+    unittest.main()